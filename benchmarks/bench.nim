@@ -0,0 +1,166 @@
+## Serialization benchmarks over the schemas bundled in tests/protos
+##
+## Run with `nimble bench`, or directly:
+##
+##   nim c -r -d:release -d:nimAllocStats benchmarks/bench.nim [results.json]
+##
+## Every message gets a synthetic payload, and each codec path is timed until
+## `benchMillis` has passed. The report gives ns/op, MB/s of encoded data
+## (binary bytes for the binary paths, JSON text for the JSON ones) and heap
+## allocations per op. `toJson` and `fromJson` include rendering and parsing
+## the text, so all JSON paths go between a message and a string.
+## Allocations are only counted with `-d:nimAllocStats`.
+## The results are written as JSON, `benchmarks/results.json` by default.
+
+import std/[monotimes, times, json, os, strutils, random]
+import ../src/nimproto3
+
+importProto3 currentSourcePath().parentDir() & "/../tests/protos/addressbook.proto"
+importProto3 currentSourcePath().parentDir() & "/../tests/protos/maps.proto"
+importProto3 currentSourcePath().parentDir() & "/../tests/protos/grpcbin.proto"
+importProto3 currentSourcePath().parentDir() & "/../tests/grpc/test_service.proto"
+
+const benchMillis {.intdefine.} = 300
+  ## Minimum measuring time per codec path
+
+type
+  BenchResult = object
+    schema, message, op: string
+    iterations: int
+    payloadBytes: int
+    nsPerOp: float
+    mbPerSec: float
+    allocsPerOp: float
+
+var results: seq[BenchResult]
+
+proc allocCount(): int =
+  ## `AllocStats` keeps its counters private; `allocCount` is the first field
+  var stats = getAllocStats()
+  cast[ptr int](addr stats)[]
+
+template measure(schemaName, messageName, opName: string, bytes: int,
+    body: untyped) =
+  ## Time `body` until `benchMillis` has passed, after one warm-up run
+  block:
+    body
+    var iterations = 0
+    var batch = 1
+    let allocsBefore = allocCount()
+    let start = getMonoTime()
+    var elapsed: Duration
+    while true:
+      for _ in 0 ..< batch:
+        body
+      iterations += batch
+      elapsed = getMonoTime() - start
+      if elapsed.inMilliseconds >= benchMillis:
+        break
+      batch *= 2
+    let allocs = allocCount() - allocsBefore
+    let ns = float(elapsed.inNanoseconds) / float(iterations)
+    let r = BenchResult(schema: schemaName, message: messageName, op: opName,
+        iterations: iterations, payloadBytes: bytes, nsPerOp: ns,
+        mbPerSec: float(bytes) / ns * 1e9 / 1e6,
+        allocsPerOp: float(allocs) / float(iterations))
+    echo alignLeft(schemaName & "." & messageName, 26), alignLeft(opName, 16),
+        align(formatFloat(r.nsPerOp, ffDecimal, 1), 12), " ns/op",
+        align(formatFloat(r.mbPerSec, ffDecimal, 1), 10), " MB/s",
+        align(formatFloat(r.allocsPerOp, ffDecimal, 1), 9), " allocs/op"
+    results.add(r)
+
+template benchCodecs(schemaName: string, T: typedesc, msg: T) =
+  ## Benchmark every codec path of one message value
+  block:
+    let value = msg
+    let data = value.toBinary()
+    let text = value.toJsonString()
+    var buf = newSeqOfCap[byte](data.len)
+    var sink: int
+    let messageName = $T
+    measure(schemaName, messageName, "toBinary", data.len):
+      sink += value.toBinary().len
+    measure(schemaName, messageName, "toBinary(buf)", data.len):
+      buf.setLen(0)
+      value.toBinary(buf)
+      sink += buf.len
+    measure(schemaName, messageName, "fromBinary", data.len):
+      sink += T.fromBinary(data).byteSize
+    measure(schemaName, messageName, "toJson", text.len):
+      sink += ($value.toJson()).len
+    measure(schemaName, messageName, "fromJson", text.len):
+      sink += T.fromJson(parseJson(text)).byteSize
+    measure(schemaName, messageName, "toJsonString", text.len):
+      sink += value.toJsonString().len
+    measure(schemaName, messageName, "fromJsonString", text.len):
+      sink += T.fromJsonString(text).byteSize
+    doAssert sink != 0
+
+# -----------------------------------------------------------------------------
+# SYNTHETIC PAYLOADS
+# -----------------------------------------------------------------------------
+
+var rng = initRand(42)
+
+proc word(len: int): string =
+  result = newString(len)
+  for i in 0 ..< len:
+    result[i] = char(ord('a') + rng.rand(25))
+
+proc sampleAddressBook(people: int): AddressBook =
+  for i in 0 ..< people:
+    var person = Person(name: word(12), id: int32(i),
+        email: word(8) & "@example.com",
+        last_updated: Google_protobuf_Timestamp(seconds: 1_700_000_000 + i,
+            nanos: int32(i)))
+    for j in 0 ..< 3:
+      person.phones.add(Person_PhoneNumber(number: $rng.rand(1_000_000_000),
+          `type`: Person_PhoneType(j mod 3)))
+    result.people.add(person)
+
+proc sampleDictionary(entries: int): Dictionary =
+  for i in 0 ..< entries:
+    result.pairs[word(10)] = word(24)
+    result.flags[int32(i)] = i mod 2 == 0
+
+proc sampleDummy(n: int): DummyMessage =
+  result = DummyMessage(f_string: word(32), f_int32: -12345, f_enum: ENUM_2,
+      f_sub: DummyMessage_Sub(f_string: word(16)), f_bool: true,
+      f_int64: 1 shl 40, f_bytes: cast[seq[byte]](word(64)), f_float: 3.5)
+  for i in 0 ..< n:
+    result.f_strings.add(word(16))
+    result.f_int32s.add(int32(rng.rand(1 shl 20)) - (1 shl 19))
+    result.f_enums.add(DummyMessage_Enum(i mod 3))
+    result.f_subs.add(DummyMessage_Sub(f_string: word(8)))
+    result.f_bools.add(i mod 3 == 0)
+    result.f_int64s.add(int64(rng.rand(1 shl 40)))
+    result.f_bytess.add(cast[seq[byte]](word(16)))
+    result.f_floats.add(float32(i) * 0.25)
+
+proc main() =
+  let output = if paramCount() > 0: paramStr(1)
+               else: currentSourcePath().parentDir() / "results.json"
+  when not defined(nimAllocStats):
+    echo "Note: build with -d:nimAllocStats to count allocations"
+
+  benchCodecs("addressbook", AddressBook, sampleAddressBook(100))
+  benchCodecs("addressbook", Person, sampleAddressBook(1).people[0])
+  benchCodecs("maps", Dictionary, sampleDictionary(100))
+  benchCodecs("grpcbin", DummyMessage, sampleDummy(64))
+  benchCodecs("test_service", TestRequest,
+      TestRequest(message: "Hello from the benchmark", counter: 42))
+  benchCodecs("test_service", TestReply,
+      TestReply(response: "Echo: Hello from the benchmark", received: true))
+
+  let report = %*{
+    "implementation": "nimproto3",
+    "nimVersion": NimVersion,
+    "allocStats": defined(nimAllocStats),
+    "benchMillis": benchMillis,
+    "results": %results
+  }
+  writeFile(output, report.pretty() & "\n")
+  echo "Results written to ", output
+
+when isMainModule:
+  main()
@@ -0,0 +1,74 @@
+## gRPC transport benchmark: many small messages against tests/grpc/server.nim
+##
+## Start the server, with its per-message logging out of the way, then run
+## the benchmark:
+##
+##   nim c -r -d:release tests/grpc/server.nim > /dev/null &
+##   nim c -r -d:release benchmarks/bench_grpc.nim [host] [port]
+##
+## Each message is a small TestRequest, so every reply travels in its own
+## small DATA frame and the cost is dominated by framing, not by payload.
+## `-d:benchMessages=N` sets the messages per scenario (20000 by default).
+
+import std/[monotimes, times, os, strutils]
+import ../src/nimproto3
+
+importProto3 currentSourcePath().parentDir() & "/../tests/grpc/test_service.proto"
+
+const benchMessages {.intdefine.} = 20000
+  ## Messages sent in each scenario
+
+proc report(name: string, messages: int, elapsed: Duration) =
+  let secs = float(elapsed.inMicroseconds) / 1e6
+  echo alignLeft(name, 28), align($messages, 8), " msgs",
+      align(formatFloat(secs * 1000, ffDecimal, 1), 10), " ms",
+      align($int(float(messages) / secs), 12), " msgs/s"
+
+proc produce(call: GrpcCall[TestRequest, TestReply], count: int) {.async.} =
+  for i in 0 ..< count:
+    await call.send(TestRequest(message: "m", counter: int32(i)))
+  await call.closeSend()
+
+proc main(host: string, port: int) {.async.} =
+  let client = newGrpcClient(host, port)
+  await client.connect()
+  await sleepAsync(200) # Wait for settings exchange
+  defer: client.close()
+
+  # Requests and replies in flight at the same time: the replies arrive
+  # back to back, many frames per read
+  block:
+    let start = getMonoTime()
+    let call = await client.streamTestCall()
+    let producer = produce(call, benchMessages)
+    var received = 0
+    while (await call.recv()).isSome:
+      inc received
+    await producer
+    doAssert received == benchMessages
+    report("bidi stream, pipelined", received, getMonoTime() - start)
+
+  # One request, then its reply, one frame per read at best
+  block:
+    let count = benchMessages div 10
+    let start = getMonoTime()
+    let call = await client.streamTestCall()
+    for i in 0 ..< count:
+      await call.send(TestRequest(message: "m", counter: int32(i)))
+      doAssert (await call.recv()).isSome
+    await call.closeSend()
+    doAssert (await call.recv()).isNone
+    report("bidi stream, ping-pong", count, getMonoTime() - start)
+
+  block:
+    let count = benchMessages div 10
+    let start = getMonoTime()
+    for i in 0 ..< count:
+      discard await client.simpleTest(TestRequest(message: "m",
+          counter: int32(i)))
+    report("unary calls", count, getMonoTime() - start)
+
+when isMainModule:
+  let host = if paramCount() > 0: paramStr(1) else: "localhost"
+  let port = if paramCount() > 1: parseInt(paramStr(2)) else: 50051
+  waitFor main(host, port)
@@ -0,0 +1,120 @@
+"""Python protobuf baseline for benchmarks/bench.nim
+
+Times the same TestRequest/TestReply values as the Nim benchmark, using the
+generated tests/grpc/test_service_pb2.py. Writes the results in the same
+JSON shape as bench.nim, and prints them next to the nimproto3 numbers if
+benchmarks/results.json exists.
+
+Usage: python3 benchmarks/bench_python.py [results_python.json]
+Needs the `protobuf` package (pip install protobuf).
+"""
+
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "tests", "grpc"))
+
+try:
+    from google.protobuf import json_format
+    import google.protobuf
+    import test_service_pb2 as pb
+except ImportError as e:
+    sys.exit("Python protobuf is not available (%s); pip install protobuf" % e)
+
+BENCH_SECONDS = float(os.environ.get("BENCH_MILLIS", "300")) / 1000
+
+
+def measure(schema, message, op, nbytes, fn):
+    """Time fn until BENCH_SECONDS has passed, after one warm-up call"""
+    fn()
+    iterations = 0
+    batch = 1
+    start = time.perf_counter_ns()
+    while True:
+        for _ in range(batch):
+            fn()
+        iterations += batch
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= BENCH_SECONDS * 1e9:
+            break
+        batch *= 2
+    ns = elapsed / iterations
+    result = {
+        "schema": schema,
+        "message": message,
+        "op": op,
+        "iterations": iterations,
+        "payloadBytes": nbytes,
+        "nsPerOp": ns,
+        "mbPerSec": nbytes / ns * 1e9 / 1e6,
+        # CPython does not expose a cheap allocation counter per call
+        "allocsPerOp": None,
+    }
+    print("%-26s%-16s%12.1f ns/op%10.1f MB/s" % (
+        schema + "." + message, op, ns, result["mbPerSec"]))
+    return result
+
+
+def bench_codecs(schema, msg):
+    cls = type(msg)
+    name = cls.__name__
+    data = msg.SerializeToString()
+    text = json_format.MessageToJson(msg, indent=None)
+    return [
+        measure(schema, name, "toBinary", len(data), msg.SerializeToString),
+        measure(schema, name, "fromBinary", len(data),
+                lambda: cls.FromString(data)),
+        measure(schema, name, "toJson", len(text),
+                lambda: json_format.MessageToJson(msg, indent=None)),
+        measure(schema, name, "fromJson", len(text),
+                lambda: json_format.Parse(text, cls())),
+    ]
+
+
+def compare(results, nim_path):
+    """Print the nimproto3 numbers for the same message and op next to ours"""
+    with open(nim_path) as f:
+        nim = {(r["schema"], r["message"], r["op"]): r
+               for r in json.load(f)["results"]}
+    print("\n%-26s%-16s%14s%14s%10s" % (
+        "message", "op", "python ns/op", "nim ns/op", "speedup"))
+    for r in results:
+        other = nim.get((r["schema"], r["message"], r["op"]))
+        if other is None:
+            continue
+        print("%-26s%-16s%14.1f%14.1f%9.1fx" % (
+            r["schema"] + "." + r["message"], r["op"], r["nsPerOp"],
+            other["nsPerOp"], r["nsPerOp"] / other["nsPerOp"]))
+
+
+def main():
+    output = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        HERE, "results_python.json")
+    results = []
+    results += bench_codecs("test_service", pb.TestRequest(
+        message="Hello from the benchmark", counter=42))
+    results += bench_codecs("test_service", pb.TestReply(
+        response="Echo: Hello from the benchmark", received=True))
+
+    report = {
+        "implementation": "python-protobuf",
+        "protobufVersion": google.protobuf.__version__,
+        "pythonVersion": sys.version.split()[0],
+        "benchMillis": int(BENCH_SECONDS * 1000),
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+    print("Results written to", output)
+
+    nim_path = os.path.join(HERE, "results.json")
+    if os.path.exists(nim_path):
+        compare(results, nim_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
-import std/[json, tables, options, os, asyncdispatch]
-import nimproto3/[ast, parser, codegen, codegen_macro, wire_format, grpc]
+import std/[json, tables, hashes, options, os, asyncdispatch]
+import nimproto3/[ast, parser, codegen, codegen_macro, wire_format, view,
+    json_stream, sorted_map, grpc, dynamic, table_codec]
 
-export ast, parser, codegen, codegen_macro, wire_format, json, tables, grpc,
-    options, os, asyncdispatch
+export ast, parser, codegen, codegen_macro, wire_format, view, json_stream,
+    sorted_map, dynamic, table_codec, json, tables, hashes,
+    grpc, options, os, asyncdispatch
 
 when defined(ssl):
     import std/[net, openssl, asyncnet]
@@ -1,7 +1,65 @@
 #codegen.nim
-import std/[strutils, tables, sets, sequtils, os]
+import std/[strutils, tables, sets, sequtils, os, algorithm]
 import ./[ast, parser]
 
+type
+  MapRepr* = enum
+    ## Nim representation of proto `map<K, V>` fields
+    mrTable         ## `Table[K, V]`
+    mrOrderedTable  ## `OrderedTable[K, V]`, kept in insertion (wire) order
+    mrSortedSeq     ## `SortedMap[K, V]`, a `seq[(K, V)]` sorted by key
+
+  CodegenOptions* = object
+    ## Options that change the shape of the generated code
+    preserveUnknownFields*: bool
+      ## Add an `unknownFields: seq[byte]` slot to every message. `fromBinary`
+      ## keeps unrecognized fields there as raw bytes and `toBinary` writes
+      ## them back verbatim.
+    mapRepr*: MapRepr
+      ## Representation of map fields. A single field can override it with
+      ## the `[(nimproto3.map_type) = "table" | "ordered" | "sorted"]` option.
+    deterministic*: bool
+      ## Make `toBinary` write map entries in ascending key order, so equal
+      ## messages always encode to the same bytes. Sorted maps are always
+      ## written in key order.
+    tableDriven*: bool
+      ## Give every message a field table (see `table_codec`) and make
+      ## `byteSize`, `toBinary`, `mergeFromBinary`, `fromBinary`, `toJson`
+      ## and `fromJson` wrappers around the shared table-driven codec instead
+      ## of unrolling them per message. This keeps the generated code small
+      ## for large schemas. A message with the option
+      ## `option (nimproto3.unrolled) = true;` keeps the unrolled procs.
+
+proc parseMapRepr*(name: string): MapRepr =
+  ## Parse a map representation name: `table`, `ordered` or `sorted`
+  case name.toLowerAscii()
+  of "table": mrTable
+  of "ordered", "orderedtable": mrOrderedTable
+  of "sorted", "sortedseq": mrSortedSeq
+  else:
+    raise newException(ValueError, "Unknown map type: " & name &
+        " (expected table, ordered or sorted)")
+
+proc mapReprOf(field: ProtoNode, options: CodegenOptions): MapRepr =
+  ## The representation of map field `field`, honouring its field option
+  result = options.mapRepr
+  for opt in field.children:
+    if opt.kind == nkOption and opt.name == "(nimproto3.map_type)":
+      return parseMapRepr(opt.value)
+
+proc mapNimType(repr: MapRepr, keyType, valType: string): string =
+  case repr
+  of mrTable: "Table[" & keyType & ", " & valType & "]"
+  of mrOrderedTable: "OrderedTable[" & keyType & ", " & valType & "]"
+  of mrSortedSeq: "SortedMap[" & keyType & ", " & valType & "]"
+
+proc mapLoop(repr: MapRepr, access: string, byKey = false): string =
+  ## Loop header binding `key` and `val` for each entry of a map field,
+  ## in ascending key order if `byKey` is set
+  if repr == mrSortedSeq: "for (key, val) in " & access & ":"
+  elif byKey: "for key, val in sortedPairs(" & access & "):"
+  else: "for key, val in " & access & ":"
+
 proc capitalizeTypeName(name: string): string =
   ## Capitalize first letter of type name for Nim convention
   if name.len > 0:
@@ -95,7 +153,8 @@ proc generateEnum*(node: ProtoNode, prefix: string = ""): string =
         result &= "\n"
 
 proc generateMessage*(node: ProtoNode, prefix: string = "",
-    nestedTypes: var seq[string], packagePrefix: string = ""): string =
+    nestedTypes: var seq[string], packagePrefix: string = "",
+    options: CodegenOptions = CodegenOptions()): string =
   ## Generate a Nim object type from a ProtoNode message
   assert node.kind == nkMessage
 
@@ -131,7 +190,7 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
       else:
         node.name
       nestedTypes.add(generateMessage(child, nestedPrefix, nestedTypes,
-          packagePrefix))
+          packagePrefix, options))
 
     of nkEnum:
       # Nested enum - generate it separately with qualified name
@@ -205,7 +264,7 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
         result &= "  " & escapeNimKeyword(fieldName) & "*: " & fieldType & "\n"
 
       of nkMapField:
-        # map<K,V> -> Table[K, V]
+        # map<K,V> -> Table[K, V], OrderedTable[K, V] or SortedMap[K, V]
         let parts = child.value.split(",")
         if parts.len == 2:
           var keyBase = parts[0].strip()
@@ -215,8 +274,8 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
             valBase = node.reanamedTypeNamesInScope[valBase]
           let keyType = protoTypeToNim(keyBase, false, packagePrefix)
           let valType = protoTypeToNim(valBase, false, packagePrefix)
-          result &= "  " & escapeNimKeyword(child.name) & "*: Table[" &
-              keyType & ", " & valType & "]\n"
+          result &= "  " & escapeNimKeyword(child.name) & "*: " &
+              mapNimType(mapReprOf(child, options), keyType, valType) & "\n"
 
       of nkOneof, nkMessage, nkEnum:
         # Skip these for now - handled separately
@@ -225,6 +284,10 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
       else:
         discard
 
+    # The unknown field slot has to come before the variant part
+    if options.preserveUnknownFields:
+      result &= "  unknownFields*: seq[byte]\n"
+
     # Add kind fields and case statements for all oneof fields
     for oneofNode in oneofFields:
       let oneofName = oneofNode.name
@@ -312,7 +375,7 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
         result &= "  " & escapeNimKeyword(fieldName) & "*: " & fieldType & "\n"
 
       of nkMapField:
-        # map<K,V> -> Table[K, V]
+        # map<K,V> -> Table[K, V], OrderedTable[K, V] or SortedMap[K, V]
         let parts = child.value.split(",")
         if parts.len == 2:
           var keyBase = parts[0].strip()
@@ -322,8 +385,8 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
             valBase = node.reanamedTypeNamesInScope[valBase]
           let keyType = protoTypeToNim(keyBase, false, packagePrefix)
           let valType = protoTypeToNim(valBase, false, packagePrefix)
-          result &= "  " & escapeNimKeyword(child.name) & "*: Table[" &
-              keyType & ", " & valType & "]\n"
+          result &= "  " & escapeNimKeyword(child.name) & "*: " &
+              mapNimType(mapReprOf(child, options), keyType, valType) & "\n"
 
       of nkOneof:
         # Skip oneofs - handled above
@@ -336,6 +399,9 @@ proc generateMessage*(node: ProtoNode, prefix: string = "",
       else:
         discard
 
+    if options.preserveUnknownFields:
+      result &= "  unknownFields*: seq[byte]\n"
+
   # Nested messages and enums are already handled in the main loop above
   # No need to process them again here
 
@@ -353,21 +419,69 @@ proc getWireType(protoType: string): string =
   else:
     "wtLengthDelimited" # Message types
 
-proc getEncodeProc(protoType: string): string =
+proc getWriteProc(protoType: string): string =
+  case protoType
+  of "int32": "writeInt32"
+  of "int64": "writeInt64"
+  of "uint32": "writeUInt32"
+  of "uint64": "writeUInt64"
+  of "sint32": "writeSInt32"
+  of "sint64": "writeSInt64"
+  of "bool": "writeBool"
+  of "string": "writeString"
+  of "float": "writeFloat32"
+  of "double": "writeFloat64"
+  of "fixed32": "writeFixed32"
+  of "fixed64": "writeFixed64"
+  of "sfixed32": "writeSFixed32"
+  of "sfixed64": "writeSFixed64"
+  of "bytes": "writeLengthDelimited"
+  else: ""
+
+proc getSizeProc(protoType: string): string =
+  case protoType
+  of "int32": "sizeInt32"
+  of "int64": "sizeInt64"
+  of "uint32": "sizeUInt32"
+  of "uint64": "sizeUInt64"
+  of "sint32": "sizeSInt32"
+  of "sint64": "sizeSInt64"
+  of "bool": "sizeBool"
+  of "string", "bytes": "sizeString"
+  of "float": "sizeFloat32"
+  of "double": "sizeFloat64"
+  of "fixed32": "sizeFixed32"
+  of "fixed64": "sizeFixed64"
+  of "sfixed32": "sizeSFixed32"
+  of "sfixed64": "sizeSFixed64"
+  else: ""
+
+proc fixedWidth(protoType: string): int =
+  ## Encoded size of a fixed-width scalar, 0 for everything else
+  case protoType
+  of "float", "fixed32", "sfixed32": 4
+  of "double", "fixed64", "sfixed64": 8
+  else: 0
+
+proc getPackedWriteProc(protoType: string): string =
+  ## Bulk writer for packed fixed-width fields
   case protoType
-  of "int32": "encodeInt32"
-  of "int64": "encodeInt64"
-  of "uint32": "encodeUInt32"
-  of "uint64": "encodeUInt64"
-  of "sint32": "encodeSInt32"
-  of "sint64": "encodeSInt64"
-  of "bool": "encodeBool"
-  of "string": "encodeString"
-  of "float": "encodeFloat32"
-  of "double": "encodeFloat64"
-  of "bytes": "encodeLengthDelimited"
+  of "float": "writePackedFloat32s"
+  of "double": "writePackedFloat64s"
+  of "fixed32": "writePackedFixed32s"
+  of "fixed64": "writePackedFixed64s"
+  of "sfixed32": "writePackedSFixed32s"
+  of "sfixed64": "writePackedSFixed64s"
   else: ""
 
+proc tagByteLen(fieldNumber: int): int =
+  ## Encoded size of a field key, resolved at generation time
+  result = 1
+  var key = fieldNumber shl 3
+  while key >= 0x80:
+    key = key shr 7
+    inc result
+
 proc getDecodeProc(protoType: string): string =
   case protoType
   of "int32": "decodeInt32"
@@ -380,12 +494,293 @@ proc getDecodeProc(protoType: string): string =
   of "string": "decodeString"
   of "float": "decodeFloat32"
   of "double": "decodeFloat64"
+  of "fixed32": "decodeFixed32"
+  of "fixed64": "decodeFixed64"
+  of "sfixed32": "decodeSFixed32"
+  of "sfixed64": "decodeSFixed64"
   of "bytes": "decodeLengthDelimited"
   else: ""
 
+proc getPackedDecodeProc(protoType: string): string =
+  case protoType
+  of "int32": "decodePackedInt32s"
+  of "int64": "decodePackedInt64s"
+  of "uint32": "decodePackedUInt32s"
+  of "uint64": "decodePackedUInt64s"
+  of "sint32": "decodePackedSInt32s"
+  of "sint64": "decodePackedSInt64s"
+  of "bool": "decodePackedBools"
+  of "float": "decodePackedFloat32s"
+  of "double": "decodePackedFloat64s"
+  of "fixed32": "decodePackedFixed32s"
+  of "fixed64": "decodePackedFixed64s"
+  of "sfixed32": "decodePackedSFixed32s"
+  of "sfixed64": "decodePackedSFixed64s"
+  else: "decodePackedEnums"
+
+proc resolveFieldType(node: ProtoNode, protoType: string,
+    nestedTypeMap: seq[(string, string)], packagePrefix: string): tuple[
+        protoType, nimType: string] =
+  ## Qualify a field's type name the same way the serializers do and return
+  ## the resolved proto type together with its Nim type
+  result.protoType = protoType
+  var typeWasRenamed = false
+  for (origName, qualName) in nestedTypeMap:
+    if result.protoType == origName:
+      result.protoType = qualName
+      typeWasRenamed = true
+      break
+  if node.reanamedTypeNamesInScope.len > 0 and
+      node.reanamedTypeNamesInScope.hasKey(result.protoType):
+    result.protoType = node.reanamedTypeNamesInScope[result.protoType]
+    typeWasRenamed = true
+  else:
+    let root = getRoot(node)
+    if root.globalTypeMap.hasKey(result.protoType):
+      result.protoType = root.globalTypeMap[result.protoType]
+      typeWasRenamed = true
+  let pkgPrefix = if typeWasRenamed: "" else: packagePrefix
+  result.nimType = protoTypeToNim(result.protoType, false, pkgPrefix)
+
+proc jsonValueExpr(protoType, nimType: string, isEnum: bool,
+    jsonExpr: string): string =
+  ## Nim expression converting the JSON value `jsonExpr` to a field value
+  case protoType
+  of "string":
+    jsonExpr & ".getStr()"
+  of "bool":
+    jsonExpr & ".getBool()"
+  of "int32", "int64", "uint32", "sint32", "sint64", "fixed32", "sfixed32",
+      "sfixed64":
+    nimType & "(" & jsonExpr & ".getBiggestInt())"
+  of "uint64", "fixed64":
+    # `%` writes values above high(int64) as raw number strings
+    "(if " & jsonExpr & ".kind == JInt: uint64(" & jsonExpr &
+        ".getBiggestInt()) else: parseBiggestUInt(" & jsonExpr & ".getStr()))"
+  of "float", "double":
+    nimType & "(" & jsonExpr & ".getFloat())"
+  of "bytes":
+    # toJson writes bytes as an array of numbers
+    jsonExpr & ".to(seq[byte])"
+  else:
+    if isEnum:
+      # Enums are written as their number, see toJson
+      nimType & "(" & jsonExpr & ".getInt())"
+    else:
+      "fromJson(" & nimType & ", " & jsonExpr & ")"
+
+proc isUnrolled(node: ProtoNode): bool =
+  ## Whether a message keeps its unrolled procs in table-driven mode
+  for child in node.children:
+    if child.kind == nkOption and child.name == "(nimproto3.unrolled)":
+      return child.value == "true"
+
+proc fieldKindName(protoType: string, isEnum: bool): string =
+  ## The `FieldKind` of a field type, see table_codec
+  if isEnum:
+    return "fkEnum"
+  case protoType
+  of "double": "fkDouble"
+  of "float": "fkFloat"
+  of "int64": "fkInt64"
+  of "uint64": "fkUInt64"
+  of "int32": "fkInt32"
+  of "fixed64": "fkFixed64"
+  of "fixed32": "fkFixed32"
+  of "bool": "fkBool"
+  of "string": "fkString"
+  of "bytes": "fkBytes"
+  of "uint32": "fkUInt32"
+  of "sfixed32": "fkSFixed32"
+  of "sfixed64": "fkSFixed64"
+  of "sint32": "fkSInt32"
+  of "sint64": "fkSInt64"
+  else: "fkMessage"
+
+proc generateSettersAndClear(node: ProtoNode, typeName: string,
+    nestedTypeMap: seq[(string, string)], enumNames: HashSet[string],
+    packagePrefix: string, oneofFields: seq[ProtoNode], indentStr: string,
+    options: CodegenOptions): string =
+  ## Oneof kind setters and the clear proc
+  # Switching a oneof goes through a setter that resets the current member
+  # before the discriminant is overwritten, so decoding into an existing
+  # object never needs -d:nimOldCaseObjects.
+  for oneofNode in oneofFields:
+    let kindField = escapeNimKeyword(oneofNode.name & "Kind")
+    result &= indentStr & "proc set" & capitalizeTypeName(oneofNode.name) &
+        "Kind*(self: var " & typeName & ", kind: " & typeName &
+        capitalizeTypeName(oneofNode.name) & "Kind) =\n"
+    result &= indentStr & "  if self." & kindField & " == kind: return\n"
+    result &= indentStr & "  case self." & kindField & "\n"
+    result &= indentStr & "  of rkNone: discard\n"
+    for oneofField in oneofNode.children:
+      if oneofField.kind == nkField:
+        result &= indentStr & "  of rk" & capitalizeTypeName(oneofField.name) &
+            ": reset(self." & escapeNimKeyword(oneofField.name) & ")\n"
+    result &= indentStr & "  {.cast(uncheckedAssign).}:\n"
+    result &= indentStr & "    self." & kindField & " = kind\n\n"
+
+  # `clear` empties seqs, strings and tables with setLen/clear so their
+  # allocations are reused by the next mergeFromBinary
+  var clearCode = indentStr & "proc clear*(self: var " & typeName & ") =\n"
+  let clearBodyStart = clearCode.len
+  for child in node.children:
+    if child.kind == nkField:
+      let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
+      let (protoType, nimType) = resolveFieldType(node, child.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+      let field = "self." & escapeNimKeyword(child.name)
+      if isRepeated or child.value in ["string", "bytes"]:
+        clearCode &= indentStr & "  " & field & ".setLen(0)\n"
+      elif getDecodeProc(child.value).len == 0 and not isEnum:
+        clearCode &= indentStr & "  clear(" & field & ")\n"
+      else:
+        clearCode &= indentStr & "  reset(" & field & ")\n"
+    elif child.kind == nkMapField:
+      if mapReprOf(child, options) == mrSortedSeq:
+        clearCode &= indentStr & "  self." & escapeNimKeyword(child.name) & ".setLen(0)\n"
+      else:
+        clearCode &= indentStr & "  self." & escapeNimKeyword(child.name) & ".clear()\n"
+  if options.preserveUnknownFields:
+    clearCode &= indentStr & "  self.unknownFields.setLen(0)\n"
+  for oneofNode in oneofFields:
+    clearCode &= indentStr & "  self.set" & capitalizeTypeName(oneofNode.name) &
+        "Kind(rkNone)\n"
+  if clearCode.len == clearBodyStart:
+    clearCode &= indentStr & "  discard\n"
+  result &= clearCode & "\n"
+
+proc generateMessageTable(node: ProtoNode, typeName: string,
+    nestedTypeMap: seq[(string, string)], enumNames: HashSet[string],
+    packagePrefix: string, oneofFields: seq[ProtoNode], indentStr: string,
+    options: CodegenOptions): string =
+  ## The statement filling in the field table of a message, after its oneof
+  ## setters. Fields are listed in the order the unrolled `toBinary` writes
+  ## them: oneof members first.
+  var entries: seq[string]
+  var oneofFieldNames: seq[string]
+  for oneofNode in oneofFields:
+    let kindField = escapeNimKeyword(oneofNode.name & "Kind")
+    let setter = "proc (p: pointer, kind: int32) {.nimcall, gcsafe.} = " &
+        "cast[ptr " & typeName & "](p)[].set" & capitalizeTypeName(oneofNode.name) &
+        "Kind(" & typeName & capitalizeTypeName(oneofNode.name) & "Kind(kind))"
+    var ordinal = 0
+    for field in oneofNode.children:
+      if field.kind != nkField:
+        continue
+      inc ordinal
+      oneofFieldNames.add(field.name)
+      let (protoType, nimType) = resolveFieldType(node, field.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+      entries.add("oneofField(\"" & field.name & "\", " & $field.number & ", " &
+          fieldKindName(field.value, isEnum) & ", offsetOf(" & typeName & ", " &
+          escapeNimKeyword(field.name) & "), " & nimType & ", offsetOf(" &
+          typeName & ", " & kindField & "), " & $ordinal & ", " & setter & ")")
+
+  for child in node.children:
+    case child.kind
+    of nkField:
+      if child.name in oneofFieldNames:
+        continue
+      let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
+      let (protoType, nimType) = resolveFieldType(node, child.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+      let kind = fieldKindName(child.value, isEnum)
+      let offset = "offsetOf(" & typeName & ", " & escapeNimKeyword(child.name) & ")"
+      let head = "\"" & child.name & "\", " & $child.number & ", "
+      if kind == "fkMessage":
+        let ctor = if isRepeated: "repeatedField(" else: "messageField("
+        entries.add(ctor & head & offset & ", " & nimType & ")")
+      else:
+        let ctor = if isRepeated: "repeatedField(" else: "scalarField("
+        entries.add(ctor & head & kind & ", " & offset & ")")
+    of nkMapField:
+      let parts = child.value.split(",")
+      let keyBase = parts[0].strip()
+      var valBase = parts[1].strip()
+      if node.reanamedTypeNamesInScope.len > 0 and
+          node.reanamedTypeNamesInScope.hasKey(valBase):
+        valBase = node.reanamedTypeNamesInScope[valBase]
+      let keyType = protoTypeToNim(keyBase, false, packagePrefix)
+      let valType = protoTypeToNim(valBase, false, packagePrefix)
+      let isEnum = enumNames.contains(valBase) or enumNames.contains(valType)
+      entries.add("mapField[" & mapNimType(mapReprOf(child, options), keyType,
+          valType) & ", " & keyType & ", " & valType & "](\"" & child.name &
+          "\", " & $child.number & ", offsetOf(" & typeName & ", " &
+          escapeNimKeyword(child.name) & "), " & fieldKindName(keyBase, false) &
+          ", " & fieldKindName(parts[1].strip(), isEnum) & ")")
+    else:
+      discard
+
+  result = indentStr & "initMessageTable(messageTable(" & typeName & "), "
+  if entries.len == 0:
+    result &= "newSeq[TableField]()"
+  else:
+    result &= "[\n"
+    for entry in entries:
+      result &= indentStr & "    " & entry & ",\n"
+    result &= indentStr & "  ]"
+  if options.preserveUnknownFields:
+    result &= ", unknownFields = offsetOf(" & typeName & ", unknownFields)"
+  if options.deterministic:
+    result &= ", deterministic = true"
+  result &= ")\n\n"
+
+proc generateTableProcs(node: ProtoNode, typeName: string,
+    nestedTypeMap: seq[(string, string)], enumNames: HashSet[string],
+    packagePrefix: string, oneofFields: seq[ProtoNode], indentStr: string,
+    options: CodegenOptions): string =
+  ## Serialization procs of a table-driven message: wrappers around the
+  ## table_codec procs, with the same signatures as the unrolled ones
+  let table = "messageTable(" & typeName & ")"
+  result &= indentStr & "proc byteSize*(self: " & typeName &
+      ", sizes: var seq[int]): int =\n"
+  result &= indentStr & "  tableSize(" & table & ", unsafeAddr self, sizes)\n\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName &
+      ", buf: var seq[byte], sizes: openArray[int], pos: var int) =\n"
+  result &= indentStr & "  tableWrite(" & table & ", unsafeAddr self, buf, sizes, pos)\n\n"
+  result &= indentStr & "proc byteSize*(self: " & typeName & "): int =\n"
+  result &= indentStr & "  tableSize(" & table & ", unsafeAddr self)\n\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName & ", buf: var seq[byte]) =\n"
+  result &= indentStr & "  tableWrite(" & table & ", unsafeAddr self, buf)\n\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName & "): seq[byte] =\n"
+  result &= indentStr & "  var sizes: seq[int]\n"
+  result &= indentStr & "  result = newSeqOfCap[byte](byteSize(self, sizes))\n"
+  result &= indentStr & "  var pos = 0\n"
+  result &= indentStr & "  toBinary(self, result, sizes, pos)\n\n"
+
+  result &= generateSettersAndClear(node, typeName, nestedTypeMap, enumNames,
+      packagePrefix, oneofFields, indentStr, options)
+
+  result &= indentStr & "proc mergeFromBinary*(self: var " & typeName &
+      ", data: openArray[byte], fields: set[FieldNumber]) =\n"
+  result &= indentStr & "  tableMerge(" & table & ", addr self, data, fields)\n\n"
+  result &= indentStr & "proc mergeFromBinary*(self: var " & typeName &
+      ", data: openArray[byte]) =\n"
+  result &= indentStr & "  tableMerge(" & table & ", addr self, data)\n\n"
+  result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
+      "], data: openArray[byte], fields: set[FieldNumber]): " & typeName & " =\n"
+  result &= indentStr & "  mergeFromBinary(result, data, fields)\n\n"
+  result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
+      "], data: openArray[byte]): " & typeName & " =\n"
+  result &= indentStr & "  mergeFromBinary(result, data)\n\n"
+
+  result &= indentStr & "proc toJson*(self: " & typeName & "): JsonNode =\n"
+  result &= indentStr & "  tableToJson(" & table & ", unsafeAddr self)\n\n"
+  result &= indentStr & "proc toJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte]): JsonNode =\n"
+  result &= indentStr & "  tableBytesToJson(" & table & ", data)\n\n"
+  result &= indentStr & "proc fromJson*(T: typedesc[" & typeName &
+      "], node: JsonNode): " & typeName & " =\n"
+  result &= indentStr & "  tableFromJson(" & table & ", addr result, node)\n\n"
+
 proc generateSerializationProcs(node: ProtoNode, typeName: string,
     nestedTypeMap: seq[(string, string)], enumNames: HashSet[string],
-        packagePrefix: string = "", checkDefined: bool = false): string =
+        packagePrefix: string = "", checkDefined: bool = false,
+        options: CodegenOptions = CodegenOptions()): string =
   ## Generate toBinary, fromBinary, toJson, and fromJson procs
   result = ""
   if checkDefined:
@@ -403,11 +798,27 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
 
   let hasOneof = oneofFields.len > 0
 
+  if options.tableDriven and not isUnrolled(node):
+    return result & generateTableProcs(node, typeName, nestedTypeMap,
+        enumNames, packagePrefix, oneofFields, indentStr, options) &
+        generateMessageTable(node, typeName, nestedTypeMap, enumNames,
+        packagePrefix, oneofFields, indentStr, options)
+
   # ==========================================
-  # toBinary proc
+  # byteSize and toBinary procs
   # ==========================================
-  result &= indentStr & "proc toBinary*(self: " & typeName & "): seq[byte] =\n"
-  result &= indentStr & "  result = @[]\n"
+  # Both procs are built in one pass over the fields. `byteSize` returns the
+  # encoded size without encoding and appends the length of every nested
+  # message, packed field and map entry to `sizes`, in the order `toBinary`
+  # writes them. `toBinary` takes each length prefix from `sizes` and then
+  # encodes the payload straight into the same buffer, so every message is
+  # sized once per encoding however deep it is nested.
+  var sizeCode = indentStr & "proc byteSize*(self: " & typeName &
+      ", sizes: var seq[int]): int =\n"
+  var binCode = indentStr & "proc toBinary*(self: " & typeName &
+      ", buf: var seq[byte], sizes: openArray[int], pos: var int) =\n"
+  let sizeBodyStart = sizeCode.len
+  let binBodyStart = binCode.len
 
   # Handle oneof fields first (if any)
   if hasOneof:
@@ -416,12 +827,16 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       let oneofName = oneofNode.name
 
       # For oneof fields, we generate a case statement
-      result &= indentStr & "  case self." & escapeNimKeyword(oneofName &
+      let caseLine = indentStr & "  case self." & escapeNimKeyword(oneofName &
           "Kind") & "\n"
+      sizeCode &= caseLine
+      binCode &= caseLine
 
       # Handle the none case
-      result &= indentStr & "  of rkNone:\n"
-      result &= indentStr & "    discard\n"
+      sizeCode &= indentStr & "  of rkNone:\n"
+      sizeCode &= indentStr & "    discard\n"
+      binCode &= indentStr & "  of rkNone:\n"
+      binCode &= indentStr & "    discard\n"
 
       # Handle each field in this oneof
       for oneofField in oneofNode.children:
@@ -452,40 +867,51 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
           # FIX: Check both proto type and resolved Nim type to correctly identify enums
           let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
 
-          let encodeProc = getEncodeProc(protoType)
+          let writeProc = getWriteProc(protoType)
+          let sizeProc = getSizeProc(protoType)
           let wireType = if isEnum: "wtVarint" else: getWireType(protoType)
+          let tagLen = $tagByteLen(fieldNum)
+          let fieldAccess = "self." & escapeNimKeyword(fieldName)
 
-          result &= indentStr & "  of rk" & capitalizeTypeName(fieldName) & ":\n"
+          sizeCode &= indentStr & "  of rk" & capitalizeTypeName(fieldName) & ":\n"
+          binCode &= indentStr & "  of rk" & capitalizeTypeName(fieldName) & ":\n"
 
           if wireType == "wtLengthDelimited":
             # Length-delimited fields (strings, bytes, messages)
-            result &= indentStr & "    # field " & $fieldNum & ", wire=2 (length-delimited)\n"
-            result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum & ", wtLengthDelimited))\n"
-            if encodeProc.len > 0:
-              result &= indentStr & "    let s = self." & escapeNimKeyword(
-                  fieldName) & "\n"
-              result &= indentStr & "    result.add(encodeString(s))\n"
+            binCode &= indentStr & "    # field " & $fieldNum & ", wire=2 (length-delimited)\n"
+            binCode &= indentStr & "    buf.writeTag(" & $fieldNum & ", wtLengthDelimited)\n"
+            if writeProc.len > 0:
+              sizeCode &= indentStr & "    result += " & tagLen & " + sizeString(" &
+                  fieldAccess & ")\n"
+              binCode &= indentStr & "    buf.writeString(" & fieldAccess & ")\n"
             else:
               # Message type
-              result &= indentStr & "    let msgData = toBinary(self." &
-                  escapeNimKeyword(fieldName) & ")\n"
-              result &= indentStr & "    result.add(encodeVarint(uint64(msgData.len)))\n"
-              result &= indentStr & "    result.add(msgData)\n"
+              sizeCode &= indentStr & "    let slot = sizes.reserveSize()\n"
+              sizeCode &= indentStr & "    let fieldSize = byteSize(" & fieldAccess &
+                  ", sizes)\n"
+              sizeCode &= indentStr & "    sizes[slot] = fieldSize\n"
+              sizeCode &= indentStr & "    result += " & tagLen &
+                  " + sizeLengthDelimited(fieldSize)\n"
+              binCode &= indentStr & "    buf.writeVarint(uint64(sizes.nextSize(pos)))\n"
+              binCode &= indentStr & "    toBinary(" & fieldAccess & ", buf, sizes, pos)\n"
           else:
-            # Varint fields (integers, booleans, enums)
-            result &= indentStr & "    # field " & $fieldNum & ", wire=0 (varint)\n"
-            result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum & ", wtVarint))\n"
-            if encodeProc.len > 0:
-              result &= indentStr & "    result.add(" & encodeProc & "(self." &
-                  escapeNimKeyword(fieldName) & "))\n"
+            # Varint and fixed-width fields (integers, floats, booleans, enums)
+            binCode &= indentStr & "    # field " & $fieldNum & ", " & wireType & "\n"
+            binCode &= indentStr & "    buf.writeTag(" & $fieldNum & ", " & wireType & ")\n"
+            if writeProc.len > 0:
+              sizeCode &= indentStr & "    result += " & tagLen & " + " & sizeProc &
+                  "(" & fieldAccess & ")\n"
+              binCode &= indentStr & "    buf." & writeProc & "(" & fieldAccess & ")\n"
             elif isEnum:
               # FIX: Correctly cast enum to int32
-              result &= indentStr & "    result.add(encodeInt32(int32(self." &
-                  escapeNimKeyword(fieldName) & ")))\n"
+              sizeCode &= indentStr & "    result += " & tagLen & " + sizeInt32(int32(" &
+                  fieldAccess & "))\n"
+              binCode &= indentStr & "    buf.writeInt32(int32(" & fieldAccess & "))\n"
             else:
               # Boolean/Other
-              result &= indentStr & "    result.add(encodeVarint(uint64(self." &
-                  escapeNimKeyword(fieldName) & ".int)))\n"
+              sizeCode &= indentStr & "    result += " & tagLen &
+                  " + varintSize(uint64(" & fieldAccess & ".int))\n"
+              binCode &= indentStr & "    buf.writeVarint(uint64(" & fieldAccess & ".int))\n"
 
   # Handle regular fields (both with and without oneof fields)
   # First, collect all oneof field names to exclude them from regular field processing
@@ -537,78 +963,106 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
 
       let wireType = if isEnum: "wtVarint" else: getWireType(protoType)
-      let encodeProc = getEncodeProc(protoType)
+      let writeProc = getWriteProc(protoType)
+      let sizeProc = getSizeProc(protoType)
+      let tagLen = $tagByteLen(fieldNum)
+      let fieldAccess = "self." & escapeNimKeyword(fieldName)
 
       if isRepeated:
-        if encodeProc.len > 0 and protoType != "string" and protoType != "bytes":
-          # Packed repeated field (numeric types)
-          result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ".len > 0:\n"
-          result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum & ", wtLengthDelimited))\n"
-          result &= indentStr & "    var packed: seq[byte] = @[]\n"
-          result &= indentStr & "    for item in self." & escapeNimKeyword(
-              fieldName) & ":\n"
-          result &= indentStr & "      packed.add(" & encodeProc & "(item))\n"
-          result &= indentStr & "    result.add(encodeLengthDelimited(packed))\n"
-        elif isEnum:
-          # Packed repeated field (enums)
-          result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ".len > 0:\n"
-          result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum & ", wtLengthDelimited))\n"
-          result &= indentStr & "    var packed: seq[byte] = @[]\n"
-          result &= indentStr & "    for item in self." & escapeNimKeyword(
-              fieldName) & ":\n"
-          result &= indentStr & "      packed.add(encodeInt32(int32(item)))\n"
-          result &= indentStr & "    result.add(encodeLengthDelimited(packed))\n"
+        if fixedWidth(protoType) > 0:
+          # Packed fixed-width field: the payload size is known from the
+          # length and the values are copied in one go
+          let payloadSize = fieldAccess & ".len * " & $fixedWidth(protoType)
+          sizeCode &= indentStr & "  if " & fieldAccess & ".len > 0:\n"
+          sizeCode &= indentStr & "    result += " & tagLen & " + sizeLengthDelimited(" &
+              payloadSize & ")\n"
+
+          binCode &= indentStr & "  if " & fieldAccess & ".len > 0:\n"
+          binCode &= indentStr & "    buf.writeTag(" & $fieldNum & ", wtLengthDelimited)\n"
+          binCode &= indentStr & "    buf.writeVarint(uint64(" & payloadSize & "))\n"
+          binCode &= indentStr & "    buf." & getPackedWriteProc(protoType) & "(" &
+              fieldAccess & ")\n"
+        elif (writeProc.len > 0 and protoType != "string" and protoType != "bytes") or isEnum:
+          # Packed repeated field (varint numeric types and enums)
+          let (itemWrite, itemSize) = if isEnum:
+            ("writeInt32(int32(item))", "sizeInt32(int32(item))")
+          else:
+            (writeProc & "(item)", sizeProc & "(item)")
+          sizeCode &= indentStr & "  if " & fieldAccess & ".len > 0:\n"
+          sizeCode &= indentStr & "    var packedSize = 0\n"
+          sizeCode &= indentStr & "    for item in " & fieldAccess & ":\n"
+          sizeCode &= indentStr & "      packedSize += " & itemSize & "\n"
+          sizeCode &= indentStr & "    sizes.add(packedSize)\n"
+          sizeCode &= indentStr & "    result += " & tagLen & " + sizeLengthDelimited(packedSize)\n"
+
+          binCode &= indentStr & "  if " & fieldAccess & ".len > 0:\n"
+          binCode &= indentStr & "    buf.writeTag(" & $fieldNum & ", wtLengthDelimited)\n"
+          binCode &= indentStr & "    buf.writeVarint(uint64(sizes.nextSize(pos)))\n"
+          binCode &= indentStr & "    for item in " & fieldAccess & ":\n"
+          binCode &= indentStr & "      buf." & itemWrite & "\n"
         else:
           # Unpacked repeated field (strings, bytes, messages)
-          result &= indentStr & "  for item in self." & escapeNimKeyword(
-              fieldName) & ":\n"
-          result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum &
-              ", " & wireType & "))\n"
-          if encodeProc.len > 0:
+          sizeCode &= indentStr & "  for item in " & fieldAccess & ":\n"
+          binCode &= indentStr & "  for item in " & fieldAccess & ":\n"
+          binCode &= indentStr & "    buf.writeTag(" & $fieldNum &
+              ", " & wireType & ")\n"
+          if writeProc.len > 0:
             # String/Bytes
-            result &= indentStr & "    result.add(" & encodeProc & "(item))\n"
+            sizeCode &= indentStr & "    result += " & tagLen & " + " & sizeProc & "(item)\n"
+            binCode &= indentStr & "    buf." & writeProc & "(item)\n"
           else:
             # Message
-            result &= indentStr & "    let itemData = toBinary(item)\n"
-            result &= indentStr & "    result.add(encodeLengthDelimited(itemData))\n"
+            sizeCode &= indentStr & "    let slot = sizes.reserveSize()\n"
+            sizeCode &= indentStr & "    let itemSize = byteSize(item, sizes)\n"
+            sizeCode &= indentStr & "    sizes[slot] = itemSize\n"
+            sizeCode &= indentStr & "    result += " & tagLen &
+                " + sizeLengthDelimited(itemSize)\n"
+            binCode &= indentStr & "    buf.writeVarint(uint64(sizes.nextSize(pos)))\n"
+            binCode &= indentStr & "    toBinary(item, buf, sizes, pos)\n"
       else:
         # Regular field
-        if encodeProc.len > 0:
+        if writeProc.len > 0:
           # Scalar or String/Bytes
-          if protoType == "string" or protoType == "bytes":
-            result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ".len > 0:\n"
-            result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum &
-                ", " & wireType & "))\n"
-            result &= indentStr & "    result.add(" & encodeProc & "(self." &
-                escapeNimKeyword(fieldName) & "))\n"
+          let condition = if protoType == "string" or protoType == "bytes":
+            fieldAccess & ".len > 0"
           elif protoType == "bool":
-            result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ":\n"
-            result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum &
-                ", " & wireType & "))\n"
-            result &= indentStr & "    result.add(" & encodeProc & "(self." &
-                escapeNimKeyword(fieldName) & "))\n"
+            fieldAccess
           else:
             # Numeric types (int, float, etc.) - check for 0
-            result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & " != 0:\n"
-            result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum &
-                ", " & wireType & "))\n"
-            result &= indentStr & "    result.add(" & encodeProc & "(self." &
-                escapeNimKeyword(fieldName) & "))\n"
+            fieldAccess & " != 0"
+          sizeCode &= indentStr & "  if " & condition & ":\n"
+          sizeCode &= indentStr & "    result += " & tagLen & " + " & sizeProc &
+              "(" & fieldAccess & ")\n"
+          binCode &= indentStr & "  if " & condition & ":\n"
+          binCode &= indentStr & "    buf.writeTag(" & $fieldNum &
+              ", " & wireType & ")\n"
+          binCode &= indentStr & "    buf." & writeProc & "(" & fieldAccess & ")\n"
         elif isEnum:
           # Enum - check for default (first value)
-          result &= indentStr & "  if int(self." & escapeNimKeyword(fieldName) & ") != 0:\n"
-          result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum & ", wtVarint))\n"
-          result &= indentStr & "    result.add(encodeInt32(int32(self." &
-              escapeNimKeyword(fieldName) & ")))\n"
+          sizeCode &= indentStr & "  if int(" & fieldAccess & ") != 0:\n"
+          sizeCode &= indentStr & "    result += " & tagLen & " + sizeInt32(int32(" &
+              fieldAccess & "))\n"
+          binCode &= indentStr & "  if int(" & fieldAccess & ") != 0:\n"
+          binCode &= indentStr & "    buf.writeTag(" & $fieldNum & ", wtVarint)\n"
+          binCode &= indentStr & "    buf.writeInt32(int32(" & fieldAccess & "))\n"
         else:
-          # Message - check if serialized data is not empty
-          result &= indentStr & "  block:\n"
-          result &= indentStr & "    let fieldData = toBinary(self." &
-              escapeNimKeyword(fieldName) & ")\n"
-          result &= indentStr & "    if fieldData.len > 0:\n"
-          result &= indentStr & "      result.add(encodeFieldKey(" & $fieldNum &
-              ", " & wireType & "))\n"
-          result &= indentStr & "      result.add(encodeLengthDelimited(fieldData))\n"
+          # Message - skipped when it encodes to nothing. Its slot is kept
+          # for toBinary to read, the lengths recorded below it are dropped.
+          sizeCode &= indentStr & "  block:\n"
+          sizeCode &= indentStr & "    let slot = sizes.reserveSize()\n"
+          sizeCode &= indentStr & "    let fieldSize = byteSize(" & fieldAccess & ", sizes)\n"
+          sizeCode &= indentStr & "    sizes[slot] = fieldSize\n"
+          sizeCode &= indentStr & "    if fieldSize > 0:\n"
+          sizeCode &= indentStr & "      result += " & tagLen & " + sizeLengthDelimited(fieldSize)\n"
+          sizeCode &= indentStr & "    else:\n"
+          sizeCode &= indentStr & "      sizes.setLen(slot + 1)\n"
+          binCode &= indentStr & "  block:\n"
+          binCode &= indentStr & "    let fieldSize = sizes.nextSize(pos)\n"
+          binCode &= indentStr & "    if fieldSize > 0:\n"
+          binCode &= indentStr & "      buf.writeTag(" & $fieldNum &
+              ", " & wireType & ")\n"
+          binCode &= indentStr & "      buf.writeVarint(uint64(fieldSize))\n"
+          binCode &= indentStr & "      toBinary(" & fieldAccess & ", buf, sizes, pos)\n"
 
     of nkMapField:
       let fieldNum = child.number
@@ -623,48 +1077,116 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       let keyWireType = getWireType(keyType)
       let valWireType = getWireType(valType)
 
-      let keyEncode = getEncodeProc(keyType)
-      let valEncode = getEncodeProc(valType)
-
-      result &= indentStr & "  for key, val in self." & escapeNimKeyword(
-          fieldName) & ":\n"
-      result &= indentStr & "    var entry = newSeq[byte]()\n"
+      let keyWrite = getWriteProc(keyType)
+      let valWrite = getWriteProc(valType)
+      let tagLen = $tagByteLen(fieldNum)
 
-      # Encode Key (field 1)
-      result &= indentStr & "    entry.add(encodeFieldKey(1, " & keyWireType & "))\n"
-      if keyEncode.len > 0:
-        result &= indentStr & "    entry.add(" & keyEncode & "(key))\n"
+      # Entry size: key (field 1) and value (field 2), one tag byte each
+      var entrySize = "2"
+      if keyWrite.len > 0:
+        entrySize &= " + " & getSizeProc(keyType) & "(key)"
       else:
         # Keys can only be scalar types, so this should be covered, but for safety:
-        result &= indentStr & "    entry.add(toBinary(key))\n"
-
-      # Encode Value (field 2)
-      result &= indentStr & "    entry.add(encodeFieldKey(2, " & valWireType & "))\n"
-      if valEncode.len > 0:
-        result &= indentStr & "    entry.add(" & valEncode & "(val))\n"
+        entrySize &= " + byteSize(key)"
+      if valWrite.len > 0:
+        entrySize &= " + " & getSizeProc(valType) & "(val)"
       else:
         # Value can be message
-        result &= indentStr & "    let valData = toBinary(val)\n"
-        result &= indentStr & "    entry.add(encodeLengthDelimited(valData))\n"
+        entrySize &= " + sizeLengthDelimited(valSize)"
+
+      # Entries are sized in the order toBinary writes them
+      let mapRepr = mapReprOf(child, options)
+      let mapAccess = "self." & escapeNimKeyword(fieldName)
+      let entryLoop = indentStr & "  " & mapLoop(mapRepr, mapAccess,
+          options.deterministic) & "\n"
+      sizeCode &= entryLoop
+      sizeCode &= indentStr & "    let entrySlot = sizes.reserveSize()\n"
+      if valWrite.len == 0:
+        sizeCode &= indentStr & "    let valSlot = sizes.reserveSize()\n"
+        sizeCode &= indentStr & "    let valSize = byteSize(val, sizes)\n"
+        sizeCode &= indentStr & "    sizes[valSlot] = valSize\n"
+      sizeCode &= indentStr & "    let entrySize = " & entrySize & "\n"
+      sizeCode &= indentStr & "    sizes[entrySlot] = entrySize\n"
+      sizeCode &= indentStr & "    result += " & tagLen & " + sizeLengthDelimited(entrySize)\n"
 
       # Add entry to result (field N)
-      result &= indentStr & "    result.add(encodeFieldKey(" & $fieldNum & ", wtLengthDelimited))\n"
-      result &= indentStr & "    result.add(encodeLengthDelimited(entry))\n"
+      binCode &= entryLoop
+      binCode &= indentStr & "    buf.writeTag(" & $fieldNum & ", wtLengthDelimited)\n"
+      binCode &= indentStr & "    buf.writeVarint(uint64(sizes.nextSize(pos)))\n"
+
+      # Encode Key (field 1)
+      binCode &= indentStr & "    buf.writeTag(1, " & keyWireType & ")\n"
+      if keyWrite.len > 0:
+        binCode &= indentStr & "    buf." & keyWrite & "(key)\n"
+      else:
+        binCode &= indentStr & "    toBinary(key, buf)\n"
+
+      # Encode Value (field 2)
+      binCode &= indentStr & "    buf.writeTag(2, " & valWireType & ")\n"
+      if valWrite.len > 0:
+        binCode &= indentStr & "    buf." & valWrite & "(val)\n"
+      else:
+        binCode &= indentStr & "    buf.writeVarint(uint64(sizes.nextSize(pos)))\n"
+        binCode &= indentStr & "    toBinary(val, buf, sizes, pos)\n"
     of nkOneof, nkMessage, nkEnum:
       discard
     else:
       discard # nkProto, nkSyntax, etc
 
+  if options.preserveUnknownFields:
+    # Unknown fields are kept with their keys, so they are written as-is
+    sizeCode &= indentStr & "  result += self.unknownFields.len\n"
+    binCode &= indentStr & "  if self.unknownFields.len > 0:\n"
+    binCode &= indentStr & "    buf.add(self.unknownFields)\n"
+
+  if sizeCode.len == sizeBodyStart:
+    sizeCode &= indentStr & "  result = 0\n"
+  if binCode.len == binBodyStart:
+    binCode &= indentStr & "  discard\n"
+
+  result &= sizeCode & "\n"
+  result &= binCode & "\n"
+
+  result &= indentStr & "proc byteSize*(self: " & typeName & "): int =\n"
+  result &= indentStr & "  var sizes: seq[int]\n"
+  result &= indentStr & "  byteSize(self, sizes)\n\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName & ", buf: var seq[byte]) =\n"
+  result &= indentStr & "  var sizes: seq[int]\n"
+  result &= indentStr & "  discard byteSize(self, sizes)\n"
+  result &= indentStr & "  var pos = 0\n"
+  result &= indentStr & "  toBinary(self, buf, sizes, pos)\n\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName & "): seq[byte] =\n"
+  result &= indentStr & "  var sizes: seq[int]\n"
+  result &= indentStr & "  result = newSeqOfCap[byte](byteSize(self, sizes))\n"
+  result &= indentStr & "  var pos = 0\n"
+  result &= indentStr & "  toBinary(self, result, sizes, pos)\n"
+
   result &= "\n"
 
+  result &= generateSettersAndClear(node, typeName, nestedTypeMap, enumNames,
+      packagePrefix, oneofFields, indentStr, options)
+
   # ==========================================
-  # fromBinary proc
+  # mergeFromBinary and fromBinary procs
   # ==========================================
-  result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
-      "], data: openArray[byte]): " & typeName & " =\n"
+  # Decoding merges into an existing object: scalars are overwritten,
+  # repeated fields and maps are appended to and message fields are merged
+  # recursively. fromBinary merges into a fresh result.
+  result &= indentStr & "proc mergeFromBinary*(self: var " & typeName &
+      ", data: openArray[byte], fields: set[FieldNumber]) =\n"
   result &= indentStr & "  var pos = 0\n"
+  var sortedMaps: seq[ProtoNode]
+  for child in node.children:
+    if child.kind == nkMapField and mapReprOf(child, options) == mrSortedSeq:
+      sortedMaps.add(child)
+      result &= indentStr & "  var reserved" & $child.number & " = false\n"
   result &= indentStr & "  while pos < data.len:\n"
+  if options.preserveUnknownFields:
+    result &= indentStr & "    let fieldStart = pos\n"
   result &= indentStr & "    let (fieldNum, wireType {.used.}) = decodeFieldKey(data, pos)\n"
+  result &= indentStr & "    if not isSelected(fields, fieldNum):\n"
+  result &= indentStr & "      skipField(data, pos, wireType)\n"
+  result &= indentStr & "      continue\n"
   result &= indentStr & "    case fieldNum\n"
 
   # Handle regular fields first
@@ -709,60 +1231,52 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
         if isPackable:
           # Handle packed or unpacked repeated fields for packable types
           result &= indentStr & "      if wireType == wtLengthDelimited:\n"
-          result &= indentStr & "        let fieldData = decodeLengthDelimited(data, pos)\n"
-          result &= indentStr & "        var bufPos = 0\n"
-          result &= indentStr & "        while bufPos < fieldData.len:\n"
-          if isEnum:
-            result &= indentStr & "          result." & escapeNimKeyword(
-                fieldName) &
-               ".add(" & nimType & "(decodeInt32(fieldData, bufPos)))\n"
-          elif protoType == "int32" or protoType == "sint32" or protoType == "sfixed32":
-            # Use decodeInt64 for 32-bit signed ints to handle negative varints safely
-            result &= indentStr & "          result." & escapeNimKeyword(
-                fieldName) &
-               ".add(" & nimType & "(decodeInt64(fieldData, bufPos)))\n"
-          else:
-            result &= indentStr & "          result." & escapeNimKeyword(
-                fieldName) &
-               ".add(" & decodeProc & "(fieldData, bufPos))\n"
+          # The whole run is decoded in bulk into the field's seq
+          result &= indentStr & "        let packedSpan = decodeLengthDelimitedSpan(data, pos)\n"
+          result &= indentStr & "        " & getPackedDecodeProc(child.value) &
+              "(data.toOpenArray(packedSpan.a, packedSpan.b), self." &
+              escapeNimKeyword(fieldName) & ")\n"
 
           result &= indentStr & "      else:\n"
           if isEnum:
-            result &= indentStr & "        result." & escapeNimKeyword(
+            result &= indentStr & "        self." & escapeNimKeyword(
                 fieldName) &
                ".add(" & nimType & "(decodeInt32(data, pos)))\n"
-          elif protoType == "int32" or protoType == "sint32" or protoType == "sfixed32":
-            result &= indentStr & "        result." & escapeNimKeyword(
-                fieldName) &
-               ".add(" & nimType & "(decodeInt64(data, pos)))\n"
           else:
-            result &= indentStr & "        result." & escapeNimKeyword(
+            result &= indentStr & "        self." & escapeNimKeyword(
                 fieldName) &
                ".add(" & decodeProc & "(data, pos))\n"
         elif decodeProc.len > 0:
           # Non-packable primitive types (string, bytes)
-          result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
               ".add(" & decodeProc & "(data, pos))\n"
         else:
-          result &= indentStr & "      let fieldData = decodeLengthDelimited(data, pos)\n"
-          result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
-              ".add(fromBinary(" & nimType & ", fieldData))\n"
+          # Decode in place into a new trailing element
+          result &= indentStr & "      let span = decodeLengthDelimitedSpan(data, pos)\n"
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
+              ".setLen(self." & escapeNimKeyword(fieldName) & ".len + 1)\n"
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
+              "[^1].mergeFromBinary(data.toOpenArray(span.a, span.b))\n"
       else:
-        if decodeProc.len > 0:
-          result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
+        if child.value in ["string", "bytes"]:
+          # Reuses the capacity the field already has
+          result &= indentStr & "      " & decodeProc & "Into(data, pos, self." &
+              escapeNimKeyword(fieldName) & ")\n"
+        elif decodeProc.len > 0:
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
               " = " & decodeProc & "(data, pos)\n"
         elif isEnum:
-          result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
               " = " & nimType &
               "(decodeInt32(data, pos))\n"
         elif protoType == "int32":
           # Use decodeInt64 -> cast to int32 to safely handle negative Varints
-          result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
               " = int32(decodeInt64(data, pos))\n"
         else:
-          result &= indentStr & "      let fieldData = decodeLengthDelimited(data, pos)\n"
-          result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
-              " = fromBinary(" & nimType & ", fieldData)\n"
+          result &= indentStr & "      let span = decodeLengthDelimitedSpan(data, pos)\n"
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) &
+              ".mergeFromBinary(data.toOpenArray(span.a, span.b))\n"
 
     of nkMapField:
       let fieldNum = child.number
@@ -779,8 +1293,16 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       let keyNimType = protoTypeToNim(keyType, false, packagePrefix)
       let valNimType = protoTypeToNim(valType, false, packagePrefix)
 
+      let repr = mapReprOf(child, options)
       result &= indentStr & "    of " & $fieldNum & ":\n"
-      result &= indentStr & "      let entryData = decodeLengthDelimited(data, pos)\n"
+      result &= indentStr & "      let entrySpan = decodeLengthDelimitedSpan(data, pos)\n"
+      if repr == mrSortedSeq:
+        # Size the seq for all entries of this field on the first one
+        result &= indentStr & "      if not reserved" & $fieldNum & ":\n"
+        result &= indentStr & "        reserved" & $fieldNum & " = true\n"
+        result &= indentStr & "        reserveEntries(self." & escapeNimKeyword(fieldName) &
+            ", 1 + countFields(data, pos, " & $fieldNum & "))\n"
+      result &= indentStr & "      template entryData: untyped = data.toOpenArray(entrySpan.a, entrySpan.b)\n"
       result &= indentStr & "      var entryPos = 0\n"
       result &= indentStr & "      var key: " & keyNimType & "\n"
       result &= indentStr & "      var val: " & valNimType & "\n"
@@ -791,17 +1313,22 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       if keyDecode.len > 0:
         result &= indentStr & "          key = " & keyDecode & "(entryData, entryPos)\n"
       else:
-        result &= indentStr & "          key = fromBinary(" & keyNimType & ", decodeLengthDelimited(entryData, entryPos))\n"
+        result &= indentStr & "          let keySpan = decodeLengthDelimitedSpan(entryData, entryPos)\n"
+        result &= indentStr & "          key = fromBinary(" & keyNimType & ", entryData.toOpenArray(keySpan.a, keySpan.b))\n"
 
       result &= indentStr & "        of 2:\n"
       if valDecode.len > 0:
         result &= indentStr & "          val = " & valDecode & "(entryData, entryPos)\n"
       else:
-        result &= indentStr & "          let valData = decodeLengthDelimited(entryData, entryPos)\n"
+        result &= indentStr & "          let valSpan = decodeLengthDelimitedSpan(entryData, entryPos)\n"
         result &= indentStr & "          val = fromBinary(" & valNimType &
-            ", valData)\n"
-      result &= indentStr & "        else: discard\n"
-      result &= indentStr & "      result." & escapeNimKeyword(fieldName) & "[key] = val\n"
+            ", entryData.toOpenArray(valSpan.a, valSpan.b))\n"
+      result &= indentStr & "        else: skipField(entryData, entryPos, wType)\n"
+      if repr == mrSortedSeq:
+        # Sorted once all entries are in
+        result &= indentStr & "      self." & escapeNimKeyword(fieldName) & ".add((key, val))\n"
+      else:
+        result &= indentStr & "      self." & escapeNimKeyword(fieldName) & "[key] = val\n"
 
     of nkOneof:
       discard # Handled below
@@ -843,49 +1370,54 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
         let wireType = if isEnum: "wtVarint" else: getWireType(oneofField.value)
 
         result &= indentStr & "    of " & $fieldNum & ":\n"
+        let setKind = indentStr & "      self.set" & capitalizeTypeName(oneofName) &
+            "Kind(rk" & capitalizeTypeName(fieldName) & ")\n"
 
         if wireType == "wtLengthDelimited":
           # Length-delimited fields
-          result &= indentStr & "      assert wireType.int == 2\n"
-          result &= indentStr & "      let length = int(decodeVarint(data, pos))\n"
+          result &= indentStr & "      assert wireType == wtLengthDelimited\n"
+          result &= setKind
           if decodeProc.len > 0:
-            result &= indentStr & "      result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & " = " & decodeProc & "(data, pos)\n"
+            # The decode proc reads the length prefix itself
+            result &= indentStr & "      " & decodeProc & "Into(data, pos, self." &
+                escapeNimKeyword(fieldName) & ")\n"
           else:
-            # Message type
-            result &= indentStr & "      let msgData = data[pos ..< pos+length]\n"
-            result &= indentStr & "      pos += length\n"
-            result &= indentStr & "      result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & " = fromBinary(" & nimType & ", msgData)\n"
+            # Message type, merged if the member was already set
+            result &= indentStr & "      let span = decodeLengthDelimitedSpan(data, pos)\n"
+            result &= indentStr & "      self." & escapeNimKeyword(
+                fieldName) & ".mergeFromBinary(data.toOpenArray(span.a, span.b))\n"
         else:
-          # Varint fields
-          result &= indentStr & "      assert wireType.int == 0\n"
+          # Varint and fixed-width fields
+          result &= indentStr & "      assert wireType == " & wireType & "\n"
           if decodeProc.len > 0:
             result &= indentStr & "      let v = " & decodeProc & "(data, pos)\n"
-            result &= indentStr & "      result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & " = v\n"
           elif isEnum:
             result &= indentStr & "      let v = " & nimType & "(int32(decodeVarint(data, pos)))\n"
-            result &= indentStr & "      result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & " = v\n"
           else:
             # Boolean
-            result &= indentStr & "      let b = decodeVarint(data, pos) != 0\n"
-            result &= indentStr & "      result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & " = b\n"
+            result &= indentStr & "      let v = decodeVarint(data, pos) != 0\n"
+          result &= setKind
+          result &= indentStr & "      self." & escapeNimKeyword(fieldName) & " = v\n"
 
   result &= indentStr & "    else:\n"
-  result &= indentStr & "      discard\n\n"
+  result &= indentStr & "      skipField(data, pos, wireType)\n"
+  if options.preserveUnknownFields:
+    result &= indentStr & "      self.unknownFields.add(data.toOpenArray(fieldStart, pos - 1))\n"
+  for child in sortedMaps:
+    result &= indentStr & "  sortEntries(self." & escapeNimKeyword(child.name) & ")\n"
+  result &= "\n"
+
+  result &= indentStr & "proc mergeFromBinary*(self: var " & typeName &
+      ", data: openArray[byte]) =\n"
+  result &= indentStr & "  mergeFromBinary(self, data, AllFields)\n\n"
+
+  result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
+      "], data: openArray[byte], fields: set[FieldNumber]): " & typeName & " =\n"
+  result &= indentStr & "  mergeFromBinary(result, data, fields)\n\n"
+
+  result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
+      "], data: openArray[byte]): " & typeName & " =\n"
+  result &= indentStr & "  mergeFromBinary(result, data, AllFields)\n\n"
 
   # ==========================================
   # toJson proc
@@ -905,11 +1437,17 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       for oneofField in oneofNode.children:
         if oneofField.kind == nkField:
           let fieldName = oneofField.name
+          let (protoType, nimType) = resolveFieldType(node, oneofField.value,
+              nestedTypeMap, packagePrefix)
+          let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+          let value = if isEnum: "%int(self." & escapeNimKeyword(fieldName) & ")"
+            elif getDecodeProc(oneofField.value).len == 0:
+              "self." & escapeNimKeyword(fieldName) & ".toJson()"
+            else: "%self." & escapeNimKeyword(fieldName)
           result &= indentStr & "  of rk" & capitalizeTypeName(fieldName) & ":\n"
           # For Oneof, we always encode the value if the kind is set, regardless of defaults
           # because the user explicitly selected this variant.
-          result &= indentStr & "    result[\"" & fieldName & "\"] = %self." &
-              escapeNimKeyword(fieldName) & "\n"
+          result &= indentStr & "    result[\"" & fieldName & "\"] = " & value & "\n"
 
   for child in node.children:
     case child.kind
@@ -958,6 +1496,13 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
           result &= indentStr & "    for item in self." & escapeNimKeyword(
               fieldName) & ":\n"
           result &= indentStr & "      result[\"" & fieldName & "\"].add(%int(item))\n"
+        elif getDecodeProc(child.value).len == 0:
+          # Messages use their own toJson, not the generic `%` for objects
+          result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ".len > 0:\n"
+          result &= indentStr & "    result[\"" & fieldName & "\"] = newJArray()\n"
+          result &= indentStr & "    for item in self." & escapeNimKeyword(
+              fieldName) & ":\n"
+          result &= indentStr & "      result[\"" & fieldName & "\"].add(item.toJson())\n"
         else:
           result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ".len > 0:\n"
           result &= indentStr & "    result[\"" & fieldName & "\"] = %self." &
@@ -996,9 +1541,14 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       let fieldName = child.name
       result &= indentStr & "  if self." & escapeNimKeyword(fieldName) & ".len > 0:\n"
       result &= indentStr & "    var " & fieldName & "Json = newJObject()\n"
-      result &= indentStr & "    for key, val in self." & escapeNimKeyword(
-          fieldName) & ":\n"
-      result &= indentStr & "      " & fieldName & "Json[$key] = %val\n"
+      result &= indentStr & "    " & mapLoop(mapReprOf(child, options),
+          "self." & escapeNimKeyword(fieldName)) & "\n"
+      let valType = child.value.split(",")[1].strip()
+      let valNimType = protoTypeToNim(valType, false, packagePrefix)
+      let value = if enumNames.contains(valType) or enumNames.contains(valNimType): "%int(val)"
+        elif getDecodeProc(valType).len == 0: "val.toJson()"
+        else: "%val"
+      result &= indentStr & "      " & fieldName & "Json[$key] = " & value & "\n"
       result &= indentStr & "    result[\"" & fieldName & "\"] = " & fieldName & "Json\n"
     else:
       discard
@@ -1066,25 +1616,16 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
 
         if isPackable:
           result &= indentStr & "      if wireType == wtLengthDelimited:\n"
-          result &= indentStr & "        let fieldData = decodeLengthDelimited(data, pos)\n"
-          result &= indentStr & "        var bufPos = 0\n"
-          result &= indentStr & "        while bufPos < fieldData.len:\n"
-          if isEnum:
-            result &= indentStr & "          result[\"" & fieldName &
-                "\"].add(%(" & nimType & "(decodeInt32(fieldData, bufPos))))\n"
-          elif protoType == "int32" or protoType == "sint32" or protoType == "sfixed32":
-            result &= indentStr & "          result[\"" & fieldName &
-                "\"].add(%(" & nimType & "(decodeInt64(fieldData, bufPos))))\n"
-          else:
-            result &= indentStr & "          result[\"" & fieldName &
-                "\"].add(%" & decodeProc & "(fieldData, bufPos))\n"
+          result &= indentStr & "        let packedSpan = decodeLengthDelimitedSpan(data, pos)\n"
+          result &= indentStr & "        var packedItems: seq[" & nimType & "]\n"
+          result &= indentStr & "        " & getPackedDecodeProc(child.value) &
+              "(data.toOpenArray(packedSpan.a, packedSpan.b), packedItems)\n"
+          result &= indentStr & "        for item in packedItems:\n"
+          result &= indentStr & "          result[\"" & fieldName & "\"].add(%item)\n"
           result &= indentStr & "      else:\n"
           if isEnum:
             result &= indentStr & "        result[\"" & fieldName &
                 "\"].add(%(" & nimType & "(decodeInt32(data, pos))))\n"
-          elif protoType == "int32" or protoType == "sint32" or protoType == "sfixed32":
-            result &= indentStr & "        result[\"" & fieldName &
-                "\"].add(%(" & nimType & "(decodeInt64(data, pos))))\n"
           else:
             result &= indentStr & "        result[\"" & fieldName &
                 "\"].add(%" & decodeProc & "(data, pos))\n"
@@ -1092,9 +1633,9 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
           result &= indentStr & "      result[\"" & fieldName & "\"].add(%" &
               decodeProc & "(data, pos))\n"
         else:
-          result &= indentStr & "      let fieldData = decodeLengthDelimited(data, pos)\n"
+          result &= indentStr & "      let span = decodeLengthDelimitedSpan(data, pos)\n"
           result &= indentStr & "      result[\"" & fieldName &
-              "\"].add(toJson(" & nimType & ", fieldData))\n"
+              "\"].add(toJson(" & nimType & ", data.toOpenArray(span.a, span.b)))\n"
       else:
         if decodeProc.len > 0:
           result &= indentStr & "      result[\"" & fieldName & "\"] = %" &
@@ -1105,9 +1646,9 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
         elif protoType == "int32":
           result &= indentStr & "      result[\"" & fieldName & "\"] = %int32(decodeInt64(data, pos))\n"
         else:
-          result &= indentStr & "      let fieldData = decodeLengthDelimited(data, pos)\n"
+          result &= indentStr & "      let span = decodeLengthDelimitedSpan(data, pos)\n"
           result &= indentStr & "      result[\"" & fieldName &
-              "\"] = toJson(" & nimType & ", fieldData)\n"
+              "\"] = toJson(" & nimType & ", data.toOpenArray(span.a, span.b))\n"
 
     of nkMapField:
       let fieldNum = child.number
@@ -1127,7 +1668,8 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       result &= indentStr & "    of " & $fieldNum & ":\n"
       result &= indentStr & "      if not result.hasKey(\"" & fieldName & "\"):\n"
       result &= indentStr & "        result[\"" & fieldName & "\"] = newJObject()\n"
-      result &= indentStr & "      let entryData = decodeLengthDelimited(data, pos)\n"
+      result &= indentStr & "      let entrySpan = decodeLengthDelimitedSpan(data, pos)\n"
+      result &= indentStr & "      template entryData: untyped = data.toOpenArray(entrySpan.a, entrySpan.b)\n"
       result &= indentStr & "      var entryPos = 0\n"
       result &= indentStr & "      var key: " & keyNimType & "\n"
       result &= indentStr & "      var valJson: JsonNode = newJNull()\n"
@@ -1139,24 +1681,25 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       if keyDecode.len > 0:
         result &= indentStr & "          key = " & keyDecode & "(entryData, entryPos)\n"
       else:
-        result &= indentStr & "          key = fromBinary(" & keyNimType & ", decodeLengthDelimited(entryData, entryPos))\n"
+        result &= indentStr & "          let keySpan = decodeLengthDelimitedSpan(entryData, entryPos)\n"
+        result &= indentStr & "          key = fromBinary(" & keyNimType & ", entryData.toOpenArray(keySpan.a, keySpan.b))\n"
 
       result &= indentStr & "        of 2:\n"
       if valDecode.len > 0:
         result &= indentStr & "          valJson = %" & valDecode & "(entryData, entryPos)\n"
       else:
-        result &= indentStr & "          let valData = decodeLengthDelimited(entryData, entryPos)\n"
-        result &= indentStr & "          valJson = toJson(" & valNimType & ", valData)\n"
+        result &= indentStr & "          let valSpan = decodeLengthDelimitedSpan(entryData, entryPos)\n"
+        result &= indentStr & "          valJson = toJson(" & valNimType & ", entryData.toOpenArray(valSpan.a, valSpan.b))\n"
 
-      result &= indentStr & "        else: discard\n"
+      result &= indentStr & "        else: skipField(entryData, entryPos, wType)\n"
 
-      result &= indentStr & "      result[\"" & fieldName & "\"][key] = valJson\n"
+      result &= indentStr & "      result[\"" & fieldName & "\"][$key] = valJson\n"
 
     else:
       discard
 
   result &= indentStr & "    else:\n"
-  result &= indentStr & "      discard\n\n"
+  result &= indentStr & "      skipField(data, pos, wireType)\n\n"
 
   # ==========================================
   # fromJson proc
@@ -1172,195 +1715,742 @@ proc generateSerializationProcs(node: ProtoNode, typeName: string,
       for oneofField in oneofNode.children:
         if oneofField.kind == nkField:
           let fieldName = oneofField.name
-          var protoType = oneofField.value
-
-          var typeWasRenamed = false
-          for (origName, qualName) in nestedTypeMap:
-            if protoType == origName:
-              protoType = qualName
-              typeWasRenamed = true
-          if node.reanamedTypeNamesInScope.len > 0 and
-              node.reanamedTypeNamesInScope.hasKey(protoType):
-            protoType = node.reanamedTypeNamesInScope[protoType]
-            typeWasRenamed = true
-          else:
-            let root = getRoot(node)
-            if root.globalTypeMap.hasKey(protoType):
-              protoType = root.globalTypeMap[protoType]
-              typeWasRenamed = true
-
-          let pkgPrefix = if typeWasRenamed: "" else: packagePrefix
+          let (protoType, nimType) = resolveFieldType(node, oneofField.value,
+              nestedTypeMap, packagePrefix)
+          let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
 
           let condition = "node.hasKey(\"" & fieldName & "\")"
           let keyword = if firstField: "  if " else: "  elif "
           firstField = false
 
           result &= indentStr & keyword & condition & ":\n"
+          result &= indentStr & "    result.set" & capitalizeTypeName(oneofName) &
+              "Kind(rk" & capitalizeTypeName(fieldName) & ")\n"
+          result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
+              " = " & jsonValueExpr(oneofField.value, nimType, isEnum,
+                  "node[\"" & fieldName & "\"]") & "\n"
 
-          case oneofField.value
-          of "string":
-            result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = node[\"" & fieldName & "\"].getStr\n"
-          of "int32", "int64":
-            result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = " & protoTypeToNim(oneofField.value, false, packagePrefix) &
-                "(node[\"" & fieldName & "\"].getInt)\n"
-          of "uint32", "uint64":
-            result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = " & protoTypeToNim(oneofField.value, false, packagePrefix) &
-                "(node[\"" & fieldName & "\"].getInt)\n"
-          of "bool":
-            result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = node[\"" & fieldName & "\"].getBool\n"
-          of "float", "double":
-            result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = " & protoTypeToNim(oneofField.value, false, packagePrefix) &
-                "(node[\"" & fieldName & "\"].getFloat)\n"
-          else:
-            let nimType = protoTypeToNim(protoType, false, pkgPrefix)
-            result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-                "Kind") & " = rk" & capitalizeTypeName(fieldName) & "\n"
-            # For enums or messages, use fromJson
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = fromJson(" & nimType & ", node[\"" & fieldName & "\"])\n"
-
-      if not firstField:
-        result &= indentStr & "  else:\n"
-        result &= indentStr & "    result." & escapeNimKeyword(oneofName &
-            "Kind") & " = rkNone\n"
   else:
     result &= indentStr & "  discard\n"
-    # Regular fields
-    for child in node.children:
-      if child.kind == nkField:
-        let fieldName = child.name
-        var protoType = child.value
-        let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
 
-        var typeWasRenamed = false
-        for (origName, qualName) in nestedTypeMap:
-          if protoType == origName:
-            protoType = qualName
-            typeWasRenamed = true
-        if node.reanamedTypeNamesInScope.len > 0 and
-            node.reanamedTypeNamesInScope.hasKey(protoType):
-          protoType = node.reanamedTypeNamesInScope[protoType]
-          typeWasRenamed = true
-        else:
-          let root = getRoot(node)
-          if root.globalTypeMap.hasKey(protoType):
-            protoType = root.globalTypeMap[protoType]
-            typeWasRenamed = true
-
-        let pkgPrefix = if typeWasRenamed: "" else: packagePrefix
+  # Regular fields are read whether or not the message has oneofs
+  for child in node.children:
+    if child.kind == nkField and child.name notin oneofFieldNames:
+      let fieldName = child.name
+      let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
+      let (protoType, nimType) = resolveFieldType(node, child.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
 
-        result &= indentStr & "  if node.hasKey(\"" & fieldName & "\"):\n"
-
-        if isRepeated:
-          result &= indentStr & "    for item in node[\"" & fieldName & "\"]:\n"
-          case child.value
-          of "string":
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & ".add(item.getStr())\n"
-          of "int32", "int64":
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & ".add(" & protoTypeToNim(child.value, false,
-                    packagePrefix) & "(item.getInt()))\n"
-          of "uint32", "uint64":
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & ".add(" & protoTypeToNim(child.value, false,
-                    packagePrefix) & "(item.getInt()))\n"
-          of "bool":
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & ".add(item.getBool())\n"
-          of "float", "double":
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & ".add(" & protoTypeToNim(child.value, false,
-                    packagePrefix) & "(item.getFloat()))\n"
-          else:
-            let nimType = protoTypeToNim(protoType, false, pkgPrefix)
-            result &= indentStr & "      result." & escapeNimKeyword(
-                fieldName) & ".add(fromJson(" & nimType & ", item))\n"
-        else:
-          case child.value
-          of "string":
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = node[\"" & fieldName & "\"].getStr()\n"
-          of "int32", "int64":
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = " & protoTypeToNim(child.value, false, packagePrefix) &
-                    "(node[\"" & fieldName & "\"].getInt())\n"
-          of "uint32", "uint64":
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = " & protoTypeToNim(child.value, false, packagePrefix) &
-                    "(node[\"" & fieldName & "\"].getInt())\n"
-          of "bool":
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = node[\"" & fieldName & "\"].getBool()\n"
-          of "float", "double":
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = " & protoTypeToNim(child.value, false, packagePrefix) &
-                    "(node[\"" & fieldName & "\"].getFloat())\n"
-          else:
-            let nimType = protoTypeToNim(protoType, false, pkgPrefix)
-            result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
-                " = fromJson(" & nimType & ", node[\"" & fieldName & "\"])\n"
+      result &= indentStr & "  if node.hasKey(\"" & fieldName & "\"):\n"
 
-      elif child.kind == nkMapField:
-        let fieldName = child.name
-        let parts = child.value.split(",")
-        var keyType = parts[0].strip()
-        var valType = parts[1].strip()
-        if node.reanamedTypeNamesInScope.len > 0 and
-            node.reanamedTypeNamesInScope.hasKey(valType):
-          valType = node.reanamedTypeNamesInScope[valType]
-        let keyNimType = protoTypeToNim(keyType, false, packagePrefix)
-        let valNimType = protoTypeToNim(valType, false, packagePrefix)
-
-        result &= indentStr & "  if node.hasKey(\"" & fieldName & "\"):\n"
-        result &= indentStr & "    for keyStr, valNode in node[\"" & fieldName & "\"]:\n"
-
-        # Parse Key
-        var keyParser = ""
-        case keyType
-        of "string": keyParser = "keyStr"
-        of "int32", "int64", "uint32", "uint64", "sint32", "sint64", "fixed32",
-            "fixed64", "sfixed32", "sfixed64":
-          keyParser = keyNimType & "(parseInt(keyStr))"
-        of "bool": keyParser = "parseBool(keyStr)"
-        else: keyParser = "keyStr"
-
-        result &= indentStr & "      let key = " & keyParser & "\n"
+      if isRepeated:
+        result &= indentStr & "    for item in node[\"" & fieldName & "\"]:\n"
+        result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
+            ".add(" & jsonValueExpr(child.value, nimType, isEnum, "item") & ")\n"
+      else:
+        result &= indentStr & "    result." & escapeNimKeyword(fieldName) &
+            " = " & jsonValueExpr(child.value, nimType, isEnum,
+                "node[\"" & fieldName & "\"]") & "\n"
+    elif child.kind == nkMapField:
+      let fieldName = child.name
+      let parts = child.value.split(",")
+      var keyType = parts[0].strip()
+      var valType = parts[1].strip()
+      if node.reanamedTypeNamesInScope.len > 0 and
+          node.reanamedTypeNamesInScope.hasKey(valType):
+        valType = node.reanamedTypeNamesInScope[valType]
+      let keyNimType = protoTypeToNim(keyType, false, packagePrefix)
+      let valNimType = protoTypeToNim(valType, false, packagePrefix)
 
-        # Parse Value
-        var valParser = ""
-        case valType
-        of "string": valParser = "valNode.getStr()"
-        of "int32", "int64", "uint32", "uint64", "sint32", "sint64", "fixed32",
-            "fixed64", "sfixed32", "sfixed64":
-          valParser = valNimType & "(valNode.getInt())"
-        of "bool": valParser = "valNode.getBool()"
-        of "float", "double": valParser = valNimType & "(valNode.getFloat())"
-        else:
-          valParser = "fromJson(" & valNimType & ", valNode)"
+      result &= indentStr & "  if node.hasKey(\"" & fieldName & "\"):\n"
+      result &= indentStr & "    for keyStr, valNode in node[\"" & fieldName & "\"]:\n"
+
+      # Parse Key
+      var keyParser = ""
+      case keyType
+      of "string": keyParser = "keyStr"
+      of "int32", "int64", "uint32", "uint64", "sint32", "sint64", "fixed32",
+          "fixed64", "sfixed32", "sfixed64":
+        keyParser = keyNimType & "(parseInt(keyStr))"
+      of "bool": keyParser = "parseBool(keyStr)"
+      else: keyParser = "keyStr"
+
+      result &= indentStr & "      let key = " & keyParser & "\n"
+
+      # Parse Value
+      var valParser = ""
+      case valType
+      of "string": valParser = "valNode.getStr()"
+      of "int32", "int64", "uint32", "uint64", "sint32", "sint64", "fixed32",
+          "fixed64", "sfixed32", "sfixed64":
+        valParser = valNimType & "(valNode.getInt())"
+      of "bool": valParser = "valNode.getBool()"
+      of "float", "double": valParser = valNimType & "(valNode.getFloat())"
+      else:
+        valParser = "fromJson(" & valNimType & ", valNode)"
 
+      if mapReprOf(child, options) == mrSortedSeq:
+        result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
+            ".put(key, " & valParser & ")\n"
+      else:
         result &= indentStr & "      result." & escapeNimKeyword(fieldName) &
             "[key] = " & valParser & "\n"
 
   result &= "\n"
 
+  if options.tableDriven:
+    # Unrolled messages get a table too, as table-driven messages encode
+    # their nested messages through it
+    result &= generateMessageTable(node, typeName, nestedTypeMap, enumNames,
+        packagePrefix, oneofFields, indentStr, options)
+
   result &= "\n"
 
+proc generateViewProcs(node: ProtoNode, typeName: string,
+    nestedTypeMap: seq[(string, string)], enumNames: HashSet[string],
+        packagePrefix: string = "", checkDefined: bool = false,
+        options: CodegenOptions = CodegenOptions()): string =
+  ## Generate the `<Msg>View` alias and lazy field accessors over ProtoView.
+  ## Table-driven messages read their values through `viewValue`.
+  result = ""
+  let tableDriven = options.tableDriven and not isUnrolled(node)
+  if checkDefined:
+    result &= "when declared(Defined_" & typeName & "):\n"
+
+  let indentStr = if checkDefined: "  " else: ""
+  let viewType = "ProtoView[" & typeName & "]"
+
+  result &= indentStr & "# Lazy view accessors for " & typeName & "\n"
+  result &= indentStr & "type " & typeName & "View* = " & viewType & "\n\n"
+
+  var fields: seq[ProtoNode] = @[]
+  for child in node.children:
+    if child.kind == nkField:
+      fields.add(child)
+    elif child.kind == nkOneof:
+      for oneofField in child.children:
+        if oneofField.kind == nkField:
+          fields.add(oneofField)
+      # Which member of the oneof is set: the last one on the wire wins
+      let oneofKindName = typeName & capitalizeTypeName(child.name) & "Kind"
+      result &= indentStr & "proc " & escapeNimKeyword(child.name & "Kind") &
+          "*(v: " & viewType & "): " & oneofKindName & " =\n"
+      if tableDriven:
+        var numbers: seq[string]
+        for oneofField in child.children:
+          if oneofField.kind == nkField:
+            numbers.add($oneofField.number)
+        result &= indentStr & "  " & oneofKindName & "(viewOneof(v, [" &
+            numbers.join(", ") & "]))\n\n"
+        continue
+      result &= indentStr & "  result = rkNone\n"
+      result &= indentStr & "  for f in viewFields(v):\n"
+      result &= indentStr & "    case f.number\n"
+      for oneofField in child.children:
+        if oneofField.kind == nkField:
+          result &= indentStr & "    of " & $oneofField.number & ": result = rk" &
+              capitalizeTypeName(oneofField.name) & "\n"
+      result &= indentStr & "    else: discard\n\n"
+
+  for field in fields:
+    let fieldNum = field.number
+    let accessor = escapeNimKeyword(field.name)
+    let isRepeated = field.attrs.anyIt(it.name == "label" and it.value == "repeated")
+    let (protoType, nimType) = resolveFieldType(node, field.value,
+        nestedTypeMap, packagePrefix)
+    let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+    let decodeProc = getDecodeProc(field.value)
+    # Expression decoding one value at `p` in the shared buffer
+    let decodeExpr = if isEnum:
+      nimType & "(decodeInt32(viewBuffer(v)[], p))"
+    else:
+      decodeProc & "(viewBuffer(v)[], p)"
+    let isMessage = decodeProc.len == 0 and not isEnum
+    let kind = fieldKindName(field.value, isEnum)
+
+    if tableDriven and not isMessage:
+      if not isRepeated:
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType & "): " &
+            nimType & " =\n"
+        result &= indentStr & "  viewValue(v, " & $fieldNum & ", " & kind & ", " &
+            nimType & ")\n\n"
+      elif protoType == "string" or protoType == "bytes":
+        result &= indentStr & "proc " & field.name & "Len*(v: " & viewType &
+            "): int =\n"
+        result &= indentStr & "  viewFieldCount(v, " & $fieldNum & ")\n\n"
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType &
+            ", i: int): " & nimType & " =\n"
+        result &= indentStr & "  viewValue(v, " & $fieldNum & ", i, " & kind &
+            ", " & nimType & ")\n\n"
+      else:
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType & "): seq[" &
+            nimType & "] =\n"
+        result &= indentStr & "  viewValues(v, " & $fieldNum & ", " & kind & ", " &
+            nimType & ")\n\n"
+      continue
+
+    if not isRepeated:
+      if isMessage:
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType &
+            "): ProtoView[" & nimType & "] =\n"
+        result &= indentStr & "  subView(v, " & nimType & ", " & $fieldNum & ")\n\n"
+      else:
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType & "): " &
+            nimType & " =\n"
+        result &= indentStr & "  var p = viewFieldPos(v, " & $fieldNum & ")\n"
+        result &= indentStr & "  if p >= 0:\n"
+        result &= indentStr & "    result = " & decodeExpr & "\n\n"
+    elif isMessage or protoType == "string" or protoType == "bytes":
+      # Repeated length-delimited values are read one at a time by index
+      result &= indentStr & "proc " & field.name & "Len*(v: " & viewType &
+          "): int =\n"
+      result &= indentStr & "  viewFieldCount(v, " & $fieldNum & ")\n\n"
+      if isMessage:
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType &
+            ", i: int): ProtoView[" & nimType & "] =\n"
+        result &= indentStr & "  subView(v, " & nimType & ", " & $fieldNum & ", i)\n\n"
+      else:
+        result &= indentStr & "proc " & accessor & "*(v: " & viewType &
+            ", i: int): " & nimType & " =\n"
+        result &= indentStr & "  var p = viewField(v, " & $fieldNum & ", i).valuePos\n"
+        result &= indentStr & "  result = " & decodeExpr & "\n\n"
+    else:
+      # Repeated scalars may arrive packed, unpacked, or split over several runs
+      result &= indentStr & "proc " & accessor & "*(v: " & viewType & "): seq[" &
+          nimType & "] =\n"
+      result &= indentStr & "  for f in viewFields(v, " & $fieldNum & "):\n"
+      result &= indentStr & "    if f.wireType == wtLengthDelimited:\n"
+      result &= indentStr & "      " & getPackedDecodeProc(field.value) &
+          "(viewBuffer(v)[].toOpenArray(f.payload.a, f.payload.b), result)\n"
+      result &= indentStr & "    else:\n"
+      result &= indentStr & "      var p = f.valuePos\n"
+      result &= indentStr & "      result.add(" & decodeExpr & ")\n\n"
+
+  # Map fields have no view accessor; use toMessage() to decode them
+
+proc jsonWriteStmt(protoType, nimType: string, isEnum: bool,
+    valueExpr: string): string =
+  ## Statement appending one value to `buf` in the `toJson` format
+  case protoType
+  of "string": "buf.writeJsonString(" & valueExpr & ")"
+  of "bytes": "buf.writeJsonBytes(" & valueExpr & ")"
+  of "bool": "buf.writeJsonBool(" & valueExpr & ")"
+  of "int32", "int64", "uint32", "sint32", "sint64", "fixed32", "sfixed32",
+      "sfixed64":
+    "buf.writeJsonInt(BiggestInt(" & valueExpr & "))"
+  of "uint64", "fixed64": "buf.writeJsonUInt(" & valueExpr & ")"
+  of "float", "double": "buf.writeJsonFloat(float(" & valueExpr & "))"
+  else:
+    if isEnum:
+      "buf.writeJsonInt(BiggestInt(" & valueExpr & "))"
+    else:
+      valueExpr & ".toJsonString(buf)"
+
+proc jsonReadStmt(protoType, nimType: string, isEnum: bool,
+    target: string): string =
+  ## Statement reading the parser's current value into `target`
+  case protoType
+  of "string": "p.readJsonString(" & target & ")"
+  of "bytes": "p.readJsonBytes(" & target & ")"
+  of "bool": target & " = p.readJsonBool()"
+  of "int32", "int64", "uint32", "sint32", "sint64", "fixed32", "sfixed32",
+      "sfixed64":
+    target & " = " & nimType & "(p.readJsonInt())"
+  of "uint64", "fixed64": target & " = p.readJsonUInt()"
+  of "float", "double": target & " = " & nimType & "(p.readJsonFloat())"
+  else:
+    if isEnum:
+      target & " = " & nimType & "(p.readJsonInt())"
+    else:
+      "p.readJson(" & target & ")"
+
+proc generateJsonStreamProcs(node: ProtoNode, typeName: string,
+    nestedTypeMap: seq[(string, string)], enumNames: HashSet[string],
+        packagePrefix: string = "", checkDefined: bool = false,
+        options: CodegenOptions = CodegenOptions()): string =
+  ## Generate toJsonString, readJson, fromJsonString and transcodeToJson,
+  ## which write and parse the `toJson` format without building a JsonNode
+  ## tree
+  result = ""
+  if checkDefined:
+    result &= "when declared(Defined_" & typeName & "):\n"
+
+  let indentStr = if checkDefined: "  " else: ""
+
+  result &= indentStr & "# Streaming JSON procs for " & typeName & "\n"
+
+  var oneofFields: seq[ProtoNode] = @[]
+  for child in node.children:
+    if child.kind == nkOneof:
+      oneofFields.add(child)
+
+  # The overloads that wrap the others are the same in both modes
+  var wrappers = indentStr & "proc toJsonString*(self: " & typeName & "): string =\n"
+  wrappers &= indentStr & "  toJsonString(self, result)\n\n"
+  wrappers &= indentStr & "proc fromJsonString*(T: typedesc[" & typeName &
+      "], text: string): " & typeName & " =\n"
+  wrappers &= indentStr & "  var p: JsonParser\n"
+  wrappers &= indentStr & "  p.openJsonParser(text)\n"
+  wrappers &= indentStr & "  p.readJson(result)\n"
+  wrappers &= indentStr & "  p.closeJsonParser()\n\n"
+  wrappers &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte], buf: var string) =\n"
+  wrappers &= indentStr & "  var index: seq[FieldSpan]\n"
+  wrappers &= indentStr & "  transcodeToJson(T, data, buf, index)\n\n"
+  wrappers &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte]): string =\n"
+  wrappers &= indentStr & "  transcodeToJson(T, data, result)\n\n"
+
+  if options.tableDriven and not isUnrolled(node):
+    let table = "messageTable(" & typeName & ")"
+    result &= indentStr & "proc toJsonString*(self: " & typeName & ", buf: var string) =\n"
+    result &= indentStr & "  tableWriteJson(" & table & ", unsafeAddr self, buf)\n\n"
+    result &= indentStr & "proc readJson*(p: var JsonParser, self: var " & typeName & ") =\n"
+    result &= indentStr & "  tableReadJson(" & table & ", addr self, p)\n\n"
+    result &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+        "], data: openArray[byte], buf: var string, index: var seq[FieldSpan]) =\n"
+    result &= indentStr & "  tableTranscodeJson(" & table & ", data, buf, index)\n\n"
+    return result & wrappers
+
+  # ==========================================
+  # toJsonString procs
+  # ==========================================
+  # Fields are written in the order and with the omissions of toJson:
+  # the set oneof members first, then every regular field that isn't at
+  # its default value.
+  result &= indentStr & "proc toJsonString*(self: " & typeName & ", buf: var string) =\n"
+  result &= indentStr & "  buf.add('{')\n"
+  result &= indentStr & "  let objStart {.used.} = buf.len\n"
+
+  for oneofNode in oneofFields:
+    result &= indentStr & "  case self." & escapeNimKeyword(oneofNode.name & "Kind") & "\n"
+    result &= indentStr & "  of rkNone: discard\n"
+    for oneofField in oneofNode.children:
+      if oneofField.kind == nkField:
+        let (protoType, nimType) = resolveFieldType(node, oneofField.value,
+            nestedTypeMap, packagePrefix)
+        let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+        result &= indentStr & "  of rk" & capitalizeTypeName(oneofField.name) & ":\n"
+        result &= indentStr & "    buf.writeJsonKey(objStart, \"" & oneofField.name & "\")\n"
+        result &= indentStr & "    " & jsonWriteStmt(oneofField.value, nimType, isEnum,
+            "self." & escapeNimKeyword(oneofField.name)) & "\n"
+
+  for child in node.children:
+    if child.kind == nkField:
+      let field = "self." & escapeNimKeyword(child.name)
+      let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
+      let (protoType, nimType) = resolveFieldType(node, child.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+      let isMessage = getDecodeProc(child.value).len == 0 and not isEnum
+      let writeKey = "buf.writeJsonKey(objStart, \"" & child.name & "\")"
+
+      if isRepeated:
+        result &= indentStr & "  if " & field & ".len > 0:\n"
+        result &= indentStr & "    " & writeKey & "\n"
+        result &= indentStr & "    buf.add('[')\n"
+        result &= indentStr & "    for i, item in " & field & ":\n"
+        result &= indentStr & "      if i > 0: buf.add(',')\n"
+        result &= indentStr & "      " & jsonWriteStmt(child.value, nimType, isEnum,
+            "item") & "\n"
+        result &= indentStr & "    buf.add(']')\n"
+      elif isMessage:
+        # Dropped again if the nested message writes nothing
+        result &= indentStr & "  block:\n"
+        result &= indentStr & "    let mark = buf.len\n"
+        result &= indentStr & "    " & writeKey & "\n"
+        result &= indentStr & "    let valueStart = buf.len\n"
+        result &= indentStr & "    " & field & ".toJsonString(buf)\n"
+        result &= indentStr & "    if buf.len == valueStart + 2:\n"
+        result &= indentStr & "      buf.setLen(mark)\n"
+      else:
+        let condition = case child.value
+          of "string", "bytes": field & ".len > 0"
+          of "bool": field
+          else:
+            if isEnum: "int(" & field & ") != 0" else: field & " != 0"
+        result &= indentStr & "  if " & condition & ":\n"
+        result &= indentStr & "    " & writeKey & "\n"
+        result &= indentStr & "    " & jsonWriteStmt(child.value, nimType, isEnum,
+            field) & "\n"
+
+    elif child.kind == nkMapField:
+      let field = "self." & escapeNimKeyword(child.name)
+      let parts = child.value.split(",")
+      var valType = parts[1].strip()
+      if node.reanamedTypeNamesInScope.len > 0 and
+          node.reanamedTypeNamesInScope.hasKey(valType):
+        valType = node.reanamedTypeNamesInScope[valType]
+      let valNimType = protoTypeToNim(valType, false, packagePrefix)
+      let isEnum = enumNames.contains(valType) or enumNames.contains(valNimType)
+      result &= indentStr & "  if " & field & ".len > 0:\n"
+      result &= indentStr & "    buf.writeJsonKey(objStart, \"" & child.name & "\")\n"
+      result &= indentStr & "    buf.add('{')\n"
+      result &= indentStr & "    let mapStart = buf.len\n"
+      result &= indentStr & "    " & mapLoop(mapReprOf(child, options), field) & "\n"
+      result &= indentStr & "      buf.writeJsonKey(mapStart, $key)\n"
+      result &= indentStr & "      " & jsonWriteStmt(valType, valNimType, isEnum,
+          "val") & "\n"
+      result &= indentStr & "    buf.add('}')\n"
+
+  result &= indentStr & "  buf.add('}')\n\n"
+
+  # ==========================================
+  # readJson and fromJsonString procs
+  # ==========================================
+  # readJson merges the object under the parser's current token into `self`.
+  # Unknown keys and null values are skipped.
+  result &= indentStr & "proc readJson*(p: var JsonParser, self: var " & typeName & ") =\n"
+  result &= indentStr & "  var key: string\n"
+  if node.children.anyIt(it.kind == nkMapField):
+    result &= indentStr & "  var mapKey: string\n"
+  result &= indentStr & "  p.expectJson(jsonObjectStart)\n"
+  result &= indentStr & "  while p.kind != jsonObjectEnd:\n"
+  result &= indentStr & "    p.readJsonKey(key)\n"
+  result &= indentStr & "    if p.kind == jsonNull:\n"
+  result &= indentStr & "      p.next()\n"
+  result &= indentStr & "      continue\n"
+  result &= indentStr & "    case key\n"
+
+  for oneofNode in oneofFields:
+    for oneofField in oneofNode.children:
+      if oneofField.kind == nkField:
+        let (protoType, nimType) = resolveFieldType(node, oneofField.value,
+            nestedTypeMap, packagePrefix)
+        let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+        result &= indentStr & "    of \"" & oneofField.name & "\":\n"
+        result &= indentStr & "      self.set" & capitalizeTypeName(oneofNode.name) &
+            "Kind(rk" & capitalizeTypeName(oneofField.name) & ")\n"
+        result &= indentStr & "      " & jsonReadStmt(oneofField.value, nimType,
+            isEnum, "self." & escapeNimKeyword(oneofField.name)) & "\n"
+
+  for child in node.children:
+    if child.kind == nkField:
+      let field = "self." & escapeNimKeyword(child.name)
+      let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
+      let (protoType, nimType) = resolveFieldType(node, child.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+      result &= indentStr & "    of \"" & child.name & "\":\n"
+      if isRepeated:
+        result &= indentStr & "      p.expectJson(jsonArrayStart)\n"
+        result &= indentStr & "      while p.kind != jsonArrayEnd:\n"
+        result &= indentStr & "        " & field & ".setLen(" & field & ".len + 1)\n"
+        result &= indentStr & "        " & jsonReadStmt(child.value, nimType, isEnum,
+            field & "[^1]") & "\n"
+        result &= indentStr & "      p.next()\n"
+      else:
+        result &= indentStr & "      " & jsonReadStmt(child.value, nimType, isEnum,
+            field) & "\n"
+
+    elif child.kind == nkMapField:
+      let field = "self." & escapeNimKeyword(child.name)
+      let parts = child.value.split(",")
+      let keyType = parts[0].strip()
+      var valType = parts[1].strip()
+      if node.reanamedTypeNamesInScope.len > 0 and
+          node.reanamedTypeNamesInScope.hasKey(valType):
+        valType = node.reanamedTypeNamesInScope[valType]
+      let keyNimType = protoTypeToNim(keyType, false, packagePrefix)
+      let valNimType = protoTypeToNim(valType, false, packagePrefix)
+      let isEnum = enumNames.contains(valType) or enumNames.contains(valNimType)
+      let keyExpr = case keyType
+        of "string": "mapKey"
+        of "bool": "parseBool(mapKey)"
+        of "uint64", "fixed64": "parseBiggestUInt(mapKey)"
+        else: keyNimType & "(parseBiggestInt(mapKey))"
+      result &= indentStr & "    of \"" & child.name & "\":\n"
+      result &= indentStr & "      p.expectJson(jsonObjectStart)\n"
+      result &= indentStr & "      while p.kind != jsonObjectEnd:\n"
+      result &= indentStr & "        p.readJsonKey(mapKey)\n"
+      result &= indentStr & "        var val: " & valNimType & "\n"
+      result &= indentStr & "        " & jsonReadStmt(valType, valNimType, isEnum,
+          "val") & "\n"
+      if mapReprOf(child, options) == mrSortedSeq:
+        result &= indentStr & "        " & field & ".add((" & keyExpr & ", val))\n"
+        result &= indentStr & "      sortEntries(" & field & ")\n"
+      else:
+        result &= indentStr & "        " & field & "[" & keyExpr & "] = val\n"
+      result &= indentStr & "      p.next()\n"
+
+  result &= indentStr & "    else:\n"
+  result &= indentStr & "      p.skipJsonValue()\n"
+  result &= indentStr & "  p.next()\n\n"
+
+  # ==========================================
+  # transcodeToJson procs
+  # ==========================================
+  # Writes JSON text straight from the encoded bytes, in the same shape as
+  # toJsonString: set oneof member first, then regular fields in declaration
+  # order, last occurrence wins for singular fields. The field index is one
+  # seq shared by all nesting levels; each level appends its spans, then a
+  # copy of them grouped by field number, and truncates both when done.
+  let spanData = "data.toOpenArray(f.payload.a, f.payload.b)"
+  var fieldNumbers: seq[int]
+  for child in node.children:
+    if child.kind in {nkField, nkMapField}:
+      fieldNumbers.add(child.number)
+    elif child.kind == nkOneof:
+      for oneofField in child.children:
+        if oneofField.kind == nkField:
+          fieldNumbers.add(oneofField.number)
+  fieldNumbers.sort()
+  # The group of field `number`: its occurrences are index[g.start ..< g.start + g.count]
+  proc group(number: int): string =
+    "groups[" & $fieldNumbers.binarySearch(number) & "]"
+
+  result &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte], buf: var string, index: var seq[FieldSpan]) =\n"
+  result &= indentStr & "  let base = index.len\n"
+  result &= indentStr & "  indexFields(data, index)\n"
+  if fieldNumbers.len > 0:
+    result &= indentStr & "  const numbers = [" & fieldNumbers.join(", ") & "]\n"
+    result &= indentStr & "  var groups: array[numbers.len, FieldGroup]\n"
+    result &= indentStr & "  groupFieldSpans(index, base, numbers, groups)\n"
+  result &= indentStr & "  buf.add('{')\n"
+  result &= indentStr & "  let objStart {.used.} = buf.len\n"
+
+  # Writes the value of span `f`, read from `data`
+  proc spanWriteStmt(protoType, nimType: string, isEnum: bool,
+      data: string): string =
+    let payload = data & ".toOpenArray(f.payload.a, f.payload.b)"
+    case protoType
+    of "string": "buf.writeJsonString(" & payload & ")"
+    of "bytes": "buf.writeJsonBytes(" & payload & ")"
+    else:
+      if isEnum or getDecodeProc(protoType).len > 0:
+        let decode = if isEnum: "decodeInt32" else: getDecodeProc(protoType)
+        "(var q = f.valuePos; " & jsonWriteStmt(protoType, nimType, isEnum,
+            decode & "(" & data & ", q)") & ")"
+      else:
+        "transcodeToJson(" & nimType & ", " & payload & ", buf, index)"
+
+  for oneofNode in oneofFields:
+    var numbers: seq[string]
+    for oneofField in oneofNode.children:
+      if oneofField.kind == nkField:
+        numbers.add($oneofField.number)
+    # The member whose last occurrence comes last on the wire wins
+    result &= indentStr & "  block:\n"
+    result &= indentStr & "    var last = -1\n"
+    for number in numbers:
+      let g = group(parseInt(number))
+      result &= indentStr & "    if " & g & ".count > 0:\n"
+      result &= indentStr & "      let i = " & g & ".start + " & g & ".count - 1\n"
+      result &= indentStr & "      if last < 0 or index[i].valuePos > index[last].valuePos: last = i\n"
+    result &= indentStr & "    if last >= 0:\n"
+    result &= indentStr & "      let f = index[last]\n"
+    result &= indentStr & "      case f.number\n"
+    for oneofField in oneofNode.children:
+      if oneofField.kind == nkField:
+        let (protoType, nimType) = resolveFieldType(node, oneofField.value,
+            nestedTypeMap, packagePrefix)
+        let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+        result &= indentStr & "      of " & $oneofField.number & ":\n"
+        result &= indentStr & "        buf.writeJsonKey(objStart, \"" & oneofField.name & "\")\n"
+        result &= indentStr & "        " & spanWriteStmt(oneofField.value, nimType,
+            isEnum, "data") & "\n"
+    result &= indentStr & "      else: discard\n"
+
+  for child in node.children:
+    if child.kind == nkField:
+      let isRepeated = child.attrs.anyIt(it.name == "label" and it.value == "repeated")
+      let (protoType, nimType) = resolveFieldType(node, child.value,
+          nestedTypeMap, packagePrefix)
+      let isEnum = enumNames.contains(protoType) or enumNames.contains(nimType)
+      let decodeProc = if isEnum: "decodeInt32" else: getDecodeProc(child.value)
+      let isPackable = decodeProc.len > 0 and child.value notin ["string", "bytes"]
+      let writeKey = "buf.writeJsonKey(objStart, \"" & child.name & "\")"
+      result &= indentStr & "  block:\n"
+
+      if isRepeated:
+        let g = group(child.number)
+        result &= indentStr & "    var first = true\n"
+        result &= indentStr & "    for i in " & g & ".start ..< " & g & ".start + " & g & ".count:\n"
+        result &= indentStr & "      let f = index[i]\n"
+        let elementStart = "buf.writeJsonElementStart(objStart, \"" & child.name &
+            "\", first)"
+        if isPackable:
+          result &= indentStr & "      if f.wireType == wtLengthDelimited:\n"
+          result &= indentStr & "        template run: untyped = " & spanData & "\n"
+          result &= indentStr & "        var q = 0\n"
+          result &= indentStr & "        while q < run.len:\n"
+          result &= indentStr & "          " & elementStart & "\n"
+          result &= indentStr & "          " & jsonWriteStmt(child.value, nimType,
+              isEnum, decodeProc & "(run, q)") & "\n"
+          result &= indentStr & "        continue\n"
+        result &= indentStr & "      " & elementStart & "\n"
+        result &= indentStr & "      " & spanWriteStmt(child.value, nimType, isEnum,
+            "data") & "\n"
+        result &= indentStr & "    if not first: buf.add(']')\n"
+      else:
+        let g = group(child.number)
+        result &= indentStr & "    if " & g & ".count > 0:\n"
+        result &= indentStr & "      let f = index[" & g & ".start + " & g & ".count - 1]\n"
+        if child.value in ["string", "bytes"]:
+          result &= indentStr & "      if f.payload.len > 0:\n"
+          result &= indentStr & "        " & writeKey & "\n"
+          result &= indentStr & "        " & spanWriteStmt(child.value, nimType,
+              isEnum, "data") & "\n"
+        elif decodeProc.len > 0:
+          # Defaults are omitted, as in toJson
+          let condition = if child.value == "bool": "v" else: "v != 0"
+          result &= indentStr & "      var q = f.valuePos\n"
+          result &= indentStr & "      let v = " & decodeProc & "(data, q)\n"
+          result &= indentStr & "      if " & condition & ":\n"
+          result &= indentStr & "        " & writeKey & "\n"
+          result &= indentStr & "        " & jsonWriteStmt(child.value, nimType,
+              isEnum, "v") & "\n"
+        else:
+          # Dropped again if the nested message writes nothing
+          result &= indentStr & "      let mark = buf.len\n"
+          result &= indentStr & "      " & writeKey & "\n"
+          result &= indentStr & "      let valueStart = buf.len\n"
+          result &= indentStr & "      transcodeToJson(" & nimType & ", " & spanData &
+              ", buf, index)\n"
+          result &= indentStr & "      if buf.len == valueStart + 2:\n"
+          result &= indentStr & "        buf.setLen(mark)\n"
+
+    elif child.kind == nkMapField:
+      let parts = child.value.split(",")
+      let keyType = parts[0].strip()
+      var valType = parts[1].strip()
+      if node.reanamedTypeNamesInScope.len > 0 and
+          node.reanamedTypeNamesInScope.hasKey(valType):
+        valType = node.reanamedTypeNamesInScope[valType]
+      let keyNimType = protoTypeToNim(keyType, false, packagePrefix)
+      let valNimType = protoTypeToNim(valType, false, packagePrefix)
+      let isEnum = enumNames.contains(valType) or enumNames.contains(valNimType)
+      let valDecode = if isEnum: "decodeInt32" else: getDecodeProc(valType)
+      result &= indentStr & "  block:\n"
+      result &= indentStr & "    var first = true\n"
+      let g = group(child.number)
+      result &= indentStr & "    var key: " & keyNimType & "\n"
+      result &= indentStr & "    for i in " & g & ".start ..< " & g & ".start + " & g & ".count:\n"
+      result &= indentStr & "      let f = index[i]\n"
+      result &= indentStr & "      template entry: untyped = " & spanData & "\n"
+      result &= indentStr & "      reset(key)\n"
+      result &= indentStr & "      var valPos = -1\n"
+      result &= indentStr & "      var entryPos = 0\n"
+      result &= indentStr & "      while entryPos < entry.len:\n"
+      result &= indentStr & "        let (fNum, wType) = decodeFieldKey(entry, entryPos)\n"
+      result &= indentStr & "        case fNum\n"
+      if keyType == "string":
+        result &= indentStr & "        of 1: decodeStringInto(entry, entryPos, key)\n"
+      else:
+        result &= indentStr & "        of 1: key = " & getDecodeProc(keyType) & "(entry, entryPos)\n"
+      result &= indentStr & "        of 2:\n"
+      result &= indentStr & "          valPos = entryPos\n"
+      result &= indentStr & "          skipField(entry, entryPos, wType)\n"
+      result &= indentStr & "        else: skipField(entry, entryPos, wType)\n"
+      result &= indentStr & "      buf.writeJsonElementStart(objStart, \"" & child.name &
+          "\", first, '{')\n"
+      result &= indentStr & "      buf.writeJsonString(" &
+          (if keyType == "string": "key" else: "$key") & ")\n"
+      result &= indentStr & "      buf.add(':')\n"
+      if valDecode.len > 0 and valType notin ["string", "bytes"]:
+        result &= indentStr & "      var val: " & (if isEnum: "int32" else: valNimType) & "\n"
+        result &= indentStr & "      if valPos >= 0:\n"
+        result &= indentStr & "        var q = valPos\n"
+        result &= indentStr & "        val = " & valDecode & "(entry, q)\n"
+        result &= indentStr & "      " & jsonWriteStmt(valType, valNimType, isEnum,
+            "val") & "\n"
+      else:
+        # Absent values are written as the empty string, array or object
+        result &= indentStr & "      var valSpan = 0 .. -1\n"
+        result &= indentStr & "      if valPos >= 0:\n"
+        result &= indentStr & "        var q = valPos\n"
+        result &= indentStr & "        valSpan = decodeLengthDelimitedSpan(entry, q)\n"
+        let valData = "entry.toOpenArray(valSpan.a, valSpan.b)"
+        let stmt = case valType
+          of "string": "buf.writeJsonString(" & valData & ")"
+          of "bytes": "buf.writeJsonBytes(" & valData & ")"
+          else: "transcodeToJson(" & valNimType & ", " & valData & ", buf, index)"
+        result &= indentStr & "      " & stmt & "\n"
+      result &= indentStr & "    if not first: buf.add('}')\n"
+
+  result &= indentStr & "  buf.add('}')\n"
+  result &= indentStr & "  index.setLen(base)\n\n"
+  result &= wrappers
+
+proc generateEqualityProcs(node: ProtoNode, typeName: string,
+    checkDefined: bool = false,
+        options: CodegenOptions = CodegenOptions()): string =
+  ## Generate `==` and `hash`, which compare and hash the fields directly
+  ## so messages can be used as Table and HashSet keys
+  result = ""
+  if checkDefined:
+    result &= "when declared(Defined_" & typeName & "):\n"
+
+  let indentStr = if checkDefined: "  " else: ""
+
+  result &= indentStr & "# Equality and hashing for " & typeName & "\n"
+
+  if options.tableDriven and not isUnrolled(node):
+    # The table is a global, which the noSideEffect procs may read
+    let table = "messageTable(" & typeName & ")"
+    result &= indentStr & "proc `==`*(a, b: " & typeName & "): bool {.noSideEffect.} =\n"
+    result &= indentStr & "  {.cast(noSideEffect).}:\n"
+    result &= indentStr & "    result = tableEquals(" & table & ", unsafeAddr a, unsafeAddr b)\n\n"
+    result &= indentStr & "proc hash*(self: " & typeName & "): Hash {.noSideEffect.} =\n"
+    result &= indentStr & "  {.cast(noSideEffect).}:\n"
+    result &= indentStr & "    result = tableHash(" & table & ", unsafeAddr self)\n\n"
+    return
+
+  var oneofFields: seq[ProtoNode] = @[]
+  var fieldNames: seq[string] = @[]
+  var orderedMaps: seq[string] = @[]
+  for child in node.children:
+    case child.kind
+    of nkOneof:
+      oneofFields.add(child)
+    of nkField:
+      fieldNames.add(escapeNimKeyword(child.name))
+    of nkMapField:
+      # OrderedTable's own == and hash depend on insertion order
+      if mapReprOf(child, options) == mrOrderedTable:
+        orderedMaps.add(escapeNimKeyword(child.name))
+      else:
+        fieldNames.add(escapeNimKeyword(child.name))
+    else:
+      discard
+  if options.preserveUnknownFields:
+    fieldNames.add("unknownFields")
+
+  # Only the set member of a oneof takes part. Both procs are declared
+  # noSideEffect up front because recursive messages reach them through
+  # the seq and tuple `==`, which are funcs.
+  var eqCode = indentStr & "proc `==`*(a, b: " & typeName & "): bool {.noSideEffect.} =\n"
+  var hashCode = indentStr & "proc hash*(self: " & typeName & "): Hash {.noSideEffect.} =\n"
+  hashCode &= indentStr & "  var h: Hash = 0\n"
+  for field in fieldNames:
+    eqCode &= indentStr & "  if a." & field & " != b." & field & ": return false\n"
+    hashCode &= indentStr & "  h = h !& hash(self." & field & ")\n"
+  for field in orderedMaps:
+    eqCode &= indentStr & "  if not sameEntries(a." & field & ", b." & field & "): return false\n"
+    hashCode &= indentStr & "  h = h !& hashEntries(self." & field & ")\n"
+  for oneofNode in oneofFields:
+    let kindField = escapeNimKeyword(oneofNode.name & "Kind")
+    eqCode &= indentStr & "  if a." & kindField & " != b." & kindField & ": return false\n"
+    eqCode &= indentStr & "  case a." & kindField & "\n"
+    eqCode &= indentStr & "  of rkNone: discard\n"
+    hashCode &= indentStr & "  h = h !& hash(self." & kindField & ")\n"
+    hashCode &= indentStr & "  case self." & kindField & "\n"
+    hashCode &= indentStr & "  of rkNone: discard\n"
+    for oneofField in oneofNode.children:
+      if oneofField.kind == nkField:
+        let member = escapeNimKeyword(oneofField.name)
+        let branch = "rk" & capitalizeTypeName(oneofField.name)
+        eqCode &= indentStr & "  of " & branch & ":\n"
+        eqCode &= indentStr & "    if a." & member & " != b." & member & ": return false\n"
+        hashCode &= indentStr & "  of " & branch & ": h = h !& hash(self." & member & ")\n"
+  eqCode &= indentStr & "  result = true\n"
+  hashCode &= indentStr & "  result = !$h\n"
+
+  result &= eqCode & "\n"
+  result &= hashCode & "\n"
+
 proc collectEnums(node: ProtoNode, prefix: string = "", results: var HashSet[string]) =
   for child in node.children:
     case child.kind
@@ -1391,7 +2481,16 @@ proc generateEnumSerializationProcs*(enumName: string): string =
   ## Generate serialization procs for an enum type
   result = ""
 
-  # toBinary proc - encode enum as int32
+  # byteSize and toBinary procs - encode enum as int32
+  result &= "proc byteSize*(self: " & enumName & "): int =\n"
+  result &= "  result = sizeInt32(int32(self))\n\n"
+  result &= "proc toBinary*(self: " & enumName & ", buf: var seq[byte]) =\n"
+  result &= "  buf.writeInt32(int32(self))\n\n"
+  result &= "proc byteSize*(self: " & enumName & ", sizes: var seq[int]): int =\n"
+  result &= "  result = sizeInt32(int32(self))\n\n"
+  result &= "proc toBinary*(self: " & enumName &
+      ", buf: var seq[byte], sizes: openArray[int], pos: var int) =\n"
+  result &= "  buf.writeInt32(int32(self))\n\n"
   result &= "proc toBinary*(self: " & enumName & "): seq[byte] =\n"
   result &= "  result = encodeInt32(int32(self))\n\n"
 
@@ -1412,7 +2511,8 @@ proc generateEnumSerializationProcs*(enumName: string): string =
 
 proc generateAllSerializationProcs(node: ProtoNode, prefix: string = "",
     enumNames: HashSet[string], packagePrefix: string = "",
-        checkDefined: bool = false): string =
+        checkDefined: bool = false,
+        options: CodegenOptions = CodegenOptions()): string =
   result = ""
 
   let typeName = if prefix.len > 0:
@@ -1435,14 +2535,19 @@ proc generateAllSerializationProcs(node: ProtoNode, prefix: string = "",
           node.name else: node.name
       # Don't pass checkDefined to nested - they're always defined when parent is
       result &= generateAllSerializationProcs(child, childPrefix, enumNames,
-          packagePrefix, false)
+          packagePrefix, false, options)
     # FIX: Removing nkEnum loop here prevents duplicate proc generation
     else:
       discard
 
   # Generate for current message
   result &= generateSerializationProcs(node, typeName, nestedTypeMap, enumNames,
-      packagePrefix, checkDefined)
+      packagePrefix, checkDefined, options)
+  result &= generateViewProcs(node, typeName, nestedTypeMap, enumNames,
+      packagePrefix, checkDefined, options)
+  result &= generateJsonStreamProcs(node, typeName, nestedTypeMap, enumNames,
+      packagePrefix, checkDefined, options)
+  result &= generateEqualityProcs(node, typeName, checkDefined, options)
 
 proc generateService*(node: ProtoNode, packageName: string = ""): string =
   ## Generate gRPC client stub procedures from a service definition
@@ -1538,6 +2643,37 @@ proc generateService*(node: ProtoNode, packageName: string = ""): string =
         result &= "  for r in rawResps:\n"
         result &= "    result.add(" & respNimType & ".fromBinary(r))\n\n"
 
+      # Streaming RPCs also get stubs returning a GrpcCall. It decodes each
+      # response as it arrives, and `<rpc>Call` lets the caller produce the
+      # requests one `send` at a time.
+      if clientStreaming or serverStreaming:
+        let path = if packageName.len > 0: "/" & packageName & "." & node.name &
+            "/" & rpcName
+                   else: "/" & node.name & "/" & rpcName
+        let callType = "GrpcCall[" & reqNimType & ", " & respNimType & "]"
+        let startCall = "  let call = await startCall[" & reqNimType & ", " &
+            respNimType & "](c, \"" & path & "\", metadata)\n"
+        if clientStreaming:
+          result &= "proc " & procName & "Call*(c: GrpcChannel, metadata: seq[HpackHeader] = @[]): Future[" &
+              callType & "] {.async.} =\n"
+          result &= startCall
+          result &= "  return call\n\n"
+        if serverStreaming:
+          if clientStreaming:
+            result &= "proc " & procName & "Stream*(c: GrpcChannel, reqs: seq[" &
+                reqNimType & "], metadata: seq[HpackHeader] = @[]): Future[" &
+                callType & "] {.async.} =\n"
+            result &= startCall
+            result &= "  call.sendAll(reqs)\n"
+          else:
+            result &= "proc " & procName & "Stream*(c: GrpcChannel, req: " &
+                reqNimType & ", metadata: seq[HpackHeader] = @[]): Future[" &
+                callType & "] {.async.} =\n"
+            result &= startCall
+            result &= "  await call.send(req)\n"
+            result &= "  await call.closeSend()\n"
+          result &= "  return call\n\n"
+
       # Generate JSON returning version of the RPC
       let jsonProcName = procName & "Json"
 
@@ -1600,7 +2736,8 @@ proc generateService*(node: ProtoNode, packageName: string = ""): string =
         result &= "    result.add(toJson(" & respNimType & ", r))\n\n"
 
 proc generateForwardDeclarations(node: ProtoNode, prefix: string = "",
-    packagePrefix: string = "", checkDefined: bool = false): string =
+    packagePrefix: string = "", checkDefined: bool = false,
+    options: CodegenOptions = CodegenOptions()): string =
   result = ""
   let typeName = if prefix.len > 0:
     capitalizeTypeName(prefix & "_" & node.name)
@@ -1612,13 +2749,45 @@ proc generateForwardDeclarations(node: ProtoNode, prefix: string = "",
 
   let indentStr = if checkDefined: "  " else: ""
 
+  result &= indentStr & "proc byteSize*(self: " & typeName & ", sizes: var seq[int]): int\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName &
+      ", buf: var seq[byte], sizes: openArray[int], pos: var int)\n"
+  result &= indentStr & "proc byteSize*(self: " & typeName & "): int\n"
+  result &= indentStr & "proc toBinary*(self: " & typeName & ", buf: var seq[byte])\n"
   result &= indentStr & "proc toBinary*(self: " & typeName & "): seq[byte]\n"
+  result &= indentStr & "proc clear*(self: var " & typeName & ")\n"
+  result &= indentStr & "proc mergeFromBinary*(self: var " & typeName &
+      ", data: openArray[byte], fields: set[FieldNumber])\n"
+  result &= indentStr & "proc mergeFromBinary*(self: var " & typeName &
+      ", data: openArray[byte])\n"
+  result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
+      "], data: openArray[byte], fields: set[FieldNumber]): " & typeName & "\n"
   result &= indentStr & "proc fromBinary*(T: typedesc[" & typeName &
       "], data: openArray[byte]): " & typeName & "\n"
   result &= indentStr & "proc toJson*(self: " & typeName & "): JsonNode\n"
   result &= indentStr & "proc toJson*(T: typedesc[" & typeName & "], data: openArray[byte]): JsonNode\n"
   result &= indentStr & "proc fromJson*(T: typedesc[" & typeName &
       "], node: JsonNode): " & typeName & "\n"
+  result &= indentStr & "proc toJsonString*(self: " & typeName & ", buf: var string)\n"
+  result &= indentStr & "proc toJsonString*(self: " & typeName & "): string\n"
+  result &= indentStr & "proc readJson*(p: var JsonParser, self: var " & typeName & ")\n"
+  result &= indentStr & "proc fromJsonString*(T: typedesc[" & typeName &
+      "], text: string): " & typeName & "\n"
+  result &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte], buf: var string, index: var seq[FieldSpan])\n"
+  result &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte], buf: var string)\n"
+  result &= indentStr & "proc transcodeToJson*(T: typedesc[" & typeName &
+      "], data: openArray[byte]): string\n"
+  result &= indentStr & "proc `==`*(a, b: " & typeName & "): bool {.noSideEffect.}\n"
+  result &= indentStr & "proc hash*(self: " & typeName & "): Hash {.noSideEffect.}\n"
+  if options.tableDriven:
+    # The table is filled in with the serialization procs, see
+    # generateMessageTable
+    result &= indentStr & "proc messageTable*(T: typedesc[" & typeName &
+        "]): ptr MessageTable =\n"
+    result &= indentStr & "  var table {.global.}: MessageTable\n"
+    result &= indentStr & "  addr table\n"
   result &= "\n"
 
   # Recursively generate for nested messages
@@ -1627,12 +2796,30 @@ proc generateForwardDeclarations(node: ProtoNode, prefix: string = "",
       let childPrefix = if prefix.len > 0: prefix & "_" &
           node.name else: node.name
       # Don't pass checkDefined to nested - they're always defined when parent is
-      result &= generateForwardDeclarations(child, childPrefix, packagePrefix, false)
+      result &= generateForwardDeclarations(child, childPrefix, packagePrefix,
+          false, options)
 
-proc generateTypes*(ast: ProtoNode): string =
+proc packageAliases(node: ProtoNode, packagePrefix: string,
+    scope: string = ""): seq[string] =
+  ## `<package>_<Name>* = <Name>` for every message and enum declared in
+  ## `node`: the names the code generated for importing files refers to them by
+  for child in node.children:
+    if child.kind == nkMessage or child.kind == nkEnum:
+      let name = if scope.len > 0: scope & "_" & child.name else: child.name
+      result.add(capitalizeTypeName(packagePrefix & "_" & name) & "* = " &
+          capitalizeTypeName(name))
+      if child.kind == nkMessage:
+        result.add(packageAliases(child, packagePrefix, name))
+
+proc generateTypes*(ast: ProtoNode,
+    options: CodegenOptions = CodegenOptions(),
+    inlineImports: bool = true): string =
   ## Generate all type definitions from a Proto AST
   ## Returns Nim code as a string
   ##
+  ## With `inlineImports = false` the types of imported files are left out,
+  ## as they come from the modules of those files (see `generateModule`), and
+  ## the file's own types get aliases under their package-qualified names.
   ast.renameSubmessageTypeNames()
 
   result = "import nimproto3\n\n\n# Generated from protobuf\n"
@@ -1675,7 +2862,7 @@ proc generateTypes*(ast: ProtoNode): string =
               case importedNode.kind
               of nkMessage:
                 mainTypes.add(generateMessage(importedNode, packagePrefix,
-                    nestedTypes, packagePrefix))
+                    nestedTypes, packagePrefix, options))
               of nkEnum:
                 let enumName = capitalizeTypeName(packagePrefix & "_" &
                     importedNode.name)
@@ -1686,13 +2873,14 @@ proc generateTypes*(ast: ProtoNode): string =
                 discard
 
   # First, process all imports (including transitive imports)
-  processImports(ast, mainTypes, nestedTypes, implCode)
+  if inlineImports:
+    processImports(ast, mainTypes, nestedTypes, implCode)
 
   # Then process the main file's types
   for child in ast.children:
     case child.kind
     of nkMessage:
-      mainTypes.add(generateMessage(child, "", nestedTypes))
+      mainTypes.add(generateMessage(child, "", nestedTypes, "", options))
     of nkEnum:
       # Main file enums
       mainTypes.add(generateEnum(child))
@@ -1702,6 +2890,12 @@ proc generateTypes*(ast: ProtoNode): string =
     else:
       discard
 
+  if not inlineImports:
+    for child in ast.children:
+      if child.kind == nkPackage:
+        mainTypes.add(packageAliases(ast, child.name.replace(".", "_")))
+        break
+
   # Output Types
   if mainTypes.len > 0 or nestedTypes.len > 0:
     result &= "type\n"
@@ -1743,14 +2937,15 @@ proc generateTypes*(ast: ProtoNode): string =
             for importedNode in importedChild.children:
               if importedNode.kind == nkMessage:
                 result &= generateForwardDeclarations(importedNode,
-                    packagePrefix, packagePrefix, false)
+                    packagePrefix, packagePrefix, false, options)
 
-  result &= processImportsFwd(ast)
+  if inlineImports:
+    result &= processImportsFwd(ast)
 
   # Forward declarations for main messages
   for child in ast.children:
     if child.kind == nkMessage:
-      result &= generateForwardDeclarations(child, "", "", false)
+      result &= generateForwardDeclarations(child, "", "", false, options)
 
   result &= "\n"
 
@@ -1785,18 +2980,20 @@ proc generateTypes*(ast: ProtoNode): string =
               case importedNode.kind
               of nkMessage:
                 result &= generateAllSerializationProcs(importedNode,
-                    packagePrefix, enumNames, packagePrefix, false)
+                    packagePrefix, enumNames, packagePrefix, false, options)
               # FIX: Removed nkEnum here to avoid duplication
               else:
                 discard
 
-  result &= processImportsImpl(ast)
+  if inlineImports:
+    result &= processImportsImpl(ast)
 
   # Generate serialization procs for main messages (Enums handled in implCode)
   for child in ast.children:
     case child.kind
     of nkMessage:
-      result &= generateAllSerializationProcs(child, "", enumNames, "", false)
+      result &= generateAllSerializationProcs(child, "", enumNames, "", false,
+          options)
     # FIX: Removed nkEnum here to avoid duplication
     else:
       discard
@@ -1814,7 +3011,9 @@ proc generateTypes*(ast: ProtoNode): string =
 
 proc genCodeFromProtoString*(protoString: string, searchDirs: seq[string] = @[],
     extraImportPackages: seq[string] = @[], replaceCode: seq[tuple[
-        oldStr: string, newStr: string]] = @[]): string =
+        oldStr: string, newStr: string]] = @[],
+        options: CodegenOptions = CodegenOptions(),
+        cache: ref Table[string, ProtoNode] = nil): string =
   ## Generate Nim code from a protobuf string.
   ##
   ## Arguments:
@@ -1822,18 +3021,23 @@ proc genCodeFromProtoString*(protoString: string, searchDirs: seq[string] = @[],
   ## - `searchDirs`: A list of directories to search for imported .proto files.
   ## - `extraImportPackages`: A list of extra Nim packages to import in the generated code.
   ## - `replaceCode`: A list of string replacement rules to apply to the generated code.
+  ## - `options`: Code generation options, see `CodegenOptions`.
+  ## - `cache`: Parse cache; on return its keys are the paths of every
+  ##   imported file, directly or not.
   ##
   ## Returns:
   ## The generated Nim code as a string.
-  let ast = parseProto(protoString, searchDirs,
+  let ast = parseProto(protoString, searchDirs, cache,
       extraImportPackages = extraImportPackages)
-  result = generateTypes(ast)
+  result = generateTypes(ast, options)
   for (oldStr, newStr) in replaceCode:
     result = result.replace(oldStr, newStr)
 
 proc genCodeFromProtoFile*(filePath: string, searchDirs: seq[string] = @[],
     extraImportPackages: seq[string] = @[], replaceCode: seq[tuple[
-        oldStr: string, newStr: string]] = @[]): string =
+        oldStr: string, newStr: string]] = @[],
+        options: CodegenOptions = CodegenOptions(),
+        cache: ref Table[string, ProtoNode] = nil): string =
   ## Generate Nim code from a protobuf file.
   ##
   ## Arguments:
@@ -1841,6 +3045,9 @@ proc genCodeFromProtoFile*(filePath: string, searchDirs: seq[string] = @[],
   ## - `searchDirs`: A list of directories to search for imported .proto files.
   ## - `extraImportPackages`: A list of extra Nim packages to import in the generated code.
   ## - `replaceCode`: A list of string replacement rules to apply to the generated code.
+  ## - `options`: Code generation options, see `CodegenOptions`.
+  ## - `cache`: Parse cache; on return its keys are the paths of every
+  ##   imported file, directly or not.
   ##
   ## Returns:
   ## The generated Nim code as a string.
@@ -1849,8 +3056,133 @@ proc genCodeFromProtoFile*(filePath: string, searchDirs: seq[string] = @[],
 
   var fullSearchDirs = searchDirs
   fullSearchDirs.add(parentDir(filePath))
-  let ast = parseProto(readFile(filePath), fullSearchDirs,
+  let ast = parseProto(readFile(filePath), fullSearchDirs, cache,
       extraImportPackages = extraImportPackages)
-  result = generateTypes(ast)
+  result = generateTypes(ast, options)
   for (oldStr, newStr) in replaceCode:
     result = result.replace(oldStr, newStr)
+
+proc protoModulePath*(protoName: string): string =
+  ## Path, relative to the output directory and without extension, of the
+  ## module multi-file generation writes for proto file `protoName`, e.g.
+  ## `google/api/http.proto` -> `google/api/http_pb`
+  var parts = protoName.changeFileExt("").split({'/', '\\'})
+  for part in parts.mitems:
+    for c in part.mitems:
+      if c notin IdentChars:
+        c = '_'
+  parts[^1].add("_pb")
+  result = parts.join("/")
+
+proc moduleAlias(protoName: string): string =
+  protoModulePath(protoName).replace("/", "_")
+
+proc generateModule*(ast: ProtoNode, protoName: string,
+    options: CodegenOptions = CodegenOptions()): string =
+  ## Generate the module of one proto file for multi-file generation.
+  ##
+  ## Unlike `generateTypes`, the types of imported files are not inlined:
+  ## the module imports and re-exports the modules of the files `protoName`
+  ## imports, found next to it under `protoModulePath` names.
+  # The AST may have been walked as another file's import before
+  ast.parent = nil
+  ast.reanamedTypeNamesInScope.clear()
+  ast.globalTypeMap.clear()
+  let code = generateTypes(ast, options, inlineImports = false)
+
+  let moduleDir = protoModulePath(protoName).parentDir
+  var imports = ""
+  var seen = initHashSet[string]()
+  for child in ast.children:
+    if child.kind == nkImport and child.children.len > 0 and
+        not seen.containsOrIncl(child.value):
+      let path = relativePath(protoModulePath(child.value),
+          if moduleDir.len > 0: moduleDir else: ".", '/')
+      imports &= "import \"" & path & "\" as " & moduleAlias(child.value) & "\n"
+      imports &= "export " & moduleAlias(child.value) & "\n"
+  let header = "import nimproto3\n"
+  result = header & imports & code[header.len .. ^1]
+
+proc protoFileName(path: string, dirs: seq[string]): string =
+  ## Name of proto file `path` relative to the first of `dirs` containing it,
+  ## the name other files import it by
+  for dir in dirs:
+    let rel = relativePath(path, dir, '/')
+    if not rel.startsWith(".."):
+      return rel
+  result = path.extractFilename
+
+proc genModulesFromProtoFiles*(files: seq[string], outDir: string,
+    searchDirs: seq[string] = @[], extraImportPackages: seq[string] = @[],
+    replaceCode: seq[tuple[oldStr: string, newStr: string]] = @[],
+    options: CodegenOptions = CodegenOptions(), shard: int = 0,
+    shardCount: int = 1, claimDir: string = ""): seq[string] =
+  ## Generate one Nim module per proto file into `outDir`, for every file in
+  ## `files` and every file they import (see `generateModule`).
+  ##
+  ## Within one call each file is parsed and generated once, however many
+  ## files import it. A file is named relative to the first of `searchDirs`
+  ## containing it, or by its file name otherwise.
+  ##
+  ## With `shardCount` > 1 only every `shardCount`-th file of `files`,
+  ## starting at index `shard`, is generated, plus the imported files that
+  ## are not in `files`. Running every shard, e.g. in parallel processes,
+  ## gives the same modules as a single run. Generating a file needs the
+  ## parsed files it imports, so each shard parses the imports of its own
+  ## files, and an import shared by files of several shards is parsed by
+  ## each of them. It is generated and written by one shard only: the first
+  ## to create its entry in `claimDir`, a directory shared by all shards of
+  ## the run. Without `claimDir` every shard reaching it writes it.
+  ##
+  ## Returns the paths of the written modules.
+  var rootNames = initHashSet[string]()
+  var roots: seq[tuple[name, path: string]]
+  for file in files:
+    if not fileExists(file):
+      raise newException(ValueError, "File does not exist: " & file)
+    let name = protoFileName(file, searchDirs)
+    rootNames.incl(name)
+    roots.add((name, file))
+
+  # Shared by all files of this run, so every import is parsed once
+  let cache = newTable[string, ProtoNode]()
+  var done = initHashSet[string]()
+  var written: seq[string]
+
+  proc writeModule(name: string, ast: ProtoNode) =
+    var code = generateModule(ast, name, options)
+    for (oldStr, newStr) in replaceCode:
+      code = code.replace(oldStr, newStr)
+    let path = outDir / protoModulePath(name) & ".nim"
+    createDir(path.parentDir)
+    writeFile(path, code)
+    written.add(path)
+
+  proc claimed(name: string): bool =
+    ## Whether another shard generates the import `name`
+    if shardCount <= 1 or claimDir.len == 0:
+      return false
+    let claim = claimDir / protoModulePath(name)
+    createDir(claim.parentDir)
+    existsOrCreateDir(claim)
+
+  proc visit(name: string, ast: ProtoNode, isRoot: bool) =
+    if done.containsOrIncl(name):
+      return
+    for child in ast.children:
+      if child.kind == nkImport and child.children.len > 0 and
+          child.value notin rootNames:
+        visit(child.value, child.children[0], false)
+    if isRoot or not claimed(name):
+      writeModule(name, ast)
+
+  for i, root in roots:
+    if shardCount > 1 and i mod shardCount != shard:
+      continue
+    var fileDirs = searchDirs
+    fileDirs.add(root.path.parentDir)
+    if not cache.hasKey(root.path):
+      cache[root.path] = parseProto(readFile(root.path), fileDirs, cache,
+          extraImportPackages)
+    visit(root.name, cache[root.path], true)
+  result = written
@@ -1,37 +1,186 @@
-import std/[macros, strutils, json, tables, strformat, os]
-import ./[wire_format]
+import std/[macros, strutils, json, tables, hashes, strformat, os,
+        compilesettings]
+import ./[wire_format, view]
 
-export wire_format, json, tables, strutils, strformat
+export wire_format, view, json, tables, hashes, strutils, strformat
 
-proc importProtoImpl(file: string, searchDirs: seq[string],
-        extraImportPackages: seq[string], replaceCode: seq[tuple[oldStr: string,
-                newStr: string]] = @[]): NimNode =
-    # var cmdPath = staticExec("which protonim")
-    # if cmdPath.len == 0:
+const protoMapType {.strdefine.} = ""
+    ## Map field representation for the macros, e.g. `-d:protoMapType=sorted`
+
+const protoCacheDir {.strdefine.} = ""
+    ## Directory for generated code kept between builds, relative to the
+    ## main module. Defaults to `nimproto3` under the nimcache directory.
+    ## `-d:protoNoCache` turns the cache off.
+
+const protonimBin {.strdefine.} = ""
+    ## A prebuilt `protonim` for the macros to run, e.g.
+    ## `-d:protonimBin=/usr/local/bin/protonim`
+
+const generatedCodeEnd = "# End of generated code"
+    ## Last line of a complete cache entry
+
+const generatorSources = ["ast.nim", "parser.nim", "codegen.nim",
+        "../tools/protonim.nim"]
+    ## Sources of protonim, relative to this file
+
+const importLine = "# Imports "
+    ## Prefix of the lines `protonim --listImports` writes before the code,
+    ## and of the lines recording imported files in a cache entry
+
+proc generatedCodeKey(cmd, input, text: string): string {.compileTime.} =
+    ## Cache key for the code `cmd` generates: a hash of the command line,
+    ## `PROTO_PATH`, the generator sources and the root proto (file `input`,
+    ## or `text` when it is read from stdin). The files the root imports are
+    ## recorded in the entry, see `importsUnchanged`.
+    ## Returns "" if `input` can't be read, so that it is not cached.
+    var h: Hash = 0
+    h = h !& hash(cmd) !& hash(getEnv("PROTO_PATH"))
+    for source in generatorSources:
+        h = h !& hash(readFile(currentSourcePath().parentDir / source))
+    if input == "-":
+        h = h !& hash(text)
+    elif fileExists(input):
+        h = h !& hash(readFile(input))
+    else:
+        return ""
+    result = toHex(!$h)
+
+proc importRecords(output: string): string {.compileTime.} =
+    ## Cache entry lines for the imported files protonim listed in `output`,
+    ## each with a hash of the file's current content
+    for line in output.splitLines():
+        if line.startsWith(importLine):
+            let path = line[importLine.len .. ^1]
+            result.add(importLine & toHex(hash(readFile(path))) & " " & path & "\n")
+
+proc importsUnchanged(entry: string): bool {.compileTime.} =
+    ## Whether every imported file recorded in cache entry `entry` still has
+    ## the content it was generated from
+    for line in entry.splitLines():
+        if not line.startsWith(importLine):
+            break
+        let record = line[importLine.len .. ^1]
+        let sep = record.find(' ')
+        if sep < 0:
+            return false
+        let path = record[sep + 1 .. ^1]
+        if not fileExists(path) or
+                toHex(hash(readFile(path))) != record[0 ..< sep]:
+            return false
+    true
+
+proc protoCacheBase(): string {.compileTime.} =
+    ## Absolute cache directory; `staticExec` runs in this module's directory,
+    ## so a relative path would name a different place for the commands
+    if protoCacheDir.len == 0:
+        querySetting(nimcacheDir) / "nimproto3"
+    elif protoCacheDir.isAbsolute:
+        protoCacheDir
+    else:
+        getProjectPath() / protoCacheDir
+
+proc protonimExe(dir: string): string {.compileTime.} =
+    ## Path of the `protonim` binary the macros run. Unless `-d:protonimBin`
+    ## names one, it is built once per generator version into cache directory
+    ## `dir` and reused by every later import.
+    when protonimBin.len > 0:
+        return protonimBin
+    var h: Hash = 0
+    for source in generatorSources:
+        h = h !& hash(readFile(currentSourcePath().parentDir / source))
+    result = dir / addFileExt("protonim_" & toHex(!$h), ExeExt)
+    if fileExists(result):
+        return
+    createDir(dir)
+    # Build under a name of our own and rename it into place, so a parallel
+    # build never runs a half-written binary
+    let partial = dir / addFileExt("protonim_" & toHex(!$h) & "_" &
+            toHex(hash(querySetting(nimcacheDir))), ExeExt)
+    let protonimPath = currentSourcePath().parentDir.parentDir / "tools" /
+            "protonim.nim"
+    let buildCmd = quoteShell(getCurrentCompilerExe()) &
+            " c -d:release --hints:off --warnings:off -o:" &
+            quoteShell(partial) & " " & quoteShell(protonimPath)
+    echo "Building protonim: " & buildCmd
+    let (output, exitCode) = gorgeEx(buildCmd)
+    if exitCode != 0:
+        raise newException(ValueError, "Failed to build protonim:\n" & output)
     when defined(windows):
-        const protonimPath = currentSourcePath().parentDir() / "\\..\\tools\\protonim.nim"
+        let moveCmd = "powershell.exe -NoProfile -Command Move-Item -Force \"" &
+                partial & "\" \"" & result & "\""
     else:
-        const protonimPath = currentSourcePath().parentDir() & "/../tools/protonim.nim"
+        let moveCmd = "mv -f " & quoteShell(partial) & " " & quoteShell(result)
+    let (moveOutput, moveCode) = gorgeEx(moveCmd)
+    if moveCode != 0:
+        raise newException(ValueError, "Failed to install protonim:\n" & moveOutput)
 
-    var cmdPath = "nim r " & protonimPath
-    var cmd = cmdPath & " -i " & file
+proc generateProtoCode(input, text: string, searchDirs: seq[string],
+        extraImportPackages: seq[string], replaceCode: seq[tuple[oldStr: string,
+                newStr: string]]): NimNode {.compileTime.} =
+    ## Run protonim on proto file `input`, or on `text` passed through stdin
+    ## if `input` is "-", and parse the generated code
+    # Not a constant argument, or the call would be folded (and protonim
+    # built) wherever this module is compiled
+    let cacheDir = protoCacheBase()
+    var cmd = quoteShell(protonimExe(cacheDir)) & " --listImports --input=" &
+            input
     for dirname in searchDirs:
         cmd &= " -s " & dirname
     for extraImport in extraImportPackages:
         cmd &= " -p " & extraImport
     for replaceRule in replaceCode:
         cmd &= " -r " & replaceRule.oldStr & ":" & replaceRule.newStr
+    when defined(protoPreserveUnknownFields):
+        cmd &= " --preserveUnknownFields"
+    when protoMapType.len > 0:
+        cmd &= " --mapType " & protoMapType
+    when defined(protoDeterministic):
+        cmd &= " --deterministic"
+    when defined(protoTableDriven):
+        cmd &= " --tableDriven"
+    let source = if input == "-": "inline proto3 code" else: input
+
+    # Generated code is cached under a hash of the command and root proto,
+    # with the files the parser imported recorded in the entry, so an
+    # unchanged proto tree skips the generator process on the next build
+    var cachePath = ""
+    when not defined(protoNoCache):
+        let key = generatedCodeKey(cmd, input, text)
+        if key.len > 0:
+            cachePath = cacheDir / key & ".nim"
+            if fileExists(cachePath):
+                let cached = readFile(cachePath)
+                if cached.endsWith(generatedCodeEnd & "\n") and
+                        importsUnchanged(cached):
+                    echo "Using cached nim code for " & source & ": " & cachePath
+                    when defined(showGeneratedProto3Code):
+                        echo cached
+                    return cached.parseStmt
+            createDir(cacheDir)
+
     echo "Running command to generate nim code: " & cmd
-    var generatedCode = staticExec(cmd)
-    if not generatedCode.contains("# Generated from protobuf"):
-        raise newException(ValueError, "Failed to parse proto file: " & file &
+    var (generatedCode, exitCode) = gorgeEx(cmd, text)
+    if exitCode != 0 or not generatedCode.contains("# Generated from protobuf"):
+        raise newException(ValueError, "Failed to parse proto file: " & source &
                 "\n" & generatedCode)
-    generatedCode = generatedCode[generatedCode.find(
-            "# Generated from protobuf") .. ^1]
+    let codeStart = generatedCode.find("# Generated from protobuf")
+    let preamble = generatedCode[0 ..< codeStart]
+    generatedCode = generatedCode[codeStart .. ^1]
+    # The parser warns about imports it could not find or parse; the code
+    # then depends on files that aren't recorded, so it is not cached
+    if cachePath.len > 0 and "Warning:" notin preamble:
+        writeFile(cachePath, importRecords(preamble) & generatedCode & "\n" &
+                generatedCodeEnd & "\n")
     when defined(showGeneratedProto3Code):
         echo generatedCode
     result = generatedCode.parseStmt
 
+proc importProtoImpl(file: string, searchDirs: seq[string],
+        extraImportPackages: seq[string], replaceCode: seq[tuple[oldStr: string,
+                newStr: string]] = @[]): NimNode =
+    result = generateProtoCode(file, "", searchDirs, extraImportPackages,
+            replaceCode)
+
 macro importProto3*(file: static[string]): untyped =
     ## Import a protobuf file and generate Nim code for it.
     ##
@@ -93,33 +242,14 @@ macro importProto3*(file: static[string], searchDirs: static[seq[
 proc proto3Impl(proto_code: NimNode, searchDirs: seq[
         string], extraImportPackages: seq[string], replaceCode: seq[tuple[
                 oldStr: string, newStr: string]]): NimNode {.compileTime.} =
-    var success = false
-
-    when defined(windows):
-        let filename = currentSourcePath().parentDir() & "\\tmp_proto3Impl.proto"
-    else:
-        let filename = "/tmp/tmp_proto3Impl.proto"
-
-    writeFile(filename, proto_code.strVal)
-
+    # The schema goes to protonim through stdin, so parallel builds never
+    # share a temporary file
     try:
-        result = importProtoImpl(filename, searchDirs, extraImportPackages)
-        success = true
-    except Exception as e:
-        echo "Failed to generate code from proto code: \n" & proto_code.strVal &
-                "\n" & e.msg
-    finally:
-        when defined(windows):
-            let cmd = "powershell.exe -NoProfile -Command Remove-Item -Force \"" &
-                    filename & "\""
-        else:
-            let cmd = "rm \"" & filename & "\""
-        echo "[nimproto3] Running command: " & cmd
-        echo staticExec(cmd)
-
-    if not success:
+        result = generateProtoCode("-", proto_code.strVal, searchDirs,
+                extraImportPackages, replaceCode)
+    except ValueError as e:
         raise newException(ValueError, "Failed to generate code from proto code: \n" &
-                proto_code.strVal)
+                proto_code.strVal & "\n" & e.msg)
 
 macro proto3*(proto_code: untyped): untyped =
     ## Generate Nim code from an inline protobuf string.
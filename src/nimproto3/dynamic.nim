@@ -0,0 +1,816 @@
+## Runtime codec for messages whose schema is only known at runtime
+##
+## `newDescriptorPool` compiles the messages of a `parseProto` AST, imports
+## included, into flat field tables: for every field its number, kind, wire
+## type, repeated/packed flags and the pool index of its message type, plus
+## an array from field number to field. A `DynamicMessage` holds one value
+## per field of its descriptor. Binary and JSON encoding and decoding walk
+## those tables, so handling a field costs an array lookup and a `case` on
+## its kind, without comparing type or field names.
+##
+## The JSON has the same shape as the generated `toJson`: fields under their
+## proto names, default scalars omitted, enums as numbers and `bytes` as
+## arrays of numbers.
+##
+## ```nim
+## let pool = newDescriptorPool(parseProto(readFile("service.proto")))
+## let msg = pool.fromBinary("pkg.Request", data)
+## echo msg["name"].getStr()
+## echo pool.transcodeToJson("pkg.Request", data)
+## ```
+
+import std/[tables, sets, json, strutils]
+import ./[ast, wire_format, json_stream]
+
+type
+  FieldKind* = enum
+    ## Proto type of a field value
+    fkDouble, fkFloat, fkInt64, fkUInt64, fkInt32, fkFixed64, fkFixed32,
+    fkBool, fkString, fkMessage, fkBytes, fkUInt32, fkEnum, fkSFixed32,
+    fkSFixed64, fkSInt32, fkSInt64
+
+  FieldDescriptor* = object
+    name*: string
+    number*: int
+    kind*: FieldKind
+    wireType*: WireType     ## wire type of a single value
+    repeated*: bool
+    packed*: bool           ## repeated scalars are written as one packed run
+    isMap*: bool            ## entries of message `message`, key 1 and value 2
+    explicitPresence*: bool ## oneof member: written when set, even to its
+                            ## default. Like the generated code, `optional`
+                            ## scalars are not tracked.
+    oneof*: int             ## index of the oneof in the message, or -1
+    message*: int           ## pool index of the message or map entry type, or -1
+
+  MessageDescriptor* = object
+    name*: string           ## full name, e.g. `pkg.Outer.Inner`
+    fields*: seq[FieldDescriptor]
+    byNumber: seq[int32]    ## field number -> field index + 1, 0 if unknown
+    sparse: Table[int, int] ## field numbers past `byNumber`
+    byName: Table[string, int]
+
+  DescriptorPool* = ref object
+    ## Compiled message types, looked up by full name
+    messages*: seq[MessageDescriptor]
+    byName: Table[string, int]
+    enums: HashSet[string]
+
+  DynamicKind* = enum
+    dkNone     ## not set
+    dkInt      ## signed integers and enums
+    dkUInt     ## unsigned integers
+    dkFloat
+    dkBool
+    dkString
+    dkBytes
+    dkMessage
+    dkList     ## repeated fields
+    dkMap      ## map fields, entries in wire order
+
+  DynamicValue* = object
+    case kind*: DynamicKind
+    of dkNone: discard
+    of dkInt: intVal*: int64
+    of dkUInt: uintVal*: uint64
+    of dkFloat: floatVal*: float64
+    of dkBool: boolVal*: bool
+    of dkString: strVal*: string
+    of dkBytes: bytesVal*: seq[byte]
+    of dkMessage: msgVal*: DynamicMessage
+    of dkList: items*: seq[DynamicValue]
+    of dkMap: entries*: seq[tuple[key, value: DynamicValue]]
+
+  DynamicMessage* = ref object
+    pool*: DescriptorPool
+    descriptor*: int           ## index into `pool.messages`
+    values*: seq[DynamicValue] ## one per field of the descriptor, in order
+
+const
+  scalarKinds = {"double": fkDouble, "float": fkFloat, "int64": fkInt64,
+      "uint64": fkUInt64, "int32": fkInt32, "fixed64": fkFixed64,
+      "fixed32": fkFixed32, "bool": fkBool, "string": fkString,
+      "bytes": fkBytes, "uint32": fkUInt32, "sfixed32": fkSFixed32,
+      "sfixed64": fkSFixed64, "sint32": fkSInt32, "sint64": fkSInt64}.toTable
+
+  kindWireTypes*: array[FieldKind, WireType] = [wt64Bit, wt32Bit, wtVarint,
+      wtVarint, wtVarint, wt64Bit, wt32Bit, wtVarint, wtLengthDelimited,
+      wtLengthDelimited, wtLengthDelimited, wtVarint, wtVarint, wt32Bit,
+      wt64Bit, wtVarint, wtVarint]
+    ## Wire type of a single value of each kind
+
+  signedKinds = {fkInt64, fkInt32, fkEnum, fkSFixed32, fkSFixed64, fkSInt32,
+      fkSInt64}
+  unsignedKinds = {fkUInt64, fkFixed64, fkFixed32, fkUInt32}
+  floatKinds = {fkDouble, fkFloat}
+  packableKinds = {low(FieldKind) .. high(FieldKind)} -
+      {fkString, fkBytes, fkMessage}
+
+  denseFieldNumbers = 1024
+    ## Field numbers below this are looked up in an array, others in a table
+
+# -----------------------------------------------------------------------------
+# DESCRIPTORS
+# -----------------------------------------------------------------------------
+
+proc fieldIndex*(desc: MessageDescriptor, number: int): int {.inline.} =
+  ## Index in `desc.fields` of the field numbered `number`, or -1
+  if number >= 0 and number < desc.byNumber.len:
+    int(desc.byNumber[number]) - 1
+  else:
+    desc.sparse.getOrDefault(number, -1)
+
+proc fieldIndex*(desc: MessageDescriptor, name: string): int =
+  ## Index in `desc.fields` of the field called `name`, or -1
+  desc.byName.getOrDefault(name, -1)
+
+proc qualify(scope, name: string): string =
+  if scope.len > 0: scope & "." & name else: name
+
+proc packageOf(file: ProtoNode): string =
+  for child in file.children:
+    if child.kind == nkPackage:
+      return child.name
+
+proc registerTypes(pool: DescriptorPool, node: ProtoNode, scope: string,
+    pending: var seq[(int, ProtoNode)]) =
+  ## Give every message of `node` (nested and imported ones included) a pool
+  ## index, so fields can refer to types declared after them
+  for child in node.children:
+    case child.kind
+    of nkMessage:
+      let name = qualify(scope, child.name)
+      if pool.byName.hasKey(name):
+        continue
+      pool.byName[name] = pool.messages.len
+      pending.add((pool.messages.len, child))
+      pool.messages.add(MessageDescriptor(name: name))
+      registerTypes(pool, child, name, pending)
+    of nkEnum:
+      pool.enums.incl(qualify(scope, child.name))
+    of nkImport:
+      for imported in child.children:
+        if imported.kind == nkProto:
+          registerTypes(pool, imported, packageOf(imported), pending)
+    else:
+      discard
+
+proc resolveType(pool: DescriptorPool, scope, typeName: string): tuple[
+    kind: FieldKind, message: int] =
+  ## Kind and message index of field type `typeName` used inside `scope`,
+  ## searching the enclosing scopes outwards like protoc
+  if typeName in scalarKinds:
+    return (scalarKinds[typeName], -1)
+  if typeName.startsWith("."):
+    let name = typeName[1 .. ^1]
+    if pool.byName.hasKey(name):
+      return (fkMessage, pool.byName[name])
+    if name in pool.enums:
+      return (fkEnum, -1)
+  else:
+    var outer = scope
+    while true:
+      let name = qualify(outer, typeName)
+      if pool.byName.hasKey(name):
+        return (fkMessage, pool.byName[name])
+      if name in pool.enums:
+        return (fkEnum, -1)
+      if outer.len == 0:
+        break
+      let dot = outer.rfind('.')
+      outer = if dot < 0: "" else: outer[0 ..< dot]
+  raise newException(ValueError, "Unknown type " & typeName & " in " & scope)
+
+proc newField(pool: DescriptorPool, scope: string, node: ProtoNode,
+    oneof: int): FieldDescriptor =
+  let (kind, message) = pool.resolveType(scope, node.value)
+  result = FieldDescriptor(name: node.name, number: node.number, kind: kind,
+      wireType: kindWireTypes[kind], oneof: oneof, message: message,
+      explicitPresence: oneof >= 0)
+  for attr in node.attrs:
+    if attr.kind == nkOption and attr.name == "label":
+      result.repeated = attr.value == "repeated"
+  # Like the generated code, scalars are always packed; both forms decode
+  result.packed = result.repeated and kind in packableKinds
+
+proc addMapEntry(pool: DescriptorPool, scope: string, node: ProtoNode): int =
+  ## Add the synthetic `<Field>Entry` message of map field `node`
+  let types = node.value.split(',')
+  var entry = MessageDescriptor(name: qualify(scope,
+      capitalizeAscii(node.name) & "Entry"))
+  for i, typeName in types:
+    let (kind, message) = pool.resolveType(scope, typeName.strip())
+    entry.fields.add(FieldDescriptor(name: if i == 0: "key" else: "value",
+        number: i + 1, kind: kind, wireType: kindWireTypes[kind], oneof: -1,
+        message: message))
+  result = pool.messages.len
+  pool.messages.add(entry)
+
+proc indexFields(desc: var MessageDescriptor) =
+  var maxNumber = 0
+  for field in desc.fields:
+    maxNumber = max(maxNumber, field.number)
+  desc.byNumber = newSeq[int32](min(maxNumber, denseFieldNumbers - 1) + 1)
+  for i, field in desc.fields:
+    if field.number < desc.byNumber.len:
+      desc.byNumber[field.number] = int32(i + 1)
+    else:
+      desc.sparse[field.number] = i
+    desc.byName[field.name] = i
+
+proc compileMessage(pool: DescriptorPool, index: int, node: ProtoNode) =
+  let scope = pool.messages[index].name
+  var fields: seq[FieldDescriptor]
+  var oneofs = 0
+  for child in node.children:
+    case child.kind
+    of nkField:
+      fields.add(pool.newField(scope, child, -1))
+    of nkMapField:
+      var field = FieldDescriptor(name: child.name, number: child.number,
+          kind: fkMessage, wireType: wtLengthDelimited, repeated: true,
+          isMap: true, oneof: -1)
+      field.message = pool.addMapEntry(scope, child)
+      indexFields(pool.messages[field.message])
+      fields.add(field)
+    of nkOneof:
+      for member in child.children:
+        if member.kind == nkField:
+          fields.add(pool.newField(scope, member, oneofs))
+      inc oneofs
+    else:
+      discard
+  pool.messages[index].fields = fields
+  indexFields(pool.messages[index])
+
+proc add*(pool: DescriptorPool, ast: ProtoNode) =
+  ## Compile the messages of a parsed proto file and of the files it imports
+  ## into `pool`. Messages already in the pool are kept as they are.
+  var pending: seq[(int, ProtoNode)]
+  registerTypes(pool, ast, packageOf(ast), pending)
+  for (index, node) in pending:
+    pool.compileMessage(index, node)
+
+proc newDescriptorPool*(ast: ProtoNode): DescriptorPool =
+  ## A pool of the messages of a parsed proto file (see `parseProto`) and of
+  ## the files it imports
+  result = DescriptorPool()
+  result.add(ast)
+
+proc messageIndex*(pool: DescriptorPool, name: string): int =
+  ## Pool index of the message with full name `name`, e.g. `pkg.Outer.Inner`
+  result = pool.byName.getOrDefault(name, -1)
+  if result < 0:
+    raise newException(ValueError, "Unknown message: " & name)
+
+# -----------------------------------------------------------------------------
+# VALUES
+# -----------------------------------------------------------------------------
+
+proc newDynamicMessage*(pool: DescriptorPool, index: int): DynamicMessage =
+  ## An empty message of the type at pool index `index`
+  DynamicMessage(pool: pool, descriptor: index,
+      values: newSeq[DynamicValue](pool.messages[index].fields.len))
+
+proc newDynamicMessage*(pool: DescriptorPool, name: string): DynamicMessage =
+  ## An empty message of type `name`
+  newDynamicMessage(pool, pool.messageIndex(name))
+
+template desc(msg: DynamicMessage): untyped =
+  msg.pool.messages[msg.descriptor]
+
+proc toDynamic*(value: SomeSignedInt): DynamicValue =
+  DynamicValue(kind: dkInt, intVal: int64(value))
+
+proc toDynamic*(value: SomeUnsignedInt): DynamicValue =
+  DynamicValue(kind: dkUInt, uintVal: uint64(value))
+
+proc toDynamic*(value: SomeFloat): DynamicValue =
+  DynamicValue(kind: dkFloat, floatVal: float64(value))
+
+proc toDynamic*(value: bool): DynamicValue =
+  DynamicValue(kind: dkBool, boolVal: value)
+
+proc toDynamic*(value: string): DynamicValue =
+  DynamicValue(kind: dkString, strVal: value)
+
+proc toDynamic*(value: seq[byte]): DynamicValue =
+  DynamicValue(kind: dkBytes, bytesVal: value)
+
+proc toDynamic*(value: DynamicMessage): DynamicValue =
+  DynamicValue(kind: dkMessage, msgVal: value)
+
+proc toDynamic*(items: seq[DynamicValue]): DynamicValue =
+  DynamicValue(kind: dkList, items: items)
+
+proc getInt*(value: DynamicValue): int64 =
+  ## The value of an integer, enum or bool field; 0 if unset
+  case value.kind
+  of dkNone: 0'i64
+  of dkInt: value.intVal
+  of dkUInt: cast[int64](value.uintVal)
+  of dkBool: int64(ord(value.boolVal))
+  else: raise newException(ValueError, "Not an integer: " & $value.kind)
+
+proc getUInt*(value: DynamicValue): uint64 =
+  ## The value of an integer field as unsigned; 0 if unset
+  case value.kind
+  of dkUInt: value.uintVal
+  else: cast[uint64](value.getInt())
+
+proc getFloat*(value: DynamicValue): float64 =
+  ## The value of a float or integer field; 0.0 if unset
+  case value.kind
+  of dkFloat: value.floatVal
+  of dkUInt: float64(value.uintVal)
+  else: float64(value.getInt())
+
+proc getBool*(value: DynamicValue): bool =
+  value.getInt() != 0
+
+proc getStr*(value: DynamicValue): string =
+  ## The value of a string or bytes field; "" if unset
+  case value.kind
+  of dkNone: ""
+  of dkString: value.strVal
+  of dkBytes: cast[string](value.bytesVal)
+  else: raise newException(ValueError, "Not a string: " & $value.kind)
+
+proc getBytes*(value: DynamicValue): seq[byte] =
+  ## The value of a bytes or string field; empty if unset
+  case value.kind
+  of dkBytes: value.bytesVal
+  else: cast[seq[byte]](value.getStr())
+
+proc isDefault(value: DynamicValue): bool =
+  case value.kind
+  of dkNone: true
+  of dkInt: value.intVal == 0
+  of dkUInt: value.uintVal == 0
+  of dkFloat: value.floatVal == 0.0
+  of dkBool: not value.boolVal
+  of dkString: value.strVal.len == 0
+  of dkBytes: value.bytesVal.len == 0
+  of dkMessage: value.msgVal == nil
+  of dkList: value.items.len == 0
+  of dkMap: value.entries.len == 0
+
+proc defaultValue(pool: DescriptorPool, field: FieldDescriptor): DynamicValue =
+  case field.kind
+  of signedKinds: DynamicValue(kind: dkInt)
+  of unsignedKinds: DynamicValue(kind: dkUInt)
+  of floatKinds: DynamicValue(kind: dkFloat)
+  of fkBool: DynamicValue(kind: dkBool)
+  of fkString: DynamicValue(kind: dkString)
+  of fkBytes: DynamicValue(kind: dkBytes)
+  of fkMessage: toDynamic(newDynamicMessage(pool, field.message))
+
+proc `[]`*(msg: DynamicMessage, name: string): DynamicValue =
+  ## The value of field `name`; `dkNone` if it is not set
+  let i = msg.desc.fieldIndex(name)
+  if i < 0:
+    raise newException(ValueError, "Unknown field " & name & " of " &
+        msg.desc.name)
+  msg.values[i]
+
+proc `[]=`*(msg: DynamicMessage, name: string, value: DynamicValue) =
+  ## Set field `name`, clearing the other members of its oneof
+  let i = msg.desc.fieldIndex(name)
+  if i < 0:
+    raise newException(ValueError, "Unknown field " & name & " of " &
+        msg.desc.name)
+  let oneof = msg.desc.fields[i].oneof
+  if oneof >= 0:
+    for j in 0 ..< msg.values.len:
+      if msg.desc.fields[j].oneof == oneof:
+        reset(msg.values[j])
+  msg.values[i] = value
+
+# -----------------------------------------------------------------------------
+# BINARY
+# -----------------------------------------------------------------------------
+
+proc decodeScalar(kind: FieldKind, data: openArray[byte],
+    pos: var int): DynamicValue =
+  case kind
+  of fkInt32, fkEnum: toDynamic(decodeInt32(data, pos))
+  of fkInt64: toDynamic(decodeInt64(data, pos))
+  of fkSInt32: toDynamic(decodeSInt32(data, pos))
+  of fkSInt64: toDynamic(decodeSInt64(data, pos))
+  of fkSFixed32: toDynamic(decodeSFixed32(data, pos))
+  of fkSFixed64: toDynamic(decodeSFixed64(data, pos))
+  of fkUInt32: toDynamic(decodeUInt32(data, pos))
+  of fkUInt64: toDynamic(decodeUInt64(data, pos))
+  of fkFixed32: toDynamic(decodeFixed32(data, pos))
+  of fkFixed64: toDynamic(decodeFixed64(data, pos))
+  of fkFloat: toDynamic(decodeFloat32(data, pos))
+  of fkDouble: toDynamic(decodeFloat64(data, pos))
+  of fkBool: toDynamic(decodeBool(data, pos))
+  of fkString: toDynamic(decodeString(data, pos))
+  of fkBytes: toDynamic(decodeLengthDelimited(data, pos))
+  of fkMessage: DynamicValue(kind: dkNone)
+
+proc mergeFromBinary*(msg: DynamicMessage, data: openArray[byte]) =
+  ## Decode `data` into `msg` with protobuf merge semantics: set fields are
+  ## overwritten, repeated fields and maps appended to, messages merged
+  var pos = 0
+  while pos < data.len:
+    let (number, wireType) = decodeFieldKey(data, pos)
+    let i = msg.desc.fieldIndex(number)
+    if i < 0:
+      skipField(data, pos, wireType)
+      continue
+    template field: untyped = msg.desc.fields[i]
+    template value: untyped = msg.values[i]
+    if field.isMap:
+      let span = decodeLengthDelimitedSpan(data, pos)
+      let entry = newDynamicMessage(msg.pool, field.message)
+      entry.mergeFromBinary(data.toOpenArray(span.a, span.b))
+      for j in 0 .. 1:
+        if entry.values[j].kind == dkNone:
+          entry.values[j] = defaultValue(msg.pool,
+              msg.pool.messages[field.message].fields[j])
+      if value.kind != dkMap:
+        value = DynamicValue(kind: dkMap)
+      value.entries.add((entry.values[0], entry.values[1]))
+    elif field.repeated:
+      if value.kind != dkList:
+        value = DynamicValue(kind: dkList)
+      if field.kind == fkMessage:
+        let span = decodeLengthDelimitedSpan(data, pos)
+        let item = newDynamicMessage(msg.pool, field.message)
+        item.mergeFromBinary(data.toOpenArray(span.a, span.b))
+        value.items.add(toDynamic(item))
+      elif wireType == wtLengthDelimited and field.kind in packableKinds:
+        let span = decodeLengthDelimitedSpan(data, pos)
+        var itemPos = span.a
+        while itemPos <= span.b:
+          value.items.add(decodeScalar(field.kind,
+              data.toOpenArray(0, span.b), itemPos))
+      else:
+        value.items.add(decodeScalar(field.kind, data, pos))
+    elif wireType != field.wireType:
+      skipField(data, pos, wireType)
+      continue
+    elif field.kind == fkMessage:
+      let span = decodeLengthDelimitedSpan(data, pos)
+      if value.kind != dkMessage:
+        value = toDynamic(newDynamicMessage(msg.pool, field.message))
+      value.msgVal.mergeFromBinary(data.toOpenArray(span.a, span.b))
+    else:
+      value = decodeScalar(field.kind, data, pos)
+    if field.oneof >= 0:
+      for j in 0 ..< msg.values.len:
+        if j != i and msg.desc.fields[j].oneof == field.oneof:
+          reset(msg.values[j])
+
+proc fromBinary*(pool: DescriptorPool, name: string,
+    data: openArray[byte]): DynamicMessage =
+  ## Decode a message of type `name`
+  result = newDynamicMessage(pool, name)
+  result.mergeFromBinary(data)
+
+proc byteSize*(msg: DynamicMessage, sizes: var seq[int]): int
+
+proc scalarSize(kind: FieldKind, value: DynamicValue): int =
+  case kind
+  of fkInt32, fkEnum: sizeInt32(int32(value.getInt()))
+  of fkInt64: sizeInt64(value.getInt())
+  of fkSInt32: sizeSInt32(int32(value.getInt()))
+  of fkSInt64: sizeSInt64(value.getInt())
+  of fkUInt32: sizeUInt32(uint32(value.getUInt()))
+  of fkUInt64: sizeUInt64(value.getUInt())
+  of fkFixed32, fkSFixed32, fkFloat: 4
+  of fkFixed64, fkSFixed64, fkDouble: 8
+  of fkBool: 1
+  of fkString, fkBytes: sizeString(value.getBytes())
+  of fkMessage: 0
+
+proc writeScalar(buf: var seq[byte], kind: FieldKind, value: DynamicValue) =
+  case kind
+  of fkInt32, fkEnum: buf.writeInt32(int32(value.getInt()))
+  of fkInt64: buf.writeInt64(value.getInt())
+  of fkSInt32: buf.writeSInt32(int32(value.getInt()))
+  of fkSInt64: buf.writeSInt64(value.getInt())
+  of fkSFixed32: buf.writeSFixed32(int32(value.getInt()))
+  of fkSFixed64: buf.writeSFixed64(value.getInt())
+  of fkUInt32: buf.writeUInt32(uint32(value.getUInt()))
+  of fkUInt64: buf.writeUInt64(value.getUInt())
+  of fkFixed32: buf.writeFixed32(uint32(value.getUInt()))
+  of fkFixed64: buf.writeFixed64(value.getUInt())
+  of fkFloat: buf.writeFloat32(float32(value.getFloat()))
+  of fkDouble: buf.writeFloat64(value.getFloat())
+  of fkBool: buf.writeBool(value.getBool())
+  of fkString: buf.writeString(value.getStr())
+  of fkBytes: buf.writeString(value.getBytes())
+  of fkMessage: discard
+
+proc writeMessage(buf: var seq[byte], msg: DynamicMessage,
+    sizes: openArray[int], pos: var int)
+
+proc writeValue(buf: var seq[byte], kind: FieldKind, value: DynamicValue,
+    sizes: openArray[int], pos: var int) =
+  ## A single value, length prefixed if it is a message
+  if kind == fkMessage:
+    buf.writeVarint(uint64(sizes.nextSize(pos)))
+    buf.writeMessage(value.msgVal, sizes, pos)
+  else:
+    buf.writeScalar(kind, value)
+
+proc valueSize(kind: FieldKind, value: DynamicValue,
+    sizes: var seq[int]): int =
+  ## Size of a single value. The length of a message is recorded in `sizes`.
+  if kind == fkMessage:
+    let slot = sizes.reserveSize()
+    let size = byteSize(value.msgVal, sizes)
+    sizes[slot] = size
+    sizeLengthDelimited(size)
+  else:
+    scalarSize(kind, value)
+
+proc isWritten(field: FieldDescriptor, value: DynamicValue): bool {.inline.} =
+  ## Whether a singular scalar field is encoded: set, and for fields without
+  ## explicit presence also not the default. Message fields are decided by
+  ## their recorded size.
+  if value.kind == dkNone: false
+  elif field.explicitPresence: true
+  else: not isDefault(value)
+
+proc byteSize*(msg: DynamicMessage, sizes: var seq[int]): int =
+  ## Size of the binary encoding of `msg`. The length of every nested
+  ## message, packed run and map entry is appended to `sizes` in the order
+  ## `toBinary` writes them.
+  for i, field in msg.desc.fields:
+    let value = msg.values[i]
+    let tagLen = tagSize(field.number)
+    if field.isMap:
+      if value.kind == dkMap:
+        template entry: untyped = msg.pool.messages[field.message]
+        for (key, val) in value.entries:
+          let slot = sizes.reserveSize()
+          let size = 2 + valueSize(entry.fields[0].kind, key, sizes) +
+              valueSize(entry.fields[1].kind, val, sizes)
+          sizes[slot] = size
+          result += tagLen + sizeLengthDelimited(size)
+    elif field.repeated:
+      if value.kind == dkList and value.items.len > 0:
+        if field.packed:
+          var payload = 0
+          for item in value.items:
+            payload += scalarSize(field.kind, item)
+          sizes.add(payload)
+          result += tagLen + sizeLengthDelimited(payload)
+        else:
+          for item in value.items:
+            result += tagLen + valueSize(field.kind, item, sizes)
+    elif field.kind == fkMessage:
+      if value.kind != dkNone:
+        # An empty message keeps its slot for writeMessage to read, the
+        # lengths recorded below it are dropped
+        let slot = sizes.reserveSize()
+        let size = byteSize(value.msgVal, sizes)
+        sizes[slot] = size
+        if size > 0 or field.explicitPresence:
+          result += tagLen + sizeLengthDelimited(size)
+        else:
+          sizes.setLen(slot + 1)
+    elif isWritten(field, value):
+      result += tagLen + scalarSize(field.kind, value)
+
+proc byteSize*(msg: DynamicMessage): int =
+  ## Size of the binary encoding of `msg`
+  var sizes: seq[int]
+  byteSize(msg, sizes)
+
+proc writeMessage(buf: var seq[byte], msg: DynamicMessage,
+    sizes: openArray[int], pos: var int) =
+  for i, field in msg.desc.fields:
+    let value = msg.values[i]
+    if field.isMap:
+      if value.kind == dkMap:
+        template entry: untyped = msg.pool.messages[field.message]
+        for (key, val) in value.entries:
+          buf.writeTag(field.number, wtLengthDelimited)
+          buf.writeVarint(uint64(sizes.nextSize(pos)))
+          buf.writeTag(1, entry.fields[0].wireType)
+          buf.writeValue(entry.fields[0].kind, key, sizes, pos)
+          buf.writeTag(2, entry.fields[1].wireType)
+          buf.writeValue(entry.fields[1].kind, val, sizes, pos)
+    elif field.repeated:
+      if value.kind == dkList and value.items.len > 0:
+        if field.packed:
+          buf.writeTag(field.number, wtLengthDelimited)
+          buf.writeVarint(uint64(sizes.nextSize(pos)))
+          for item in value.items:
+            buf.writeScalar(field.kind, item)
+        else:
+          for item in value.items:
+            buf.writeTag(field.number, field.wireType)
+            buf.writeValue(field.kind, item, sizes, pos)
+    elif field.kind == fkMessage:
+      if value.kind != dkNone:
+        let size = sizes.nextSize(pos)
+        if size > 0 or field.explicitPresence:
+          buf.writeTag(field.number, wtLengthDelimited)
+          buf.writeVarint(uint64(size))
+          buf.writeMessage(value.msgVal, sizes, pos)
+    elif isWritten(field, value):
+      buf.writeTag(field.number, field.wireType)
+      buf.writeScalar(field.kind, value)
+
+proc toBinary*(msg: DynamicMessage, buf: var seq[byte]) =
+  ## Append the binary encoding of `msg` to `buf`
+  var sizes: seq[int]
+  discard byteSize(msg, sizes)
+  var pos = 0
+  buf.writeMessage(msg, sizes, pos)
+
+proc toBinary*(msg: DynamicMessage): seq[byte] =
+  var sizes: seq[int]
+  result = newSeqOfCap[byte](byteSize(msg, sizes))
+  var pos = 0
+  result.writeMessage(msg, sizes, pos)
+
+# -----------------------------------------------------------------------------
+# JSON
+# -----------------------------------------------------------------------------
+
+proc toJson*(msg: DynamicMessage): JsonNode
+
+proc mapKey(value: DynamicValue): string =
+  ## JSON object key of a map key
+  case value.kind
+  of dkInt: $value.intVal
+  of dkUInt: $value.uintVal
+  of dkBool: $value.boolVal
+  else: value.getStr()
+
+proc valueToJson(kind: FieldKind, value: DynamicValue): JsonNode =
+  case kind
+  of signedKinds: %value.getInt()
+  of unsignedKinds: %value.getUInt()
+  of floatKinds: %value.getFloat()
+  of fkBool: %value.getBool()
+  of fkString: %value.getStr()
+  of fkBytes: %value.getBytes()
+  of fkMessage: value.msgVal.toJson()
+
+proc toJson*(msg: DynamicMessage): JsonNode =
+  ## JSON of `msg`, in the shape of the generated `toJson`
+  result = newJObject()
+  for i, field in msg.desc.fields:
+    let value = msg.values[i]
+    if field.isMap:
+      if value.kind == dkMap and value.entries.len > 0:
+        let kind = msg.pool.messages[field.message].fields[1].kind
+        var entries = newJObject()
+        for (key, val) in value.entries:
+          entries[mapKey(key)] = valueToJson(kind, val)
+        result[field.name] = entries
+    elif field.repeated:
+      if value.kind == dkList and value.items.len > 0:
+        var items = newJArray()
+        for item in value.items:
+          items.add(valueToJson(field.kind, item))
+        result[field.name] = items
+    elif field.kind == fkMessage:
+      if value.kind == dkMessage:
+        let fieldJson = value.msgVal.toJson()
+        if fieldJson.len > 0 or field.explicitPresence:
+          result[field.name] = fieldJson
+    elif isWritten(field, value):
+      result[field.name] = valueToJson(field.kind, value)
+
+proc toJsonString*(msg: DynamicMessage, buf: var string)
+
+proc writeJsonValue(buf: var string, kind: FieldKind, value: DynamicValue) =
+  case kind
+  of signedKinds: buf.writeJsonInt(value.getInt())
+  of unsignedKinds: buf.writeJsonUInt(value.getUInt())
+  of floatKinds: buf.writeJsonFloat(value.getFloat())
+  of fkBool: buf.writeJsonBool(value.getBool())
+  of fkString: buf.writeJsonString(value.getStr())
+  of fkBytes: buf.writeJsonBytes(value.getBytes())
+  of fkMessage: value.msgVal.toJsonString(buf)
+
+proc toJsonString*(msg: DynamicMessage, buf: var string) =
+  ## Append the JSON text of `msg` to `buf`, without building a `JsonNode`
+  buf.add('{')
+  let objStart = buf.len
+  for i, field in msg.desc.fields:
+    let value = msg.values[i]
+    if field.isMap:
+      if value.kind == dkMap and value.entries.len > 0:
+        let kind = msg.pool.messages[field.message].fields[1].kind
+        buf.writeJsonKey(objStart, field.name)
+        buf.add('{')
+        for j, (key, val) in value.entries:
+          if j > 0:
+            buf.add(',')
+          buf.writeJsonString(mapKey(key))
+          buf.add(':')
+          buf.writeJsonValue(kind, val)
+        buf.add('}')
+    elif field.repeated:
+      if value.kind == dkList and value.items.len > 0:
+        buf.writeJsonKey(objStart, field.name)
+        buf.add('[')
+        for j, item in value.items:
+          if j > 0:
+            buf.add(',')
+          buf.writeJsonValue(field.kind, item)
+        buf.add(']')
+    elif field.kind == fkMessage:
+      if value.kind == dkMessage:
+        # Empty messages are left out, like in toJson
+        let mark = buf.len
+        buf.writeJsonKey(objStart, field.name)
+        value.msgVal.toJsonString(buf)
+        if buf.endsWith("{}") and not field.explicitPresence:
+          buf.setLen(mark)
+    elif isWritten(field, value):
+      buf.writeJsonKey(objStart, field.name)
+      buf.writeJsonValue(field.kind, value)
+  buf.add('}')
+
+proc toJsonString*(msg: DynamicMessage): string =
+  msg.toJsonString(result)
+
+proc `$`*(msg: DynamicMessage): string =
+  msg.toJsonString()
+
+proc fromJson*(pool: DescriptorPool, index: int, node: JsonNode): DynamicMessage
+
+proc valueFromJson(pool: DescriptorPool, field: FieldDescriptor,
+    node: JsonNode): DynamicValue =
+  case field.kind
+  of signedKinds:
+    if node.kind == JString: toDynamic(parseBiggestInt(node.getStr()))
+    else: toDynamic(node.getBiggestInt())
+  of unsignedKinds:
+    # `%` writes values above high(int64) as raw number strings
+    if node.kind == JInt: toDynamic(uint64(node.getBiggestInt()))
+    else: toDynamic(parseBiggestUInt(node.getStr()))
+  of floatKinds:
+    if node.kind == JString: toDynamic(parseFloat(node.getStr()))
+    else: toDynamic(node.getFloat())
+  of fkBool: toDynamic(node.getBool())
+  of fkString: toDynamic(node.getStr())
+  of fkBytes: toDynamic(node.to(seq[byte]))
+  of fkMessage: toDynamic(pool.fromJson(field.message, node))
+
+proc mapKeyFromJson(field: FieldDescriptor, key: string): DynamicValue =
+  case field.kind
+  of signedKinds: toDynamic(parseBiggestInt(key))
+  of unsignedKinds: toDynamic(parseBiggestUInt(key))
+  of fkBool: toDynamic(parseBool(key))
+  else: toDynamic(key)
+
+proc fromJson*(pool: DescriptorPool, index: int, node: JsonNode): DynamicMessage =
+  ## Decode the JSON of a message of the type at pool index `index`. Unknown
+  ## keys and nulls are skipped.
+  result = newDynamicMessage(pool, index)
+  template target: untyped = pool.messages[index]
+  for key, value in node:
+    let i = target.fieldIndex(key)
+    if i < 0 or value.kind == JNull:
+      continue
+    template field: untyped = target.fields[i]
+    if field.isMap:
+      template entry: untyped = pool.messages[field.message]
+      var map = DynamicValue(kind: dkMap)
+      for k, v in value:
+        map.entries.add((mapKeyFromJson(entry.fields[0], k),
+            pool.valueFromJson(entry.fields[1], v)))
+      result.values[i] = map
+    elif field.repeated:
+      var list = DynamicValue(kind: dkList)
+      for item in value:
+        list.items.add(pool.valueFromJson(field, item))
+      result.values[i] = list
+    else:
+      result.values[i] = pool.valueFromJson(field, value)
+
+proc fromJson*(pool: DescriptorPool, name: string, node: JsonNode): DynamicMessage =
+  ## Decode the JSON of a message of type `name`
+  pool.fromJson(pool.messageIndex(name), node)
+
+proc fromJsonString*(pool: DescriptorPool, name: string,
+    text: string): DynamicMessage =
+  ## Decode the JSON text of a message of type `name`
+  pool.fromJson(name, parseJson(text))
+
+proc transcodeToJson*(pool: DescriptorPool, name: string,
+    data: openArray[byte], buf: var string) =
+  ## Append the JSON text of the encoded message `data` of type `name` to
+  ## `buf`
+  pool.fromBinary(name, data).toJsonString(buf)
+
+proc transcodeToJson*(pool: DescriptorPool, name: string,
+    data: openArray[byte]): string =
+  pool.transcodeToJson(name, data, result)
+
+proc transcodeToBinary*(pool: DescriptorPool, name: string,
+    text: string): seq[byte] =
+  ## The binary encoding of the JSON text `text` of a message of type `name`
+  pool.fromJsonString(name, text).toBinary()
@@ -1,5 +1,5 @@
 # grpc.nim
-import std/[asyncdispatch, asyncnet, net, strutils, tables,
+import std/[asyncdispatch, asyncnet, net, nativesockets, strutils, tables,
     deques, options, json, sequtils, sugar]
 import ./utils/huffman
 import zippy 
@@ -80,6 +80,16 @@ type
     CompressionDeflate = 2
     CompressionSnappy = 3
 
+const
+  DEFAULT_WINDOW_SIZE* = 65535 ## Initial HTTP/2 flow-control window (RFC 9113)
+  MAX_WINDOW_SIZE = 0x7FFFFFFF
+  SETTINGS_MAX_CONCURRENT_STREAMS = 0x3'u16
+  SETTINGS_INITIAL_WINDOW_SIZE = 0x4'u16
+  SETTINGS_MAX_FRAME_SIZE = 0x5'u16
+  DEFAULT_MAX_FRAME_SIZE* = 16384 ## Largest frame payload a peer accepts by default
+  READ_BUFFER_SIZE = 65536
+  SMALL_FRAME_BODY = 4096 # Bodies up to this size go out with their header
+
 # =============================================================================
 # 2. UTILITIES & COMPRESSION
 # =============================================================================
@@ -309,7 +319,7 @@ proc packFrame*(ft: FrameType, flags: uint8, streamId: uint32,
   if length > 0:
     for i in 0 ..< length: result[9+i] = payload[i]
 
-proc parseFrameHeader*(data: seq[byte]): Http2Frame =
+proc parseFrameHeader*(data: openArray[byte]): Http2Frame =
   let len = (data[0].uint32 shl 16) or (data[1].uint32 shl 8) or data[2].uint32
   
   # Validate FrameType to prevent RangeDefect
@@ -350,7 +360,12 @@ type
     headers*: Table[string, string]
     trailers*: Table[string, string]
     closed*: bool
+    reset*: bool
     connection*: Http2Connection
+    # Flow control: bytes the peer still accepts on this stream, and bytes
+    # consumed by the application but not yet returned in a WINDOW_UPDATE
+    sendWindow*: int
+    recvPending*: int
 
   OnNewStreamCallback = proc(s: Http2Stream) {.async.}
 
@@ -361,7 +376,20 @@ type
     nextStreamId*: uint32
     streams*: TableRef[uint32, Http2Stream]
     hpack*: HpackContext
+    # Flow control. `windowSize` is the connection-level window of the peer,
+    # `initialWindowSize` the receive window advertised for each stream and
+    # for the connection, and `peerInitialWindowSize` the peer's setting
     windowSize*: int
+    initialWindowSize*: int
+    peerInitialWindowSize*: int
+    recvPending*: int
+    windowWaiters: seq[Future[void]]
+    # Largest DATA payload the peer accepts, from SETTINGS_MAX_FRAME_SIZE
+    peerMaxFrameSize*: int
+    # One frame is written at a time, so frames written by concurrent
+    # senders never interleave on the socket
+    writeLocked: bool
+    writeWaiters: Deque[Future[void]]
     connected*: bool
     loopFuture*: Future[void]
     isServer*: bool
@@ -371,30 +399,73 @@ type
     sslCaFile*: string
 
 proc newHttp2Connection*(host: string, port: int,
-    isServer: bool = false): Http2Connection =
+    isServer: bool = false,
+    initialWindowSize: int = DEFAULT_WINDOW_SIZE): Http2Connection =
   new(result)
-  result.socket = newAsyncSocket()
+  # Unbuffered, as readLoop does its own buffering
+  result.socket = newAsyncSocket(buffered = false)
   result.host = host
   result.port = port.Port
   result.nextStreamId = if isServer: 2 else: 1
   result.streams = newTable[uint32, Http2Stream]()
   result.hpack = newHpack()
-  result.windowSize = 65535
+  result.windowSize = DEFAULT_WINDOW_SIZE
+  result.initialWindowSize = min(max(initialWindowSize, DEFAULT_WINDOW_SIZE),
+      MAX_WINDOW_SIZE)
+  result.peerInitialWindowSize = DEFAULT_WINDOW_SIZE
+  result.peerMaxFrameSize = DEFAULT_MAX_FRAME_SIZE
+  result.writeWaiters = initDeque[Future[void]]()
   result.isServer = isServer
   # Defaults
   result.sslVerify = true
   result.sslCaFile = ""
 
-proc sendFrame*(conn: Http2Connection, frame: seq[byte]) {.async.} =
+proc lockWrite(conn: Http2Connection): Future[void] =
+  result = newFuture[void]("Http2Connection.lockWrite")
+  if conn.writeLocked:
+    conn.writeWaiters.addLast(result)
+  else:
+    conn.writeLocked = true
+    result.complete()
+
+proc unlockWrite(conn: Http2Connection) =
+  # The lock passes straight to the next waiter, if any
+  if conn.writeWaiters.len > 0:
+    conn.writeWaiters.popFirst().complete()
+  else:
+    conn.writeLocked = false
+
+proc sendFrameParts(conn: Http2Connection, head: seq[byte], body: pointer,
+    bodyLen: int) {.async.} =
+  # Writes a frame whose payload ends with `bodyLen` bytes at `body`. A
+  # large body is written from where it lies, the caller keeps it alive. A
+  # small one is copied behind the header, to write the frame in one call.
   if conn.connected:
+    await conn.lockWrite()
     try:
+      if not conn.connected or conn.socket.isClosed:
+        return
       when defined(traceGrpc):
-        echo "[gRPC] sending frame: ", frame.toHex
-      await conn.socket.send(cast[string](frame))
+        echo "[gRPC] sending frame: ", head.toHex, " + ", bodyLen, " bytes"
+      if bodyLen > 0 and bodyLen <= SMALL_FRAME_BODY:
+        var frame = newSeqOfCap[byte](head.len + bodyLen)
+        frame.add(head)
+        frame.setLen(head.len + bodyLen)
+        copyMem(addr frame[head.len], body, bodyLen)
+        await conn.socket.send(addr frame[0], frame.len)
+      else:
+        await conn.socket.send(unsafeAddr head[0], head.len)
+        if bodyLen > 0:
+          await conn.socket.send(body, bodyLen)
       when defined(traceGrpc):
         echo "[gRPC] frame sent"
     except:
       conn.connected = false
+    finally:
+      conn.unlockWrite()
+
+proc sendFrame*(conn: Http2Connection, frame: seq[byte]) {.async.} =
+  await conn.sendFrameParts(frame, nil, 0)
 
 proc createStream*(conn: Http2Connection, id: uint32 = 0): Http2Stream =
   new(result)
@@ -408,16 +479,131 @@ proc createStream*(conn: Http2Connection, id: uint32 = 0): Http2Stream =
   result.headers = initTable[string, string]()
   result.trailers = initTable[string, string]()
   result.connection = conn
+  result.sendWindow = conn.peerInitialWindowSize
   conn.streams[result.id] = result
 
-proc processFrame*(conn: Http2Connection, frame: Http2Frame, payload: seq[byte]) =
+# --- Flow Control ---
+
+proc packWindowUpdate(streamId: uint32, increment: int): seq[byte] =
+  let inc = increment.uint32
+  packFrame(WINDOW_UPDATE, 0, streamId, [((inc shr 24) and 0x7F).byte,
+      ((inc shr 16) and 0xFF).byte, ((inc shr 8) and 0xFF).byte,
+      (inc and 0xFF).byte])
+
+proc settingsPayload(conn: Http2Connection): seq[byte] =
+  for (id, value) in [(SETTINGS_MAX_CONCURRENT_STREAMS, 100'u32),
+      (SETTINGS_INITIAL_WINDOW_SIZE, conn.initialWindowSize.uint32)]:
+    result.add([(id shr 8).byte, (id and 0xFF).byte,
+        ((value shr 24) and 0xFF).byte, ((value shr 16) and 0xFF).byte,
+        ((value shr 8) and 0xFF).byte, (value and 0xFF).byte])
+
+proc sendSettings(conn: Http2Connection) {.async.} =
+  await conn.sendFrame(packFrame(SETTINGS, 0, 0, conn.settingsPayload()))
+  # The connection window starts at 65535 whatever the settings say, and
+  # only grows through WINDOW_UPDATE
+  if conn.initialWindowSize > DEFAULT_WINDOW_SIZE:
+    await conn.sendFrame(packWindowUpdate(0,
+        conn.initialWindowSize - DEFAULT_WINDOW_SIZE))
+
+proc wakeWindowWaiters(conn: Http2Connection) =
+  let waiters = move conn.windowWaiters
+  conn.windowWaiters = @[]
+  for fut in waiters:
+    if not fut.finished: fut.complete()
+
+proc waitForWindow(conn: Http2Connection): Future[void] =
+  result = newFuture[void]("Http2Connection.waitForWindow")
+  conn.windowWaiters.add(result)
+
+proc consumeData*(stream: Http2Stream, length: int) =
+  ## Return `length` bytes of DATA read by the application to the peer's
+  ## window of this stream. WINDOW_UPDATE is sent once half of the window
+  ## has been consumed, so the peer keeps sending while we keep reading.
+  let conn = stream.connection
+  stream.recvPending += length
+  if stream.recvPending >= conn.initialWindowSize div 2 and not stream.closed:
+    asyncCheck conn.sendFrame(packWindowUpdate(stream.id, stream.recvPending))
+    stream.recvPending = 0
+
+proc sendDataParts(stream: Http2Stream, prefix: seq[byte],
+    data: sink seq[byte], endStream: bool) {.async.} =
+  # Sends `prefix` followed by `data` as DATA frames. Each frame is cut to
+  # the peer's max frame size and to the flow-control window, and waits
+  # when the window is used up. The frame header and any bytes of `prefix`
+  # are packed into one small buffer, `data` is written without a copy.
+  let conn = stream.connection
+  let flags = if endStream: FrameFlags.ACK_OR_END_STREAM.ord.uint8 else: 0'u8
+  let total = prefix.len + data.len
+  if total == 0:
+    await conn.sendFrame(packFrame(DATA, flags, stream.id, []))
+    return
+  var pos = 0
+  while pos < total:
+    if not conn.connected:
+      raise newException(IOError, "Connection closed")
+    if stream.reset:
+      raise newException(IOError, "Stream reset by peer")
+    let window = min(conn.windowSize, stream.sendWindow)
+    if window <= 0:
+      await conn.waitForWindow()
+      continue
+    let n = min(min(window, conn.peerMaxFrameSize), total - pos)
+    conn.windowSize -= n
+    stream.sendWindow -= n
+    let last = pos + n == total
+    let prefixEnd = min(pos + n, prefix.len)
+    var head = packFrame(DATA, if last: flags else: 0'u8, stream.id, [])
+    head[0] = ((n shr 16) and 0xFF).byte
+    head[1] = ((n shr 8) and 0xFF).byte
+    head[2] = (n and 0xFF).byte
+    if pos < prefixEnd:
+      head.add(prefix.toOpenArray(pos, prefixEnd - 1))
+    let bodyStart = max(pos, prefix.len) - prefix.len
+    let bodyLen = pos + n - max(pos, prefix.len)
+    await conn.sendFrameParts(head,
+        if bodyLen > 0: unsafeAddr data[bodyStart] else: nil, bodyLen)
+    pos += n
+
+proc sendData*(stream: Http2Stream, data: sink seq[byte],
+    endStream: bool = false): Future[void] =
+  ## Send `data` in DATA frames on `stream`. Frames are no larger than the
+  ## peer's SETTINGS_MAX_FRAME_SIZE. Sending waits whenever the stream or
+  ## connection window of the peer is used up, and resumes when the peer's
+  ## WINDOW_UPDATE arrives.
+  stream.sendDataParts(@[], data, endStream)
+
+proc processFrame*(conn: Http2Connection, frame: Http2Frame, payload: openArray[byte]) =
   let isEndStream = (frame.flags and FrameFlags.ACK_OR_END_STREAM.ord.uint8) != 0
 
   case frame.frameType
   of SETTINGS:
     if (frame.flags and FrameFlags.ACK_OR_END_STREAM.ord.uint8) == 0:
+      var i = 0
+      while i + 6 <= payload.len:
+        let id = (payload[i].uint16 shl 8) or payload[i+1].uint16
+        let value = (payload[i+2].int shl 24) or (payload[i+3].int shl 16) or
+            (payload[i+4].int shl 8) or payload[i+5].int
+        if id == SETTINGS_MAX_FRAME_SIZE:
+          conn.peerMaxFrameSize = max(value, DEFAULT_MAX_FRAME_SIZE)
+        elif id == SETTINGS_INITIAL_WINDOW_SIZE:
+          # Applies to every open stream, as a delta on its current window
+          let delta = value - conn.peerInitialWindowSize
+          conn.peerInitialWindowSize = value
+          for stream in conn.streams.values:
+            stream.sendWindow += delta
+          conn.wakeWindowWaiters()
+        i += 6
       let ack = packFrame(SETTINGS, FrameFlags.ACK_OR_END_STREAM.ord.uint8, 0, [])
       asyncCheck conn.sendFrame(ack)
+  of WINDOW_UPDATE:
+    if payload.len >= 4:
+      let increment = ((payload[0].int and 0x7F) shl 24) or
+          (payload[1].int shl 16) or (payload[2].int shl 8) or payload[3].int
+      if frame.streamId == 0:
+        conn.windowSize += increment
+      elif conn.streams.hasKey(frame.streamId):
+        conn.streams[frame.streamId].sendWindow += increment
+      conn.wakeWindowWaiters()
   of PING:
     if (frame.flags and FrameFlags.ACK_OR_END_STREAM.ord.uint8) == 0:
       let ack = packFrame(PING, FrameFlags.ACK_OR_END_STREAM.ord.uint8, 0, payload)
@@ -432,7 +618,7 @@ proc processFrame*(conn: Http2Connection, frame: Http2Frame, payload: seq[byte])
       isNew = true
 
     if stream != nil:
-      let decoded = decodeHeaders(conn.hpack, payload)
+      let decoded = decodeHeaders(conn.hpack, @payload)
       # Heuristic for Trailers-Only or Trailers
       var isTrailers = stream.headers.len > 0 and isEndStream
       if stream.headers.len == 0 and isEndStream: isTrailers = true
@@ -451,38 +637,68 @@ proc processFrame*(conn: Http2Connection, frame: Http2Frame, payload: seq[byte])
       if isNew and conn.onNewStream != nil:
         asyncCheck conn.onNewStream(stream)
   of DATA:
+    # The connection window is returned as soon as a frame arrives, so a
+    # stream the application stops reading never stalls the others. Each
+    # stream's own window is returned as its data is read, see consumeData.
+    conn.recvPending += frame.length.int
+    if conn.recvPending >= conn.initialWindowSize div 2:
+      asyncCheck conn.sendFrame(packWindowUpdate(0, conn.recvPending))
+      conn.recvPending = 0
     if conn.streams.hasKey(frame.streamId):
       let stream = conn.streams[frame.streamId]
-      stream.eventQueue.put(StreamEvent(kind: SE_DATA, data: payload,
+      stream.eventQueue.put(StreamEvent(kind: SE_DATA, data: @payload,
           endStream: isEndStream))
       if isEndStream: stream.closed = true
   of RST_STREAM:
     if conn.streams.hasKey(frame.streamId):
       let stream = conn.streams[frame.streamId]
       stream.closed = true
+      stream.reset = true
       stream.eventQueue.put(StreamEvent(kind: SE_RST, endStream: true))
+      conn.wakeWindowWaiters()
   else:
     discard
 
 proc readLoop*(conn: Http2Connection) {.async.} =
-  var headerBuf = newString(9)
+  ## Read and process frames until the connection closes. One read fills a
+  ## reusable buffer with whatever the socket has, and every complete frame
+  ## in it is processed in place before the next read, so a burst of small
+  ## frames costs one read instead of two per frame. Expects an unbuffered
+  ## socket, as created by `newHttp2Connection` and `newGrpcServer`.
+  var buf = newSeq[byte](READ_BUFFER_SIZE)
+  var start = 0 # unprocessed bytes are buf[start ..< stop]
+  var stop = 0
   try:
     while conn.connected:
-      let nRead = await conn.socket.recvInto(addr headerBuf[0], 9)
-      if nRead != 9: break
-      let rawHeader = cast[seq[byte]](headerBuf)
-      let frameHeader = parseFrameHeader(rawHeader)
-      var payload: seq[byte] = @[]
-      if frameHeader.length > 0:
-        let payloadStr = await conn.socket.recv(frameHeader.length.int)
-        if payloadStr.len != frameHeader.length.int: break
-        payload = cast[seq[byte]](payloadStr)
-      conn.processFrame(frameHeader, payload)
+      while stop - start >= 9:
+        let frameHeader = parseFrameHeader(buf.toOpenArray(start, start + 8))
+        let frameEnd = start + 9 + frameHeader.length.int
+        if frameEnd > stop: break
+        conn.processFrame(frameHeader, buf.toOpenArray(start + 9, frameEnd - 1))
+        start = frameEnd
+      if not conn.connected: break
+
+      # Move the partial frame to the front, and make room for all of it
+      let pending = stop - start
+      if start > 0:
+        if pending > 0: moveMem(addr buf[0], addr buf[start], pending)
+        start = 0
+        stop = pending
+      if pending >= 9:
+        let frameLen = 9 + parseFrameHeader(buf.toOpenArray(0, 8)).length.int
+        if frameLen > buf.len: buf.setLen(frameLen)
+
+      let nRead = await conn.socket.recvInto(addr buf[stop], buf.len - stop)
+      if nRead <= 0: break
+      stop += nRead
   except:
     if conn.connected: 
       # echo "[gRPC] Connection Error in ReadLoop: " & getCurrentExceptionMsg()
       discard
     conn.connected = false
+  conn.connected = false
+  # Senders waiting for a window would otherwise wait forever
+  conn.wakeWindowWaiters()
 
 proc connect*(conn: Http2Connection) {.async.} =
   # Enable SSL for Client if defined
@@ -509,24 +725,26 @@ proc connect*(conn: Http2Connection) {.async.} =
       raise newException(GrpcError, "Failed to initialize SSL for client: " & e.msg)
 
   await conn.socket.connect(conn.host, conn.port)
+  # Frames are written whole, so waiting to coalesce them only adds latency
+  conn.socket.setSockOpt(OptNoDelay, true, level = IPPROTO_TCP.toInt)
   conn.connected = true
   await conn.socket.send("PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n")
-  let settingsPayload: seq[byte] = @[0x00.byte, 0x03.byte, 0x00.byte, 0x00.byte,
-      0x00.byte, 0x64.byte]
-  await conn.sendFrame(packFrame(SETTINGS, 0, 0, settingsPayload))
+  await conn.sendSettings()
   conn.loopFuture = readLoop(conn)
 
 proc acceptHttp2*(conn: Http2Connection) {.async.} =
   conn.connected = true
   let prefaceExpected = "PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
-  let prefaceReceived = await conn.socket.recv(prefaceExpected.len)
+  var prefaceReceived = ""
+  while prefaceReceived.len < prefaceExpected.len:
+    let part = await conn.socket.recv(prefaceExpected.len - prefaceReceived.len)
+    if part.len == 0: break
+    prefaceReceived.add(part)
   if prefaceReceived != prefaceExpected:
     conn.socket.close()
     conn.connected = false
     raise newException(IOError, "Invalid HTTP/2 Preface : `" & prefaceReceived.toSeq.map(it => it.uint8.toHex).join("") & "` but expect : `" & prefaceExpected.toSeq.map(it => it.uint8.toHex).join("") & "`")
-  let settingsPayload: seq[byte] = @[0x00.byte, 0x03.byte, 0x00.byte, 0x00.byte,
-      0x00.byte, 0x64.byte]
-  await conn.sendFrame(packFrame(SETTINGS, 0, 0, settingsPayload))
+  await conn.sendSettings()
   conn.loopFuture = readLoop(conn)
 
 # =============================================================================
@@ -538,7 +756,11 @@ type GrpcStream* = ref object
   isServer*: bool
   sendCompression: GrpcCompression
   recvEncoding: string
-  readBuffer: seq[byte]
+  # Received DATA not yet handed out as messages: the frame payloads as
+  # they arrived, a read cursor into the first one, and the unread total
+  readChunks: Deque[seq[byte]]
+  readPos: int
+  buffered: int
   # Headers available after call starts (Client) or request received (Server)
   headers*: Table[string, string]
   trailers*: Table[string, string]
@@ -550,67 +772,108 @@ proc newGrpcStream(httpStream: Http2Stream, isServer: bool,
   result.isServer = isServer
   result.sendCompression = sendComp
   result.recvEncoding = "identity"
-  result.readBuffer = @[]
+  result.readChunks = initDeque[seq[byte]]()
   # Copy headers immediately if available (mostly for server side)
   result.headers = httpStream.headers
   result.trailers = httpStream.trailers
 
-# --- Send Message ---
-proc sendMsg*(stream: GrpcStream, data: seq[byte]) {.async.} =
-  var finalPayload = compressPayload(data, stream.sendCompression)
-  var compFlag: byte = if stream.sendCompression !=
-      CompressionIdentity: 1 else: 0
+# --- Read Buffer ---
+
+proc peekByte(stream: GrpcStream, offset: int): byte =
+  # The unread byte at `offset`, which must be below `buffered`
+  var i = stream.readPos + offset
+  for chunk in stream.readChunks:
+    if i < chunk.len: return chunk[i]
+    i -= chunk.len
+
+proc skipBytes(stream: GrpcStream, count: int) =
+  var count = count
+  stream.buffered -= count
+  while count > 0:
+    let left = stream.readChunks[0].len - stream.readPos
+    if count < left:
+      stream.readPos += count
+      return
+    count -= left
+    discard stream.readChunks.popFirst()
+    stream.readPos = 0
+
+proc takeBytes(stream: GrpcStream, count: int): seq[byte] =
+  # Removes the next `count` unread bytes. Bytes that fill the rest of a
+  # chunk are handed out as that chunk, shifted down in place, bytes inside
+  # a chunk are copied out, and bytes spanning chunks are stitched into a
+  # new seq. The unread tail is never copied, so many small messages in one
+  # frame cost linear time. recvMsg with a callback avoids the copies.
+  if count == 0:
+    return @[]
+  let left = stream.readChunks[0].len - stream.readPos
+  if count == left:
+    result = stream.readChunks.popFirst()
+    if stream.readPos > 0:
+      moveMem(addr result[0], addr result[stream.readPos], count)
+      result.setLen(count)
+    stream.readPos = 0
+    stream.buffered -= count
+  elif count < left:
+    result = stream.readChunks[0][stream.readPos ..< stream.readPos + count]
+    stream.readPos += count
+    stream.buffered -= count
+  else:
+    result = newSeq[byte](count)
+    var filled = 0
+    while filled < count:
+      let chunkLeft = stream.readChunks[0].len - stream.readPos
+      let n = min(chunkLeft, count - filled)
+      copyMem(addr result[filled], addr stream.readChunks[0][stream.readPos], n)
+      filled += n
+      stream.skipBytes(n)
 
+# --- Send Message ---
+proc sendMsg*(stream: GrpcStream, data: sink seq[byte]): Future[void] =
+  ## Send one message. Without compression the bytes of `data` go to the
+  ## socket as they are: the 5-byte gRPC prefix and the frame headers are
+  ## written around them, and a temporary such as `req.toBinary()` is moved
+  ## in rather than copied.
   when defined(traceGrpc):
     echo "[gRPC] sending data: ", data.toHex
-  
-  var frameData = newSeq[byte]()
-  frameData.add(compFlag)
-  let length = finalPayload.len.uint32
-  frameData.add(((length shr 24) and 0xFF).byte)
-  frameData.add(((length shr 16) and 0xFF).byte)
-  frameData.add(((length shr 8) and 0xFF).byte)
-  frameData.add((length and 0xFF).byte)
-  frameData.add(finalPayload)
-
-  await stream.httpStream.connection.sendFrame(packFrame(DATA, 0,
-      stream.httpStream.id, frameData))
+
+  var payload = data
+  var compFlag: byte = 0
+  if stream.sendCompression != CompressionIdentity:
+    payload = compressPayload(payload, stream.sendCompression)
+    compFlag = 1
+  let length = payload.len.uint32
+  let prefix = @[compFlag, ((length shr 24) and 0xFF).byte,
+      ((length shr 16) and 0xFF).byte, ((length shr 8) and 0xFF).byte,
+      (length and 0xFF).byte]
+  stream.httpStream.sendDataParts(prefix, payload, endStream = false)
+
+proc sendMsg*(stream: GrpcStream, data: openArray[byte]): Future[void] =
+  ## Send one message from any byte buffer. `data` is copied once, so the
+  ## buffer can be reused as soon as this returns.
+  stream.sendMsg(@data)
 
 # --- Send Close (Half Close) ---
 proc closeSend*(stream: GrpcStream) {.async.} =
   # Sends an empty DATA frame with END_STREAM set
-  await stream.httpStream.connection.sendFrame(packFrame(DATA,
-      FrameFlags.ACK_OR_END_STREAM.ord.uint8, stream.httpStream.id, []))
+  await stream.httpStream.sendData(@[], endStream = true)
 
-proc recvMsg*(stream: GrpcStream): Future[Option[seq[byte]]] {.async.} =
+proc waitMsg(stream: GrpcStream): Future[int] {.async.} =
+  # Read events until a whole message is buffered and return its length,
+  # or -1 at the end of the stream
   while true:
     # 1. Check if we have a complete message in the buffer
-    if stream.readBuffer.len >= 5:
-      let msgLen = (stream.readBuffer[1].uint32 shl 24) or (stream.readBuffer[2].uint32 shl 16) or
-                   (stream.readBuffer[3].uint32 shl 8) or stream.readBuffer[4].uint32
+    if stream.buffered >= 5:
+      let msgLen = (stream.peekByte(1).uint32 shl 24) or (stream.peekByte(2).uint32 shl 16) or
+                   (stream.peekByte(3).uint32 shl 8) or stream.peekByte(4).uint32
       let totalFrame = 5 + msgLen.int
 
-      if stream.readBuffer.len >= totalFrame:
-        let isCompressed = stream.readBuffer[0] == 1
-        let payload = stream.readBuffer[5 ..< totalFrame]
-
-        # Remove from buffer
-        if stream.readBuffer.len == totalFrame: stream.readBuffer = @[]
-        else: stream.readBuffer = stream.readBuffer[totalFrame .. ^1]
-
-        # Decompress and return
-        if isCompressed:
-          when defined(traceGrpc):
-            echo "[gRPC] receiving compressed frame: ", payload.toHex
-          return some(decompressPayload(payload, stream.recvEncoding))
-        else:
-          when defined(traceGrpc):
-            echo "[gRPC] receiving uncompressed frame: ", payload.toHex
-          return some(payload)
-
-    # 2. Check if the stream is truly finished.
+      if stream.buffered >= totalFrame:
+        return msgLen.int
+
+    # 2. Check if the stream is truly finished. No complete message is
+    # buffered at this point, so any bytes left are a truncated message.
     if stream.httpStream.closed and
-       stream.readBuffer.len < 5 and
        stream.httpStream.eventQueue.items.len == 0:
 
       # Check for error trailers
@@ -619,12 +882,15 @@ proc recvMsg*(stream: GrpcStream): Future[Option[seq[byte]]] {.async.} =
         if status != 0:
           let msg = stream.httpStream.trailers.getOrDefault("grpc-message", "Unknown error")
           raise newException(GrpcError, "gRPC Error " & $status & ": " & msg)
+      if stream.buffered > 0:
+        raise newException(GrpcError, "Stream ended inside a message, " &
+            $stream.buffered & " bytes left")
       when defined(traceGrpc):
         echo "[gRPC] returning EOF"
-      return none(seq[byte])
+      return -1
 
     # 3. Read more events
-    let evt = await stream.httpStream.eventQueue.get()
+    var evt = await stream.httpStream.eventQueue.get()
 
     case evt.kind
     of SE_HEADERS:
@@ -632,12 +898,68 @@ proc recvMsg*(stream: GrpcStream): Future[Option[seq[byte]]] {.async.} =
         stream.headers[h.name] = h.value
         if h.name == "grpc-encoding": stream.recvEncoding = h.value
     of SE_DATA:
-      stream.readBuffer.add(evt.data)
+      let length = evt.data.len
+      if length > 0:
+        stream.readChunks.addLast(move evt.data)
+        stream.buffered += length
+      stream.httpStream.consumeData(length)
     of SE_TRAILERS:
       for h in evt.headers: stream.trailers[h.name] = h.value
     of SE_RST:
       raise newException(IOError, "Stream reset by peer")
 
+proc recvMsg*(stream: GrpcStream): Future[Option[seq[byte]]] {.async.} =
+  ## Wait for the next message, or `none` once the peer ends the stream
+  let msgLen = await stream.waitMsg()
+  if msgLen < 0:
+    return none(seq[byte])
+  let isCompressed = stream.peekByte(0) == 1
+
+  # Remove from buffer
+  stream.skipBytes(5)
+  let payload = stream.takeBytes(msgLen)
+
+  # Decompress and return
+  if isCompressed:
+    when defined(traceGrpc):
+      echo "[gRPC] receiving compressed frame: ", payload.toHex
+    return some(decompressPayload(payload, stream.recvEncoding))
+  else:
+    when defined(traceGrpc):
+      echo "[gRPC] receiving uncompressed frame: ", payload.toHex
+    return some(payload)
+
+proc recvMsg*(stream: GrpcStream,
+    onMsg: proc(data: openArray[byte]) {.gcsafe.}): Future[bool] {.async.} =
+  ## Wait for the next message and pass its bytes to `onMsg`, or return
+  ## false once the peer ends the stream. An uncompressed message inside
+  ## one received DATA chunk is passed in place, without being copied out
+  ## of the receive buffer; others are assembled first. `data` is only
+  ## valid during the call.
+  ##
+  ## Example:
+  ## ```nim
+  ## var reply: TestReply
+  ## proc decode(data: openArray[byte]) = reply = TestReply.fromBinary(data)
+  ## while await stream.recvMsg(decode):
+  ##   echo reply.response
+  ## ```
+  let msgLen = await stream.waitMsg()
+  if msgLen < 0:
+    return false
+  let isCompressed = stream.peekByte(0) == 1
+  stream.skipBytes(5)
+  if not isCompressed and msgLen > 0 and
+      stream.readChunks[0].len - stream.readPos >= msgLen:
+    let start = stream.readPos
+    onMsg(stream.readChunks[0].toOpenArray(start, start + msgLen - 1))
+    stream.skipBytes(msgLen)
+  elif isCompressed:
+    onMsg(decompressPayload(stream.takeBytes(msgLen), stream.recvEncoding))
+  else:
+    onMsg(stream.takeBytes(msgLen))
+  return true
+
 
 # =============================================================================
 # 7. GRPC CLIENT
@@ -650,9 +972,10 @@ type GrpcChannel* = ref object
 proc newGrpcChannel*(host: string, port: int,
     compression: GrpcCompression = CompressionIdentity,
     sslVerify: bool = true,
-    certFile: string = ""): GrpcChannel =
+    certFile: string = "",
+    windowSize: int = DEFAULT_WINDOW_SIZE): GrpcChannel =
   new(result)
-  result.conn = newHttp2Connection(host, port, false)
+  result.conn = newHttp2Connection(host, port, false, windowSize)
   result.conn.sslVerify = sslVerify
   result.conn.sslCaFile = certFile
   result.compression = compression
@@ -660,7 +983,8 @@ proc newGrpcChannel*(host: string, port: int,
 proc newGrpcClient*(host: string, port: int,
     compression: GrpcCompression = CompressionIdentity,
     sslVerify: bool = true,
-    certFile: string = ""): GrpcChannel =
+    certFile: string = "",
+    windowSize: int = DEFAULT_WINDOW_SIZE): GrpcChannel =
   ## Create a new gRPC client channel.
   ##
   ## Arguments:
@@ -669,12 +993,14 @@ proc newGrpcClient*(host: string, port: int,
   ## - `compression`: The compression algorithm to use for sending messages.
   ## - `sslVerify`: Whether to verify the server's SSL certificate (default: true).
   ## - `certFile`: Path to a CA certificate file for verification (optional).
+  ## - `windowSize`: HTTP/2 receive window of each stream and of the connection.
+  ##   Larger windows let the server send more before waiting for us to read.
   ##
   ## Example:
   ## ```nim
   ## let client = newGrpcClient("localhost", 50051)
   ## ```
-  newGrpcChannel(host, port, compression, sslVerify, certFile)
+  newGrpcChannel(host, port, compression, sslVerify, certFile, windowSize)
 
 proc connect*(chan: GrpcChannel) {.async.} =
   ## Connect to the gRPC server.
@@ -730,25 +1056,112 @@ proc startRpc*(chan: GrpcChannel, methodPath: string, metadata: seq[
 
   return newGrpcStream(stream, false, chan.compression)
 
+proc recvAll(stream: GrpcStream): Future[seq[seq[byte]]] {.async.} =
+  while true:
+    let msgOpt = await stream.recvMsg()
+    if msgOpt.isNone: break
+    result.add(msgOpt.get())
+
 # Helper for Unary calls that wraps startRpc
 proc grpcInvoke*(chan: GrpcChannel, methodPath: string, requests: seq[seq[
     byte]], metadata: seq[HpackHeader] = @[]): Future[seq[seq[
     byte]]] {.async.} =
   let stream = await chan.startRpc(methodPath, metadata)
 
-  # Send all requests
+  # Read responses while the requests go out: a streaming server that
+  # answers before the last request would otherwise stall on a full window
+  let responses = stream.recvAll()
   for req in requests:
     await stream.sendMsg(req)
 
   await stream.closeSend()
 
-  var responses: seq[seq[byte]] = @[]
-  while true:
-    let msgOpt = await stream.recvMsg()
-    if msgOpt.isNone: break
-    responses.add(msgOpt.get())
+  return await responses
+
+# Typed handle of a streaming call. Responses are decoded one at a time as
+# they arrive, so a long stream never sits in memory as a whole.
+type GrpcCall*[Req, Resp] = ref object
+  stream*: GrpcStream
+  sending: Future[void] # requests queued by `sendAll`, if any
+
+proc startCall*[Req, Resp](chan: GrpcChannel, methodPath: string,
+    metadata: seq[HpackHeader] = @[]): Future[GrpcCall[Req, Resp]] {.async.} =
+  ## Start a call whose requests are `Req` and responses are `Resp`.
+  ##
+  ## Example:
+  ## ```nim
+  ## let call = await startCall[TestRequest, TestReply](client, "/TestService/StreamTest")
+  ## ```
+  let stream = await chan.startRpc(methodPath, metadata)
+  return GrpcCall[Req, Resp](stream: stream)
+
+proc recv*[Req, Resp](call: GrpcCall[Req, Resp]): Future[Option[Resp]] {.async.} =
+  ## Wait for the next response, or `none` once the server ends the stream.
+  ## A non-OK status in the trailers raises `GrpcError`.
+  ##
+  ## Example:
+  ## ```nim
+  ## while true:
+  ##   let reply = await call.recv()
+  ##   if reply.isNone: break
+  ##   echo reply.get().response
+  ## ```
+  # Decoded straight from the receive buffer where the message allows it
+  var resp: Resp
+  let received = await call.stream.recvMsg(proc(data: openArray[byte]) =
+    resp = Resp.fromBinary(data))
+  if not received:
+    if call.sending != nil and call.sending.failed:
+      raise call.sending.readError()
+    return none(Resp)
+  return some(resp)
+
+proc send*[Req, Resp](call: GrpcCall[Req, Resp], req: Req): Future[void] =
+  ## Encode and send one request. The future completes once the request is
+  ## written to the connection, so a producer awaiting each `send` holds
+  ## only one encoded request at a time.
+  ##
+  ## Example:
+  ## ```nim
+  ## for row in cursor:
+  ##   await call.send(TestRequest(message: row))
+  ## await call.closeSend()
+  ## ```
+  call.stream.sendMsg(req.toBinary())
+
+proc closeSend*[Req, Resp](call: GrpcCall[Req, Resp]): Future[void] =
+  ## Tell the server that no more requests follow.
+  call.stream.closeSend()
+
+proc sendRequests[Req, Resp](call: GrpcCall[Req, Resp],
+    reqs: seq[Req]) {.async.} =
+  for req in reqs:
+    await call.send(req)
+  await call.closeSend()
+
+proc sendAll*[Req, Resp](call: GrpcCall[Req, Resp], reqs: seq[Req]) =
+  ## Send `reqs` and close the request side in the background, so the
+  ## caller can read responses while the requests go out. Waiting for all
+  ## sends first would stall once the server blocks on unread responses.
+  ## A failed send is raised by `recv` at the end of the stream.
+  ##
+  ## Example:
+  ## ```nim
+  ## call.sendAll(requests)
+  ## while true:
+  ##   let reply = await call.recv()
+  ##   if reply.isNone: break
+  ##   echo reply.get().response
+  ## ```
+  call.sending = call.sendRequests(reqs)
 
-  return responses
+proc finish*[Req, Resp](call: GrpcCall[Req, Resp]): Future[Resp] {.async.} =
+  ## End the requests of a client-streaming call and wait for its response.
+  await call.closeSend()
+  let resp = await call.recv()
+  if resp.isNone:
+    raise newException(ValueError, "No response received")
+  return resp.get()
 
 # =============================================================================
 # 8. GRPC SERVER
@@ -764,9 +1177,11 @@ type GrpcServer* = ref object
   preferredResponseCompression: GrpcCompression
   certFile: string
   keyFile: string
+  windowSize: int
 
 proc newGrpcServer*(port: int, preferredCompression: GrpcCompression = CompressionIdentity,
-                    certFile: string = "", keyFile: string = ""): GrpcServer =
+                    certFile: string = "", keyFile: string = "",
+                    windowSize: int = DEFAULT_WINDOW_SIZE): GrpcServer =
   ## Create a new gRPC server.
   ##
   ## Arguments:
@@ -774,19 +1189,22 @@ proc newGrpcServer*(port: int, preferredCompression: GrpcCompression = Compressi
   ## - `preferredCompression`: The preferred compression algorithm for responses.
   ## - `certFile`: Path to the SSL certificate file (PEM format).
   ## - `keyFile`: Path to the SSL private key file (PEM format).
+  ## - `windowSize`: HTTP/2 receive window of each stream and connection.
   ##
   ## Example:
   ## ```nim
   ## let server = newGrpcServer(50051)
   ## ```
   new(result)
-  result.socket = newAsyncSocket()
+  # Accepted sockets inherit this, and readLoop needs them unbuffered
+  result.socket = newAsyncSocket(buffered = false)
   result.socket.setSockOpt(OptReuseAddr, true)
   result.port = port
   result.handlers = initTable[string, RpcHandler]()
   result.preferredResponseCompression = preferredCompression
   result.certFile = certFile
   result.keyFile = keyFile
+  result.windowSize = windowSize
 
 proc registerHandler*(server: GrpcServer, path: string, handler: RpcHandler) =
   ## Register a handler for a specific gRPC method path.
@@ -885,8 +1303,10 @@ proc handleServerStream(server: GrpcServer, httpStream: Http2Stream) {.async.} =
         httpStream.id, encodeHeaders(httpStream.connection.hpack, trailers)))
 
 proc processClient(server: GrpcServer, socket: AsyncSocket) {.async.} =
-  let conn = newHttp2Connection("", 0, isServer = true)
+  let conn = newHttp2Connection("", 0, isServer = true,
+      initialWindowSize = server.windowSize)
   conn.socket = socket
+  conn.socket.setSockOpt(OptNoDelay, true, level = IPPROTO_TCP.toInt)
   conn.onNewStream = proc(s: Http2Stream) {.async.} =
     await server.handleServerStream(s)
   try:
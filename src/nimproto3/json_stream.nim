@@ -0,0 +1,220 @@
+## Streaming JSON helpers used by the generated `toJsonString`,
+## `fromJsonString` and `readJson` procs
+##
+## The writers append JSON text straight to a string buffer, and the readers
+## pull tokens from a `std/parsejson` parser and convert them in place. No
+## `JsonNode` tree is built in either direction. The text has the same shape
+## as the generated `toJson`: default scalars are omitted, enums are written
+## as numbers and `bytes` as arrays of numbers.
+##
+## Every reader consumes the value under the parser's current token and
+## moves the parser past it.
+
+import std/[json, parsejson, streams, strutils]
+
+# -----------------------------------------------------------------------------
+# WRITING
+# -----------------------------------------------------------------------------
+
+proc writeJsonKey*(buf: var string, objStart: int, key: string) {.inline.} =
+  ## Write `"key":`, preceded by a comma unless it is the first key of the
+  ## object whose body starts at `objStart`
+  if buf.len > objStart:
+    buf.add(',')
+  escapeJson(key, buf)
+  buf.add(':')
+
+proc writeJsonKey*(buf: var string, objStart: int, key: cstring) {.inline.} =
+  ## Write a field name as a key. Field names need no escaping.
+  if buf.len > objStart:
+    buf.add(',')
+  buf.add('"')
+  buf.add(key)
+  buf.add("\":")
+
+proc writeJsonInt*(buf: var string, value: BiggestInt) {.inline.} =
+  buf.addInt(value)
+
+proc writeJsonUInt*(buf: var string, value: uint64) {.inline.} =
+  if value > uint64(high(int64)):
+    buf.add($value)
+  else:
+    buf.addInt(BiggestInt(value))
+
+proc writeJsonFloat*(buf: var string, value: float) =
+  ## NaN and infinities are written as the strings `%` uses
+  if value != value:
+    buf.add("\"nan\"")
+  elif value == Inf:
+    buf.add("\"inf\"")
+  elif value == -Inf:
+    buf.add("\"-inf\"")
+  else:
+    buf.addFloat(value)
+
+proc writeJsonBool*(buf: var string, value: bool) {.inline.} =
+  buf.add(if value: "true" else: "false")
+
+proc writeJsonString*(buf: var string, value: string) {.inline.} =
+  escapeJson(value, buf)
+
+proc writeJsonString*(buf: var string, value: openArray[byte]) =
+  ## Write UTF-8 bytes as a JSON string, escaped like `escapeJson`
+  buf.add('"')
+  for b in value:
+    let c = char(b)
+    case c
+    of '\L': buf.add("\\n")
+    of '\b': buf.add("\\b")
+    of '\f': buf.add("\\f")
+    of '\t': buf.add("\\t")
+    of '\v': buf.add("\\u000b")
+    of '\r': buf.add("\\r")
+    of '"': buf.add("\\\"")
+    of '\0'..'\7': buf.add("\\u000" & $ord(c))
+    of '\14'..'\31': buf.add("\\u00" & toHex(ord(c), 2))
+    of '\\': buf.add("\\\\")
+    else: buf.add(c)
+  buf.add('"')
+
+proc writeJsonElementStart*(buf: var string, objStart: int,
+    key: string | cstring, first: var bool, open: char = '[') {.inline.} =
+  ## Before the first element of an array (or map object) under `key`, write
+  ## the key and the opening bracket; before the others, a comma
+  if first:
+    buf.writeJsonKey(objStart, key)
+    buf.add(open)
+    first = false
+  else:
+    buf.add(',')
+
+proc writeJsonBytes*(buf: var string, value: openArray[byte]) =
+  buf.add('[')
+  for i, b in value:
+    if i > 0:
+      buf.add(',')
+    buf.addInt(int(b))
+  buf.add(']')
+
+# -----------------------------------------------------------------------------
+# READING
+# -----------------------------------------------------------------------------
+
+proc openJsonParser*(p: var JsonParser, text: string) =
+  ## Open `p` over `text` and load the first token
+  p.open(newStringStream(text), "")
+  p.next()
+
+proc closeJsonParser*(p: var JsonParser) =
+  ## Check that the whole input was consumed, then close `p`
+  if p.kind != jsonEof:
+    raiseParseErr(p, "end of input")
+  p.close()
+
+proc expectJson*(p: var JsonParser, kind: JsonEventKind) =
+  ## Check that the current token is `kind` and move past it
+  if p.kind != kind:
+    if p.kind == jsonError:
+      raise newException(JsonParsingError, errorMsg(p))
+    raiseParseErr(p, $kind)
+  p.next()
+
+proc readJsonKey*(p: var JsonParser, key: var string) =
+  ## Read an object key into `key`, reusing its capacity
+  if p.kind != jsonString:
+    p.expectJson(jsonString)
+  key.setLen(0)
+  key.add(p.a)
+  p.next()
+
+proc readJsonInt*(p: var JsonParser): BiggestInt =
+  ## Integers may also be given as strings
+  case p.kind
+  of jsonInt, jsonString:
+    try:
+      result = parseBiggestInt(p.a)
+    except ValueError:
+      raiseParseErr(p, "integer")
+  else:
+    raiseParseErr(p, "integer")
+  p.next()
+
+proc readJsonUInt*(p: var JsonParser): uint64 =
+  case p.kind
+  of jsonInt, jsonString:
+    try:
+      result = parseBiggestUInt(p.a)
+    except ValueError:
+      raiseParseErr(p, "unsigned integer")
+  else:
+    raiseParseErr(p, "unsigned integer")
+  p.next()
+
+proc readJsonFloat*(p: var JsonParser): float =
+  ## Accepts numbers and the strings written for NaN and infinities
+  case p.kind
+  of jsonInt, jsonFloat:
+    result = parseFloat(p.a)
+  of jsonString:
+    case p.a
+    of "nan", "NaN": result = NaN
+    of "inf", "Infinity": result = Inf
+    of "-inf", "-Infinity": result = -Inf
+    else:
+      try:
+        result = parseFloat(p.a)
+      except ValueError:
+        raiseParseErr(p, "number")
+  else:
+    raiseParseErr(p, "number")
+  p.next()
+
+proc readJsonBool*(p: var JsonParser): bool =
+  case p.kind
+  of jsonTrue: result = true
+  of jsonFalse: result = false
+  else: raiseParseErr(p, "true or false")
+  p.next()
+
+proc readJsonString*(p: var JsonParser, dest: var string) =
+  ## Read a string into `dest`, reusing its capacity
+  if p.kind != jsonString:
+    p.expectJson(jsonString)
+  dest.setLen(0)
+  dest.add(p.a)
+  p.next()
+
+proc readJsonString*(p: var JsonParser): string =
+  p.readJsonString(result)
+
+proc readJsonBytes*(p: var JsonParser, dest: var seq[byte]) =
+  ## Read an array of byte values into `dest`, reusing its capacity
+  dest.setLen(0)
+  p.expectJson(jsonArrayStart)
+  while p.kind != jsonArrayEnd:
+    let b = p.readJsonInt()
+    if b < 0 or b > 255:
+      raiseParseErr(p, "byte value")
+    dest.add(byte(b))
+  p.next()
+
+proc readJsonBytes*(p: var JsonParser): seq[byte] =
+  p.readJsonBytes(result)
+
+proc skipJsonValue*(p: var JsonParser) =
+  ## Move past the current value, including everything nested in it
+  case p.kind
+  of jsonObjectStart, jsonArrayStart:
+    var depth = 0
+    while true:
+      case p.kind
+      of jsonObjectStart, jsonArrayStart: inc depth
+      of jsonObjectEnd, jsonArrayEnd: dec depth
+      of jsonError, jsonEof: p.expectJson(jsonObjectEnd)
+      else: discard
+      p.next()
+      if depth == 0: break
+  of jsonString, jsonInt, jsonFloat, jsonTrue, jsonFalse, jsonNull:
+    p.next()
+  else:
+    raiseParseErr(p, "value")
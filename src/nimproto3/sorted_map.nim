@@ -0,0 +1,106 @@
+## Sorted entry sequences for proto `map` fields
+##
+## With `mrSortedSeq` a `map<K, V>` field is generated as `SortedMap[K, V]`,
+## a plain `seq[(K, V)]` kept in ascending key order. For small maps that
+## are mostly iterated this is cheaper than a `Table`: decoding fills one
+## pre-sized seq, there is no hashing, and the entries are encoded in key
+## order. Lookups are binary searches.
+##
+## The generated decoders keep the order themselves. Code that adds entries
+## with `add` should call `sortEntries` afterwards, or use `put`.
+##
+## `sortedPairs` walks a `Table` or `OrderedTable` in the same key order. It is
+## what deterministic `toBinary` uses for maps in the other representations.
+## `sameEntries` and `hashEntries` compare and hash an `OrderedTable` without
+## regard to insertion order, as the generated `==` and `hash` need.
+
+import std/[algorithm, hashes, tables]
+
+type
+  SortedMap*[K, V] = seq[(K, V)]
+
+proc cmpKeys[K, V](a, b: (K, V)): int =
+  cmp(a[0], b[0])
+
+proc findKey[K, V](m: SortedMap[K, V], key: K): int =
+  ## Index of the first entry whose key is not less than `key`
+  var lo = 0
+  var hi = m.len
+  while lo < hi:
+    let mid = (lo + hi) shr 1
+    if m[mid][0] < key:
+      lo = mid + 1
+    else:
+      hi = mid
+  lo
+
+proc hasKey*[K, V](m: SortedMap[K, V], key: K): bool =
+  let i = m.findKey(key)
+  i < m.len and m[i][0] == key
+
+proc getOrDefault*[K, V](m: SortedMap[K, V], key: K,
+    default: V = default(V)): V =
+  let i = m.findKey(key)
+  if i < m.len and m[i][0] == key: m[i][1] else: default
+
+proc put*[K, V](m: var SortedMap[K, V], key: K, val: sink V) =
+  ## Insert `key` or replace its value, keeping the keys sorted
+  let i = m.findKey(key)
+  if i < m.len and m[i][0] == key:
+    m[i][1] = val
+  else:
+    m.insert((key, val), i)
+
+proc sortEntries*[K, V](m: var SortedMap[K, V]) =
+  ## Restore key order after entries were appended. For duplicate keys the
+  ## entry added last wins, as for a repeated map key on the wire. Costs one
+  ## pass when the entries are already in order.
+  var ordered = true
+  for i in 1 ..< m.len:
+    if not (m[i - 1][0] < m[i][0]):
+      ordered = false
+      break
+  if ordered:
+    return
+  m.sort(cmpKeys[K, V])  # stable, so equal keys keep their arrival order
+  var kept = 0
+  for i in 0 ..< m.len:
+    if i + 1 < m.len and m[i + 1][0] == m[i][0]:
+      continue
+    if kept != i:
+      m[kept] = move(m[i])
+    inc kept
+  m.setLen(kept)
+
+proc reserveEntries*[K, V](m: var SortedMap[K, V], extra: int) =
+  ## Make room for `extra` more entries with at most one reallocation
+  if m.capacity >= m.len + extra:
+    return
+  var grown = newSeqOfCap[(K, V)](m.len + extra)
+  for entry in m.mitems:
+    grown.add(move(entry))
+  m = move(grown)
+
+iterator sortedPairs*[K, V](t: Table[K, V] | OrderedTable[K, V]): (K, V) =
+  ## Entries of `t` in ascending key order
+  var keys = newSeqOfCap[K](t.len)
+  for key in t.keys:
+    keys.add(key)
+  keys.sort()
+  for key in keys:
+    yield (key, t[key])
+
+proc sameEntries*[K, V](a, b: OrderedTable[K, V]): bool =
+  ## Whether `a` and `b` hold the same entries, in any order
+  if a.len != b.len:
+    return false
+  for key, val in a:
+    if not b.hasKey(key) or b[key] != val:
+      return false
+  true
+
+proc hashEntries*[K, V](t: OrderedTable[K, V]): Hash =
+  ## Hash of the entries of `t` that does not depend on their order
+  for entry in t.pairs:
+    result = result xor hash(entry)
+  result = !$result
@@ -0,0 +1,1260 @@
+## Table-driven serialization for generated messages
+##
+## With `CodegenOptions(tableDriven: true)` (`protonim --tableDriven`,
+## `-d:protoTableDriven` for the macros) every message gets a `MessageTable`:
+## one `TableField` per field with its number, kind, shape and offset in the
+## object, filled in by `initMessageTable` when the generated module is
+## initialized. `byteSize`, `toBinary`, `mergeFromBinary`, `fromBinary`,
+## `toJson`, `fromJson`, the streaming JSON procs, `==`, `hash` and the view
+## accessors of the message are then one-line wrappers around the procs of
+## this module, so the generated code, and the C compiled from it, no longer
+## grows with a dozen unrolled procs per message.
+##
+## Fields are reached through their offset and read as the Nim type of their
+## kind, e.g. `int32` for `fkSInt32` and for enums, which are generated with
+## `{.size: 4.}`. Nested messages are encoded through their own table. The
+## few operations that need the concrete type (growing a seq of messages,
+## switching a oneof, map access) go through small generic procs that are
+## instantiated once per type, not once per field.
+
+import std/[algorithm, json, parsejson, tables, hashes, strutils]
+import ./[wire_format, sorted_map, dynamic, json_stream, view]
+
+type
+  FieldShape* = enum
+    fsSingular ## written unless it has its default value
+    fsOneof    ## written when its oneof selects it
+    fsRepeated
+    fsMap
+
+  TableField* = object
+    name*: cstring              ## proto field name, the JSON key
+    number*: int
+    kind*: FieldKind            ## kind of the value, for maps of the map value
+    keyKind*: FieldKind         ## kind of map keys
+    shape*: FieldShape
+    offset*: int                ## offset of the field in the object
+    message*: ptr MessageTable  ## table of message values, else nil
+    oneofOffset*: int           ## offset of the oneof discriminator
+    oneofKind*: int32           ## discriminator value selecting this field
+    setOneof*: proc (p: pointer, kind: int32) {.nimcall, gcsafe.}
+    # seq of messages
+    seqLen: proc (p: pointer): int {.nimcall, gcsafe.}
+    seqItem: proc (p: pointer, i: int): pointer {.nimcall, gcsafe.}
+    seqGrow: proc (p: pointer): pointer {.nimcall, gcsafe.}
+    # maps
+    mapSize: proc (field: ptr TableField, p: pointer, sorted: bool,
+        sizes: var seq[int]): int {.nimcall, gcsafe.}
+    mapWrite: proc (field: ptr TableField, p: pointer, buf: var seq[byte],
+        sorted: bool, sizes: openArray[int], pos: var int) {.nimcall, gcsafe.}
+    mapRead: proc (field: ptr TableField, p: pointer,
+        data: openArray[byte]) {.nimcall, gcsafe.}
+    mapFinish: proc (p: pointer) {.nimcall, gcsafe.}
+    mapToJson: proc (field: ptr TableField, p: pointer): JsonNode {.nimcall, gcsafe.}
+    mapFromJson: proc (field: ptr TableField, p: pointer,
+        node: JsonNode) {.nimcall, gcsafe.}
+    mapWriteJson: proc (field: ptr TableField, p: pointer, objStart: int,
+        buf: var string) {.nimcall, gcsafe.}
+    mapReadJson: proc (field: ptr TableField, p: pointer,
+        parser: var JsonParser) {.nimcall, gcsafe.}
+    mapEquals: proc (a, b: pointer): bool {.nimcall, gcsafe.}
+    mapHash: proc (p: pointer): Hash {.nimcall, gcsafe.}
+    group: int                  ## position of `number` in `sortedNumbers`
+
+  MessageTable* = object
+    ## Field table of a generated message. It lives in shared memory and is
+    ## never freed, so generated procs can read it from any thread.
+    fields*: ptr UncheckedArray[TableField]
+    len*: int
+    byNumber: ptr UncheckedArray[int16] ## field number -> index + 1
+    numbers: int
+    sortedNumbers: ptr UncheckedArray[int] ## field numbers, ascending
+    unknownFields*: int  ## offset of `unknownFields`, or -1
+    deterministic*: bool ## write map entries in key order
+    finishMaps: bool     ## has maps that are sorted after decoding
+
+const
+  packedKinds = {low(FieldKind) .. high(FieldKind)} -
+      {fkString, fkBytes, fkMessage}
+  maxDenseNumber = 4096
+    ## Field numbers above this are found by a scan of the fields
+
+template at(p: pointer, offset: int): pointer =
+  cast[pointer](cast[uint](p) + uint(offset))
+
+template fieldPtr(p: pointer, field: TableField): pointer =
+  at(p, field.offset)
+
+template fieldAs(p: pointer, T: typedesc): untyped =
+  cast[ptr T](p)[]
+
+proc fieldIndex(table: MessageTable, number: int): int {.inline.} =
+  if number >= 0 and number < table.numbers:
+    return int(table.byNumber[number]) - 1
+  for i in 0 ..< table.len:
+    if table.fields[i].number == number:
+      return i
+  -1
+
+proc fieldIndex(table: MessageTable, name: string, hint: int): int =
+  ## Index of the field called `name`, or -1. The scan starts at `hint`, the
+  ## field after the previous key, as keys mostly come in field order.
+  for k in 0 ..< table.len:
+    let i = (hint + k) mod table.len
+    if table.fields[i].name == name.cstring:
+      return i
+  -1
+
+# -----------------------------------------------------------------------------
+# BINARY
+# -----------------------------------------------------------------------------
+
+proc tableSize*(table: ptr MessageTable, p: pointer,
+    sizes: var seq[int]): int {.gcsafe.}
+proc tableWrite*(table: ptr MessageTable, p: pointer, buf: var seq[byte],
+    sizes: openArray[int], pos: var int) {.gcsafe.}
+proc tableMerge*(table: ptr MessageTable, p: pointer, data: openArray[byte],
+    fields: set[FieldNumber] = AllFields) {.gcsafe.}
+
+proc isDefault(kind: FieldKind, p: pointer): bool =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum: p.fieldAs(int32) == 0
+  of fkInt64, fkSInt64, fkSFixed64: p.fieldAs(int64) == 0
+  of fkUInt32, fkFixed32: p.fieldAs(uint32) == 0
+  of fkUInt64, fkFixed64: p.fieldAs(uint64) == 0
+  of fkFloat: p.fieldAs(float32) == 0
+  of fkDouble: p.fieldAs(float64) == 0
+  of fkBool: not p.fieldAs(bool)
+  of fkString: p.fieldAs(string).len == 0
+  of fkBytes: p.fieldAs(seq[byte]).len == 0
+  of fkMessage: false
+
+proc scalarSize(kind: FieldKind, p: pointer): int =
+  ## Encoded size of the scalar, string or bytes value at `p`
+  case kind
+  of fkInt32, fkEnum: sizeInt32(p.fieldAs(int32))
+  of fkInt64: sizeInt64(p.fieldAs(int64))
+  of fkUInt32: sizeUInt32(p.fieldAs(uint32))
+  of fkUInt64: sizeUInt64(p.fieldAs(uint64))
+  of fkSInt32: sizeSInt32(p.fieldAs(int32))
+  of fkSInt64: sizeSInt64(p.fieldAs(int64))
+  of fkBool: 1
+  of fkFixed32, fkSFixed32, fkFloat: 4
+  of fkFixed64, fkSFixed64, fkDouble: 8
+  of fkString: sizeString(p.fieldAs(string))
+  of fkBytes: sizeString(p.fieldAs(seq[byte]))
+  of fkMessage: 0
+
+proc valueSize(kind: FieldKind, message: ptr MessageTable, p: pointer,
+    sizes: var seq[int]): int =
+  ## Encoded size of the value at `p`, without its key. The length of a
+  ## message is recorded in `sizes`.
+  if kind == fkMessage:
+    let slot = sizes.reserveSize()
+    let size = tableSize(message, p, sizes)
+    sizes[slot] = size
+    sizeLengthDelimited(size)
+  else:
+    scalarSize(kind, p)
+
+proc writeScalar(buf: var seq[byte], kind: FieldKind, p: pointer) =
+  ## Write the scalar, string or bytes value at `p`
+  case kind
+  of fkInt32, fkEnum: buf.writeInt32(p.fieldAs(int32))
+  of fkInt64: buf.writeInt64(p.fieldAs(int64))
+  of fkUInt32: buf.writeUInt32(p.fieldAs(uint32))
+  of fkUInt64: buf.writeUInt64(p.fieldAs(uint64))
+  of fkSInt32: buf.writeSInt32(p.fieldAs(int32))
+  of fkSInt64: buf.writeSInt64(p.fieldAs(int64))
+  of fkBool: buf.writeBool(p.fieldAs(bool))
+  of fkFixed32: buf.writeFixed32(p.fieldAs(uint32))
+  of fkFixed64: buf.writeFixed64(p.fieldAs(uint64))
+  of fkSFixed32: buf.writeSFixed32(p.fieldAs(int32))
+  of fkSFixed64: buf.writeSFixed64(p.fieldAs(int64))
+  of fkFloat: buf.writeFloat32(p.fieldAs(float32))
+  of fkDouble: buf.writeFloat64(p.fieldAs(float64))
+  of fkString: buf.writeString(p.fieldAs(string))
+  of fkBytes: buf.writeString(p.fieldAs(seq[byte]))
+  of fkMessage: discard
+
+proc writeValue(buf: var seq[byte], kind: FieldKind, message: ptr MessageTable,
+    p: pointer, sizes: openArray[int], pos: var int) =
+  ## Write the value at `p`, length prefixed if it is a message
+  if kind == fkMessage:
+    buf.writeVarint(uint64(sizes.nextSize(pos)))
+    tableWrite(message, p, buf, sizes, pos)
+  else:
+    buf.writeScalar(kind, p)
+
+proc readValue(data: openArray[byte], pos: var int, kind: FieldKind,
+    message: ptr MessageTable, p: pointer) =
+  ## Decode a value into `p`. Strings and bytes reuse their capacity,
+  ## messages are merged.
+  case kind
+  of fkInt32, fkEnum: p.fieldAs(int32) = decodeInt32(data, pos)
+  of fkInt64: p.fieldAs(int64) = decodeInt64(data, pos)
+  of fkUInt32: p.fieldAs(uint32) = decodeUInt32(data, pos)
+  of fkUInt64: p.fieldAs(uint64) = decodeUInt64(data, pos)
+  of fkSInt32: p.fieldAs(int32) = decodeSInt32(data, pos)
+  of fkSInt64: p.fieldAs(int64) = decodeSInt64(data, pos)
+  of fkBool: p.fieldAs(bool) = decodeBool(data, pos)
+  of fkFixed32: p.fieldAs(uint32) = decodeFixed32(data, pos)
+  of fkFixed64: p.fieldAs(uint64) = decodeFixed64(data, pos)
+  of fkSFixed32: p.fieldAs(int32) = decodeSFixed32(data, pos)
+  of fkSFixed64: p.fieldAs(int64) = decodeSFixed64(data, pos)
+  of fkFloat: p.fieldAs(float32) = decodeFloat32(data, pos)
+  of fkDouble: p.fieldAs(float64) = decodeFloat64(data, pos)
+  of fkString: decodeStringInto(data, pos, p.fieldAs(string))
+  of fkBytes: decodeLengthDelimitedInto(data, pos, p.fieldAs(seq[byte]))
+  of fkMessage:
+    let span = decodeLengthDelimitedSpan(data, pos)
+    tableMerge(message, p, data.toOpenArray(span.a, span.b))
+
+template withScalarSeq(kind: FieldKind, p: pointer, s, body: untyped) =
+  ## Run `body` with `s` bound to the seq of scalars at `p`
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum:
+    template s: untyped = p.fieldAs(seq[int32])
+    body
+  of fkInt64, fkSInt64, fkSFixed64:
+    template s: untyped = p.fieldAs(seq[int64])
+    body
+  of fkUInt32, fkFixed32:
+    template s: untyped = p.fieldAs(seq[uint32])
+    body
+  of fkUInt64, fkFixed64:
+    template s: untyped = p.fieldAs(seq[uint64])
+    body
+  of fkFloat:
+    template s: untyped = p.fieldAs(seq[float32])
+    body
+  of fkDouble:
+    template s: untyped = p.fieldAs(seq[float64])
+    body
+  of fkBool:
+    template s: untyped = p.fieldAs(seq[bool])
+    body
+  of fkString:
+    template s: untyped = p.fieldAs(seq[string])
+    body
+  of fkBytes:
+    template s: untyped = p.fieldAs(seq[seq[byte]])
+    body
+  of fkMessage:
+    discard
+
+proc packedSize(kind: FieldKind, p: pointer): int =
+  ## Payload size of a packed repeated field
+  withScalarSeq(kind, p, s):
+    case kind
+    of fkFixed32, fkSFixed32, fkFloat: result = s.len * 4
+    of fkFixed64, fkSFixed64, fkDouble: result = s.len * 8
+    of fkBool: result = s.len
+    else:
+      for i in 0 ..< s.len:
+        result += scalarSize(kind, addr s[i])
+
+proc repeatedLen(field: TableField, p: pointer): int =
+  if field.kind == fkMessage:
+    result = field.seqLen(p)
+  else:
+    withScalarSeq(field.kind, p, s):
+      result = s.len
+
+proc fieldSize(table: ptr MessageTable, field: ptr TableField, msg: pointer,
+    sizes: var seq[int]): int =
+  let p = fieldPtr(msg, field[])
+  let tagLen = tagSize(field.number)
+  case field.shape
+  of fsSingular:
+    if field.kind == fkMessage:
+      # An empty message keeps its slot for writeField to read, the lengths
+      # recorded below it are dropped
+      let slot = sizes.reserveSize()
+      let size = tableSize(field.message, p, sizes)
+      sizes[slot] = size
+      if size > 0:
+        result = tagLen + sizeLengthDelimited(size)
+      else:
+        sizes.setLen(slot + 1)
+    elif not isDefault(field.kind, p):
+      result = tagLen + scalarSize(field.kind, p)
+  of fsOneof:
+    if at(msg, field.oneofOffset).fieldAs(int32) == field.oneofKind:
+      result = tagLen + valueSize(field.kind, field.message, p, sizes)
+  of fsRepeated:
+    let n = repeatedLen(field[], p)
+    if n == 0:
+      return 0
+    if field.kind in packedKinds:
+      let size = packedSize(field.kind, p)
+      sizes.add(size)
+      result = tagLen + sizeLengthDelimited(size)
+    elif field.kind == fkMessage:
+      for i in 0 ..< n:
+        result += tagLen + valueSize(fkMessage, field.message,
+            field.seqItem(p, i), sizes)
+    else:
+      withScalarSeq(field.kind, p, s):
+        for i in 0 ..< n:
+          result += tagLen + scalarSize(field.kind, addr s[i])
+  of fsMap:
+    result = field.mapSize(field, p, table.deterministic, sizes)
+
+proc tableSize*(table: ptr MessageTable, p: pointer,
+    sizes: var seq[int]): int =
+  ## Encoded size of the message at `p`. The length of every nested
+  ## message, packed run and map entry is appended to `sizes` in the order
+  ## `tableWrite` writes them.
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    result += fieldSize(table, field, p, sizes)
+  if table.unknownFields >= 0:
+    result += at(p, table.unknownFields).fieldAs(seq[byte]).len
+
+proc tableSize*(table: ptr MessageTable, p: pointer): int =
+  ## Encoded size of the message at `p`
+  var sizes: seq[int]
+  tableSize(table, p, sizes)
+
+proc writePacked(buf: var seq[byte], kind: FieldKind, p: pointer) =
+  withScalarSeq(kind, p, s):
+    case kind
+    of fkFloat: buf.writePackedFloat32s(p.fieldAs(seq[float32]))
+    of fkDouble: buf.writePackedFloat64s(p.fieldAs(seq[float64]))
+    of fkFixed32: buf.writePackedFixed32s(p.fieldAs(seq[uint32]))
+    of fkFixed64: buf.writePackedFixed64s(p.fieldAs(seq[uint64]))
+    of fkSFixed32: buf.writePackedSFixed32s(p.fieldAs(seq[int32]))
+    of fkSFixed64: buf.writePackedSFixed64s(p.fieldAs(seq[int64]))
+    else:
+      for i in 0 ..< s.len:
+        buf.writeScalar(kind, addr s[i])
+
+proc writeField(buf: var seq[byte], table: ptr MessageTable,
+    field: ptr TableField, msg: pointer, sizes: openArray[int], pos: var int) =
+  let p = fieldPtr(msg, field[])
+  case field.shape
+  of fsSingular:
+    if field.kind == fkMessage:
+      let size = sizes.nextSize(pos)
+      if size > 0:
+        buf.writeTag(field.number, wtLengthDelimited)
+        buf.writeVarint(uint64(size))
+        tableWrite(field.message, p, buf, sizes, pos)
+    elif not isDefault(field.kind, p):
+      buf.writeTag(field.number, kindWireTypes[field.kind])
+      buf.writeScalar(field.kind, p)
+  of fsOneof:
+    if at(msg, field.oneofOffset).fieldAs(int32) == field.oneofKind:
+      buf.writeTag(field.number, kindWireTypes[field.kind])
+      buf.writeValue(field.kind, field.message, p, sizes, pos)
+  of fsRepeated:
+    let n = repeatedLen(field[], p)
+    if n == 0:
+      return
+    if field.kind in packedKinds:
+      buf.writeTag(field.number, wtLengthDelimited)
+      buf.writeVarint(uint64(sizes.nextSize(pos)))
+      buf.writePacked(field.kind, p)
+    elif field.kind == fkMessage:
+      for i in 0 ..< n:
+        buf.writeTag(field.number, wtLengthDelimited)
+        buf.writeValue(fkMessage, field.message, field.seqItem(p, i), sizes, pos)
+    else:
+      withScalarSeq(field.kind, p, s):
+        for i in 0 ..< n:
+          buf.writeTag(field.number, wtLengthDelimited)
+          buf.writeScalar(field.kind, addr s[i])
+  of fsMap:
+    field.mapWrite(field, p, buf, table.deterministic, sizes, pos)
+
+proc tableWrite*(table: ptr MessageTable, p: pointer, buf: var seq[byte],
+    sizes: openArray[int], pos: var int) =
+  ## Append the encoding of the message at `p` to `buf`, taking lengths
+  ## from `sizes[pos .. ^1]` as recorded by `tableSize(table, p, sizes)`
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    buf.writeField(table, field, p, sizes, pos)
+  if table.unknownFields >= 0:
+    let unknown = addr at(p, table.unknownFields).fieldAs(seq[byte])
+    if unknown[].len > 0:
+      buf.add(unknown[])
+
+proc tableWrite*(table: ptr MessageTable, p: pointer, buf: var seq[byte]) =
+  ## Append the encoding of the message at `p` to `buf`
+  var sizes: seq[int]
+  discard tableSize(table, p, sizes)
+  var pos = 0
+  tableWrite(table, p, buf, sizes, pos)
+
+proc readPacked(data: openArray[byte], kind: FieldKind, p: pointer) =
+  case kind
+  of fkInt32, fkEnum: decodePackedInt32s(data, p.fieldAs(seq[int32]))
+  of fkInt64: decodePackedInt64s(data, p.fieldAs(seq[int64]))
+  of fkUInt32: decodePackedUInt32s(data, p.fieldAs(seq[uint32]))
+  of fkUInt64: decodePackedUInt64s(data, p.fieldAs(seq[uint64]))
+  of fkSInt32: decodePackedSInt32s(data, p.fieldAs(seq[int32]))
+  of fkSInt64: decodePackedSInt64s(data, p.fieldAs(seq[int64]))
+  of fkBool: decodePackedBools(data, p.fieldAs(seq[bool]))
+  of fkFloat: decodePackedFloat32s(data, p.fieldAs(seq[float32]))
+  of fkDouble: decodePackedFloat64s(data, p.fieldAs(seq[float64]))
+  of fkFixed32: decodePackedFixed32s(data, p.fieldAs(seq[uint32]))
+  of fkFixed64: decodePackedFixed64s(data, p.fieldAs(seq[uint64]))
+  of fkSFixed32: decodePackedSFixed32s(data, p.fieldAs(seq[int32]))
+  of fkSFixed64: decodePackedSFixed64s(data, p.fieldAs(seq[int64]))
+  of fkString, fkBytes, fkMessage: discard
+
+proc tableMerge*(table: ptr MessageTable, p: pointer, data: openArray[byte],
+    fields: set[FieldNumber] = AllFields) =
+  ## Decode `data` into the message at `p` with protobuf merge semantics,
+  ## like the generated `mergeFromBinary`
+  var pos = 0
+  while pos < data.len:
+    let fieldStart = pos
+    let (number, wireType) = decodeFieldKey(data, pos)
+    if not isSelected(fields, number):
+      skipField(data, pos, wireType)
+      continue
+    let i = table[].fieldIndex(number)
+    if i < 0:
+      skipField(data, pos, wireType)
+      if table.unknownFields >= 0:
+        at(p, table.unknownFields).fieldAs(seq[byte]).add(
+            data.toOpenArray(fieldStart, pos - 1))
+      continue
+    let field = addr table.fields[i]
+    let fp = fieldPtr(p, field[])
+    case field.shape
+    of fsSingular:
+      readValue(data, pos, field.kind, field.message, fp)
+    of fsOneof:
+      field.setOneof(p, field.oneofKind)
+      readValue(data, pos, field.kind, field.message, fp)
+    of fsRepeated:
+      if field.kind == fkMessage:
+        readValue(data, pos, fkMessage, field.message, field.seqGrow(fp))
+      elif wireType == wtLengthDelimited and field.kind in packedKinds:
+        let span = decodeLengthDelimitedSpan(data, pos)
+        readPacked(data.toOpenArray(span.a, span.b), field.kind, fp)
+      else:
+        withScalarSeq(field.kind, fp, s):
+          s.setLen(s.len + 1)
+          readValue(data, pos, field.kind, nil, addr s[^1])
+    of fsMap:
+      let span = decodeLengthDelimitedSpan(data, pos)
+      field.mapRead(field, fp, data.toOpenArray(span.a, span.b))
+  if table.finishMaps:
+    for i in 0 ..< table.len:
+      let field = addr table.fields[i]
+      if field.mapFinish != nil:
+        field.mapFinish(fieldPtr(p, field[]))
+
+# -----------------------------------------------------------------------------
+# JSON
+# -----------------------------------------------------------------------------
+
+proc tableToJson*(table: ptr MessageTable, p: pointer): JsonNode {.gcsafe.}
+proc tableBytesToJson*(table: ptr MessageTable,
+    data: openArray[byte]): JsonNode {.gcsafe.}
+proc tableFromJson*(table: ptr MessageTable, p: pointer,
+    node: JsonNode) {.gcsafe.}
+
+proc valueToJson(kind: FieldKind, message: ptr MessageTable,
+    p: pointer): JsonNode =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum: %p.fieldAs(int32)
+  of fkInt64, fkSInt64, fkSFixed64: %p.fieldAs(int64)
+  of fkUInt32, fkFixed32: %p.fieldAs(uint32)
+  of fkUInt64, fkFixed64: %p.fieldAs(uint64)
+  of fkFloat: %p.fieldAs(float32)
+  of fkDouble: %p.fieldAs(float64)
+  of fkBool: %p.fieldAs(bool)
+  of fkString: %p.fieldAs(string)
+  of fkBytes: %p.fieldAs(seq[byte])
+  of fkMessage: tableToJson(message, p)
+
+proc valueFromJson(node: JsonNode, kind: FieldKind, message: ptr MessageTable,
+    p: pointer) =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32: p.fieldAs(int32) = int32(node.getBiggestInt())
+  of fkEnum: p.fieldAs(int32) = int32(node.getInt())
+  of fkInt64, fkSInt64, fkSFixed64: p.fieldAs(int64) = node.getBiggestInt()
+  of fkUInt32, fkFixed32: p.fieldAs(uint32) = uint32(node.getBiggestInt())
+  of fkUInt64, fkFixed64:
+    # `%` writes values above high(int64) as raw number strings
+    p.fieldAs(uint64) = if node.kind == JInt: uint64(node.getBiggestInt())
+      else: parseBiggestUInt(node.getStr())
+  of fkFloat: p.fieldAs(float32) = float32(node.getFloat())
+  of fkDouble: p.fieldAs(float64) = node.getFloat()
+  of fkBool: p.fieldAs(bool) = node.getBool()
+  of fkString: p.fieldAs(string) = node.getStr()
+  of fkBytes: p.fieldAs(seq[byte]) = node.to(seq[byte])
+  of fkMessage: tableFromJson(message, p, node)
+
+proc tableToJson*(table: ptr MessageTable, p: pointer): JsonNode =
+  ## JSON of the message at `p`, like the generated `toJson`
+  result = newJObject()
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    let fp = fieldPtr(p, field[])
+    case field.shape
+    of fsSingular:
+      if field.kind == fkMessage:
+        let fieldJson = tableToJson(field.message, fp)
+        if fieldJson.len > 0:
+          result[$field.name] = fieldJson
+      elif not isDefault(field.kind, fp):
+        result[$field.name] = valueToJson(field.kind, nil, fp)
+    of fsOneof:
+      if at(p, field.oneofOffset).fieldAs(int32) == field.oneofKind:
+        result[$field.name] = valueToJson(field.kind, field.message, fp)
+    of fsRepeated:
+      let n = repeatedLen(field[], fp)
+      if n > 0:
+        var items = newJArray()
+        if field.kind == fkMessage:
+          for j in 0 ..< n:
+            items.add(tableToJson(field.message, field.seqItem(fp, j)))
+        else:
+          withScalarSeq(field.kind, fp, s):
+            for j in 0 ..< n:
+              items.add(valueToJson(field.kind, nil, addr s[j]))
+        result[$field.name] = items
+    of fsMap:
+      let entries = field.mapToJson(field, fp)
+      if entries.len > 0:
+        result[$field.name] = entries
+
+proc decodeToJson(data: openArray[byte], pos: var int, kind: FieldKind,
+    message: ptr MessageTable): JsonNode =
+  ## JSON of one encoded value
+  case kind
+  of fkMessage:
+    let span = decodeLengthDelimitedSpan(data, pos)
+    tableBytesToJson(message, data.toOpenArray(span.a, span.b))
+  of fkString: %decodeString(data, pos)
+  of fkBytes: %decodeLengthDelimited(data, pos)
+  else:
+    var value: array[8, byte]
+    readValue(data, pos, kind, nil, addr value)
+    valueToJson(kind, nil, addr value)
+
+proc decodeMapKey(data: openArray[byte], pos: var int, kind: FieldKind): string =
+  case kind
+  of fkString: decodeString(data, pos)
+  of fkBool: $decodeBool(data, pos)
+  of fkUInt32, fkFixed32, fkUInt64, fkFixed64:
+    var value: uint64
+    readValue(data, pos, kind, nil, addr value)
+    if kind in {fkUInt32, fkFixed32}: $cast[ptr uint32](addr value)[]
+    else: $value
+  else:
+    $decodeToJson(data, pos, kind, nil).getBiggestInt()
+
+proc tableBytesToJson*(table: ptr MessageTable, data: openArray[byte]): JsonNode =
+  ## JSON of an encoded message, without decoding it into an object
+  result = newJObject()
+  var pos = 0
+  while pos < data.len:
+    let (number, wireType) = decodeFieldKey(data, pos)
+    let i = table[].fieldIndex(number)
+    if i < 0:
+      skipField(data, pos, wireType)
+      continue
+    let field = addr table.fields[i]
+    let name = $field.name
+    case field.shape
+    of fsSingular, fsOneof:
+      result[name] = decodeToJson(data, pos, field.kind, field.message)
+    of fsRepeated:
+      if not result.hasKey(name):
+        result[name] = newJArray()
+      if wireType == wtLengthDelimited and field.kind in packedKinds:
+        let span = decodeLengthDelimitedSpan(data, pos)
+        var itemPos = span.a
+        while itemPos <= span.b:
+          result[name].add(decodeToJson(data.toOpenArray(0, span.b), itemPos,
+              field.kind, nil))
+      else:
+        result[name].add(decodeToJson(data, pos, field.kind, field.message))
+    of fsMap:
+      if not result.hasKey(name):
+        result[name] = newJObject()
+      let span = decodeLengthDelimitedSpan(data, pos)
+      template entry: untyped = data.toOpenArray(span.a, span.b)
+      var entryPos = 0
+      var key = ""
+      var value = newJNull()
+      while entryPos < entry.len:
+        let (entryNumber, entryWireType) = decodeFieldKey(entry, entryPos)
+        case entryNumber
+        of 1: key = decodeMapKey(entry, entryPos, field.keyKind)
+        of 2: value = decodeToJson(entry, entryPos, field.kind, field.message)
+        else: skipField(entry, entryPos, entryWireType)
+      result[name][key] = value
+
+proc tableFromJson*(table: ptr MessageTable, p: pointer, node: JsonNode) =
+  ## Read the JSON of a message into the fresh message at `p`, like the
+  ## generated `fromJson`. Of a oneof, the first member present is taken.
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    let value = node.getOrDefault($field.name)
+    if value == nil:
+      continue
+    let fp = fieldPtr(p, field[])
+    case field.shape
+    of fsSingular:
+      valueFromJson(value, field.kind, field.message, fp)
+    of fsOneof:
+      if at(p, field.oneofOffset).fieldAs(int32) == 0:
+        field.setOneof(p, field.oneofKind)
+        valueFromJson(value, field.kind, field.message, fp)
+    of fsRepeated:
+      for item in value:
+        if field.kind == fkMessage:
+          valueFromJson(item, fkMessage, field.message, field.seqGrow(fp))
+        else:
+          withScalarSeq(field.kind, fp, s):
+            s.setLen(s.len + 1)
+            valueFromJson(item, field.kind, nil, addr s[^1])
+    of fsMap:
+      field.mapFromJson(field, fp, value)
+
+# -----------------------------------------------------------------------------
+# STREAMING JSON
+# -----------------------------------------------------------------------------
+# The same text as the generated `toJsonString`, `readJson` and
+# `transcodeToJson` of unrolled messages, field for field.
+
+proc tableWriteJson*(table: ptr MessageTable, p: pointer,
+    buf: var string) {.gcsafe.}
+proc tableReadJson*(table: ptr MessageTable, p: pointer,
+    parser: var JsonParser) {.gcsafe.}
+proc transcodeJson(table: ptr MessageTable, data: openArray[byte],
+    buf: var string, index: var seq[FieldSpan],
+    groups: var seq[FieldGroup]) {.gcsafe.}
+
+proc writeJsonValue(buf: var string, kind: FieldKind, message: ptr MessageTable,
+    p: pointer) =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum: buf.writeJsonInt(p.fieldAs(int32))
+  of fkInt64, fkSInt64, fkSFixed64: buf.writeJsonInt(p.fieldAs(int64))
+  of fkUInt32, fkFixed32: buf.writeJsonInt(BiggestInt(p.fieldAs(uint32)))
+  of fkUInt64, fkFixed64: buf.writeJsonUInt(p.fieldAs(uint64))
+  of fkFloat: buf.writeJsonFloat(float(p.fieldAs(float32)))
+  of fkDouble: buf.writeJsonFloat(p.fieldAs(float64))
+  of fkBool: buf.writeJsonBool(p.fieldAs(bool))
+  of fkString: buf.writeJsonString(p.fieldAs(string))
+  of fkBytes: buf.writeJsonBytes(p.fieldAs(seq[byte]))
+  of fkMessage: tableWriteJson(message, p, buf)
+
+proc readJsonValue(parser: var JsonParser, kind: FieldKind,
+    message: ptr MessageTable, p: pointer) =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum:
+    p.fieldAs(int32) = int32(parser.readJsonInt())
+  of fkInt64, fkSInt64, fkSFixed64: p.fieldAs(int64) = parser.readJsonInt()
+  of fkUInt32, fkFixed32: p.fieldAs(uint32) = uint32(parser.readJsonInt())
+  of fkUInt64, fkFixed64: p.fieldAs(uint64) = parser.readJsonUInt()
+  of fkFloat: p.fieldAs(float32) = float32(parser.readJsonFloat())
+  of fkDouble: p.fieldAs(float64) = parser.readJsonFloat()
+  of fkBool: p.fieldAs(bool) = parser.readJsonBool()
+  of fkString: parser.readJsonString(p.fieldAs(string))
+  of fkBytes: parser.readJsonBytes(p.fieldAs(seq[byte]))
+  of fkMessage: tableReadJson(message, p, parser)
+
+proc tableWriteJson*(table: ptr MessageTable, p: pointer, buf: var string) =
+  ## Append the JSON of the message at `p` to `buf`, like the generated
+  ## `toJsonString`
+  buf.add('{')
+  let objStart = buf.len
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    let fp = fieldPtr(p, field[])
+    case field.shape
+    of fsSingular:
+      if field.kind == fkMessage:
+        # Dropped again if the nested message writes nothing
+        let mark = buf.len
+        buf.writeJsonKey(objStart, field.name)
+        let valueStart = buf.len
+        tableWriteJson(field.message, fp, buf)
+        if buf.len == valueStart + 2:
+          buf.setLen(mark)
+      elif not isDefault(field.kind, fp):
+        buf.writeJsonKey(objStart, field.name)
+        buf.writeJsonValue(field.kind, nil, fp)
+    of fsOneof:
+      if at(p, field.oneofOffset).fieldAs(int32) == field.oneofKind:
+        buf.writeJsonKey(objStart, field.name)
+        buf.writeJsonValue(field.kind, field.message, fp)
+    of fsRepeated:
+      let n = repeatedLen(field[], fp)
+      if n > 0:
+        buf.writeJsonKey(objStart, field.name)
+        buf.add('[')
+        if field.kind == fkMessage:
+          for j in 0 ..< n:
+            if j > 0: buf.add(',')
+            tableWriteJson(field.message, field.seqItem(fp, j), buf)
+        else:
+          withScalarSeq(field.kind, fp, s):
+            for j in 0 ..< n:
+              if j > 0: buf.add(',')
+              buf.writeJsonValue(field.kind, nil, addr s[j])
+        buf.add(']')
+    of fsMap:
+      field.mapWriteJson(field, fp, objStart, buf)
+  buf.add('}')
+
+proc tableReadJson*(table: ptr MessageTable, p: pointer,
+    parser: var JsonParser) =
+  ## Merge the JSON object under the parser's current token into the message
+  ## at `p`, like the generated `readJson`. Unknown keys and null values are
+  ## skipped.
+  var key: string
+  var hint = 0
+  parser.expectJson(jsonObjectStart)
+  while parser.kind != jsonObjectEnd:
+    parser.readJsonKey(key)
+    if parser.kind == jsonNull:
+      parser.next()
+      continue
+    let i = table[].fieldIndex(key, hint)
+    if i < 0:
+      parser.skipJsonValue()
+      continue
+    hint = i + 1
+    let field = addr table.fields[i]
+    let fp = fieldPtr(p, field[])
+    case field.shape
+    of fsSingular:
+      parser.readJsonValue(field.kind, field.message, fp)
+    of fsOneof:
+      field.setOneof(p, field.oneofKind)
+      parser.readJsonValue(field.kind, field.message, fp)
+    of fsRepeated:
+      parser.expectJson(jsonArrayStart)
+      while parser.kind != jsonArrayEnd:
+        if field.kind == fkMessage:
+          parser.readJsonValue(fkMessage, field.message, field.seqGrow(fp))
+        else:
+          withScalarSeq(field.kind, fp, s):
+            s.setLen(s.len + 1)
+            parser.readJsonValue(field.kind, nil, addr s[^1])
+      parser.next()
+    of fsMap:
+      field.mapReadJson(field, fp, parser)
+  parser.next()
+
+proc transcodeValue(buf: var string, data: openArray[byte], f: FieldSpan,
+    kind: FieldKind, message: ptr MessageTable, index: var seq[FieldSpan],
+    groups: var seq[FieldGroup]) =
+  ## Write the value of the occurrence `f` in `data`
+  case kind
+  of fkString: buf.writeJsonString(data.toOpenArray(f.payload.a, f.payload.b))
+  of fkBytes: buf.writeJsonBytes(data.toOpenArray(f.payload.a, f.payload.b))
+  of fkMessage:
+    transcodeJson(message, data.toOpenArray(f.payload.a, f.payload.b), buf,
+        index, groups)
+  else:
+    var value: uint64
+    var pos = f.valuePos
+    readValue(data, pos, kind, nil, addr value)
+    buf.writeJsonValue(kind, nil, addr value)
+
+proc transcodeMapEntry(buf: var string, entry: openArray[byte],
+    field: ptr TableField, index: var seq[FieldSpan],
+    groups: var seq[FieldGroup]) =
+  ## Write `"key":value` of one encoded map entry. Absent keys and values
+  ## are written as their defaults.
+  var key = if field.keyKind == fkString: "" elif field.keyKind == fkBool: "false"
+    else: "0"
+  var valPos = -1
+  var pos = 0
+  while pos < entry.len:
+    let (number, wireType) = decodeFieldKey(entry, pos)
+    case number
+    of 1: key = decodeMapKey(entry, pos, field.keyKind)
+    of 2:
+      valPos = pos
+      skipField(entry, pos, wireType)
+    else: skipField(entry, pos, wireType)
+  buf.writeJsonString(key)
+  buf.add(':')
+  if field.kind in {fkString, fkBytes, fkMessage}:
+    var span = 0 .. -1
+    if valPos >= 0:
+      span = decodeLengthDelimitedSpan(entry, valPos)
+    buf.transcodeValue(entry, FieldSpan(payload: span), field.kind,
+        field.message, index, groups)
+  else:
+    var value: uint64
+    if valPos >= 0:
+      readValue(entry, valPos, field.kind, nil, addr value)
+    buf.writeJsonValue(field.kind, nil, addr value)
+
+proc transcodeJson(table: ptr MessageTable, data: openArray[byte],
+    buf: var string, index: var seq[FieldSpan], groups: var seq[FieldGroup]) =
+  # Each level appends its spans to `index` and its field groups to
+  # `groups`, and truncates both when done
+  let base = index.len
+  let groupBase = groups.len
+  indexFields(data, index)
+  groups.setLen(groupBase + table.len)
+  if table.len > 0:
+    groupFieldSpans(index, base, table.sortedNumbers.toOpenArray(0,
+        table.len - 1), groups.toOpenArray(groupBase, groups.high))
+  template groupOf(field: ptr TableField): FieldGroup =
+    groups[groupBase + field.group]
+
+  buf.add('{')
+  let objStart = buf.len
+  var i = 0
+  while i < table.len:
+    let field = addr table.fields[i]
+    inc i
+    case field.shape
+    of fsOneof:
+      # Of the members of this oneof, the one last on the wire wins
+      var member = field
+      var last = -1
+      var j = i - 1
+      while j < table.len and table.fields[j].shape == fsOneof and
+          table.fields[j].oneofOffset == field.oneofOffset:
+        let g = groupOf(addr table.fields[j])
+        if g.count > 0:
+          let k = g.start + g.count - 1
+          if last < 0 or index[k].valuePos > index[last].valuePos:
+            last = k
+            member = addr table.fields[j]
+        inc j
+      i = j
+      if last >= 0:
+        let f = index[last]
+        buf.writeJsonKey(objStart, member.name)
+        buf.transcodeValue(data, f, member.kind, member.message, index, groups)
+    of fsSingular:
+      let g = groupOf(field)
+      if g.count == 0:
+        continue
+      let f = index[g.start + g.count - 1]
+      case field.kind
+      of fkString, fkBytes:
+        if f.payload.len > 0:
+          buf.writeJsonKey(objStart, field.name)
+          buf.transcodeValue(data, f, field.kind, nil, index, groups)
+      of fkMessage:
+        # Dropped again if the nested message writes nothing
+        let mark = buf.len
+        buf.writeJsonKey(objStart, field.name)
+        let valueStart = buf.len
+        buf.transcodeValue(data, f, fkMessage, field.message, index, groups)
+        if buf.len == valueStart + 2:
+          buf.setLen(mark)
+      else:
+        # Defaults are omitted, as in toJson
+        var value: uint64
+        var pos = f.valuePos
+        readValue(data, pos, field.kind, nil, addr value)
+        if not isDefault(field.kind, addr value):
+          buf.writeJsonKey(objStart, field.name)
+          buf.writeJsonValue(field.kind, nil, addr value)
+    of fsRepeated:
+      let g = groupOf(field)
+      var first = true
+      for k in g.start ..< g.start + g.count:
+        let f = index[k]
+        if f.wireType == wtLengthDelimited and field.kind in packedKinds:
+          template run: untyped = data.toOpenArray(f.payload.a, f.payload.b)
+          var pos = 0
+          while pos < run.len:
+            buf.writeJsonElementStart(objStart, field.name, first)
+            var value: uint64
+            readValue(run, pos, field.kind, nil, addr value)
+            buf.writeJsonValue(field.kind, nil, addr value)
+        else:
+          buf.writeJsonElementStart(objStart, field.name, first)
+          buf.transcodeValue(data, f, field.kind, field.message, index, groups)
+      if not first: buf.add(']')
+    of fsMap:
+      let g = groupOf(field)
+      var first = true
+      for k in g.start ..< g.start + g.count:
+        let f = index[k]
+        buf.writeJsonElementStart(objStart, field.name, first, '{')
+        buf.transcodeMapEntry(data.toOpenArray(f.payload.a, f.payload.b), field,
+            index, groups)
+      if not first: buf.add('}')
+  buf.add('}')
+  index.setLen(base)
+  groups.setLen(groupBase)
+
+proc tableTranscodeJson*(table: ptr MessageTable, data: openArray[byte],
+    buf: var string, index: var seq[FieldSpan]) =
+  ## Append the JSON of an encoded message to `buf` straight from the bytes,
+  ## like the generated `transcodeToJson`. `index` is scratch space, shared
+  ## by all nesting levels.
+  var groups: seq[FieldGroup]
+  transcodeJson(table, data, buf, index, groups)
+
+# -----------------------------------------------------------------------------
+# EQUALITY
+# -----------------------------------------------------------------------------
+
+proc tableEquals*(table: ptr MessageTable, a, b: pointer): bool {.gcsafe.}
+proc tableHash*(table: ptr MessageTable, p: pointer): Hash {.gcsafe.}
+
+proc valueEquals(kind: FieldKind, message: ptr MessageTable,
+    a, b: pointer): bool =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum: a.fieldAs(int32) == b.fieldAs(int32)
+  of fkInt64, fkSInt64, fkSFixed64: a.fieldAs(int64) == b.fieldAs(int64)
+  of fkUInt32, fkFixed32: a.fieldAs(uint32) == b.fieldAs(uint32)
+  of fkUInt64, fkFixed64: a.fieldAs(uint64) == b.fieldAs(uint64)
+  of fkFloat: a.fieldAs(float32) == b.fieldAs(float32)
+  of fkDouble: a.fieldAs(float64) == b.fieldAs(float64)
+  of fkBool: a.fieldAs(bool) == b.fieldAs(bool)
+  of fkString: a.fieldAs(string) == b.fieldAs(string)
+  of fkBytes: a.fieldAs(seq[byte]) == b.fieldAs(seq[byte])
+  of fkMessage: tableEquals(message, a, b)
+
+proc valueHash(kind: FieldKind, message: ptr MessageTable, p: pointer): Hash =
+  case kind
+  of fkInt32, fkSInt32, fkSFixed32, fkEnum: hash(p.fieldAs(int32))
+  of fkInt64, fkSInt64, fkSFixed64: hash(p.fieldAs(int64))
+  of fkUInt32, fkFixed32: hash(p.fieldAs(uint32))
+  of fkUInt64, fkFixed64: hash(p.fieldAs(uint64))
+  of fkFloat: hash(p.fieldAs(float32))
+  of fkDouble: hash(p.fieldAs(float64))
+  of fkBool: hash(p.fieldAs(bool))
+  of fkString: hash(p.fieldAs(string))
+  of fkBytes: hash(p.fieldAs(seq[byte]))
+  of fkMessage: tableHash(message, p)
+
+proc tableEquals*(table: ptr MessageTable, a, b: pointer): bool =
+  ## Whether the messages at `a` and `b` are equal, like the generated `==`.
+  ## Only the set member of a oneof takes part.
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    let fa = fieldPtr(a, field[])
+    let fb = fieldPtr(b, field[])
+    case field.shape
+    of fsSingular:
+      if not valueEquals(field.kind, field.message, fa, fb):
+        return false
+    of fsOneof:
+      let kind = at(a, field.oneofOffset).fieldAs(int32)
+      if kind != at(b, field.oneofOffset).fieldAs(int32):
+        return false
+      if kind == field.oneofKind and
+          not valueEquals(field.kind, field.message, fa, fb):
+        return false
+    of fsRepeated:
+      let n = repeatedLen(field[], fa)
+      if n != repeatedLen(field[], fb):
+        return false
+      if field.kind == fkMessage:
+        for j in 0 ..< n:
+          if not tableEquals(field.message, field.seqItem(fa, j),
+              field.seqItem(fb, j)):
+            return false
+      else:
+        withScalarSeq(field.kind, fa, s):
+          if s != cast[ptr typeof(s)](fb)[]:
+            return false
+    of fsMap:
+      if not field.mapEquals(fa, fb):
+        return false
+  if table.unknownFields >= 0:
+    return at(a, table.unknownFields).fieldAs(seq[byte]) ==
+        at(b, table.unknownFields).fieldAs(seq[byte])
+  true
+
+proc tableHash*(table: ptr MessageTable, p: pointer): Hash =
+  ## Hash of the message at `p`, like the generated `hash`
+  var h: Hash = 0
+  for i in 0 ..< table.len:
+    let field = addr table.fields[i]
+    let fp = fieldPtr(p, field[])
+    case field.shape
+    of fsSingular:
+      h = h !& valueHash(field.kind, field.message, fp)
+    of fsOneof:
+      if at(p, field.oneofOffset).fieldAs(int32) == field.oneofKind:
+        h = h !& hash(field.number)
+        h = h !& valueHash(field.kind, field.message, fp)
+    of fsRepeated:
+      if field.kind == fkMessage:
+        for j in 0 ..< repeatedLen(field[], fp):
+          h = h !& tableHash(field.message, field.seqItem(fp, j))
+      else:
+        withScalarSeq(field.kind, fp, s):
+          h = h !& hash(s)
+    of fsMap:
+      h = h !& field.mapHash(fp)
+  if table.unknownFields >= 0:
+    h = h !& hash(at(p, table.unknownFields).fieldAs(seq[byte]))
+  !$h
+
+# -----------------------------------------------------------------------------
+# VIEWS
+# -----------------------------------------------------------------------------
+# The view accessors of table-driven messages. `S` is the Nim type of
+# `kind`, as for the fields of the message object.
+
+proc viewValue*[T](v: ProtoView[T], number: int, kind: FieldKind,
+    S: typedesc): S =
+  ## The last value of field `number`, or the default if it is absent
+  var pos = viewFieldPos(v, number)
+  if pos >= 0:
+    readValue(viewBuffer(v)[], pos, kind, nil, addr result)
+
+proc viewValue*[T](v: ProtoView[T], number, n: int, kind: FieldKind,
+    S: typedesc): S =
+  ## The `n`-th value of repeated field `number`
+  var pos = viewField(v, number, n).valuePos
+  readValue(viewBuffer(v)[], pos, kind, nil, addr result)
+
+proc viewValues*[T](v: ProtoView[T], number: int, kind: FieldKind,
+    S: typedesc): seq[S] =
+  ## The values of repeated scalar field `number`, packed, unpacked or split
+  ## over several runs
+  for f in viewFields(v, number):
+    if f.wireType == wtLengthDelimited:
+      readPacked(viewBuffer(v)[].toOpenArray(f.payload.a, f.payload.b), kind,
+          addr result)
+    else:
+      result.setLen(result.len + 1)
+      var pos = f.valuePos
+      readValue(viewBuffer(v)[], pos, kind, nil, addr result[^1])
+
+# -----------------------------------------------------------------------------
+# TABLES
+# -----------------------------------------------------------------------------
+# The generated code builds its tables with the constructors below, e.g.
+#
+#   initMessageTable(messageTable(Order), [
+#     scalarField("id", 1, fkString, offsetOf(Order, id)),
+#     repeatedField("items", 2, offsetOf(Order, items), Item),
+#     mapField[Table[string, int32], string, int32]("counts", 3,
+#         offsetOf(Order, counts), fkString, fkInt32)])
+
+proc seqLenOf[T](p: pointer): int {.nimcall, gcsafe.} =
+  p.fieldAs(seq[T]).len
+
+proc seqItemOf[T](p: pointer, i: int): pointer {.nimcall, gcsafe.} =
+  addr p.fieldAs(seq[T])[i]
+
+proc seqGrowOf[T](p: pointer): pointer {.nimcall, gcsafe.} =
+  template s: untyped = p.fieldAs(seq[T])
+  s.setLen(s.len + 1)
+  addr s[^1]
+
+proc messageTableOf[T](): ptr MessageTable =
+  mixin messageTable
+  when T is object:
+    messageTable(T)
+  else:
+    nil
+
+proc scalarField*(name: cstring, number: int, kind: FieldKind,
+    offset: int): TableField =
+  ## A singular scalar, string, bytes or enum field
+  TableField(name: name, number: number, kind: kind, offset: offset)
+
+proc messageField*(name: cstring, number: int, offset: int,
+    T: typedesc): TableField =
+  ## A singular field of message type `T`
+  TableField(name: name, number: number, kind: fkMessage, offset: offset,
+      message: messageTableOf[T]())
+
+proc repeatedField*(name: cstring, number: int, kind: FieldKind,
+    offset: int): TableField =
+  ## A repeated scalar, string, bytes or enum field
+  TableField(name: name, number: number, kind: kind, shape: fsRepeated,
+      offset: offset)
+
+proc repeatedField*(name: cstring, number: int, offset: int,
+    T: typedesc): TableField =
+  ## A repeated field of message type `T`
+  TableField(name: name, number: number, kind: fkMessage, shape: fsRepeated,
+      offset: offset, message: messageTableOf[T](), seqLen: seqLenOf[T],
+      seqItem: seqItemOf[T], seqGrow: seqGrowOf[T])
+
+proc oneofField*(name: cstring, number: int, kind: FieldKind, offset: int,
+    T: typedesc, oneofOffset: int, oneofKind: int32,
+    setOneof: proc (p: pointer, kind: int32) {.nimcall, gcsafe.}): TableField =
+  ## A member of a oneof, holding values of type `T`. `setOneof` switches
+  ## the oneof at `oneofOffset` to the member selected by `oneofKind`.
+  TableField(name: name, number: number, kind: kind, shape: fsOneof,
+      offset: offset, message: messageTableOf[T](), oneofOffset: oneofOffset,
+      oneofKind: oneofKind, setOneof: setOneof)
+
+template forEntries[M](m: M, sorted: bool, key, val, body: untyped) =
+  when M is seq:
+    for entry in m:
+      template key: untyped = entry[0]
+      template val: untyped = entry[1]
+      body
+  else:
+    if sorted:
+      for key, val in sortedPairs(m):
+        body
+    else:
+      for key, val in m:
+        body
+
+proc mapSizeOf[M, K, V](field: ptr TableField, p: pointer, sorted: bool,
+    sizes: var seq[int]): int {.nimcall, gcsafe.} =
+  # Entries are sized in the order mapWriteOf writes them
+  let tagLen = tagSize(field.number)
+  forEntries(p.fieldAs(M), sorted, key, val):
+    let slot = sizes.reserveSize()
+    let size = 2 + scalarSize(field.keyKind, unsafeAddr key) +
+        valueSize(field.kind, field.message, unsafeAddr val, sizes)
+    sizes[slot] = size
+    result += tagLen + sizeLengthDelimited(size)
+
+proc mapWriteOf[M, K, V](field: ptr TableField, p: pointer, buf: var seq[byte],
+    sorted: bool, sizes: openArray[int], pos: var int) {.nimcall, gcsafe.} =
+  forEntries(p.fieldAs(M), sorted, key, val):
+    buf.writeTag(field.number, wtLengthDelimited)
+    buf.writeVarint(uint64(sizes.nextSize(pos)))
+    buf.writeTag(1, kindWireTypes[field.keyKind])
+    buf.writeScalar(field.keyKind, unsafeAddr key)
+    buf.writeTag(2, kindWireTypes[field.kind])
+    buf.writeValue(field.kind, field.message, unsafeAddr val, sizes, pos)
+
+proc mapReadOf[M, K, V](field: ptr TableField, p: pointer,
+    data: openArray[byte]) {.nimcall, gcsafe.} =
+  var key: K
+  var val: V
+  var pos = 0
+  while pos < data.len:
+    let (number, wireType) = decodeFieldKey(data, pos)
+    case number
+    of 1: readValue(data, pos, field.keyKind, nil, addr key)
+    of 2: readValue(data, pos, field.kind, field.message, addr val)
+    else: skipField(data, pos, wireType)
+  when M is seq:
+    # Sorted once all entries are in, see mapFinishOf
+    p.fieldAs(M).add((key, val))
+  else:
+    p.fieldAs(M)[key] = val
+
+proc mapFinishOf[M](p: pointer) {.nimcall, gcsafe.} =
+  sortEntries(p.fieldAs(M))
+
+proc mapToJsonOf[M, K, V](field: ptr TableField,
+    p: pointer): JsonNode {.nimcall, gcsafe.} =
+  result = newJObject()
+  forEntries(p.fieldAs(M), false, key, val):
+    result[$key] = valueToJson(field.kind, field.message, unsafeAddr val)
+
+proc parseMapKey[K](text: string): K =
+  when K is string:
+    text
+  elif K is bool:
+    parseBool(text)
+  elif K is uint64:
+    parseBiggestUInt(text)
+  else:
+    K(parseBiggestInt(text))
+
+proc mapFromJsonOf[M, K, V](field: ptr TableField, p: pointer,
+    node: JsonNode) {.nimcall, gcsafe.} =
+  for keyStr, valNode in node:
+    let key = parseMapKey[K](keyStr)
+    var val: V
+    valueFromJson(valNode, field.kind, field.message, addr val)
+    when M is seq:
+      p.fieldAs(M).put(key, val)
+    else:
+      p.fieldAs(M)[key] = val
+
+proc mapWriteJsonOf[M, K, V](field: ptr TableField, p: pointer, objStart: int,
+    buf: var string) {.nimcall, gcsafe.} =
+  template m: untyped = p.fieldAs(M)
+  if m.len > 0:
+    buf.writeJsonKey(objStart, field.name)
+    buf.add('{')
+    let mapStart = buf.len
+    forEntries(m, false, key, val):
+      buf.writeJsonKey(mapStart, $key)
+      buf.writeJsonValue(field.kind, field.message, unsafeAddr val)
+    buf.add('}')
+
+proc mapReadJsonOf[M, K, V](field: ptr TableField, p: pointer,
+    parser: var JsonParser) {.nimcall, gcsafe.} =
+  var mapKey: string
+  parser.expectJson(jsonObjectStart)
+  while parser.kind != jsonObjectEnd:
+    parser.readJsonKey(mapKey)
+    var val: V
+    parser.readJsonValue(field.kind, field.message, addr val)
+    when M is seq:
+      p.fieldAs(M).add((parseMapKey[K](mapKey), val))
+    else:
+      p.fieldAs(M)[parseMapKey[K](mapKey)] = val
+  when M is seq:
+    sortEntries(p.fieldAs(M))
+  parser.next()
+
+proc mapEqualsOf[M](a, b: pointer): bool {.nimcall, gcsafe.} =
+  # OrderedTable's own == depends on insertion order
+  when M is OrderedTable:
+    sameEntries(a.fieldAs(M), b.fieldAs(M))
+  else:
+    a.fieldAs(M) == b.fieldAs(M)
+
+proc mapHashOf[M](p: pointer): Hash {.nimcall, gcsafe.} =
+  when M is OrderedTable:
+    hashEntries(p.fieldAs(M))
+  else:
+    hash(p.fieldAs(M))
+
+proc mapField*[M, K, V](name: cstring, number: int, offset: int,
+    keyKind, valueKind: FieldKind): TableField =
+  ## A map field of Nim type `M` (`Table`, `OrderedTable` or `SortedMap`)
+  ## with keys of type `K` and values of type `V`
+  result = TableField(name: name, number: number, kind: valueKind,
+      keyKind: keyKind, shape: fsMap, offset: offset,
+      message: messageTableOf[V](), mapSize: mapSizeOf[M, K, V],
+      mapWrite: mapWriteOf[M, K, V], mapRead: mapReadOf[M, K, V],
+      mapToJson: mapToJsonOf[M, K, V], mapFromJson: mapFromJsonOf[M, K, V],
+      mapWriteJson: mapWriteJsonOf[M, K, V], mapReadJson: mapReadJsonOf[M, K, V],
+      mapEquals: mapEqualsOf[M], mapHash: mapHashOf[M])
+  when M is seq:
+    result.mapFinish = mapFinishOf[M]
+
+proc initMessageTable*(table: ptr MessageTable, fields: openArray[TableField],
+    unknownFields = -1, deterministic = false) =
+  ## Fill in the table of a message, in the order its fields are written
+  table.len = fields.len
+  table.fields = cast[ptr UncheckedArray[TableField]](
+      createShared(TableField, max(fields.len, 1)))
+  var numbers = 0
+  for i, field in fields:
+    table.fields[i] = field
+    table.finishMaps = table.finishMaps or field.mapFinish != nil
+    if field.number < maxDenseNumber:
+      numbers = max(numbers, field.number + 1)
+  table.numbers = numbers
+  table.byNumber = cast[ptr UncheckedArray[int16]](
+      createShared(int16, max(numbers, 1)))
+  for i, field in fields:
+    if field.number < numbers:
+      table.byNumber[field.number] = int16(i + 1)
+  var sorted = newSeq[int](fields.len)
+  for i, field in fields:
+    sorted[i] = field.number
+  sorted.sort()
+  table.sortedNumbers = cast[ptr UncheckedArray[int]](
+      createShared(int, max(fields.len, 1)))
+  for i, number in sorted:
+    table.sortedNumbers[i] = number
+  for i, field in fields:
+    table.fields[i].group = sorted.binarySearch(field.number)
+  table.unknownFields = unknownFields
+  table.deterministic = deterministic
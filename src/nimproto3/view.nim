@@ -0,0 +1,199 @@
+## Lazy read-only views over encoded protobuf messages
+##
+## A `ProtoView[T]` wraps the encoded bytes of a message of type `T` and
+## decodes fields only when they are asked for. The first access walks the
+## buffer once and records where each field lives; accessors then decode
+## just that field. Nested message accessors return views that share the
+## same buffer, so no bytes are copied until a scalar, string or bytes value
+## is read.
+##
+## The generated code emits a `<Msg>View* = ProtoView[<Msg>]` alias and one
+## accessor per field for every message.
+
+import std/[algorithm, tables]
+import ./wire_format
+
+type
+  FieldSpan* = object
+    ## Location of one encoded field occurrence inside a view's buffer
+    number*: int
+    wireType*: WireType
+    valuePos*: int        ## offset of the encoded value (length prefix included)
+    payload*: Slice[int]  ## the value bytes (without length prefix)
+
+  FieldGroup* = tuple[start, count: int]
+    ## A run of `count` positions starting at `start`, holding the
+    ## occurrences of one field number
+
+  ProtoView*[T] = ref object
+    buf: ref seq[byte]
+    span: Slice[int]
+    index: seq[FieldSpan]     ## every occurrence, in wire order
+    order: seq[int32]         ## `index` positions, grouped by field number
+    groups: Table[int, FieldGroup]
+    indexed: bool
+
+proc newProtoView*[T](_: typedesc[T], data: ref seq[byte],
+    span: Slice[int]): ProtoView[T] =
+  ## Create a view over `data[span]`. The buffer is shared, not copied.
+  if span.a < 0 or span.b >= data[].len:
+    raise newException(ValueError, "View span out of range")
+  ProtoView[T](buf: data, span: span)
+
+proc newProtoView*[T](_: typedesc[T], data: ref seq[byte]): ProtoView[T] =
+  newProtoView(T, data, 0 ..< data[].len)
+
+proc newProtoView*[T](_: typedesc[T], data: sink seq[byte]): ProtoView[T] =
+  ## Create a view that takes ownership of `data`
+  var buf = new(seq[byte])
+  buf[] = data
+  newProtoView(T, buf)
+
+proc newProtoView*[T](_: typedesc[ProtoView[T]], data: ref seq[byte]): ProtoView[T] =
+  ## Allows `PersonView.newProtoView(data)` as well as `newProtoView(Person, data)`
+  newProtoView(T, data)
+
+proc newProtoView*[T](_: typedesc[ProtoView[T]], data: sink seq[byte]): ProtoView[T] =
+  newProtoView(T, data)
+
+proc viewBuffer*[T](v: ProtoView[T]): ref seq[byte] {.inline.} =
+  ## The shared buffer the view reads from
+  v.buf
+
+proc viewSpan*[T](v: ProtoView[T]): Slice[int] {.inline.} =
+  ## The range of `viewBuffer(v)` holding the encoded message
+  v.span
+
+iterator fieldSpans(data: openArray[byte], offset: int): FieldSpan =
+  var pos = 0
+  while pos < data.len:
+    let (fieldNum, wireType) = decodeFieldKey(data, pos)
+    let valuePos = pos
+    var payload: Slice[int]
+    if wireType == wtLengthDelimited:
+      let inner = decodeLengthDelimitedSpan(data, pos)
+      payload = offset + inner.a .. offset + inner.b
+    else:
+      skipField(data, pos, wireType)
+      payload = offset + valuePos .. offset + pos - 1
+    yield FieldSpan(number: fieldNum, wireType: wireType,
+        valuePos: offset + valuePos, payload: payload)
+
+proc indexFields*(data: openArray[byte], index: var seq[FieldSpan],
+    offset: int = 0) =
+  ## Append the location of every field occurrence in `data` to `index`, in
+  ## wire order. Positions are shifted by `offset`.
+  for f in fieldSpans(data, offset):
+    index.add(f)
+
+proc groupFieldSpans*(index: var seq[FieldSpan], base: int,
+    numbers: openArray[int], groups: var openArray[FieldGroup]) =
+  ## Append a copy of the spans in `index[base .. ^1]` whose number is in
+  ## `numbers` (sorted ascending), grouped by number and in wire order within
+  ## a number. `groups[k]` is set to the positions of `numbers[k]`. Spans of
+  ## other numbers are left out of the copy.
+  let top = index.len
+  for i in base ..< top:
+    let k = numbers.binarySearch(index[i].number)
+    if k >= 0:
+      inc groups[k].count
+  var start = top
+  for g in groups.mitems:
+    g.start = start
+    start += g.count
+    g.count = 0
+  index.setLen(start)
+  for i in base ..< top:
+    let k = numbers.binarySearch(index[i].number)
+    if k >= 0:
+      index[groups[k].start + groups[k].count] = index[i]
+      inc groups[k].count
+
+proc buildIndex[T](v: ProtoView[T]) =
+  # Count occurrences per field number while walking the buffer, then
+  # place each occurrence in its number's slot of `order` (a counting sort
+  # that keeps wire order within a number)
+  for f in fieldSpans(v.buf[].toOpenArray(v.span.a, v.span.b), v.span.a):
+    v.groups.mgetOrPut(f.number, (0, 0)).count.inc
+    v.index.add(f)
+  var start = 0
+  for g in v.groups.mvalues:
+    g.start = start
+    start += g.count
+    g.count = 0
+  v.order.setLen(v.index.len)
+  for i, f in v.index:
+    let g = addr v.groups[f.number]
+    v.order[g.start + g.count] = int32(i)
+    inc g.count
+  v.indexed = true
+
+proc ensureIndex[T](v: ProtoView[T]) {.inline.} =
+  if not v.indexed:
+    buildIndex(v)
+
+iterator viewFields*[T](v: ProtoView[T]): FieldSpan =
+  ## All field occurrences in wire order
+  ensureIndex(v)
+  for f in v.index:
+    yield f
+
+iterator viewFields*[T](v: ProtoView[T], number: int): FieldSpan =
+  ## Occurrences of field `number` in wire order
+  ensureIndex(v)
+  let g = v.groups.getOrDefault(number)
+  for k in g.start ..< g.start + g.count:
+    yield v.index[v.order[k]]
+
+proc viewFieldCount*[T](v: ProtoView[T], number: int): int =
+  ## Number of occurrences of field `number`
+  ensureIndex(v)
+  v.groups.getOrDefault(number).count
+
+proc viewLastField[T](v: ProtoView[T], number: int): int =
+  ensureIndex(v)
+  let g = v.groups.getOrDefault(number)
+  result = if g.count > 0: v.order[g.start + g.count - 1] else: -1
+
+proc viewFieldPos*[T](v: ProtoView[T], number: int): int =
+  ## Offset in `viewBuffer(v)` of the last value of field `number`, or -1 if
+  ## the field is absent. The last occurrence wins, as for singular fields.
+  let i = viewLastField(v, number)
+  result = if i >= 0: v.index[i].valuePos else: -1
+
+proc viewOneof*[T](v: ProtoView[T], numbers: openArray[int]): int =
+  ## 1 + the position in `numbers` of the field whose last occurrence comes
+  ## last on the wire, or 0 if none is present: the set member of a oneof
+  var last = -1
+  for k, number in numbers:
+    let i = viewLastField(v, number)
+    if i > last:
+      last = i
+      result = k + 1
+
+proc viewField*[T](v: ProtoView[T], number: int, n: int): FieldSpan =
+  ## The `n`-th occurrence of field `number`
+  ensureIndex(v)
+  let g = v.groups.getOrDefault(number)
+  if n < 0 or n >= g.count:
+    raise newException(IndexDefect, "Field " & $number & " has no occurrence " &
+        $n & " (count " & $g.count & ")")
+  v.index[v.order[g.start + n]]
+
+proc subView*[T](v: ProtoView[T], S: typedesc, number: int): ProtoView[S] =
+  ## View of the embedded message in field `number` (empty if absent)
+  let i = viewLastField(v, number)
+  if i >= 0:
+    ProtoView[S](buf: v.buf, span: v.index[i].payload)
+  else:
+    ProtoView[S](buf: v.buf, span: v.span.a ..< v.span.a)
+
+proc subView*[T](v: ProtoView[T], S: typedesc, number: int,
+    n: int): ProtoView[S] =
+  ## View of the `n`-th embedded message in repeated field `number`
+  ProtoView[S](buf: v.buf, span: viewField(v, number, n).payload)
+
+proc toMessage*[T](v: ProtoView[T]): T =
+  ## Decode the whole viewed message
+  mixin fromBinary
+  fromBinary(T, v.buf[].toOpenArray(v.span.a, v.span.b))
@@ -1,6 +1,8 @@
 ## Protobuf wire format encoder/decoder
 ## Implements the basic protobuf binary format with varint encoding
 
+import std/[bitops, endians]
+
 type
   WireType* = enum
     wtVarint = 0          # int32, int64, uint32, uint64, sint32, sint64, bool, enum
@@ -10,14 +12,30 @@ type
     wtEndGroup = 4        # groups (deprecated)
     wt32Bit = 5           # fixed32, sfixed32, float
 
-proc encodeVarint*(value: uint64): seq[byte] =
-  ## Encode an unsigned integer as a varint
+  FieldNumber* = range[0..4095]
+    ## Field numbers that can be selected for partial decoding. Fields with
+    ## larger numbers are always decoded.
+
+const AllFields*: set[FieldNumber] = {low(FieldNumber) .. high(FieldNumber)}
+  ## Field selection that decodes every field
+
+proc isSelected*(fields: set[FieldNumber], fieldNumber: int): bool {.inline.} =
+  ## Whether `fieldNumber` should be decoded under the selection `fields`
+  fieldNumber > high(FieldNumber) or fieldNumber < low(FieldNumber) or
+      FieldNumber(fieldNumber) in fields
+
+proc writeVarint*(buf: var seq[byte], value: uint64) =
+  ## Append an unsigned integer as a varint to `buf`
   var val = value
-  result = @[]
   while val >= 0x80'u64:
-    result.add(byte((val and 0x7F) or 0x80))
+    buf.add(byte((val and 0x7F) or 0x80))
     val = val shr 7
-  result.add(byte(val))
+  buf.add(byte(val))
+
+proc encodeVarint*(value: uint64): seq[byte] =
+  ## Encode an unsigned integer as a varint
+  result = @[]
+  result.writeVarint(value)
 
 proc encodeZigZag*(value: int64): uint64 =
   ## ZigZag encoding for signed integers
@@ -26,8 +44,8 @@ proc encodeZigZag*(value: int64): uint64 =
   else:
     result = uint64(value * -2 - 1)
 
-proc decodeVarint*(data: openArray[byte], pos: var int): uint64 =
-  ## Decode a varint from byte array, updating pos
+proc decodeVarintSlow(data: openArray[byte], pos: var int): uint64 =
+  ## Byte-at-a-time varint decoding with a bounds check per byte
   result = 0
   var shift = 0
   while pos < data.len:
@@ -43,6 +61,52 @@ proc decodeVarint*(data: openArray[byte], pos: var int): uint64 =
   if shift > 0 and pos >= data.len:
     raise newException(ValueError, "Truncated varint")
 
+proc compactVarintWord(word: uint64): uint64 {.inline.} =
+  ## Join the 7-bit payloads of up to 8 little-endian varint bytes
+  var x = word and 0x7F7F7F7F7F7F7F7F'u64
+  x = (x and 0x007F007F007F007F'u64) or ((x and 0x7F007F007F007F00'u64) shr 1)
+  x = (x and 0x00003FFF00003FFF'u64) or ((x and 0x3FFF00003FFF0000'u64) shr 2)
+  (x and 0x000000000FFFFFFF'u64) or ((x and 0x0FFFFFFF00000000'u64) shr 4)
+
+proc decodeVarintLong(data: openArray[byte], pos: var int): uint64 =
+  ## Multi-byte varints. With at least 10 bytes left the longest varint fits,
+  ## so 8 bytes are loaded as one word and the terminator (first byte without
+  ## the continuation bit) is found without per-byte bounds checks.
+  when cpuEndian == littleEndian:
+    if pos >= 0 and pos + 10 <= data.len:
+      var word: uint64
+      copyMem(addr word, unsafeAddr data[pos], 8)
+      let stops = not word and 0x8080808080808080'u64
+      if stops != 0:
+        let bits = countTrailingZeroBits(stops) + 1
+        pos += bits div 8
+        if bits < 64:
+          word = word and ((1'u64 shl bits) - 1)
+        return compactVarintWord(word)
+      result = compactVarintWord(word)
+      let b8 = data[pos + 8]
+      result = result or (uint64(b8 and 0x7F) shl 56)
+      if b8 < 0x80'u8:
+        pos += 9
+        return
+      let b9 = data[pos + 9]
+      if b9 >= 0x80'u8:
+        raise newException(ValueError, "Varint too long")
+      result = result or (uint64(b9) shl 63)
+      pos += 10
+      return
+  # Near the end of the buffer
+  result = decodeVarintSlow(data, pos)
+
+proc decodeVarint*(data: openArray[byte], pos: var int): uint64 {.inline.} =
+  ## Decode a varint from byte array, updating pos
+  if pos < data.len and data[pos] < 0x80'u8:
+    # Single byte varints (small values, most field keys) need no setup
+    result = uint64(data[pos])
+    inc pos
+  else:
+    result = decodeVarintLong(data, pos)
+
 proc decodeZigZag*(value: uint64): int64 =
   ## ZigZag decoding for signed integers
   if (value and 1) == 0:
@@ -50,10 +114,14 @@ proc decodeZigZag*(value: uint64): int64 =
   else:
     result = -int64((value + 1) shr 1)
 
+proc writeTag*(buf: var seq[byte], fieldNumber: int, wireType: WireType) =
+  ## Append a field key (field number and wire type) to `buf`
+  buf.writeVarint(uint64((fieldNumber shl 3) or int(wireType)))
+
 proc encodeFieldKey*(fieldNumber: int, wireType: WireType): seq[byte] =
   ## Encode field number and wire type into a field key
-  let key = uint64((fieldNumber shl 3) or int(wireType))
-  result = encodeVarint(key)
+  result = @[]
+  result.writeTag(fieldNumber, wireType)
 
 proc decodeFieldKey*(data: openArray[byte], pos: var int): tuple[
     fieldNumber: int, wireType: WireType] =
@@ -70,67 +138,304 @@ proc decodeFieldKey*(data: openArray[byte], pos: var int): tuple[
   result.wireType = WireType(wireVal)
   result.fieldNumber = int(key shr 3)
 
+proc writeLengthDelimited*(buf: var seq[byte], data: openArray[byte]) =
+  ## Append length-delimited data (length prefix + data) to `buf`
+  buf.writeVarint(uint64(data.len))
+  if data.len > 0:
+    let start = buf.len
+    buf.setLen(start + data.len)
+    copyMem(addr buf[start], unsafeAddr data[0], data.len)
+
 proc encodeLengthDelimited*(data: openArray[byte]): seq[byte] =
   ## Encode length-delimited data (length prefix + data)
-  result = encodeVarint(uint64(data.len))
-  result.add(data)
+  result = @[]
+  result.writeLengthDelimited(data)
+
+proc decodeLength(data: openArray[byte], pos: var int, what: string): int =
+  ## Decode a length prefix, checking that the payload fits in `data`. The
+  ## check is done before the conversion to int, so a length above
+  ## high(int) is reported like any other truncated field.
+  let length = decodeVarint(data, pos)
+  if length > uint64(data.len - pos):
+    raise newException(ValueError, "Unexpected end of data reading " & what)
+  int(length)
+
+proc decodeLengthDelimitedSpan*(data: openArray[byte], pos: var int): Slice[int] =
+  ## Decode a length prefix and return the payload range within `data`
+  ## without copying it; `pos` is moved past the payload. Use
+  ## `data.toOpenArray(span.a, span.b)` to read the payload in place.
+  let length = decodeLength(data, pos, "length delimited field")
+  result = pos ..< pos + length
+  pos += length
 
 proc decodeLengthDelimited*(data: openArray[byte], pos: var int): seq[byte] =
   ## Decode length-delimited data
-  let length = int(decodeVarint(data, pos))
-  if pos + length > data.len:
-    raise newException(ValueError, "Unexpected end of data reading length delimited field")
+  let length = decodeLength(data, pos, "length delimited field")
 
   result = newSeq[byte](length)
   if length > 0:
     copyMem(addr result[0], unsafeAddr data[pos], length)
     pos += length
 
+proc decodeLengthDelimitedInto*(data: openArray[byte], pos: var int,
+    dest: var seq[byte]) =
+  ## Like `decodeLengthDelimited` but overwrites `dest`, reusing its capacity
+  let length = decodeLength(data, pos, "length delimited field")
+  dest.setLen(length)
+  if length > 0:
+    copyMem(addr dest[0], unsafeAddr data[pos], length)
+    pos += length
+
+proc skipField*(data: openArray[byte], pos: var int, wireType: WireType) =
+  ## Move `pos` past the value of a field whose key has already been read
+  case wireType
+  of wtVarint:
+    discard decodeVarint(data, pos)
+  of wt64Bit:
+    if pos + 8 > data.len:
+      raise newException(ValueError, "Unexpected end of data skipping 64-bit field")
+    pos += 8
+  of wtLengthDelimited:
+    discard decodeLengthDelimitedSpan(data, pos)
+  of wtStartGroup:
+    # Skip nested fields until the matching end-group key
+    while true:
+      if pos >= data.len:
+        raise newException(ValueError, "Unexpected end of data skipping group")
+      let (_, groupWireType) = decodeFieldKey(data, pos)
+      if groupWireType == wtEndGroup:
+        break
+      skipField(data, pos, groupWireType)
+  of wtEndGroup:
+    raise newException(ValueError, "Corrupted protobuf stream: unexpected end group at offset " & $pos)
+  of wt32Bit:
+    if pos + 4 > data.len:
+      raise newException(ValueError, "Unexpected end of data skipping 32-bit field")
+    pos += 4
+
+proc countFields*(data: openArray[byte], pos: int, fieldNumber: int): int =
+  ## Number of occurrences of `fieldNumber` between `pos`, which must be at
+  ## a field boundary, and the end of `data`
+  var p = pos
+  while p < data.len:
+    let (num, wireType) = decodeFieldKey(data, p)
+    if num == fieldNumber:
+      inc result
+    skipField(data, p, wireType)
+
+# -----------------------------------------------------------------------------
+# WRITING HELPERS
+# -----------------------------------------------------------------------------
+# The write* procs append to a caller-owned buffer instead of allocating a new
+# seq per value. Generated `toBinary(self, buf)` overloads are built on these.
+
+proc writeInt32*(buf: var seq[byte], value: int32) =
+  # Negative int32 values are sign-extended to 10 bytes, as in the spec.
+  buf.writeVarint(cast[uint64](int64(value)))
+
+proc writeInt64*(buf: var seq[byte], value: int64) =
+  buf.writeVarint(cast[uint64](value))
+
+proc writeUInt32*(buf: var seq[byte], value: uint32) =
+  buf.writeVarint(uint64(value))
+
+proc writeUInt64*(buf: var seq[byte], value: uint64) =
+  buf.writeVarint(value)
+
+proc writeSInt32*(buf: var seq[byte], value: int32) =
+  buf.writeVarint(encodeZigZag(value))
+
+proc writeSInt64*(buf: var seq[byte], value: int64) =
+  buf.writeVarint(encodeZigZag(value))
+
+proc writeBool*(buf: var seq[byte], value: bool) =
+  buf.add(if value: 1'u8 else: 0'u8)
+
+proc writeString*(buf: var seq[byte], value: string) =
+  buf.writeVarint(uint64(value.len))
+  if value.len > 0:
+    let start = buf.len
+    buf.setLen(start + value.len)
+    copyMem(addr buf[start], unsafeAddr value[0], value.len)
+
+proc writeString*(buf: var seq[byte], value: openArray[byte]) =
+  buf.writeLengthDelimited(value)
+
+template writeFixedWidth(buf: var seq[byte], value: typed) =
+  # Fixed-width values are little endian on the wire
+  let start = buf.len
+  buf.setLen(start + sizeof(value))
+  when sizeof(value) == 4:
+    littleEndian32(addr buf[start], unsafeAddr value)
+  else:
+    littleEndian64(addr buf[start], unsafeAddr value)
+
+proc writeFloat32*(buf: var seq[byte], value: float32) =
+  buf.writeFixedWidth(value)
+
+proc writeFloat64*(buf: var seq[byte], value: float64) =
+  buf.writeFixedWidth(value)
+
+proc writeFixed32*(buf: var seq[byte], value: uint32) =
+  buf.writeFixedWidth(value)
+
+proc writeFixed64*(buf: var seq[byte], value: uint64) =
+  buf.writeFixedWidth(value)
+
+proc writeSFixed32*(buf: var seq[byte], value: int32) =
+  buf.writeFixedWidth(value)
+
+proc writeSFixed64*(buf: var seq[byte], value: int64) =
+  buf.writeFixedWidth(value)
+
+template writePackedFixedWidth[T](buf: var seq[byte], values: openArray[T]) =
+  when cpuEndian == littleEndian:
+    # The wire layout of a packed fixed-width field is the in-memory layout
+    # of the array, so the whole run is a single copy.
+    if values.len > 0:
+      let start = buf.len
+      buf.setLen(start + values.len * sizeof(T))
+      copyMem(addr buf[start], unsafeAddr values[0], values.len * sizeof(T))
+  else:
+    for value in values:
+      buf.writeFixedWidth(value)
+
+proc writePackedFloat32s*(buf: var seq[byte], values: openArray[float32]) =
+  ## Append the payload of a packed `float` field (without length prefix)
+  buf.writePackedFixedWidth(values)
+
+proc writePackedFloat64s*(buf: var seq[byte], values: openArray[float64]) =
+  ## Append the payload of a packed `double` field (without length prefix)
+  buf.writePackedFixedWidth(values)
+
+proc writePackedFixed32s*(buf: var seq[byte], values: openArray[uint32]) =
+  buf.writePackedFixedWidth(values)
+
+proc writePackedFixed64s*(buf: var seq[byte], values: openArray[uint64]) =
+  buf.writePackedFixedWidth(values)
+
+proc writePackedSFixed32s*(buf: var seq[byte], values: openArray[int32]) =
+  buf.writePackedFixedWidth(values)
+
+proc writePackedSFixed64s*(buf: var seq[byte], values: openArray[int64]) =
+  buf.writePackedFixedWidth(values)
+
+# -----------------------------------------------------------------------------
+# SIZE HELPERS
+# -----------------------------------------------------------------------------
+# Encoded sizes without encoding. Generated `byteSize` procs use these so that
+# length prefixes of nested messages can be written before their content.
+
+proc varintSize*(value: uint64): int {.inline.} =
+  ## Number of bytes `value` occupies as a varint (1..10)
+  (63 - countLeadingZeroBits(value or 1)) div 7 + 1
+
+proc tagSize*(fieldNumber: int): int {.inline.} =
+  varintSize(uint64(fieldNumber shl 3))
+
+proc sizeLengthDelimited*(length: int): int {.inline.} =
+  ## Size of a length prefix plus `length` bytes of payload
+  varintSize(uint64(length)) + length
+
+proc sizeInt32*(value: int32): int {.inline.} =
+  varintSize(cast[uint64](int64(value)))
+
+proc sizeInt64*(value: int64): int {.inline.} =
+  varintSize(cast[uint64](value))
+
+proc sizeUInt32*(value: uint32): int {.inline.} =
+  varintSize(uint64(value))
+
+proc sizeUInt64*(value: uint64): int {.inline.} =
+  varintSize(value)
+
+proc sizeSInt32*(value: int32): int {.inline.} =
+  varintSize(encodeZigZag(value))
+
+proc sizeSInt64*(value: int64): int {.inline.} =
+  varintSize(encodeZigZag(value))
+
+proc sizeBool*(value: bool): int {.inline.} = 1
+
+proc sizeString*(value: string): int {.inline.} =
+  sizeLengthDelimited(value.len)
+
+proc sizeString*(value: openArray[byte]): int {.inline.} =
+  sizeLengthDelimited(value.len)
+
+proc sizeFloat32*(value: float32): int {.inline.} = 4
+
+proc sizeFloat64*(value: float64): int {.inline.} = 8
+
+proc sizeFixed32*(value: uint32): int {.inline.} = 4
+
+proc sizeFixed64*(value: uint64): int {.inline.} = 8
+
+proc sizeSFixed32*(value: int32): int {.inline.} = 4
+
+proc sizeSFixed64*(value: int64): int {.inline.} = 8
+
+proc reserveSize*(sizes: var seq[int]): int {.inline.} =
+  ## Append a slot for a length to `sizes` and return its index. Generated
+  ## `byteSize(self, sizes)` procs record the length of every nested
+  ## message, packed run and map entry this way, in the order `toBinary`
+  ## writes them, so each length is computed once per encoding.
+  result = sizes.len
+  sizes.add(0)
+
+proc nextSize*(sizes: openArray[int], pos: var int): int {.inline.} =
+  ## The next length recorded by `byteSize(self, sizes)`
+  result = sizes[pos]
+  inc pos
+
 # -----------------------------------------------------------------------------
 # ENCODING HELPERS
 # -----------------------------------------------------------------------------
 
 proc encodeInt32*(value: int32): seq[byte] =
-  if value < 0:
-    encodeVarint(cast[uint64](int64(value)))
-  else:
-    encodeVarint(uint64(value))
+  result.writeInt32(value)
 
 proc encodeInt64*(value: int64): seq[byte] =
-  encodeVarint(cast[uint64](value))
+  result.writeInt64(value)
 
 proc encodeUInt32*(value: uint32): seq[byte] =
-  encodeVarint(uint64(value))
+  result.writeUInt32(value)
 
 proc encodeUInt64*(value: uint64): seq[byte] =
-  encodeVarint(value)
+  result.writeUInt64(value)
 
 proc encodeSInt32*(value: int32): seq[byte] =
-  encodeVarint(encodeZigZag(value))
+  result.writeSInt32(value)
 
 proc encodeSInt64*(value: int64): seq[byte] =
-  encodeVarint(encodeZigZag(value))
+  result.writeSInt64(value)
 
 proc encodeBool*(value: bool): seq[byte] =
-  encodeVarint(if value: 1'u64 else: 0'u64)
+  result.writeBool(value)
 
 proc encodeString*(value: string): seq[byte] =
-  result = encodeVarint(uint64(value.len))
-  for c in value:
-    result.add(byte(c))
+  result.writeString(value)
 
 proc encodeString*(value: openArray[byte]): seq[byte] =
-  result = encodeVarint(uint64(value.len))
-  if value.len > 0:
-    result.add(value)
+  result.writeString(value)
 
 proc encodeFloat32*(value: float32): seq[byte] =
-  result = newSeq[byte](4)
-  copyMem(addr result[0], unsafeAddr value, 4)
+  result.writeFloat32(value)
 
 proc encodeFloat64*(value: float64): seq[byte] =
-  result = newSeq[byte](8)
-  copyMem(addr result[0], unsafeAddr value, 8)
+  result.writeFloat64(value)
+
+proc encodeFixed32*(value: uint32): seq[byte] =
+  result.writeFixed32(value)
+
+proc encodeFixed64*(value: uint64): seq[byte] =
+  result.writeFixed64(value)
+
+proc encodeSFixed32*(value: int32): seq[byte] =
+  result.writeSFixed32(value)
+
+proc encodeSFixed64*(value: int64): seq[byte] =
+  result.writeSFixed64(value)
 
 # -----------------------------------------------------------------------------
 # DECODING HELPERS
@@ -161,22 +466,133 @@ proc decodeBool*(data: openArray[byte], pos: var int): bool =
   decodeVarint(data, pos) != 0
 
 proc decodeString*(data: openArray[byte], pos: var int): string =
-  let length = int(decodeVarint(data, pos))
-  if pos + length > data.len:
-    raise newException(ValueError, "Unexpected end of data reading string")
+  let length = decodeLength(data, pos, "string")
   result = newString(length)
   if length > 0:
     copyMem(addr result[0], unsafeAddr data[pos], length)
     pos += length
 
+proc decodeStringInto*(data: openArray[byte], pos: var int, dest: var string) =
+  ## Like `decodeString` but overwrites `dest`, reusing its capacity
+  let length = decodeLength(data, pos, "string")
+  dest.setLen(length)
+  if length > 0:
+    copyMem(addr dest[0], unsafeAddr data[pos], length)
+    pos += length
+
+proc readFixedWidth[T](data: openArray[byte], pos: var int,
+    name: string): T {.inline.} =
+  if pos + sizeof(T) > data.len:
+    raise newException(ValueError, "Unexpected end of data reading " & name)
+  when sizeof(T) == 4:
+    littleEndian32(addr result, unsafeAddr data[pos])
+  else:
+    littleEndian64(addr result, unsafeAddr data[pos])
+  pos += sizeof(T)
+
 proc decodeFloat32*(data: openArray[byte], pos: var int): float32 =
-  if pos + 4 > data.len:
-    raise newException(ValueError, "Unexpected end of data reading float32")
-  copyMem(addr result, unsafeAddr data[pos], 4)
-  pos += 4
+  readFixedWidth[float32](data, pos, "float32")
 
 proc decodeFloat64*(data: openArray[byte], pos: var int): float64 =
-  if pos + 8 > data.len:
-    raise newException(ValueError, "Unexpected end of data reading float64")
-  copyMem(addr result, unsafeAddr data[pos], 8)
-  pos += 8
+  readFixedWidth[float64](data, pos, "float64")
+
+proc decodeFixed32*(data: openArray[byte], pos: var int): uint32 =
+  readFixedWidth[uint32](data, pos, "fixed32")
+
+proc decodeFixed64*(data: openArray[byte], pos: var int): uint64 =
+  readFixedWidth[uint64](data, pos, "fixed64")
+
+proc decodeSFixed32*(data: openArray[byte], pos: var int): int32 =
+  readFixedWidth[int32](data, pos, "sfixed32")
+
+proc decodeSFixed64*(data: openArray[byte], pos: var int): int64 =
+  readFixedWidth[int64](data, pos, "sfixed64")
+
+# -----------------------------------------------------------------------------
+# PACKED REPEATED DECODING
+# -----------------------------------------------------------------------------
+# The decodePacked* procs decode the payload of a packed repeated field and
+# append the values to `dest`. The element count is known before decoding
+# (one terminator byte per varint, or a fixed width), so `dest` is resized
+# once instead of growing element by element.
+
+proc countVarints*(data: openArray[byte]): int =
+  ## Number of varints in `data`, i.e. bytes without the continuation bit
+  var i = 0
+  while i + 8 <= data.len:
+    var word: uint64
+    copyMem(addr word, unsafeAddr data[i], 8)
+    result += countSetBits(not word and 0x8080808080808080'u64)
+    i += 8
+  while i < data.len:
+    if data[i] < 0x80'u8:
+      inc result
+    inc i
+
+template decodePackedVarints(data: openArray[byte], dest: var seq,
+    convert: untyped) =
+  let start = dest.len
+  dest.setLen(start + countVarints(data))
+  var pos = 0
+  for i in start ..< dest.len:
+    let raw {.inject.} = decodeVarint(data, pos)
+    dest[i] = convert
+  if pos != data.len:
+    raise newException(ValueError, "Truncated varint in packed field")
+
+template decodePackedFixed(data: openArray[byte], dest: var seq, T: typedesc) =
+  if data.len mod sizeof(T) != 0:
+    raise newException(ValueError, "Packed field length " & $data.len &
+        " is not a multiple of " & $sizeof(T))
+  let start = dest.len
+  dest.setLen(start + data.len div sizeof(T))
+  when cpuEndian == littleEndian:
+    # One copy for the whole run, see writePackedFixedWidth
+    if data.len > 0:
+      copyMem(addr dest[start], unsafeAddr data[0], data.len)
+  else:
+    var pos = 0
+    for i in start ..< dest.len:
+      dest[i] = readFixedWidth[T](data, pos, $T)
+
+proc decodePackedInt32s*(data: openArray[byte], dest: var seq[int32]) =
+  decodePackedVarints(data, dest, cast[int32](uint32(raw and 0xFFFFFFFF'u64)))
+
+proc decodePackedInt64s*(data: openArray[byte], dest: var seq[int64]) =
+  decodePackedVarints(data, dest, cast[int64](raw))
+
+proc decodePackedUInt32s*(data: openArray[byte], dest: var seq[uint32]) =
+  decodePackedVarints(data, dest, uint32(raw and 0xFFFFFFFF'u64))
+
+proc decodePackedUInt64s*(data: openArray[byte], dest: var seq[uint64]) =
+  decodePackedVarints(data, dest, raw)
+
+proc decodePackedSInt32s*(data: openArray[byte], dest: var seq[int32]) =
+  decodePackedVarints(data, dest, cast[int32](decodeZigZag(raw)))
+
+proc decodePackedSInt64s*(data: openArray[byte], dest: var seq[int64]) =
+  decodePackedVarints(data, dest, decodeZigZag(raw))
+
+proc decodePackedBools*(data: openArray[byte], dest: var seq[bool]) =
+  decodePackedVarints(data, dest, raw != 0)
+
+proc decodePackedEnums*[T: enum](data: openArray[byte], dest: var seq[T]) =
+  decodePackedVarints(data, dest, T(cast[int32](uint32(raw and 0xFFFFFFFF'u64))))
+
+proc decodePackedFloat32s*(data: openArray[byte], dest: var seq[float32]) =
+  decodePackedFixed(data, dest, float32)
+
+proc decodePackedFloat64s*(data: openArray[byte], dest: var seq[float64]) =
+  decodePackedFixed(data, dest, float64)
+
+proc decodePackedFixed32s*(data: openArray[byte], dest: var seq[uint32]) =
+  decodePackedFixed(data, dest, uint32)
+
+proc decodePackedFixed64s*(data: openArray[byte], dest: var seq[uint64]) =
+  decodePackedFixed(data, dest, uint64)
+
+proc decodePackedSFixed32s*(data: openArray[byte], dest: var seq[int32]) =
+  decodePackedFixed(data, dest, int32)
+
+proc decodePackedSFixed64s*(data: openArray[byte], dest: var seq[int64]) =
+  decodePackedFixed(data, dest, int64)
@@ -6,9 +6,13 @@
 ##
 ## Usage:
 ##   protonim [options] -i <input.proto>
+##   protonim [options] --outDir <dir> <file.proto | dir>...
+##
+## The second form generates one module per proto file, see "Multi-file mode".
 ##
 ## Options:
-##   -i, --input <file>       Input .proto file (required)
+##   -i, --input <file>       Input .proto file (required), or `-` to read the
+##                            proto source from stdin
 ##   -o, --output <file>      Output .nim file (optional, defaults to stdout)
 ##   -s, --searchDirs <dir>   Search directories for imported .proto files (can be used multiple times)
 ##   -p, --extraImportPackages <pkg>
@@ -16,6 +20,30 @@
 ##   -r, --replaceCode <old:new>
 ##                            Replace code in the generated Nim code (can be used multiple times)
 ##                            Format: "old_string:new_string"
+##   --preserveUnknownFields  Keep unrecognized fields in an `unknownFields` slot
+##                            and write them back in `toBinary`
+##   --mapType <type>         Representation of map fields: table (default),
+##                            ordered (OrderedTable) or sorted (SortedMap)
+##   --deterministic          Write map entries in key order in `toBinary`
+##   --tableDriven            Encode and decode through one shared codec walking
+##                            a per-message field table, for smaller binaries
+##   --listImports            Write an `# Imports <path>` line before the code
+##                            for every proto file the input imports, directly
+##                            or not, as the parser resolved it
+##   --outDir <dir>           Output directory of multi-file mode
+##   --jobs <n>               Processes to generate with in multi-file mode
+##                            (default: number of CPUs)
+##
+## Multi-file mode:
+##   Given .proto files or directories (searched recursively for .proto
+##   files), protonim writes one module per proto file into `--outDir`,
+##   including the files they import, e.g. `google/api/http.proto` to
+##   `<outDir>/google/api/http_pb.nim`. A module imports and re-exports the
+##   modules of its imports instead of inlining their types, so every file is
+##   parsed, generated and compiled once. A file is named by its path relative
+##   to the first search dir containing it; directories given as inputs are
+##   search dirs too. Types keep the names of the single-file output, and also
+##   get `<package>_<Name>` aliases, the names importing modules use.
 ##
 ## Examples:
 ##   # Generate code to stdout
@@ -29,12 +57,66 @@
 ##
 ##   # Replace a type name in the generated code
 ##   protonim -i my_proto.proto -r "OldType:NewType"
+##
+##   # Generate map fields as sorted seqs
+##   protonim -i my_proto.proto --mapType sorted
+##
+##   # Read the proto source from stdin
+##   cat my_proto.proto | protonim -i - -s ./protos
+##
+##   # One module per proto file under ./protos, generated on 4 processes
+##   protonim --outDir ./generated --jobs 4 ./protos
 
-import strutils
-import ../nimproto3/[codegen]
+import std/[strutils, os, osproc, algorithm, tables]
+import ../nimproto3/[ast, codegen]
 
-proc main(input: string, output: string = "", searchDirs: seq[string] = @[],
-    extraImportPackages: seq[string] = @[], replaceCode: seq[string] = @[]) =
+proc generateModules(roots: seq[string], outDir: string,
+    searchDirs: seq[string], extraImportPackages: seq[string],
+    replaceCode: seq[tuple[oldStr: string, newStr: string]],
+    options: CodegenOptions, jobs: int, shard: int, claims: string) =
+  ## Multi-file mode: one module per proto file of `roots`
+  var files: seq[string]
+  var dirs = searchDirs
+  for root in roots:
+    if dirExists(root):
+      var found: seq[string]
+      for path in walkDirRec(root):
+        if path.endsWith(".proto"):
+          found.add(path)
+      files.add(sorted(found))
+      dirs.add(root)
+    else:
+      files.add(root)
+
+  let workers = min(if jobs > 0: jobs else: countProcessors(), files.len)
+  if shard >= 0:
+    for path in genModulesFromProtoFiles(files, outDir, dirs,
+        extraImportPackages, replaceCode, options, shard, jobs, claims):
+      echo path
+  elif workers > 1:
+    # One process per shard of the files, each with its own parse cache.
+    # Imports outside the files go to the first shard claiming them.
+    let claimDir = getTempDir() / "protonim-" & $getCurrentProcessId()
+    createDir(claimDir)
+    defer: removeDir(claimDir)
+    var commands: seq[string]
+    for i in 0 ..< workers:
+      commands.add(quoteShellCommand(@[getAppFilename()] &
+          commandLineParams() & @["--jobs=" & $workers, "--shard=" & $i,
+          "--claims=" & claimDir]))
+    if execProcesses(commands, n = workers, options = {poParentStreams}) != 0:
+      raise newException(ValueError, "Failed to generate modules")
+  else:
+    for path in genModulesFromProtoFiles(files, outDir, dirs,
+        extraImportPackages, replaceCode, options):
+      echo path
+
+proc main(input: string = "", output: string = "", searchDirs: seq[string] = @[],
+    extraImportPackages: seq[string] = @[], replaceCode: seq[string] = @[],
+    preserveUnknownFields: bool = false, mapType: string = "table",
+    deterministic: bool = false, tableDriven: bool = false,
+    listImports: bool = false, outDir: string = "", jobs: int = 0,
+    shard: int = -1, claims: string = "", roots: seq[string]) =
 
   var replaceCodeTuples: seq[tuple[oldStr: string, newStr: string]]
   for i in 0 ..< replaceCode.len:
@@ -44,7 +126,32 @@ proc main(input: string, output: string = "", searchDirs: seq[string] = @[],
     let (oldStr, newStr) = (replaceCodeParts[0], replaceCodeParts[1])
     replaceCodeTuples.add((oldStr, newStr))
 
-  let nimCode = genCodeFromProtoFile(input, searchDirs, extraImportPackages, replaceCodeTuples)
+  let options = CodegenOptions(preserveUnknownFields: preserveUnknownFields,
+      mapRepr: parseMapRepr(mapType), deterministic: deterministic,
+      tableDriven: tableDriven)
+
+  if roots.len > 0:
+    if outDir.len == 0:
+      raise newException(ValueError, "--outDir is required in multi-file mode")
+    generateModules(roots, outDir, searchDirs, extraImportPackages,
+        replaceCodeTuples, options, jobs, shard, claims)
+    return
+  if input.len == 0:
+    raise newException(ValueError, "No input file, use -i <input.proto>")
+
+  let imported = newTable[string, ProtoNode]()
+  var nimCode =
+    if input == "-":
+      genCodeFromProtoString(stdin.readAll(), searchDirs, extraImportPackages,
+          replaceCodeTuples, options, imported)
+    else:
+      genCodeFromProtoFile(input, searchDirs, extraImportPackages,
+          replaceCodeTuples, options, imported)
+  if listImports:
+    var header = ""
+    for path in imported.keys:
+      header.add("# Imports " & absolutePath(path) & "\n")
+    nimCode = header & nimCode
 
   # Output
   if output.len > 0:
@@ -55,8 +162,18 @@ proc main(input: string, output: string = "", searchDirs: seq[string] = @[],
 when isMainModule:
   import cligen
   cligen.dispatch(main, short = {"input": 'i', "output": 'o',
-      "extraImportPackages": 'p'}, help = {
+      "extraImportPackages": 'p'}, positional = "roots", help = {
       "extraImportPackages": "Extra import packages to add to the generated code. For example: -p google.protobuf.any -p google.protobuf.duration",
       "replaceCode": "Replace code in the generated Nim code. For example: -r old_code:new_code -r another_old_code:another_new_code",
       "searchDirs": "Search directories for imported proto files. For example: -s /path/to/protos -s /path/to/other/protos",
-      "output": "Output file. If not specified, prints to stdout"})
+      "input": "Input .proto file, or - to read the proto source from stdin",
+      "output": "Output file. If not specified, prints to stdout",
+      "preserveUnknownFields": "Keep unrecognized fields as raw bytes in an unknownFields slot and write them back in toBinary",
+      "mapType": "Representation of map fields: table, ordered (OrderedTable) or sorted (SortedMap, a seq sorted by key)",
+      "deterministic": "Write map entries in ascending key order in toBinary, so equal messages encode to the same bytes",
+      "tableDriven": "Generate a field table per message and route toBinary, fromBinary and JSON through one shared table-driven codec instead of unrolled procs per message",
+      "listImports": "Write an '# Imports <path>' line before the code for every proto file the input imports, directly or not",
+      "outDir": "Output directory for multi-file mode: one module per proto file given as an argument (or found in a directory argument) and per file they import",
+      "jobs": "Number of processes for multi-file mode. 0 uses one per CPU",
+      "shard": "Internal: the share of the files a --jobs worker process generates",
+      "claims": "Internal: directory where --jobs workers claim the imports they generate"})
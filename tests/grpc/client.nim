@@ -68,4 +68,87 @@ when isMainModule:
 
     clientStream.close()
 
+    # Example 4: Streaming, one reply at a time
+    echo "\n--------------------------------------------------------------------------------"
+    echo "Incremental Streaming Test..."
+    let clientCall = newGrpcClient("localhost", 50051, CompressionIdentity)
+    await clientCall.connect()
+    await sleepAsync(200)
+
+    echo "\n[TEST 4] Bidirectional Stream, Replies Decoded As They Arrive"
+    block:
+      let call = await clientCall.streamTestStream(@[
+        TestRequest(message: "Ping 1", counter: 1),
+        TestRequest(message: "Ping 2", counter: 2)
+      ])
+      var replies = 0
+      while true:
+        let reply = await call.recv()
+        if reply.isNone: break
+        inc replies
+        echo "Stream Reply: ", reply.get().response
+        doAssert reply.get().response == "Echo: Ping " & $replies
+      doAssert replies == 2
+
+    clientCall.close()
+
+    # Example 5: Streaming, one request at a time
+    echo "\n--------------------------------------------------------------------------------"
+    echo "Ping-Pong Streaming Test..."
+    let clientPingPong = newGrpcClient("localhost", 50051, CompressionIdentity)
+    await clientPingPong.connect()
+    await sleepAsync(200)
+
+    echo "\n[TEST 5] Bidirectional Stream, One Request Per Reply"
+    block:
+      let call = await clientPingPong.streamTestCall()
+      for i in 1 .. 3:
+        await call.send(TestRequest(message: "Ping " & $i, counter: i.int32))
+        let reply = await call.recv()
+        echo "Stream Reply: ", reply.get().response
+        doAssert reply.get().response == "Echo: Ping " & $i
+      await call.closeSend()
+      doAssert (await call.recv()).isNone
+
+    clientPingPong.close()
+
+    # Example 6: Messages larger than the 64 KiB flow-control window
+    echo "\n--------------------------------------------------------------------------------"
+    echo "Flow Control Test..."
+    for windowSize in [DEFAULT_WINDOW_SIZE, 4 * 1024 * 1024]:
+      let clientBulk = newGrpcClient("localhost", 50051, CompressionIdentity,
+          windowSize = windowSize)
+      await clientBulk.connect()
+      await sleepAsync(200)
+
+      echo "\n[TEST 6] 1 MiB Unary Call, window ", windowSize
+      block:
+        let big = repeat('x', 1024 * 1024)
+        let reply = await clientBulk.simpleTest(TestRequest(message: big))
+        echo "Reply length: ", reply.response.len
+        doAssert reply.response == "Server says: " & big.toUpperAscii()
+
+      clientBulk.close()
+
+    # Example 7: Concurrent large calls, whose frames share one connection
+    echo "\n--------------------------------------------------------------------------------"
+    echo "Concurrent Calls Test..."
+    let clientConcurrent = newGrpcClient("localhost", 50051, CompressionIdentity)
+    await clientConcurrent.connect()
+    await sleepAsync(200)
+
+    echo "\n[TEST 7] 4 Concurrent 256 KiB Unary Calls"
+    block:
+      var calls: seq[Future[TestReply]]
+      for i in 0 ..< 4:
+        let msg = repeat(char(ord('a') + i), 256 * 1024)
+        calls.add(clientConcurrent.simpleTest(TestRequest(message: msg)))
+      let replies = await all(calls)
+      for i, reply in replies:
+        doAssert reply.response == "Server says: " &
+            repeat(char(ord('A') + i), 256 * 1024)
+      echo "Replies: ", replies.len
+
+    clientConcurrent.close()
+
   waitFor runTests()
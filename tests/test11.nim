@@ -0,0 +1,452 @@
+## Test generated serialization procs: buffer encoding, byteSize, views and JSON
+import unittest
+import nimproto3
+
+proto3 """
+syntax = "proto3";
+package codec;
+
+enum Level {
+  LOW = 0;
+  MID = 1;
+  HIGH = 2;
+}
+
+message Point {
+  sint32 x = 1;
+  sint32 y = 2;
+}
+
+message Shape {
+  string name = 1;
+  repeated Point points = 2;
+  Point origin = 3;
+  repeated int32 tags = 4;
+  Level level = 5;
+  map<string, Point> anchors = 6;
+  bytes blob = 7;
+  repeated string notes = 8;
+  oneof fill {
+    string color = 9;
+    Point pattern = 10;
+  }
+}
+
+message Layer {
+  Shape shape = 1;
+  repeated Shape shapes = 2;
+}
+
+message Embedding {
+  repeated float values = 1;
+  fixed64 id = 2;
+  sfixed32 offset = 3;
+  repeated double weights = 4;
+  repeated sfixed64 stamps = 5;
+  oneof scale {
+    double factor = 6;
+    fixed32 bucket = 7;
+  }
+}
+
+message Inventory {
+  map<string, int32> counts = 1 [(nimproto3.map_type) = "sorted"];
+  map<int32, Point> spots = 2 [(nimproto3.map_type) = "sorted"];
+  map<string, int32> seen = 3 [(nimproto3.map_type) = "ordered"];
+}
+"""
+
+proc sampleShape(): Shape =
+  result = Shape(name: "triangle", level: HIGH, blob: @[1'u8, 2, 3],
+      tags: @[1'i32, -1, 300], notes: @["a", "", "c"],
+      fillKind: rkPattern, pattern: Point(x: -3, y: 4))
+  result.points = @[Point(x: 0, y: 0), Point(x: 10, y: -10), Point(x: 5, y: 7)]
+  result.origin = Point(x: 1, y: 1)
+  result.anchors["top"] = Point(x: 5, y: 7)
+
+suite "Generated binary serialization":
+  test "buffer overload appends to existing content":
+    let shape = sampleShape()
+    let encoded = shape.toBinary()
+    var buf = @[0xFF'u8]
+    shape.toBinary(buf)
+    check buf.len == encoded.len + 1
+    check buf[0] == 0xFF'u8
+    check buf[1 .. ^1] == encoded
+    # Reusing the buffer after clearing it gives the same bytes
+    buf.setLen(0)
+    shape.toBinary(buf)
+    check buf == encoded
+
+  test "byteSize matches the encoded length":
+    let shape = sampleShape()
+    check shape.byteSize == shape.toBinary().len
+    check Point().byteSize == 0
+    check Point(x: -1).byteSize == 2
+    let layer = Layer(shape: shape, shapes: @[shape, Shape()])
+    check layer.byteSize == layer.toBinary().len
+
+  test "nested lengths are recorded once, in write order":
+    var sizes: seq[int]
+    # An empty nested message leaves only its own zero length
+    check Layer(shape: Shape(origin: Point())).byteSize(sizes) == 0
+    check sizes == @[0]
+    var shape = Shape(points: @[Point(x: 1)], origin: Point(),
+        tags: @[1'i32, 300])
+    shape.anchors["a"] = Point(x: 1)
+    let layer = Layer(shapes: @[shape])
+    sizes.setLen(0)
+    let size = layer.byteSize(sizes)
+    # The empty shape field, then the repeated shape: its point, its empty
+    # origin, the packed tags, the anchor entry and the anchor's point
+    check sizes == @[0, size - 2, 2, 0, 3, 7, 2]
+    var buf: seq[byte]
+    var pos = 0
+    layer.toBinary(buf, sizes, pos)
+    check pos == sizes.len
+    check buf == layer.toBinary()
+
+  test "nested round trip":
+    let layer = Layer(shape: sampleShape(), shapes: @[sampleShape(), Shape(name: "empty")])
+    let decoded = Layer.fromBinary(layer.toBinary())
+    check decoded.shape.points == layer.shape.points
+    check decoded.shape.anchors["top"] == Point(x: 5, y: 7)
+    check decoded.shapes[1].name == "empty"
+    check decoded.shapes[0].fillKind == rkPattern
+    check decoded.shapes[0].pattern == Point(x: -3, y: 4)
+    check decoded.toBinary() == layer.toBinary()
+
+  test "unknown fields are skipped by wire type":
+    var data: seq[byte]
+    data.writeTag(1, wtVarint)
+    data.writeSInt32(5)
+    data.writeTag(20, wtLengthDelimited)
+    data.writeString("skipped")
+    data.writeTag(21, wt64Bit)
+    data.writeFloat64(1.5)
+    data.writeTag(22, wt32Bit)
+    data.writeFloat32(2.5)
+    data.writeTag(2, wtVarint)
+    data.writeSInt32(-6)
+    check Point.fromBinary(data) == Point(x: 5, y: -6)
+
+  test "oneof string member round trip":
+    let shape = Shape(fillKind: rkColor, color: "red")
+    let decoded = Shape.fromBinary(shape.toBinary())
+    check decoded.fillKind == rkColor
+    check decoded.color == "red"
+
+suite "Fixed-width fields":
+  test "packed floats and fixed-width scalars round trip":
+    let e = Embedding(values: @[0.5'f32, -1.25, 3e10], id: high(uint64) - 1,
+        offset: -7, weights: @[1.0, -0.0], stamps: @[low(int64), 1],
+        scaleKind: rkFactor, factor: 0.125)
+    let data = e.toBinary()
+    check data.len == e.byteSize
+    let decoded = Embedding.fromBinary(data)
+    check decoded.values == e.values
+    check decoded.id == e.id
+    check decoded.offset == -7
+    check decoded.weights == e.weights
+    check decoded.stamps == e.stamps
+    check decoded.scaleKind == rkFactor
+    check decoded.factor == 0.125
+    check decoded.toBinary() == data
+
+  test "packed float payload is the raw little-endian array":
+    let e = Embedding(values: @[1.5'f32, 2.5])
+    var expected: seq[byte]
+    expected.writeTag(1, wtLengthDelimited)
+    expected.writeVarint(8)
+    expected.writeFloat32(1.5)
+    expected.writeFloat32(2.5)
+    check e.toBinary() == expected
+
+  test "oneof fixed32 member uses the 32-bit wire type":
+    let e = Embedding(scaleKind: rkBucket, bucket: 9)
+    check e.toBinary() == @[0x3D'u8, 9, 0, 0, 0]
+    check Embedding.fromBinary(e.toBinary()).bucket == 9
+
+  test "JSON round trip":
+    let e = Embedding(values: @[0.5'f32], id: 42, offset: -1, stamps: @[-5'i64])
+    check Embedding.fromJson(e.toJson()).toBinary() == e.toBinary()
+
+suite "Lazy views":
+  test "scalar, string and nested accessors":
+    let shape = sampleShape()
+    let v = ShapeView.newProtoView(shape.toBinary())
+    check v.name == "triangle"
+    check v.level == HIGH
+    check v.blob == @[1'u8, 2, 3]
+    check v.tags == @[1'i32, -1, 300]
+    check v.origin.x == 1
+    check v.pointsLen == 3
+    check v.points(1).y == -10
+    check v.notesLen == 3
+    check v.notes(2) == "c"
+    check v.fillKind == rkPattern
+    check v.pattern.x == -3
+
+  test "nested views share the buffer":
+    let layer = Layer(shape: sampleShape())
+    let v = LayerView.newProtoView(layer.toBinary())
+    let inner = v.shape
+    check viewBuffer(inner) == viewBuffer(v)
+    check inner.points(2).toMessage() == Point(x: 5, y: 7)
+    check inner.toMessage().anchors["top"] == Point(x: 5, y: 7)
+
+  test "interleaved occurrences keep wire order per field":
+    # Fields written out of order and repeated: notes, name, notes, name
+    var data: seq[byte]
+    for (num, s) in [(8, "x"), (1, "first"), (8, "y"), (1, "last"), (8, "z")]:
+      data.writeTag(num, wtLengthDelimited)
+      data.writeString(s)
+    let v = ShapeView.newProtoView(data)
+    check v.name == "last"
+    check v.notesLen == 3
+    check v.notes(0) == "x"
+    check v.notes(1) == "y"
+    check v.notes(2) == "z"
+    check viewFieldCount(v, 1) == 2
+    check viewFieldCount(v, 4) == 0
+    expect IndexDefect:
+      discard v.notes(3)
+
+  test "absent fields read as defaults":
+    let v = ShapeView.newProtoView(Shape().toBinary())
+    check v.name == ""
+    check v.level == LOW
+    check v.tags.len == 0
+    check v.pointsLen == 0
+    check v.origin.x == 0
+    check v.fillKind == rkNone
+    expect IndexDefect:
+      discard v.points(0)
+
+suite "Partial decoding":
+  test "only selected fields are decoded":
+    let shape = sampleShape()
+    let decoded = Shape.fromBinary(shape.toBinary(), {1, 5})
+    check decoded.name == "triangle"
+    check decoded.level == HIGH
+    check decoded.points.len == 0
+    check decoded.anchors.len == 0
+    check decoded.notes.len == 0
+    check decoded.fillKind == rkNone
+
+  test "selected message fields are decoded in full":
+    let layer = Layer(shape: sampleShape(), shapes: @[sampleShape()])
+    let decoded = Layer.fromBinary(layer.toBinary(), {1})
+    check decoded.shape.toBinary() == layer.shape.toBinary()
+    check decoded.shapes.len == 0
+
+  test "AllFields matches the plain overload":
+    let data = sampleShape().toBinary()
+    check Shape.fromBinary(data, AllFields).toBinary() == Shape.fromBinary(data).toBinary()
+    check Shape.fromBinary(data, {}).toBinary().len == 0
+
+suite "Reusable-object decoding":
+  test "clear then merge gives the same object as fromBinary":
+    let data = sampleShape().toBinary()
+    var shape = Shape(name: "old", tags: @[9'i32], fillKind: rkColor, color: "blue")
+    shape.anchors["stale"] = Point()
+    shape.clear()
+    check shape.toBinary().len == 0
+    shape.mergeFromBinary(data)
+    check shape.toBinary() == data
+    check shape.fillKind == rkPattern
+    check shape.anchors.len == 1
+
+  test "clear keeps the capacity of seqs and strings":
+    var shape = sampleShape()
+    shape.name = newStringOfCap(64)
+    shape.name.add("triangle")
+    shape.tags = newSeqOfCap[int32](64)
+    shape.tags.add(1)
+    let nameBuf = shape.name[0].addr
+    let tagsBuf = shape.tags[0].addr
+    for i in 0 ..< 3:
+      shape.clear()
+      shape.mergeFromBinary(sampleShape().toBinary())
+      check shape.name == "triangle"
+      check shape.tags == @[1'i32, -1, 300]
+      check shape.name[0].addr == nameBuf
+      check shape.tags[0].addr == tagsBuf
+
+  test "merging follows protobuf merge semantics":
+    var layer = Layer(shape: Shape(name: "a", tags: @[1'i32]), shapes: @[Shape()])
+    layer.mergeFromBinary(Layer(shape: Shape(level: MID, tags: @[2'i32]),
+        shapes: @[Shape(name: "b")]).toBinary())
+    check layer.shape.name == "a"
+    check layer.shape.level == MID
+    check layer.shape.tags == @[1'i32, 2]
+    check layer.shapes.len == 2
+    check layer.shapes[1].name == "b"
+
+  test "oneof member switches on merge":
+    var shape = Shape(fillKind: rkPattern, pattern: Point(x: 1))
+    shape.mergeFromBinary(Shape(fillKind: rkColor, color: "red").toBinary())
+    check shape.fillKind == rkColor
+    check shape.color == "red"
+    shape.setFillKind(rkNone)
+    check shape.fillKind == rkNone
+    check shape.toBinary().len == 0
+
+suite "Streaming JSON":
+  test "toJsonString writes the same text as toJson":
+    let shape = sampleShape()
+    check shape.toJsonString() == $shape.toJson()
+    let layer = Layer(shape: shape, shapes: @[Shape(), Shape(fillKind: rkColor, color: "red")])
+    check layer.toJsonString() == $layer.toJson()
+    let e = Embedding(values: @[0.5'f32], id: high(uint64), scaleKind: rkBucket, bucket: 3)
+    check e.toJsonString() == $e.toJson()
+    check Point().toJsonString() == "{}"
+
+  test "buffer overload appends":
+    var buf = "["
+    Point(x: 1).toJsonString(buf)
+    buf.add(',')
+    Point(y: -2).toJsonString(buf)
+    buf.add(']')
+    check buf == """[{"x":1},{"y":-2}]"""
+
+  test "fromJsonString round trip":
+    let layer = Layer(shape: sampleShape(), shapes: @[sampleShape()])
+    check Layer.fromJsonString(layer.toJsonString()).toBinary() == layer.toBinary()
+    let e = Embedding(values: @[0.5'f32, -2], id: high(uint64) - 3, offset: -1,
+        weights: @[1e-3], stamps: @[low(int64)], scaleKind: rkFactor, factor: 2.5)
+    check Embedding.fromJsonString(e.toJsonString()).toBinary() == e.toBinary()
+
+  test "unknown keys and nulls are skipped":
+    let text = """{"extra": {"a": [1, {"b": null}]}, "name": "n", "origin": null,
+        "level": 2, "tags": ["7", 8], "color": "green"}"""
+    let shape = Shape.fromJsonString(text)
+    check shape.name == "n"
+    check shape.level == HIGH
+    check shape.tags == @[7'i32, 8]
+    check shape.fillKind == rkColor
+    check shape.color == "green"
+
+  test "malformed input raises":
+    expect ValueError:
+      discard Point.fromJsonString("""{"x": 1""")
+    expect ValueError:
+      discard Point.fromJsonString("""{"x": "one"}""")
+    expect ValueError:
+      discard Point.fromJsonString("""{"x": 1} {}""")
+
+  test "readJson decodes messages out of a larger document":
+    var p: JsonParser
+    p.openJsonParser("""[{"x": 1}, {"y": 2}]""")
+    p.expectJson(jsonArrayStart)
+    var point: Point
+    var points: seq[Point]
+    while p.kind != jsonArrayEnd:
+      point.clear()
+      p.readJson(point)
+      points.add(point)
+    p.expectJson(jsonArrayEnd)
+    p.closeJsonParser()
+    check points == @[Point(x: 1), Point(y: 2)]
+
+suite "Binary to JSON transcoding":
+  test "writes the same text as toJsonString":
+    let layer = Layer(shape: sampleShape(), shapes: @[sampleShape(), Shape(),
+        Shape(fillKind: rkColor, color: "a\"b\n")])
+    check Layer.transcodeToJson(layer.toBinary()) == layer.toJsonString()
+    let e = Embedding(values: @[0.5'f32, 2], id: high(uint64), offset: -4,
+        stamps: @[-1'i64], scaleKind: rkBucket, bucket: 0)
+    check Embedding.transcodeToJson(e.toBinary()) == e.toJsonString()
+    check Point.transcodeToJson(@[]) == "{}"
+
+  test "unpacked runs, split fields and repeated singular fields":
+    var data: seq[byte]
+    data.writeTag(4, wtVarint)
+    data.writeInt32(5)
+    data.writeTag(1, wtLengthDelimited)
+    data.writeString("first")
+    data.writeTag(4, wtLengthDelimited)
+    data.writeVarint(2)
+    data.writeInt32(6)
+    data.writeInt32(7)
+    data.writeTag(1, wtLengthDelimited)
+    data.writeString("second")
+    data.writeTag(9, wtLengthDelimited)
+    data.writeString("red")
+    check Shape.transcodeToJson(data) == Shape.fromBinary(data).toJsonString()
+    check parseJson(Shape.transcodeToJson(data)) ==
+        %*{"color": "red", "name": "second", "tags": [5, 6, 7]}
+
+  test "last oneof member on the wire wins, unknown fields are skipped":
+    var data: seq[byte]
+    data.writeTag(9, wtLengthDelimited)
+    data.writeString("red")
+    data.writeTag(30, wtVarint)
+    data.writeInt32(1)
+    data.writeTag(10, wtLengthDelimited)
+    data.writeVarint(2)
+    data.writeTag(1, wtVarint)
+    data.writeSInt32(4)
+    data.writeTag(8, wtLengthDelimited)
+    data.writeString("n")
+    check Shape.transcodeToJson(data) == Shape.fromBinary(data).toJsonString()
+    check parseJson(Shape.transcodeToJson(data)) ==
+        %*{"pattern": {"x": 4}, "notes": ["n"]}
+    data.writeTag(9, wtLengthDelimited)
+    data.writeString("blue")
+    check parseJson(Shape.transcodeToJson(data)) ==
+        %*{"color": "blue", "notes": ["n"]}
+
+  test "buffer overload appends":
+    var buf = "log: "
+    Point.transcodeToJson(Point(x: 3).toBinary(), buf)
+    check buf == """log: {"x":3}"""
+
+suite "Map representations":
+  test "field options select the map type":
+    check Inventory().counts is SortedMap[string, int32]
+    check Inventory().spots is SortedMap[int32, Point]
+    check Inventory().seen is OrderedTable[string, int32]
+    check Shape().anchors is Table[string, Point]
+
+  test "decoded sorted maps are in key order and the last duplicate wins":
+    var unsorted = Inventory()
+    unsorted.counts = @[("pear", 1'i32), ("apple", 2'i32), ("pear", 3'i32)]
+    unsorted.spots = @[(7'i32, Point(x: 7)), (-1'i32, Point(y: 1))]
+    let decoded = Inventory.fromBinary(unsorted.toBinary())
+    check decoded.counts == @[("apple", 2'i32), ("pear", 3'i32)]
+    check decoded.spots == @[(-1'i32, Point(y: 1)), (7'i32, Point(x: 7))]
+
+  test "encoding is independent of insertion order":
+    var a, b: Inventory
+    a.counts.put("x", 1)
+    a.counts.put("y", 2)
+    b.counts.put("y", 2)
+    b.counts.put("x", 1)
+    check a.counts == b.counts
+    check a.toBinary() == b.toBinary()
+
+  test "lookups and JSON round trips":
+    var inv = Inventory()
+    inv.counts.put("b", 2)
+    inv.counts.put("a", 1)
+    inv.counts.put("b", 5)
+    check inv.counts == @[("a", 1'i32), ("b", 5'i32)]
+    check inv.counts.hasKey("a") and not inv.counts.hasKey("c")
+    check inv.counts.getOrDefault("b") == 5
+    check inv.counts.getOrDefault("c", -1) == -1
+    inv.spots.put(3, Point(x: 3))
+    check Inventory.fromJson(inv.toJson()) == inv
+    check Inventory.fromJsonString(inv.toJsonString()) == inv
+    check Inventory.transcodeToJson(inv.toBinary()) == inv.toJsonString()
+
+  test "ordered maps keep insertion order":
+    var inv = Inventory()
+    inv.seen["z"] = 1
+    inv.seen["a"] = 2
+    let decoded = Inventory.fromBinary(inv.toBinary())
+    var keys: seq[string]
+    for key in decoded.seen.keys:
+      keys.add(key)
+    check keys == @["z", "a"]
+    check Inventory.fromJsonString(inv.toJsonString()).seen == inv.seen
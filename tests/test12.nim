@@ -0,0 +1,90 @@
+## Test unknown field preservation (-d:protoPreserveUnknownFields)
+import unittest
+import nimproto3
+
+proto3 """
+syntax = "proto3";
+package skew;
+
+message Item {
+  string id = 1;
+  int32 count = 2;
+}
+
+message Meta {
+  string source = 1;
+}
+
+message ItemV2 {
+  string id = 1;
+  int32 count = 2;
+  repeated string labels = 3;
+  double price = 4;
+  Meta meta = 5;
+}
+
+message Envelope {
+  Item item = 1;
+  repeated Item items = 2;
+}
+
+message Catalog {
+  map<string, Item> items = 1;
+  map<string, int32> counts = 2;
+}
+"""
+
+suite "Unknown field preservation":
+  test "unrecognized fields are kept and written back verbatim":
+    let newer = ItemV2(id: "a1", count: 3, labels: @["x", "y"], price: 9.5,
+        meta: Meta(source: "v2"))
+    let data = newer.toBinary()
+    let older = Item.fromBinary(data)
+    check older.id == "a1"
+    check older.count == 3
+    check older.unknownFields.len > 0
+    check older.byteSize == data.len
+    check older.toBinary() == data
+    let back = ItemV2.fromBinary(older.toBinary())
+    check back.labels == @["x", "y"]
+    check back.price == 9.5
+    check back.meta.source == "v2"
+
+  test "nested messages keep their own unknown fields":
+    let newer = ItemV2(id: "inner", labels: @["keep"])
+    var env = Envelope(item: Item.fromBinary(newer.toBinary()))
+    env.items.add(Item.fromBinary(newer.toBinary()))
+    let forwarded = Envelope.fromBinary(env.toBinary())
+    check ItemV2.fromBinary(forwarded.item.toBinary()).labels == @["keep"]
+    check ItemV2.fromBinary(forwarded.items[0].toBinary()).labels == @["keep"]
+
+  test "known messages have no unknown fields":
+    let item = Item(id: "b", count: 1)
+    check Item.fromBinary(item.toBinary()).unknownFields.len == 0
+
+  test "map entries with fields from a newer schema":
+    # Entries written by a version of the map entry with fields 3 and 4
+    var data: seq[byte]
+    for number in [1, 2]:
+      var entry: seq[byte]
+      entry.writeTag(1, wtLengthDelimited)
+      entry.writeString("k")
+      entry.writeTag(3, wtVarint)
+      entry.writeVarint(300)
+      if number == 1:
+        entry.writeTag(2, wtLengthDelimited)
+        entry.writeString(Item(id: "a", count: 2).toBinary())
+      else:
+        entry.writeTag(2, wtVarint)
+        entry.writeVarint(7)
+      # The payload reads as a key and a value if it is not skipped whole
+      entry.writeTag(4, wtLengthDelimited)
+      entry.writeString(@[0x0a'u8, 0x01, byte('z'), 0x10, 0x63])
+      data.writeTag(number, wtLengthDelimited)
+      data.writeString(entry)
+    let json = Catalog.toJson(data)
+    check json["items"]["k"]["id"].getStr() == "a"
+    check json["counts"]["k"].getInt() == 7
+    let catalog = Catalog.fromBinary(data)
+    check catalog.items["k"] == Item(id: "a", count: 2)
+    check catalog.counts["k"] == 7
@@ -0,0 +1,89 @@
+## Test deterministic serialization (-d:protoDeterministic) and generated ==/hash
+import unittest
+import std/sets
+import nimproto3
+
+proto3 """
+syntax = "proto3";
+package memo;
+
+message Item {
+  string name = 1;
+  double price = 2;
+}
+
+message Query {
+  string user = 1;
+  repeated int32 ids = 2;
+  map<string, int32> weights = 3;
+  map<int32, Item> items = 4 [(nimproto3.map_type) = "ordered"];
+  oneof scope {
+    string region = 5;
+    Item pinned = 6;
+  }
+}
+"""
+
+proc sampleQuery(reverse: bool): Query =
+  result = Query(user: "u1", ids: @[3'i32, 1, 2], scopeKind: rkPinned,
+      pinned: Item(name: "p", price: 1.5))
+  var keys = @[1'i32, 2, 3, 4, 5]
+  if reverse:
+    keys = @[5'i32, 4, 3, 2, 1]
+  for k in keys:
+    result.weights[$k] = k * 10
+    result.items[k] = Item(name: "i" & $k, price: float(k))
+
+suite "Deterministic serialization":
+  test "map entries are written in key order":
+    var q = Query()
+    q.items[2] = Item(name: "b")
+    q.items[1] = Item(name: "a")
+    let data = q.toBinary()
+    let decoded = Query.fromBinary(data)
+    var keys: seq[int32]
+    for k in decoded.items.keys:
+      keys.add(k)
+    check keys == @[1'i32, 2]
+
+  test "insertion order does not change the encoding":
+    let a = sampleQuery(false)
+    let b = sampleQuery(true)
+    check a.toBinary() == b.toBinary()
+    check a.byteSize == b.byteSize
+
+suite "Generated == and hash":
+  test "equal messages compare and hash equal":
+    let a = sampleQuery(false)
+    let b = Query.fromBinary(a.toBinary())
+    check a == b
+    check hash(a) == hash(b)
+    check Item(name: "x") == Item(name: "x")
+    check hash(Item()) == hash(Item())
+
+  test "any field difference makes messages unequal":
+    let a = sampleQuery(false)
+    var b = a
+    b.ids.add(4)
+    check a != b
+    b = a
+    b.weights["1"] = 11
+    check a != b
+    b = a
+    b.pinned.price = 2.5
+    check a != b
+    b = a
+    b.setScopeKind(rkRegion)
+    check a != b
+    check Query(scopeKind: rkRegion, region: "") != Query()
+
+  test "messages work as Table and HashSet keys":
+    var cache = initTable[Query, string]()
+    cache[sampleQuery(false)] = "cached"
+    check cache.getOrDefault(sampleQuery(true)) == "cached"
+    check not cache.hasKey(Query(user: "u2"))
+    var seen = initHashSet[Item]()
+    seen.incl(Item(name: "a", price: 1))
+    seen.incl(Item(name: "a", price: 1))
+    seen.incl(Item(name: "b"))
+    check seen.len == 2
@@ -0,0 +1,98 @@
+## Test the generated code cache of importProto3 (-d:protoCacheDir)
+import unittest
+import std/[os, osproc, strutils]
+
+const workDir = "tests/temp_cache_test"
+let cacheDir = getCurrentDir() / workDir / "cache"
+const mainFile = "tests/temp_cache_test_main.nim"
+
+proc writeProtos(extraField: bool) =
+  writeFile(workDir & "/dep.proto", """
+syntax = "proto3";
+package dep;
+message Dep {
+  int32 id = 1;
+""" & (if extraField: "  string extra = 2;\n" else: "") & "}\n")
+  # The import shares its line with the package statement, and a
+  # commented-out import must not count
+  writeFile(workDir & "/root.proto", """
+syntax = "proto3";
+package root; import "dep.proto";
+// import "missing.proto";
+message Root {
+  Dep dep = 1;
+}
+""")
+
+var builds = 0
+
+proc build(flags = ""): string =
+  # A fresh main module each time, otherwise nim skips the up-to-date build
+  inc builds
+  writeFile(mainFile, """
+import ../src/nimproto3
+importProto3 currentSourcePath().parentDir() & "/temp_cache_test/root.proto"
+echo "has extra: ", compiles(Dep_Dep().extra)
+""" & "# build " & $builds & "\n")
+  let (output, exitCode) = execCmdEx("nim c -r --hints:off --warnings:off " &
+      "-d:protoCacheDir=" & cacheDir & " " & flags & " " & mainFile)
+  checkpoint(output)
+  check exitCode == 0
+  output
+
+proc cacheEntries(): int =
+  for file in walkFiles(cacheDir & "/*.nim"):
+    inc result
+
+suite "Generated code cache":
+  setup:
+    removeDir(workDir)
+    createDir(workDir)
+    writeProtos(extraField = false)
+
+  teardown:
+    removeDir(workDir)
+    removeFile(mainFile)
+    removeFile(mainFile.changeFileExt(ExeExt))
+
+  test "a second build reuses the generated code":
+    let first = build()
+    check "Running command to generate nim code" in first
+    check cacheEntries() == 1
+    let second = build()
+    check "Using cached nim code" in second
+    check "Running command to generate nim code" notin second
+    check "has extra: false" in second
+
+  test "changing an imported proto regenerates the code":
+    discard build()
+    writeProtos(extraField = true)
+    let output = build()
+    check "Running command to generate nim code" in output
+    check "has extra: true" in output
+    # The entry is replaced, and the next build uses it
+    check cacheEntries() == 1
+    check "Using cached nim code" in build()
+
+  test "changed options get their own entry":
+    discard build()
+    check "Running command to generate nim code" in
+        build("-d:protoPreserveUnknownFields")
+    check cacheEntries() == 2
+
+  test "-d:protoNoCache skips the cache":
+    discard build()
+    let output = build("-d:protoNoCache")
+    check "Running command to generate nim code" in output
+    check cacheEntries() == 1
+
+  test "protonim is built once and reused":
+    check "Building protonim" in build()
+    var binaries = 0
+    for file in walkFiles(cacheDir & "/protonim_*"):
+      inc binaries
+    check binaries == 1
+    writeProtos(extraField = true)
+    let output = build()
+    check "Running command to generate nim code" in output
+    check "Building protonim" notin output
@@ -0,0 +1,131 @@
+## Test multi-file generation: one module per proto file (genModulesFromProtoFiles)
+import unittest
+import std/[os, osproc, strutils, algorithm]
+import nimproto3
+
+const workDir = "tests/temp_modules_test"
+const protoDir = workDir & "/protos"
+const outDir = workDir & "/out"
+
+proc writeProtos() =
+  createDir(protoDir & "/common")
+  writeFile(protoDir & "/common/types.proto", """
+syntax = "proto3";
+package acme.common;
+message Money {
+  string currency = 1;
+  int64 units = 2;
+}
+enum Status {
+  UNKNOWN = 0;
+  ACTIVE = 1;
+}
+""")
+  writeFile(protoDir & "/account.proto", """
+syntax = "proto3";
+package acme.account;
+import "common/types.proto";
+message Account {
+  message Limit {
+    acme.common.Money amount = 1;
+  }
+  string id = 1;
+  acme.common.Money balance = 2;
+  acme.common.Status status = 3;
+  repeated Limit limits = 4;
+}
+""")
+  writeFile(protoDir & "/ledger.proto", """
+syntax = "proto3";
+package acme.ledger;
+import "account.proto";
+import "common/types.proto";
+message Entry {
+  acme.account.Account account = 1;
+  acme.common.Money amount = 2;
+  map<string, acme.common.Money> totals = 3;
+}
+""")
+
+proc protoFiles(): seq[string] =
+  for path in walkDirRec(protoDir):
+    if path.endsWith(".proto"):
+      result.add(path)
+  result.sort()
+
+proc relativeModules(paths: seq[string]): seq[string] =
+  for path in paths:
+    result.add(relativePath(path, outDir, '/'))
+  result.sort()
+
+suite "Multi-file generation":
+  setup:
+    removeDir(workDir)
+    writeProtos()
+
+  teardown:
+    removeDir(workDir)
+
+  test "one module per proto file":
+    let written = genModulesFromProtoFiles(protoFiles(), outDir, @[protoDir])
+    check relativeModules(written) ==
+        @["account_pb.nim", "common/types_pb.nim", "ledger_pb.nim"]
+    let ledger = readFile(outDir & "/ledger_pb.nim")
+    check "import \"account_pb\" as account_pb" in ledger
+    check "import \"common/types_pb\" as common_types_pb" in ledger
+    # Imported types are not inlined
+    check "Money* = object" notin ledger
+    check "Money* = object" in readFile(outDir & "/common/types_pb.nim")
+    check "Acme_common_Money* = Money" in
+        readFile(outDir & "/common/types_pb.nim")
+    check "import \"../account_pb\"" notin
+        readFile(outDir & "/common/types_pb.nim")
+
+  test "shards write the same modules as a single run":
+    let single = genModulesFromProtoFiles(protoFiles(), outDir, @[protoDir])
+    var contents: seq[string]
+    for path in single:
+      contents.add(readFile(path))
+    removeDir(outDir)
+    var sharded: seq[string]
+    for shard in 0 ..< 2:
+      sharded.add(genModulesFromProtoFiles(protoFiles(), outDir, @[protoDir],
+          shard = shard, shardCount = 2))
+    check relativeModules(sharded) == relativeModules(single)
+    for i, path in single:
+      check readFile(path) == contents[i]
+
+  test "an import shared by shards is written by one of them":
+    # Both files import common/types.proto, which is not an input
+    let files = @[protoDir & "/account.proto", protoDir & "/ledger.proto"]
+    let claimDir = workDir & "/claims"
+    createDir(claimDir)
+    var sharded: seq[string]
+    for shard in 0 ..< 2:
+      sharded.add(genModulesFromProtoFiles(files, outDir, @[protoDir],
+          shard = shard, shardCount = 2, claimDir = claimDir))
+    check relativeModules(sharded) ==
+        @["account_pb.nim", "common/types_pb.nim", "ledger_pb.nim"]
+
+  test "generated modules compile and round trip":
+    discard genModulesFromProtoFiles(protoFiles(), outDir, @[protoDir])
+    writeFile(outDir & "/main.nim", """
+import nimproto3
+import ledger_pb
+
+var entry = Entry(account: Account(id: "a-1",
+    balance: Money(currency: "EUR", units: 10), status: ACTIVE),
+    amount: Money(currency: "EUR", units: 3))
+entry.account.limits.add(Account_Limit(amount: Money(units: 100)))
+entry.totals["EUR"] = Money(currency: "EUR", units: 13)
+let data = entry.toBinary()
+doAssert Entry.fromBinary(data) == entry
+doAssert Entry.fromJsonString(entry.toJsonString()) == entry
+doAssert Entry.transcodeToJson(data) == entry.toJsonString()
+echo "round trip ok"
+""")
+    let (output, exitCode) = execCmdEx("nim c -r --hints:off --warnings:off " &
+        outDir & "/main.nim")
+    checkpoint(output)
+    check exitCode == 0
+    check "round trip ok" in output
@@ -0,0 +1,166 @@
+## Test the table-driven codec (-d:protoTableDriven)
+import unittest
+import std/[json, tables]
+import nimproto3
+
+const schemaFile = currentSourcePath().parentDir() & "/protos/dynamic.proto"
+
+importProto3 schemaFile
+
+proto3 """
+syntax = "proto3";
+package shop;
+
+message Receipt {
+  option (nimproto3.unrolled) = true;
+  string id = 1;
+  int64 total = 2;
+  repeated int32 counts = 7;
+  map<int32, string> labels = 11;
+  oneof target {
+    string email = 14;
+    Item gift = 15;
+  }
+}
+"""
+
+const schema = staticRead(schemaFile)
+let pool = newDescriptorPool(parseProto(schema))
+
+proc sampleOrder(): Order =
+  result = Order(id: "o-1", total: -42, delta: -7, stamp: 1234567890123'u64,
+      paid: true, blob: @[0'u8, 1, 255], counts: @[1'i32, -2, 300],
+      sizes: @[4'u32, 5], note: Order_Note(text: "fragile"), limit: 9,
+      targetKind: rkGift, gift: Item(name: "card", color: GREEN))
+  result.items.add(Item(name: "pen", price: 1.5, color: GREEN))
+  result.items.add(Item(name: "ink"))
+  result.byName["pen"] = Item(name: "pen", price: 1.5)
+  result.labels[3] = "three"
+
+suite "Table-driven codec":
+  test "round trips through binary":
+    let order = sampleOrder()
+    let data = order.toBinary()
+    check data.len == order.byteSize
+    check Order.fromBinary(data) == order
+    check Order.fromBinary(Order().toBinary()) == Order()
+
+  test "writes the same bytes as the descriptor-driven codec":
+    var order = sampleOrder()
+    let msg = pool.fromBinary("shop.Order", order.toBinary())
+    check msg["gift"].msgVal["name"].getStr() == "card"
+    check Order.fromBinary(msg.toBinary()) == order
+    # Without a oneof member both write the fields in declaration order
+    order.setTargetKind(rkNone)
+    let data = order.toBinary()
+    check pool.fromBinary("shop.Order", data).toBinary() == data
+
+  test "JSON matches the descriptor-driven codec":
+    let order = sampleOrder()
+    let msg = pool.fromBinary("shop.Order", order.toBinary())
+    check order.toJson() == msg.toJson()
+    check Order.fromJson(order.toJson()) == order
+    check Order.toJson(order.toBinary()) == order.toJson()
+
+  test "oneof setters and clear":
+    var order = sampleOrder()
+    order.setTargetKind(rkEmail)
+    order.email = "a@b.c"
+    check order.targetKind == rkEmail
+    let decoded = Order.fromBinary(order.toBinary())
+    check decoded.targetKind == rkEmail
+    check decoded.email == "a@b.c"
+    order.clear()
+    check order == Order()
+
+  test "unknown fields are kept":
+    var data = Item(name: "pen").toBinary()
+    data.writeTag(99, wtVarint)
+    data.writeVarint(5)
+    let item = Item.fromBinary(data)
+    check item.unknownFields.len > 0
+    check item.toBinary() == data
+
+  test "unrolled messages share the encoding":
+    var order = Order(id: "r", total: 3, counts: @[5'i32, 6],
+        targetKind: rkEmail, email: "x@y.z")
+    order.labels[1] = "one"
+    var receipt = Receipt(id: "r", total: 3, counts: @[5'i32, 6],
+        targetKind: rkEmail, email: "x@y.z")
+    receipt.labels[1] = "one"
+    check receipt.toBinary() == order.toBinary()
+    check Receipt.fromBinary(order.toBinary()) == receipt
+    check receipt.toJson() == order.toJson()
+
+suite "Table-driven JSON, equality and views":
+  test "streaming JSON matches toJson and the unrolled procs":
+    let order = sampleOrder()
+    check parseJson(order.toJsonString()) == order.toJson()
+    check Order.fromJsonString(order.toJsonString()) == order
+    check parseJson(Order.transcodeToJson(order.toBinary())) == order.toJson()
+    var shared = Order(id: "r", total: 3, counts: @[5'i32, 6],
+        targetKind: rkGift, gift: Item(name: "card", color: GREEN))
+    shared.labels[1] = "one"
+    let receipt = Receipt.fromBinary(shared.toBinary())
+    check shared.toJsonString() == receipt.toJsonString()
+    check Order.transcodeToJson(shared.toBinary()) ==
+        Receipt.transcodeToJson(shared.toBinary())
+    check Order.fromJsonString(receipt.toJsonString()) == shared
+
+  test "transcoding follows the wire: split runs, last oneof member, map defaults":
+    var data: seq[byte]
+    data.writeTag(7, wtVarint)
+    data.writeInt32(1)
+    data.writeTag(7, wtLengthDelimited)
+    data.writeString(@[2'u8, 3])
+    data.writeTag(14, wtLengthDelimited)
+    data.writeString("a@b.c")
+    data.writeTag(15, wtLengthDelimited)
+    data.writeString(Item(name: "card").toBinary())
+    data.writeTag(99, wtVarint)
+    data.writeVarint(7)
+    # A map entry without a value, and one without a key
+    data.writeTag(10, wtLengthDelimited)
+    data.writeString(@[0x0A'u8, 1, ord('k').byte])
+    data.writeTag(11, wtLengthDelimited)
+    data.writeString(@[0x12'u8, 1, ord('v').byte])
+    let expected = Order.fromBinary(data).toJsonString()
+    check Order.transcodeToJson(data) == expected
+    check parseJson(expected)["gift"]["name"].getStr() == "card"
+    check parseJson(expected)["counts"] == %[1, 2, 3]
+
+  test "== and hash compare field by field":
+    let a = sampleOrder()
+    var b = sampleOrder()
+    check a == b
+    check hash(a) == hash(b)
+    b.setTargetKind(rkEmail)
+    check a != b
+    b = sampleOrder()
+    b.items[1].price = 2.0
+    check a != b
+    b = sampleOrder()
+    b.unknownFields = @[0x08'u8, 1]
+    check a != b
+    var seen: Table[Order, int]
+    seen[a] = 1
+    check seen.getOrDefault(sampleOrder()) == 1
+
+  test "views read through the table":
+    let order = sampleOrder()
+    let v = OrderView.newProtoView(order.toBinary())
+    check v.id == "o-1"
+    check v.total == -42
+    check v.delta == -7
+    check v.stamp == 1234567890123'u64
+    check v.paid
+    check v.blob == @[0'u8, 1, 255]
+    check v.counts == @[1'i32, -2, 300]
+    check v.sizes == @[4'u32, 5]
+    check v.itemsLen == 2
+    check v.items(0).color == GREEN
+    check v.note.text == "fragile"
+    check v.limit == 9
+    check v.targetKind == rkGift
+    check v.gift.name == "card"
+    check OrderView.newProtoView(Order().toBinary()).targetKind == rkNone
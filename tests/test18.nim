@@ -0,0 +1,148 @@
+## Test gRPC message reassembly: recvMsg over DATA chunks split at any byte
+import unittest
+import nimproto3
+
+proc grpcFrame(msg: seq[byte]): seq[byte] =
+  ## `msg` with its 5-byte length prefix
+  let l = msg.len.uint32
+  result = @[0'u8, byte(l shr 24), byte(l shr 16), byte(l shr 8), byte(l)]
+  result.add(msg)
+
+proc newTestStream(): GrpcStream =
+  # The channel is never connected, so nothing is written; the stream reads
+  # only the events the test queues
+  let chan = newGrpcChannel("localhost", 0)
+  waitFor chan.startRpc("/test.Service/Method")
+
+proc feed(stream: GrpcStream, chunks: varargs[seq[byte]]) =
+  for chunk in chunks:
+    stream.httpStream.eventQueue.put(StreamEvent(kind: SE_DATA, data: chunk))
+
+proc finish(stream: GrpcStream) =
+  stream.httpStream.eventQueue.put(StreamEvent(kind: SE_DATA,
+      endStream: true))
+  stream.httpStream.closed = true
+
+proc recv(stream: GrpcStream): Option[seq[byte]] =
+  waitFor stream.recvMsg()
+
+proc recvAll(stream: GrpcStream): seq[seq[byte]] =
+  ## Every message, read through the borrowing recvMsg
+  var messages: seq[seq[byte]]
+  proc keep(data: openArray[byte]) = messages.add(@data)
+  while waitFor stream.recvMsg(keep):
+    discard
+  messages
+
+suite "Message reassembly":
+  test "a length prefix split across chunks":
+    let stream = newTestStream()
+    let data = grpcFrame(@[1'u8, 2, 3])
+    stream.feed(data[0 .. 1], data[2 .. 3], data[4 .. ^1])
+    stream.finish()
+    check stream.recv() == some(@[1'u8, 2, 3])
+    check stream.recv().isNone
+
+  test "a message spanning several chunks":
+    let stream = newTestStream()
+    var msg = newSeq[byte](1000)
+    for i in 0 ..< msg.len:
+      msg[i] = byte(i mod 251)
+    let data = grpcFrame(msg)
+    stream.feed(data[0 ..< 300], data[300 ..< 301], data[301 ..< 700],
+        data[700 .. ^1])
+    stream.finish()
+    check stream.recv() == some(msg)
+    check stream.recv().isNone
+
+  test "zero-length messages":
+    let stream = newTestStream()
+    stream.feed(grpcFrame(@[]) & grpcFrame(@[7'u8]) & grpcFrame(@[]))
+    stream.finish()
+    check stream.recv() == some(newSeq[byte]())
+    check stream.recv() == some(@[7'u8])
+    check stream.recv() == some(newSeq[byte]())
+    check stream.recv().isNone
+
+  test "a message ending at a chunk boundary after a partial read":
+    # The first message leaves the read cursor inside the chunk; the second
+    # takes the rest of it exactly
+    let stream = newTestStream()
+    let second = @[4'u8, 5, 6, 7]
+    stream.feed(grpcFrame(@[1'u8, 2]) & grpcFrame(second),
+        grpcFrame(@[8'u8]))
+    stream.finish()
+    check stream.recv() == some(@[1'u8, 2])
+    check stream.recv() == some(second)
+    check stream.recv() == some(@[8'u8])
+    check stream.recv().isNone
+
+  test "many messages in one chunk":
+    let stream = newTestStream()
+    var data: seq[byte]
+    for i in 0 ..< 1000:
+      data.add(grpcFrame(@[byte(i mod 256)]))
+    stream.feed(data)
+    stream.finish()
+    for i in 0 ..< 1000:
+      check stream.recv() == some(@[byte(i mod 256)])
+    check stream.recv().isNone
+
+  test "end of stream inside a length prefix":
+    let stream = newTestStream()
+    stream.feed(grpcFrame(@[9'u8]) & @[0'u8, 0, 0])
+    stream.finish()
+    check stream.recv() == some(@[9'u8])
+    expect GrpcError:
+      discard stream.recv()
+
+  test "end of stream inside a message body":
+    let stream = newTestStream()
+    stream.feed(grpcFrame(@[1'u8, 2, 3, 4])[0 .. 6])
+    stream.finish()
+    expect GrpcError:
+      discard stream.recv()
+
+  test "an error status in the trailers":
+    let stream = newTestStream()
+    stream.feed(grpcFrame(@[1'u8]))
+    # As processFrame does on the HEADERS frame ending the stream
+    let trailers = @[("grpc-status", "5"), ("grpc-message", "not found")]
+    for (name, value) in trailers:
+      stream.httpStream.trailers[name] = value
+    stream.httpStream.eventQueue.put(StreamEvent(kind: SE_TRAILERS,
+        headers: trailers, endStream: true))
+    stream.httpStream.closed = true
+    check stream.recv() == some(@[1'u8])
+    expect GrpcError:
+      discard stream.recv()
+
+  test "borrowed messages in and across chunks":
+    let stream = newTestStream()
+    var msg = newSeq[byte](1000)
+    for i in 0 ..< msg.len:
+      msg[i] = byte(i mod 251)
+    let data = grpcFrame(@[1'u8, 2]) & grpcFrame(@[]) & grpcFrame(msg)
+    stream.feed(data[0 ..< 500], data[500 .. ^1])
+    stream.finish()
+    check stream.recvAll() == @[@[1'u8, 2], newSeq[byte](), msg]
+
+  test "borrowed messages in one chunk are not copied":
+    let stream = newTestStream()
+    var data: seq[byte]
+    for i in 0 ..< 10:
+      data.add(grpcFrame(@[byte(i), byte(i)]))
+    stream.feed(data)
+    stream.finish()
+    proc messageStarts(stream: GrpcStream): seq[int] =
+      var starts: seq[int]
+      proc mark(data: openArray[byte]) =
+        starts.add(cast[int](unsafeAddr data[0]))
+      while waitFor stream.recvMsg(mark):
+        discard
+      starts
+    let starts = stream.messageStarts()
+    check starts.len == 10
+    for i in 1 ..< starts.len:
+      # One frame further along the same buffer
+      check starts[i] - starts[i - 1] == 7
@@ -0,0 +1,223 @@
+## Test HTTP/2 flow control and frame splitting over loopback: a server in
+## this process, and a raw socket standing in for a peer that withholds its
+## window or limits its frame size
+import unittest
+import std/[net, asyncnet]
+import nimproto3
+
+proto3 """
+syntax = "proto3";
+package test;
+
+message Chunk {
+  bytes data = 1;
+}
+
+service Echo {
+  rpc Relay(stream Chunk) returns (stream Chunk);
+}
+"""
+
+const
+  echoPath = "/test.Echo/Echo"
+  relayPath = "/test.Echo/Relay"
+  prefaceLen = 24 # "PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+proc handleEcho(stream: GrpcStream) {.async.} =
+  while true:
+    let msg = await stream.recvMsg()
+    if msg.isNone: break
+    await stream.sendMsg(msg.get())
+
+proc startServer(port: int, windowSize = DEFAULT_WINDOW_SIZE) =
+  let server = newGrpcServer(port, windowSize = windowSize)
+  server.registerHandler(echoPath, handleEcho)
+  server.registerHandler(relayPath, handleEcho)
+  asyncCheck server.serve("127.0.0.1")
+
+proc pattern(len: int): seq[byte] =
+  result = newSeq[byte](len)
+  for i in 0 ..< len:
+    result[i] = byte((i * 7) mod 256)
+
+proc echoRoundTrip(port: int, windowSize: int,
+    msg: seq[byte]): Future[seq[seq[byte]]] {.async.} =
+  let client = newGrpcClient("127.0.0.1", port, windowSize = windowSize)
+  await client.connect()
+  defer: client.close()
+  result = await client.grpcInvoke(echoPath, @[msg])
+
+proc relayRoundTrip(port: int, count, size: int): Future[bool] {.async.} =
+  ## Whether a bidi stream of `count` requests of about `size` bytes comes
+  ## back in order through the generated `relayStream`
+  let client = newGrpcClient("127.0.0.1", port)
+  await client.connect()
+  defer: client.close()
+  var reqs: seq[Chunk]
+  for i in 0 ..< count:
+    reqs.add(Chunk(data: pattern(size + i)))
+  let call = await client.relayStream(reqs)
+  var received = 0
+  result = true
+  while true:
+    let reply = await call.recv()
+    if reply.isNone: break
+    result = result and received < count and
+        reply.get().data == reqs[received].data
+    inc received
+  result = result and received == count
+
+# --- A peer speaking raw HTTP/2 frames ---
+
+type Peer = object
+  client: GrpcChannel
+  socket: AsyncSocket
+
+proc sendFrame(peer: Peer, frame: seq[byte]) {.async.} =
+  var data = newString(frame.len)
+  for i, b in frame:
+    data[i] = char(b)
+  await peer.socket.send(data)
+
+proc readFrame(peer: Peer): Future[(Http2Frame, string)] {.async.} =
+  let head = await peer.socket.recv(9)
+  doAssert head.len == 9, "Connection closed"
+  let frame = parseFrameHeader(head.toOpenArrayByte(0, 8))
+  var payload = ""
+  if frame.length > 0:
+    payload = await peer.socket.recv(frame.length.int)
+  result = (frame, payload)
+
+proc windowUpdate(streamId: uint32, increment: int): seq[byte] =
+  packFrame(WINDOW_UPDATE, 0, streamId, [byte(increment shr 24),
+      byte(increment shr 16), byte(increment shr 8), byte(increment)])
+
+proc openPeer(port: int, settings: seq[byte] = @[]): Future[Peer] {.async.} =
+  ## Connect a client to a raw peer, which sends SETTINGS with `settings`
+  ## as payload and returns once the client has acknowledged them
+  let listener = newAsyncSocket()
+  listener.setSockOpt(OptReuseAddr, true)
+  listener.bindAddr(Port(port), "127.0.0.1")
+  listener.listen()
+  let accepting = listener.accept()
+  result.client = newGrpcClient("127.0.0.1", port)
+  await result.client.connect()
+  result.socket = await accepting
+  listener.close()
+  doAssert (await result.socket.recv(prefaceLen)).len == prefaceLen
+  await result.sendFrame(packFrame(SETTINGS, 0, 0, settings))
+  while true:
+    let (frame, _) = await result.readFrame()
+    if frame.frameType == SETTINGS and (frame.flags and 1) != 0:
+      break
+
+proc readData(peer: Peer, total: int): Future[seq[int]] {.async.} =
+  ## Read frames until `total` bytes of DATA arrived; the DATA frame sizes
+  var received = 0
+  while received < total:
+    let (frame, _) = await peer.readFrame()
+    if frame.frameType == DATA:
+      result.add(frame.length.int)
+      received += frame.length.int
+  doAssert received == total
+
+proc stalledSend(port: int): Future[bool] {.async.} =
+  ## Whether a 200 KB message stops at the 64 KiB window of a peer that
+  ## does not read, and completes after the peer's WINDOW_UPDATE
+  let peer = await openPeer(port)
+  defer: peer.client.close()
+  let stream = await peer.client.startRpc(echoPath)
+  let msgLen = 5 + 200_000
+  let sending = stream.sendMsg(pattern(200_000))
+  discard await peer.readData(DEFAULT_WINDOW_SIZE)
+  await sleepAsync(200)
+  let stalled = not sending.finished and stream.httpStream.sendWindow == 0 and
+      peer.client.conn.windowSize == 0
+  let increment = msgLen - DEFAULT_WINDOW_SIZE
+  await peer.sendFrame(windowUpdate(0, increment))
+  await peer.sendFrame(windowUpdate(stream.httpStream.id, increment))
+  discard await peer.readData(increment)
+  await sending
+  result = stalled and stream.httpStream.sendWindow == 0
+
+proc dataFrameSizes(port: int, maxFrameSize: int): Future[seq[int]] {.async.} =
+  ## Sizes of the DATA frames carrying a 300 KB message to a peer that
+  ## sets SETTINGS_MAX_FRAME_SIZE to `maxFrameSize` (0: leaves the default)
+  var settings: seq[byte]
+  if maxFrameSize > 0:
+    settings = @[0'u8, 0x5, byte(maxFrameSize shr 24),
+        byte(maxFrameSize shr 16), byte(maxFrameSize shr 8), byte(maxFrameSize)]
+  let peer = await openPeer(port, settings)
+  defer: peer.client.close()
+  # Windows large enough that only the frame size limits the frames, in
+  # effect once the client acknowledges the SETTINGS after the update
+  await peer.sendFrame(windowUpdate(0, 1024 * 1024))
+  await peer.sendFrame(packFrame(SETTINGS, 0, 0,
+      [0'u8, 0x4, 0, 0x10, 0, 0]))
+  while true:
+    let (frame, _) = await peer.readFrame()
+    if frame.frameType == SETTINGS and (frame.flags and 1) != 0:
+      break
+  let stream = await peer.client.startRpc(echoPath)
+  await stream.sendMsg(pattern(300_000))
+  result = await peer.readData(5 + 300_000)
+
+suite "Flow control":
+  startServer(50171)
+  startServer(50172, windowSize = 4 * 1024 * 1024)
+
+  test "unary round trip larger than 1 MiB, default windows":
+    let msg = pattern(1536 * 1024)
+    check waitFor(echoRoundTrip(50171, DEFAULT_WINDOW_SIZE, msg)) == @[msg]
+
+  test "unary round trip larger than 1 MiB, 4 MiB windows":
+    let msg = pattern(1536 * 1024)
+    check waitFor(echoRoundTrip(50172, 4 * 1024 * 1024, msg)) == @[msg]
+
+  test "concurrent calls share the connection window":
+    proc run(): Future[bool] {.async.} =
+      let client = newGrpcClient("127.0.0.1", 50171)
+      await client.connect()
+      defer: client.close()
+      var calls: seq[Future[seq[seq[byte]]]]
+      for i in 0 ..< 4:
+        calls.add(client.grpcInvoke(echoPath, @[pattern(300_000 + i)]))
+      let replies = await all(calls)
+      result = true
+      for i, reply in replies:
+        result = result and reply == @[pattern(300_000 + i)]
+    check waitFor(run())
+
+  test "bidi stream with more than a window in each direction":
+    # 40 messages of 10 KB: the echoes fill the client's window long
+    # before the last request is sent
+    let relay = relayRoundTrip(50171, 40, 10_000)
+    check waitFor(relay.withTimeout(20_000))
+    check relay.finished and relay.read()
+
+  test "grpcInvoke with more than a window in each direction":
+    proc run(): Future[bool] {.async.} =
+      let client = newGrpcClient("127.0.0.1", 50171)
+      await client.connect()
+      defer: client.close()
+      var msgs: seq[seq[byte]]
+      for i in 0 ..< 40:
+        msgs.add(pattern(10_000 + i))
+      result = (await client.grpcInvoke(echoPath, msgs)) == msgs
+    let invoke = run()
+    check waitFor(invoke.withTimeout(20_000))
+    check invoke.finished and invoke.read()
+
+  test "a sender waits for the peer's WINDOW_UPDATE":
+    check waitFor(stalledSend(50173))
+
+suite "Frame splitting":
+  test "DATA frames stay within the default max frame size":
+    let sizes = waitFor dataFrameSizes(50174, 0)
+    check sizes.len > 1
+    check max(sizes) == DEFAULT_MAX_FRAME_SIZE
+
+  test "DATA frames follow the peer's SETTINGS_MAX_FRAME_SIZE":
+    let sizes = waitFor dataFrameSizes(50175, 40_000)
+    check max(sizes) == 40_000
+    check sizes.len == (5 + 300_000 + 39_999) div 40_000
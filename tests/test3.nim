@@ -35,4 +35,157 @@ when isMainModule:
   echo "Decoded: ", decodedStr
   assert decodedStr == "hello"
 
+  # Test append-into-buffer writers
+  echo "\nTesting buffer writers..."
+  var buf: seq[byte] = @[]
+  buf.writeTag(1, wtVarint)
+  buf.writeVarint(150)
+  buf.writeTag(2, wtLengthDelimited)
+  buf.writeString("hello")
+  buf.writeInt32(-1)
+  echo "Written: ", buf
+  assert buf[0 ..< 3] == encodeFieldKey(1, wtVarint) & encodeVarint(150)
+  assert buf[3 ..< 10] == encodeFieldKey(2, wtLengthDelimited) & encodeString("hello")
+  assert buf[10 .. ^1] == encodeInt32(-1)
+  assert buf[10 .. ^1].len == 10
+  pos = 3
+  discard decodeFieldKey(buf, pos)
+  assert decodeString(buf, pos) == "hello"
+  assert decodeInt32(buf, pos) == -1
+
+  # Writers append without disturbing existing content
+  buf.setLen(0)
+  buf.writeFloat64(1.5)
+  buf.writeSInt64(-2)
+  buf.writeLengthDelimited([1'u8, 2, 3])
+  assert buf == encodeFloat64(1.5) & encodeSInt64(-2) & encodeLengthDelimited([1'u8, 2, 3])
+
+  # Size helpers agree with the encoders
+  echo "\nTesting size helpers..."
+  for v in [0'u64, 1, 127, 128, 16383, 16384, 1'u64 shl 35, high(uint64)]:
+    assert varintSize(v) == encodeVarint(v).len
+  assert sizeInt32(-1) == 10
+  assert sizeSInt32(-1) == 1
+  assert tagSize(15) == 1 and tagSize(16) == 2
+  assert sizeString("hello") == encodeString("hello").len
+  assert sizeLengthDelimited(300) == 302
+
+  # Length-delimited spans point into the input instead of copying
+  echo "\nTesting length-delimited spans..."
+  let framed = encodeVarint(7) & encodeLengthDelimited(encodeString("nested"))
+  pos = 1
+  let span = decodeLengthDelimitedSpan(framed, pos)
+  assert pos == framed.len
+  assert span == 2 .. framed.len - 1
+  var innerPos = 0
+  assert decodeString(framed.toOpenArray(span.a, span.b), innerPos) == "nested"
+  pos = 0
+  try:
+    discard decodeLengthDelimitedSpan([5'u8, 1, 2], pos)
+    assert false, "truncated span must raise"
+  except ValueError:
+    discard
+
+  # Varints decode the same with and without 10 bytes of lookahead
+  echo "\nTesting varint fast path..."
+  for v in [0'u64, 1, 127, 128, 300, 16384, 1'u64 shl 49, 1'u64 shl 56,
+      (1'u64 shl 63) - 1, 1'u64 shl 63, high(uint64)]:
+    let exact = encodeVarint(v)
+    let padded = exact & newSeq[byte](10)
+    pos = 0
+    assert decodeVarint(exact, pos) == v and pos == exact.len
+    pos = 0
+    assert decodeVarint(padded, pos) == v and pos == exact.len
+  var tooLong = newSeq[byte](12)
+  for b in tooLong.mitems: b = 0xFF
+  pos = 0
+  try:
+    discard decodeVarint(tooLong, pos)
+    assert false, "11-byte varint must raise"
+  except ValueError:
+    discard
+
+  # Packed decoders append the whole run to the destination
+  echo "\nTesting packed decoders..."
+  var packed: seq[byte]
+  for v in [1'i64, -2, 300, high(int64), low(int64)]:
+    packed.writeInt64(v)
+  var i64s = @[42'i64]
+  decodePackedInt64s(packed, i64s)
+  assert i64s == @[42'i64, 1, -2, 300, high(int64), low(int64)]
+  assert countVarints(packed) == 5
+  packed.setLen(0)
+  for v in [-1'i32, 2, -300000]:
+    packed.writeSInt32(v)
+  var s32s: seq[int32]
+  decodePackedSInt32s(packed, s32s)
+  assert s32s == @[-1'i32, 2, -300000]
+  packed.setLen(0)
+  packed.writeFloat64(0.5)
+  packed.writeFloat64(-1e10)
+  var f64s: seq[float64]
+  decodePackedFloat64s(packed, f64s)
+  assert f64s == @[0.5, -1e10]
+  try:
+    decodePackedInt32s([0x01'u8, 0x80], s32s)
+    assert false, "trailing continuation byte must raise"
+  except ValueError:
+    discard
+  var f32s: seq[float32]
+  try:
+    decodePackedFloat32s([0'u8, 0, 0], f32s)
+    assert false, "packed floats must be a multiple of 4 bytes"
+  except ValueError:
+    discard
+
+  # Fixed-width scalars are little endian and packed runs are copied as a block
+  echo "\nTesting fixed-width values..."
+  assert encodeFixed32(1) == @[1'u8, 0, 0, 0]
+  assert encodeSFixed64(-2) == @[0xFE'u8, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
+  pos = 0
+  assert decodeSFixed32(encodeSFixed32(-5), pos) == -5 and pos == 4
+  pos = 0
+  assert decodeFixed64(encodeFixed64(high(uint64)), pos) == high(uint64)
+  pos = 0
+  try:
+    discard decodeFixed32([1'u8, 2], pos)
+    assert false, "truncated fixed32 must raise"
+  except ValueError:
+    discard
+  buf.setLen(0)
+  buf.writePackedFloat32s([1.5'f32, -2.0])
+  assert buf == encodeFloat32(1.5) & encodeFloat32(-2.0)
+  var fixed64s: seq[uint64]
+  buf.setLen(0)
+  buf.writePackedFixed64s([7'u64, high(uint64)])
+  decodePackedFixed64s(buf, fixed64s)
+  assert fixed64s == @[7'u64, high(uint64)]
+  assert sizeSFixed32(-1) == 4 and sizeFixed64(0) == 8
+
+  # Decoding into an existing string or seq reuses its buffer
+  var dest = newStringOfCap(32)
+  dest.add("previous contents")
+  let destBuf = dest[0].addr
+  pos = 0
+  decodeStringInto(encodeString("hi"), pos, dest)
+  assert dest == "hi" and dest[0].addr == destBuf
+  var bytesDest = @[9'u8, 9, 9, 9]
+  pos = 0
+  decodeLengthDelimitedInto(encodeString([1'u8, 2]), pos, bytesDest)
+  assert bytesDest == @[1'u8, 2] and pos == 3
+
+  # A length prefix that overflows int is rejected like any other bad length
+  let hugeLength = encodeVarint(high(uint64)) & @[1'u8, 2]
+  for decode in [0, 1, 2, 3]:
+    pos = 0
+    try:
+      case decode
+      of 0: decodeStringInto(hugeLength, pos, dest)
+      of 1: decodeLengthDelimitedInto(hugeLength, pos, bytesDest)
+      of 2: discard decodeString(hugeLength, pos)
+      else: discard decodeLengthDelimited(hugeLength, pos)
+      assert false, "a negative length must raise"
+    except ValueError:
+      discard
+
   echo "\n✅ All wire format tests passed!"